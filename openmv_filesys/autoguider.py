@@ -2,7 +2,7 @@ import micropython
 micropython.opt_level(2)
 
 import comutils
-import blobstar, astro_sensor, time_location, captive_portal, star_finder, guider_calibration, backlash_mgr, guide_filter
+import blobstar, astro_sensor, time_location, captive_portal, star_finder, guider_calibration, backlash_mgr, guide_filter, guide_pec, guide_trace, guide_session, guide_recal, calib_store, guider_wsproto
 import guidepulser
 import guidestar
 import exclogger
@@ -38,6 +38,19 @@ INTERVALSTATE_SINGLE_ENDING  = micropython.const(6)
 CALIIDX_RA  = micropython.const(0)
 CALIIDX_DEC = micropython.const(1)
 
+# index into stage_dur, how long each part of task() took for the last frame, in milliseconds
+STAGE_CAM      = micropython.const(0) # camera init and starting the exposure
+STAGE_ANALYSIS = micropython.const(1) # decide(), on the previous frame while the next one is exposing
+STAGE_SEND     = micropython.const(2) # sending the state and star list
+STAGE_WAIT     = micropython.const(3) # waiting for the exposure to end, network and pulser tasks run in here
+STAGE_READ     = micropython.const(4) # reading out the frame
+STAGE_RESHOOT  = micropython.const(5) # shooting again because the mount moved during the exposure
+STAGE_NET      = micropython.const(6) # total time spent on network tasks
+STAGE_CYCLE    = micropython.const(7) # frame to frame
+STAGE_CNT      = micropython.const(8)
+
+NET_STARVE_MS  = micropython.const(1000) # network tasks always get to run after being held off for this long
+
 class AutoGuider(object):
 
     def __init__(self, debug = False, simulate_file = None, simulate = False):
@@ -85,6 +98,17 @@ class AutoGuider(object):
         self.advfilt_dec    = guide_filter.GuideFilter("dec", "advfilt")
         self.preempfilt_ra  = guide_filter.GuideFilter("ra" , "preempfilt")
         self.preempfilt_dec = guide_filter.GuideFilter("dec", "preempfilt")
+        self.pec            = guide_pec.PeriodicErrorCorrector()
+        self.tracer         = guide_trace.LatencyTracer()
+        self.session        = guide_session.SessionLog()
+        self.recal          = guide_recal.OnlineCalibration()
+        self.recal_msg      = [0, 0]
+        self.recal_ts       = None
+        self.calib_store    = calib_store.CalibrationStore()
+        self.pointing       = None # (RA in degrees, DEC in degrees, pier side), sent by the web page or a planetarium app
+        self.session_frame_ts     = None
+        self.session_stars_serial = 0
+        self.session_failed       = False
 
         self.cam_err = 0
         self.expo_err = 0
@@ -92,10 +116,18 @@ class AutoGuider(object):
         self.prev_panic = ""
         self.panic_move_cnt = 0
         self.last_move_err = 0
+        self.last_move_mcnt = 0
         self.snap_millis = 0
         self.stop_time = 0
         self.last_pulse_dur = 0
+        self.move_millis = 0
         self.analysis_dur = [0, 0, 0, 0, 0]
+        self.stage_dur = [0] * STAGE_CNT
+        self.stage_net = 0      # network time adding up during the current frame
+        self.cycle_millis = 0
+        self.net_millis = 0     # when the network tasks last ran
+        self.net_est = 0        # how long a network task might take, peak hold with a slow decay
+        self.send_pending = False
         self.dbg_t1 = 0
         self.dbg_t2 = 0
         self.dbg_t3 = 0
@@ -111,7 +143,15 @@ class AutoGuider(object):
         self.load_settings()
         self.load_hotpixels(use_log = False, set_usage = False)
 
-        self.portal = captive_portal.CaptivePortal(debug = self.debug)
+        self.portal = None
+        if self.settings["net_async"]:
+            try:
+                import captive_portal_async
+                self.portal = captive_portal_async.AsyncCaptivePortal(debug = self.debug)
+            except ImportError as exc:
+                exclogger.log_exception(exc)
+        if self.portal is None:
+            self.portal = captive_portal.CaptivePortal(debug = self.debug)
         self.portal.allow_hw_kick = False
         if self.portal is not None:
             self.register_http_handlers()
@@ -123,7 +163,10 @@ class AutoGuider(object):
         self.histogram = None
         self.img_stats = None
         self.stars = None
+        self.stars_serial = 0
         self.prev_stars = None
+        self.roi_centers = None # stars that get a window when guiding with ROI, the selected star is first
+        self.roi_scale = 1
         self.hotpixels = []
         self.multistar_cnt = [0, 0]
         self.zoom = 1
@@ -136,6 +179,8 @@ class AutoGuider(object):
         self.stream_sock_err = 0
         self.session_randid = 0
         self.need_send_stars = False
+        self.websock_binary = False
+        self.state_enc = guider_wsproto.StateEncoder()
 
         self.pulselog_buff = [[0, 0, 0, 0, 0]] * LOG_BUFF_LEN
         self.msglog_buff   = [[0, 0, None]] * LOG_BUFF_LEN
@@ -164,6 +209,11 @@ class AutoGuider(object):
         self.settings.update({"calibration_pulse_ra"     : 750})
         self.settings.update({"calibration_pulse_dec"    : 750})
         self.settings.update({"calib_points_cnt"         : 10})
+        self.settings.update({"calib_points_extra"       : 5})
+        self.settings.update({"calib_ci_angle"           : 2.0})
+        self.settings.update({"calib_ci_rate"            : 5.0})
+        self.settings.update({"recal_enable"             : True})
+        self.settings.update({"calib_store_radius"       : 20})
         self.settings.update({"correction_scale_ra"      : 100})
         self.settings.update({"correction_scale_dec"     : 100})
         self.settings.update({"move_grace"               : 50})
@@ -188,10 +238,17 @@ class AutoGuider(object):
         self.settings.update({"use_led"                  : True})
         self.settings.update({"fast_mode"                : True})
         self.settings.update({"always_guiding"           : False})
+        self.settings.update({"net_async"                : False})
+        self.settings.update({"roi_guiding"              : False})
+        self.settings.update({"roi_size"                 : 256})
+        self.settings.update({"roi_cnt"                  : 6})
+        self.settings.update({"trace_enable"             : True})
+        self.settings.update({"session_log"              : False})
         self.advfilt_ra    .fill_settings(self.settings)
         self.advfilt_dec   .fill_settings(self.settings)
         self.preempfilt_ra .fill_settings(self.settings)
         self.preempfilt_dec.fill_settings(self.settings)
+        self.pec           .fill_settings(self.settings)
 
     def send_settings(self):
         obj = {}
@@ -200,7 +257,7 @@ class AutoGuider(object):
             obj.update({k: self.settings[k]})
         self.send_websocket(obj)
 
-    def get_state_obj(self):
+    def get_state_obj(self, with_stars = True):
         state = {}
         state.update({"pkt_type"            : "state"})
         state.update({"time"                : self.time_mgr.get_sec()})
@@ -231,7 +288,10 @@ class AutoGuider(object):
 
         # star list can be sent here but there's a huge risk of memory allocation error if the list is long
         # problem is solved by sending it separately, in small chunks
-        if self.stars is not None:
+        # the binary state packet sends the star list on its own, see send_state_bin()
+        if with_stars == False:
+            self.need_send_stars = False
+        elif self.stars is not None:
             if len(self.stars) <= STAR_CNT_JSON_LIMIT:
                 x = ""
                 for i in self.stars:
@@ -266,6 +326,9 @@ class AutoGuider(object):
         state.update({"logs"        : self.get_logs_obj()})
         state.update({"hw_err"      : self.hw_err})
         state.update({"analysis_dur": self.analysis_dur})
+        state.update({"stage_dur"   : self.stage_dur})
+        if self.pec.model is not None:
+            state.update({"pec": self.pec.get_state_obj()})
         return state
 
     def get_logs_obj(self):
@@ -288,8 +351,34 @@ class AutoGuider(object):
     def send_state(self):
         if self.websock is None:
             return
-        obj = self.get_state_obj()
-        self.send_websocket(obj)
+        t = pyb.millis()
+        if self.websock_binary:
+            self.send_state_bin()
+        else:
+            obj = self.get_state_obj()
+            self.send_websocket(obj)
+        self.trace_end(guide_trace.SPAN_SEND, t)
+
+    def send_state_bin(self):
+        # only used once the web page has shown that it can decode the binary state packets, by acknowledging one
+        # only the fields that changed since the last acknowledged packet are sent
+        try:
+            head, stars = self.state_enc.encode(self.get_state_obj(with_stars = False), stars = self.stars, stars_serial = self.stars_serial)
+            self.portal.websocket_send_start(self.websock, guider_wsproto.packet_len(head, stars), 0x82)
+            self.websock.send(head)
+            if stars is not None:
+                self.state_enc.write_stars(self.websock, stars)
+            self.portal.tickle()
+            self.stream_sock_err = 0
+            self.websock_millis = pyb.millis()
+        except Exception as exc:
+            self.stream_sock_err += 1
+            if self.stream_sock_err > 5:
+                if self.debug:
+                    print("websock too many errors")
+                exclogger.log_exception(exc, to_file=False)
+                self.kill_websocket()
+            pass
 
     def send_stars(self):
         if self.websock is None:
@@ -398,6 +487,8 @@ class AutoGuider(object):
             self.misc_cmd(obj["cmd"])
         elif pkt_type == "select_star":
             self.user_select_star(obj["star_x"], obj["star_y"])
+        elif pkt_type == "pointing":
+            self.set_pointing(comutils.try_parse_setting(obj["ra"]), comutils.try_parse_setting(obj["dec"]), obj["pier"] if "pier" in obj else None)
         elif pkt_type == "settings":
             need_save = False
             for k in obj.keys():
@@ -417,6 +508,9 @@ class AutoGuider(object):
             self.apply_settings()
             if need_save:
                 self.save_settings()
+        elif pkt_type == "state_ack":
+            self.websock_binary = True
+            self.state_enc.ack(comutils.try_parse_setting(obj["seq"]))
         elif pkt_type == "ping":
             if self.debug:
                 print("websock json ping")
@@ -438,6 +532,8 @@ class AutoGuider(object):
         self.advfilt_dec   .load_settings(self.settings)
         self.preempfilt_ra .load_settings(self.settings)
         self.preempfilt_dec.load_settings(self.settings)
+        self.pec           .load_settings(self.settings)
+        self.tracer.enabled = self.settings["trace_enable"]
         if self.settings["use_led"]:
             guidepulser.enable_led()
         else:
@@ -458,10 +554,25 @@ class AutoGuider(object):
             self.guide_state = GUIDESTATE_IDLE
             return decided_pulse
         if self.img is not None:
-            self.histogram = self.img.get_histogram()
-            self.img_stats = self.histogram.get_statistics()
-            latest_stars, code = star_finder.find_stars(self.img, hist = self.histogram, stats = self.img_stats, thresh = self.settings["guidecam_thresh"], force_solve = False, guider = True)
-            self.dbg_t1 = pyb.millis()
+            t = pyb.millis()
+            self.tracer.begin(self.img.timestamp())
+            self.tracer.set(guide_trace.SPAN_EXPO, t - self.img.timestamp())
+            rois = self.get_rois()
+            if rois is None:
+                self.histogram = self.img.get_histogram()
+                self.img_stats = self.histogram.get_statistics()
+                t = self.trace_end(guide_trace.SPAN_HIST, t)
+                latest_stars, code = star_finder.find_stars(self.img, hist = self.histogram, stats = self.img_stats, thresh = self.settings["guidecam_thresh"], force_solve = False, guider = True)
+            else:
+                # only the windows around the tracked stars are looked at, the selected star's window gives the background level
+                self.histogram = self.img.get_histogram(roi = rois[0])
+                self.img_stats = self.histogram.get_statistics()
+                t = self.trace_end(guide_trace.SPAN_HIST, t)
+                latest_stars, code = star_finder.find_stars_rois(self.img, rois, hist = self.histogram, stats = self.img_stats, thresh = self.settings["guidecam_thresh"], force_solve = False, guider = True)
+                if code == star_finder.EXPO_JUST_RIGHT and len(latest_stars) <= 0:
+                    self.roi_expand()
+                    return decided_pulse
+            self.dbg_t1 = self.trace_end(guide_trace.SPAN_FIND, t)
             if self.simulator is not None:
                 latest_stars = self.simulator.get_stars(self, latest_stars)
                 pass
@@ -473,6 +584,7 @@ class AutoGuider(object):
             #self.good_star_cnt = res[3]
 
             self.dbg_t2 = pyb.millis()
+            self.tracer.set(guide_trace.SPAN_PROCESS, self.dbg_t2 - self.dbg_t1)
 
             self.expo_code = code
             if code != star_finder.EXPO_JUST_RIGHT or len(latest_stars) <= 0:
@@ -481,6 +593,7 @@ class AutoGuider(object):
                     print("exposure error %u %u" % (code, len(latest_stars)))
                 if self.expo_err > self.settings["panicthresh_expoerr"]:
                     self.stars = []
+                    self.stars_serial += 1
                     self.panic(msg = "too many exposure errors")
                 self.dither_calm = 0
                 return decided_pulse
@@ -496,6 +609,7 @@ class AutoGuider(object):
                         self.prev_stars = None
                         gc.collect()
                 self.stars = latest_stars
+                self.stars_serial += 1
 
                 # motion can be detected if previous data is available
                 # if previous data is unavailable, then just populate it for no motion
@@ -508,12 +622,17 @@ class AutoGuider(object):
                         if self.selected_star is not None:
                             self.log_msg("MSG: auto selected star at [%u , %u]" % (int(round(self.selected_star.cxf())), int(round(self.selected_star.cyf()))))
 
+                t = pyb.millis()
                 res = guidestar.get_multi_star_motion(self.prev_stars, latest_stars, self.selected_star, self.settings["starmove_tolerance"], False, self.settings["multistar_ratings_thresh"], self.settings["multistar_cnt_min"], self.settings["multistar_cnt_max"])
+                self.trace_end(guide_trace.SPAN_MOTION, t)
                 real_star    = res[0]
                 virtual_star = [res[1], res[2]]
                 move_err     = res[3]
-                self.last_move_err = move_err
                 self.multistar_cnt = [res[4], res[5]]
+                if real_star is not None:
+                    # a failed match reports the sensor diagonal as the error, that is not how noisy the star is
+                    self.last_move_err  = move_err
+                    self.last_move_mcnt = res[5]
 
                 if self.queue_imgsave == 2:
                     self.save_image_meta(res)
@@ -532,6 +651,10 @@ class AutoGuider(object):
                     else:
                         self.log_msg("MSG: lost track of selected star")
                     lost = True
+                if rois is not None and (lost or real_star is None or move_err > self.settings["panicthresh_move_err"] or has_stars_required == False):
+                    # the stars might have moved out of their windows, this frame does not count, look wider next time
+                    self.roi_expand()
+                    return decided_pulse
                 self.selected_star = real_star
                 self.virtual_star  = virtual_star
                 # virtual star only matters if multi-star mode is used, it accounts for atmospheric distortion
@@ -543,7 +666,7 @@ class AutoGuider(object):
                     else:
                         print("no star")
 
-                if move_err > self.settings["panicthresh_move_err"] or move_err < 0 or has_stars_required == False or lost:
+                if real_star is None or move_err > self.settings["panicthresh_move_err"] or has_stars_required == False or lost:
                     self.panic_move_cnt += 1
                     if self.panic_move_cnt >= self.settings["panicthresh_move_cnt"]:
                         if lost:
@@ -555,6 +678,7 @@ class AutoGuider(object):
                 else:
                     self.panic_move_cnt = 0
                     self.prev_stars     = self.stars
+                    self.update_rois(latest_stars)
 
                 # passive guiding will cause the mount to autoguide even if not in a autoguiding state
                 # this is useful for simulation and headless operation
@@ -633,6 +757,7 @@ class AutoGuider(object):
                         self.advfilt_dec.pause(False)
                         self.preempfilt_ra.pause(False)
                         self.preempfilt_dec.pause(False)
+                    self.task_recal()
                     decided_pulse = self.pulse_to_target(force_move = (self.guide_state == GUIDESTATE_DITHER))
                     self.last_pulse_dur = decided_pulse
                     return decided_pulse
@@ -650,6 +775,7 @@ class AutoGuider(object):
                     self.advfilt_dec.pause(True)
                     self.preempfilt_ra.pause(True)
                     self.preempfilt_dec.pause(True)
+                    self.task_recal()
                     decided_pulse = self.pulse_to_target(force_move = True)
                     self.last_pulse_dur = decided_pulse
                     if decided_pulse <= self.settings["dither_calmness"]:
@@ -715,13 +841,25 @@ class AutoGuider(object):
                         self.calibration[i] = guider_calibration.GuiderCalibration(virtual_star[0], virtual_star[1], pulse_width)
                     else:
                         self.calibration[i].append_pt(self.virtual_star)
-                    if len(self.calibration[i].points) >= self.settings["calib_points_cnt"]:
-                        self.guide_state = GUIDESTATE_IDLE
+                    points_cnt = self.calibration[i].pt_cnt
+                    success = None
+                    if points_cnt >= self.settings["calib_points_cnt"]:
                         success = self.calibration[i].analyze()
+                        if success == False and points_cnt < self.settings["calib_points_cnt"] + self.settings["calib_points_extra"]:
+                            # points thrown out for backlash, a bad frame or a gust are made up with a few more pulses, instead of starting over
+                            if points_cnt == self.settings["calib_points_cnt"]:
+                                self.log_msg("WARN: calibration of %s needs more points" % (axis))
+                            self.calibration[i].success = "wait"
+                            success = None
+                    elif self.calibration[i].good_enough(self.settings["calib_ci_angle"], self.settings["calib_ci_rate"]):
+                        success = True
+                    if success is not None:
+                        self.guide_state = GUIDESTATE_IDLE
                         if success:
                             self.calibration[i].timestamp = self.time_mgr.get_sec()
-                            msg = "calibration of %s done, angle = %0.1f , dist = %0.1f" % (axis, self.calibration[i].angle, self.calibration[i].farthest)
+                            msg = "calibration of %s done, angle = %0.1f (+/- %0.1f) , dist = %0.1f , points = %u" % (axis, self.calibration[i].angle, self.calibration[i].angle_ci, self.calibration[i].farthest, points_cnt)
                             self.log_msg("SUCCESS: " + msg)
+                            self.store_calibration()
                         else:
                             msg = "calibration of %s failed" % (axis)
                             self.log_msg("FAILED: " + msg)
@@ -742,6 +880,8 @@ class AutoGuider(object):
                     self.preempfilt_ra.neutralize()
                     self.preempfilt_dec.neutralize()
                     self.dither_interval = 0
+                    if self.recal.ready:
+                        self.recal.reset()
                     if self.selected_star is None:
                         return decided_pulse
                     #if self.target_coord is None:
@@ -788,12 +928,64 @@ class AutoGuider(object):
         pulse_dec *= self.settings["correction_scale_dec"]
         pulse_ra  /= 100
         pulse_dec /= 100
+        # the filters are told how much to trust this measurement, in the same units as the pulses
+        noise = self.get_centroid_noise()
+        noise_ra  = noise * self.calibration[CALIIDX_RA].ms_per_pix * self.settings["correction_scale_ra"] / 100
+        noise_dec = noise * (self.calibration[CALIIDX_DEC] if self.calibration[CALIIDX_DEC] is not None else self.calibration[CALIIDX_RA]).ms_per_pix * self.settings["correction_scale_dec"] / 100
+        self.advfilt_ra    .set_noise(noise_ra)
+        self.advfilt_dec   .set_noise(noise_dec)
+        self.preempfilt_ra .set_noise(noise_ra)
+        self.preempfilt_dec.set_noise(noise_dec)
         self.preempfilt_ra.filter(pulse_ra)
         self.preempfilt_dec.filter(pulse_dec)
         pulse_ra  = self.advfilt_ra.filter(pulse_ra)
         pulse_dec = self.advfilt_dec.filter(pulse_dec)
         return [pulse_ra, pulse_dec, nx, ny]
 
+    def task_recal(self):
+        # the calibration is kept up to date from the guide pulses and how the star moved, see guide_recal.py
+        if self.settings["recal_enable"] == False or self.img is None or self.virtual_star is None:
+            return
+        r = self.recal
+        if r.is_current(self.calibration[CALIIDX_RA], self.calibration[CALIIDX_DEC]) == False:
+            r.start(self.calibration[CALIIDX_RA], self.calibration[CALIIDX_DEC])
+            self.recal_msg = [guide_recal.RECAL_WAIT, guide_recal.RECAL_WAIT]
+        pos = self.virtual_star
+        if hasattr(pos, "cxf"):
+            pos = (pos.cxf(), pos.cyf())
+        t = self.img.timestamp()
+        if t == self.recal_ts:
+            return
+        self.recal_ts = t
+        if r.update(t - self.cam.get_timespan(), t, pos) == False:
+            return
+        i = 0
+        while i < 2:
+            res = r.apply(i)
+            # only the first change of state is logged, not every frame
+            if res != guide_recal.RECAL_WAIT and res != self.recal_msg[i]:
+                axis = "RA" if i == CALIIDX_RA else "DEC"
+                if res == guide_recal.RECAL_APPLIED:
+                    self.log_msg("MSG: calibration of %s is being updated while guiding, angle = %0.1f , %0.1f ms/pix" % (axis, self.calibration[i].angle, self.calibration[i].ms_per_pix))
+                else:
+                    ang, ppm, rel = r.get_axis(i)
+                    self.log_msg("WARN: calibration of %s no longer matches the guiding, angle = %0.1f , %0.1f ms/pix, recalibration is needed" % (axis, ang, 1.0 / ppm))
+                self.recal_msg[i] = res
+            i += 1
+
+    def get_centroid_noise(self):
+        # rough standard deviation of the guide star's position in pixels, from how well the star field matched the last frame
+        # the move error is the average distance between where the stars were expected and where they were found, from the last frame that matched
+        # averaging several stars cuts the noise down, a poorly rated single star is trusted less
+        noise = max(0.1, abs(self.last_move_err))
+        if self.last_move_mcnt >= 2:
+            noise /= math.sqrt(self.last_move_mcnt)
+        elif self.selected_star is not None:
+            rating = self.selected_star.star_rating()
+            if rating < 100:
+                noise *= 100 / max(10, rating)
+        return noise
+
     def clamp_pulse(self, pulse, pul_abs, pul_min, pul_max):
         if pul_abs < pul_min * 0.75:
             pul_abs = 0
@@ -817,6 +1009,8 @@ class AutoGuider(object):
             res = self.get_pulse_to_target()
             if res is None:
                 return 0
+            self.pec_sample()
+            res[0] += self.get_pec_pulse()
         else:
             res = pulse_data
         pulse_ra = res[0]
@@ -855,6 +1049,22 @@ class AutoGuider(object):
         pulse_dec_fin = self.backlash_dec.filter(pulse_dec, force_move = force_move)
         if pulse_ra_fin != 0 or pulse_dec_fin != 0:
             self.stop_time = guidepulser.move(pulse_ra_fin, pulse_dec_fin, self.settings["move_grace"])
+            if self.recal.ready:
+                self.recal.add_pulse(pyb.millis(), pulse_ra_fin, pulse_dec_fin, max(self.settings["backlash_limit_ra"], self.settings["backlash_hyster_ra"]), max(self.settings["backlash_limit_dec"], self.settings["backlash_hyster_dec"]))
+            if self.session.is_open():
+                self.session.add_pulse(pyb.millis(), guide_session.PULSE_CORRECTIVE if nx is not None else guide_session.PULSE_PREEMP, (pulse_ra, pulse_dec), (pulse_ra_fin, pulse_dec_fin), self.advfilt_ra.get_state(), self.advfilt_dec.get_state(), (self.backlash_ra.st.value, self.backlash_dec.st.value))
+            if nx is not None and self.img is not None:
+                self.tracer.set(guide_trace.SPAN_PULSE, pyb.elapsed_millis(self.img.timestamp()))
+            # the filters work with the correction scale already applied
+            given_ra  = pulse_ra_fin  * self.settings["correction_scale_ra" ] / 100
+            given_dec = pulse_dec_fin * self.settings["correction_scale_dec"] / 100
+            self.advfilt_ra    .add_given(given_ra)
+            self.advfilt_dec   .add_given(given_dec)
+            self.preempfilt_ra .add_given(given_ra)
+            self.preempfilt_dec.add_given(given_dec)
+            self.pec.add_pulse(pulse_ra_fin * self.calibration[CALIIDX_RA].pix_per_ms)
+            if pulse_ra_fin != 0:
+                self.pec.used()
             return ret
         return 0
 
@@ -865,11 +1075,82 @@ class AutoGuider(object):
             return 0
         pulse_ra  = self.preempfilt_ra.get_preemp()
         pulse_dec = self.preempfilt_dec.get_preemp()
+        # the periodic error that is about to happen is corrected ahead of time
+        pulse_ra += self.get_pec_pulse()
         x = 0
         if pulse_ra != 0 or pulse_dec != 0:
             x = self.pulse_to_target(pulse_data = [pulse_ra, pulse_dec])
         return x
 
+    def pec_sample(self):
+        # how far the star is from the origin along the RA axis, the origin stays put while dithering
+        if self.pec.enabled == False or self.origin_coord is None or self.img is None:
+            return
+        dx = self.virtual_star[0] - self.origin_coord[0]
+        dy = self.virtual_star[1] - self.origin_coord[1]
+        ang = math.radians(self.calibration[CALIIDX_RA].angle)
+        pos = (dx * math.cos(ang)) + (dy * math.sin(ang))
+        self.pec.add_sample(self.img.timestamp() - (self.cam.get_timespan() // 2), pos, self.origin_coord)
+
+    def get_pec_pulse(self):
+        if self.pec.enabled == False or self.calibration[CALIIDX_RA] is None:
+            return 0
+        # the pulse aims at the middle of the next exposure
+        return self.pec.get_pulse(pyb.millis(), self.cam.get_timespan() // 2, self.calibration[CALIIDX_RA].ms_per_pix)
+
+    def task_pec(self):
+        if self.pec.task():
+            if self.pec.model is not None:
+                self.log_msg("MSG: PEC model updated, %u periods, %0.1f px, %u%% of the error explained" % (len(self.pec.model), self.pec.get_amplitude(), int(round(self.pec.explained * 100))))
+            elif self.debug:
+                print("PEC found no periodic error, explained %0.2f" % self.pec.explained)
+
+    def task_session(self):
+        # the session log runs while the guider is doing anything other than sitting idle, one frame record for every frame decide() looked at
+        if self.settings["session_log"] == False or self.guide_state == GUIDESTATE_IDLE:
+            self.session_failed = False
+            if self.session.is_open():
+                self.session.stop()
+                self.log_msg("MSG: session log closed, %u bytes, %u records dropped" % (self.session.written, self.session.dropped))
+            return
+        if self.session.is_open() == False:
+            if self.session_failed:
+                return
+            if self.start_session() == False:
+                self.session_failed = True
+                self.log_msg("ERR: cannot open session log")
+                return
+        if self.img is None or self.img.timestamp() == self.session_frame_ts:
+            return
+        self.session_frame_ts = self.img.timestamp()
+        flags = 0
+        if guidepulser.is_shutter_open():
+            flags |= guide_session.FLAG_SHUTTER
+        if self.stars_serial != self.session_stars_serial:
+            flags |= guide_session.FLAG_STARS
+            self.session_stars_serial = self.stars_serial
+        sel = (self.selected_star.cxf(), self.selected_star.cyf()) if self.selected_star is not None else None
+        virt = self.virtual_star
+        if virt is not None and hasattr(virt, "cxf"):
+            virt = (virt.cxf(), virt.cyf())
+        self.session.add_frame(self.session_frame_ts, self.guide_state, flags, self.expo_code, sel, virt, self.target_coord, self.last_move_err, self.multistar_cnt, self.stars)
+
+    def start_session(self):
+        tstr = comutils.fmt_time_filename(self.time_mgr.get_time())
+        info = {}
+        info.update({"time"           : comutils.fmt_time(self.time_mgr.get_time())})
+        info.update({"millis"         : pyb.millis()})
+        info.update({"session_rand_id": self.session_randid})
+        info.update({"timespan"       : self.cam.get_timespan() if self.cam is not None else 0})
+        info.update({"calib"          : [c.get_json_obj(short = True) if c is not None else None for c in self.calibration]})
+        info.update({"settings"       : self.settings})
+        if self.session.start("guide-%s.gsl" % tstr, info, now = pyb.millis()) == False:
+            return False
+        self.session_frame_ts = None
+        self.session_stars_serial = self.stars_serial - 1
+        self.log_msg("MSG: session log started, guide-%s.gsl" % tstr)
+        return True
+
     def log_pulse(self, nx, ny):
         timestamp = self.img.timestamp()
         self.pulselog_buff[self.pulselog_buff_idx][0] = timestamp
@@ -897,6 +1178,8 @@ class AutoGuider(object):
         self.msglog_buff[self.msglog_buff_idx][2] = msg
         self.msglog_buff_idx += 1
         self.msglog_buff_idx %= LOG_BUFF_LEN
+        if self.session.is_open():
+            self.session.add_msg(timestamp, msg)
         if to_print:
             if self.has_time:
                 tstr = comutils.fmt_time(self.time_mgr.get_time())
@@ -904,7 +1187,64 @@ class AutoGuider(object):
                 tstr = str(timestamp)
             print("msg[%s]: %s" % (tstr, msg))
 
+    def get_rois(self):
+        # windows for the star finder, (x, y, w, h), the selected star's is first, None means the whole frame
+        if self.settings["roi_guiding"] == False or self.guide_state != GUIDESTATE_GUIDING or self.selected_star is None or self.roi_centers is None:
+            return None
+        size = int(self.settings["roi_size"] * self.roi_scale)
+        w = self.img.width() - 150 # same as the default region of star_finder.find_stars
+        h = self.img.height()
+        if size >= w or size >= h:
+            return None
+        rois = []
+        for c in self.roi_centers:
+            x = int(round(c[0] - (size / 2)))
+            y = int(round(c[1] - (size / 2)))
+            x = max(0, min(w - size, x))
+            y = max(0, min(h - size, y))
+            rois.append((x, y, size, size))
+        return rois
+
+    def roi_expand(self):
+        self.roi_scale *= 2
+        if self.debug:
+            print("ROI expanded to %u" % int(self.settings["roi_size"] * self.roi_scale))
+
+    def update_rois(self, stars):
+        # the selected star, plus the best rated stars that are not already inside another window
+        # windows from the previous frame are kept, moved along with the selected star, so a star that was missed once is not dropped
+        self.roi_scale = 1
+        if self.settings["roi_guiding"] == False or self.selected_star is None:
+            self.roi_centers = None
+            return
+        half = self.settings["roi_size"] / 2
+        sx = self.selected_star.cxf()
+        sy = self.selected_star.cyf()
+        centers = [(sx, sy)]
+        cand = []
+        for s in sorted(stars, key = lambda s: s.star_rating(), reverse = True):
+            if s.star_rating() < self.settings["multistar_ratings_thresh"]:
+                break
+            cand.append((s.cxf(), s.cyf()))
+        if self.roi_centers is not None:
+            dx = sx - self.roi_centers[0][0]
+            dy = sy - self.roi_centers[0][1]
+            for c in self.roi_centers[1:]:
+                cand.append((c[0] + dx, c[1] + dy))
+        for p in cand:
+            if len(centers) >= self.settings["roi_cnt"]:
+                break
+            inside = False
+            for c in centers:
+                if abs(p[0] - c[0]) < half and abs(p[1] - c[1]) < half:
+                    inside = True
+                    break
+            if inside == False:
+                centers.append(p)
+        self.roi_centers = centers
+
     def reset_guiding(self):
+        self.recal.reset()
         self.backlash_ra.neutralize()
         self.backlash_dec.neutralize()
         self.advfilt_ra.neutralize()
@@ -913,6 +1253,8 @@ class AutoGuider(object):
         self.preempfilt_dec.neutralize()
         self.selected_star   = None
         self.prev_stars      = None
+        self.roi_centers     = None
+        self.roi_scale       = 1
         self.target_origin   = None
         self.target_final    = None
 
@@ -983,13 +1325,38 @@ class AutoGuider(object):
             guidepulser.task()
             return False
 
+    def net_window(self):
+        # network tasks are kept away from the end of a guide pulse and the end of the exposure
+        # so that a slow network task does not delay the next decision or the readout of the frame
+        quiet = max(self.settings["net_quiet_time"], self.net_est)
+        if self.move > 0 and guidepulser.is_moving() and pyb.elapsed_millis(self.move_millis) > (self.move - quiet):
+            return False
+        if pyb.elapsed_millis(self.snap_millis) > (self.cam.get_timespan() - quiet):
+            # long network tasks would never fit into a short exposure, they run anyways once in a while
+            return pyb.elapsed_millis(self.net_millis) > max(NET_STARVE_MS, self.cam.get_timespan())
+        return True
+
+    def task_io(self):
+        # one step of everything that can wait until there is time for it
+        if self.net_window():
+            if self.send_pending:
+                self.send_all()
+            self.task_network()
+            self.session.flush(now = pyb.millis())
+
+    def send_all(self):
+        t = pyb.millis()
+        self.send_state()
+        if self.need_send_stars:
+            self.send_stars()
+        self.send_pending = False
+        self.stage_dur[STAGE_SEND] = pyb.elapsed_millis(t)
+
     def snap_wait(self):
-        self.task_network()
+        self.task_io()
         self.task_pulser()
         while True:
-            if pyb.elapsed_millis(self.snap_millis) <= (self.move - self.settings["net_quiet_time"]) or self.move == 0 or guidepulser.is_moving() == False:
-                self.task_network()
-            #guidepulser.task()
+            self.task_io()
             self.task_pulser()
             if guidepulser.is_moving():
                 if self.cam.snapshot_check():
@@ -1021,11 +1388,23 @@ class AutoGuider(object):
             gc.collect()
             return
 
+        t = pyb.millis()
+        self.stage_dur[STAGE_CYCLE] = pyb.elapsed_millis(self.cycle_millis)
+        self.stage_dur[STAGE_NET] = self.stage_net
+        self.stage_net = 0
+        self.cycle_millis = t
+        # the next frame starts exposing before the last one is looked at
         success = self.snap_start()
         gc.collect()
         if success == False:
             return
+        t = self.stage_end(STAGE_CAM, t)
         self.move = self.decide()
+        self.move_millis = pyb.millis()
+        self.task_pec()
+        self.task_session()
+        t = self.stage_end(STAGE_ANALYSIS, t)
+        self.tracer.set(guide_trace.SPAN_CYCLE, self.stage_dur[STAGE_CYCLE])
         self.analysis_dur[4] = gc.mem_free()
         if self.img is not None:
             img_ts = self.img.timestamp()
@@ -1035,11 +1414,17 @@ class AutoGuider(object):
             self.analysis_dur[3] = self.dbg_t3 - self.dbg_t2
             if self.debug:
                 print("analysis debug %s" % self.analysis_dur)
-        self.send_state()
-        if self.need_send_stars:
-            self.send_stars()
+                print("stage debug %s" % self.stage_dur)
+        # the state is sent now if it does not get in the way, otherwise it waits for a quiet moment during the exposure
+        self.send_pending = True
+        self.stage_dur[STAGE_SEND] = 0
+        self.task_io()
+        t = pyb.millis()
+        self.stage_dur[STAGE_RESHOOT] = 0
         if self.snap_wait():
+            t = self.stage_end(STAGE_WAIT, t)
             img = self.cam.snapshot_finish()
+            t = self.stage_end(STAGE_READ, t)
             #img_time = img.timestamp()
             tspan = self.cam.get_timespan()
             tspent = self.last_pulse_dur
@@ -1064,6 +1449,7 @@ class AutoGuider(object):
                     else:
                         self.log_msg("ERR: guidecam failed to read image during wait")
                         self.cam.snapshot_finish()
+                self.stage_end(STAGE_RESHOOT, t)
             if self.imgstream_sock is not None and self.img_is_compressed == False:
                 if self.guide_state != GUIDESTATE_IDLE:
                     print("warning: compressing JPG while autoguiding")
@@ -1074,6 +1460,18 @@ class AutoGuider(object):
             self.log_msg("ERR: guidecam failed to read image")
             self.cam.snapshot_finish()
 
+    def trace_end(self, span, t):
+        # same as stage_end(), for the latency tracer
+        now = pyb.millis()
+        self.tracer.set(span, now - t)
+        return now
+
+    def stage_end(self, stage, t):
+        # records how long a stage took, returns the start time of the next stage
+        now = pyb.millis()
+        self.stage_dur[stage] = now - t
+        return now
+
     # note: check py_guidepulser.c and qstrdefsomv.h for available function calls
     def task_pulser(self):
         guidepulser.task()
@@ -1148,6 +1546,53 @@ class AutoGuider(object):
         if self.guide_state == GUIDESTATE_PANIC:
             self.guide_state = GUIDESTATE_IDLE
 
+    def set_pointing(self, ra, dec, pier = None):
+        # ra in hours, dec in degrees, pier is "east" or "west", or nothing for a mount without sides
+        for v in [ra, dec]:
+            # JSON null, or a string that didn't parse, would break the math, the packet is ignored and the old pointing is kept
+            if isinstance(v, (int, float)) == False or isinstance(v, bool):
+                self.log_msg("ERR: pointing ignored, RA and DEC must be numbers")
+                return
+        self.pointing = ((ra * 15.0) % 360.0, dec, calib_store.norm_pier(pier))
+        if self.debug:
+            print("pointing RA %0.2f , DEC %0.2f , pier \"%s\"" % self.pointing)
+        if self.guide_state == GUIDESTATE_IDLE or self.guide_state == GUIDESTATE_PANIC:
+            self.recall_calibration(self.pointing)
+
+    def recall_calibration(self, pointing, use_log = False):
+        radius = self.settings["calib_store_radius"]
+        if radius <= 0:
+            if use_log:
+                self.log_msg("ERR: calibration store is disabled")
+            return False
+        if self.guide_state != GUIDESTATE_IDLE and self.guide_state != GUIDESTATE_PANIC:
+            if use_log:
+                self.log_msg("ERR: invalid moment to change calibration")
+            return False
+        res, dist = self.calib_store.recall(pointing[0], pointing[1], pointing[2], radius, now = self.time_mgr.get_sec())
+        if res is None:
+            if use_log:
+                self.log_msg("FAILED: no stored calibration within %0.1f deg" % (radius))
+            return False
+        if res[CALIIDX_RA] is not None:
+            self.calibration[CALIIDX_RA] = res[CALIIDX_RA]
+        if res[CALIIDX_DEC] is not None:
+            self.calibration[CALIIDX_DEC] = res[CALIIDX_DEC]
+        self.clear_panic()
+        self.log_msg("SUCCESS: restored calibration from %0.1f deg away%s" % (dist, " (for RA)" if res[CALIIDX_DEC] is None else (" (for DEC)" if res[CALIIDX_RA] is None else "")))
+        return True
+
+    def store_calibration(self, use_log = False):
+        if self.pointing is None or self.settings["calib_store_radius"] <= 0:
+            return False
+        if self.calib_store.store(self.pointing[0], self.pointing[1], self.pointing[2], self.calibration[CALIIDX_RA], self.calibration[CALIIDX_DEC], now = self.time_mgr.get_sec()):
+            if use_log:
+                self.log_msg("SUCCESS: calibration stored for RA %0.1f , DEC %0.1f" % (self.pointing[0], self.pointing[1]))
+            return True
+        if use_log:
+            self.log_msg("FAILED: cannot store calibration")
+        return False
+
     def guide_cmd(self, cmd):
         if cmd == GUIDESTATE_GUIDING:
             if self.guide_state != GUIDESTATE_IDLE and self.guide_state != GUIDESTATE_PANIC:
@@ -1316,6 +1761,15 @@ class AutoGuider(object):
                 self.log_msg("FAILED: cannot save any calibration to file")
             else:
                 self.log_msg("FAILED: cannot save some calibration to file")
+            self.store_calibration(use_log = True)
+        elif cmd == "calib_recall":
+            if self.pointing is None:
+                self.log_msg("ERR: pointing is not known")
+                return
+            self.recall_calibration(self.pointing, use_log = True)
+        elif cmd == "calib_store_clear":
+            self.calib_store.remove_all()
+            self.log_msg("CMD: calibration store cleared")
         elif cmd == "hotpixels_save":
             self.save_hotpixels(use_log = True)
         elif cmd == "hotpixels_load":
@@ -1393,6 +1847,7 @@ class AutoGuider(object):
 
     def task_network(self):
         if self.portal is not None:
+            t = pyb.millis()
             ret = self.portal.task()
             if ret == captive_portal.STS_KICKED:
                 red_led.off()
@@ -1401,6 +1856,13 @@ class AutoGuider(object):
                 green_led.off()
                 self.check_panic_builtin_led()
             self.check_websocket()
+            t = pyb.elapsed_millis(t)
+            self.stage_net += t
+            self.net_millis = pyb.millis()
+            if t >= self.net_est:
+                self.net_est = t
+            else:
+                self.net_est -= (self.net_est - t + 7) // 8
 
     def register_http_handlers(self):
         if self.portal is None:
@@ -1411,6 +1873,27 @@ class AutoGuider(object):
         self.portal.install_handler("/stream",         self.handle_imgstream)
         self.portal.install_handler("/websocket",      self.handle_websocket)
         self.portal.install_handler("/memory",         self.handle_memory)
+        self.portal.install_handler("/trace",          self.handle_trace)
+
+    def handle_trace(self, client_stream, req, headers, content):
+        # /trace gives the latency percentiles as JSON, /trace?csv gives every frame in the ring buffer, /trace?reset starts over
+        if self.debug:
+            print("handle_trace")
+        request_page, request_urlparams = captive_portal.split_get_request(req)
+        if "csv" in request_urlparams:
+            client_stream.write(captive_portal.default_reply_header(content_type = "text/csv"))
+            captive_portal.send_iter(client_stream, self.tracer.iter_csv())
+        else:
+            obj = {}
+            obj.update({"frames": self.tracer.cnt})
+            obj.update({"spans" : self.tracer.get_summary()})
+            json_str = ujson.dumps(obj)
+            client_stream.write(captive_portal.default_reply_header(content_type = "application/json", content_length = len(json_str)) + json_str)
+            # not done for the CSV, the event loop server might still be reading from the ring buffer
+            if "reset" in request_urlparams:
+                self.tracer.reset()
+        client_stream.close()
+        return True
 
     def handle_memory(self, client_stream, req, headers, content):
         if self.debug:
@@ -1626,6 +2109,8 @@ class AutoGuider(object):
             print("established websock")
         self.websock = client_stream
         self.websock.settimeout(0.1)
+        self.websock_binary = False
+        self.state_enc.reset()
         self.stream_sock_err = 0
         self.websock_millis = pyb.millis()
         return False # won't kill the socket
@@ -1,19 +1,35 @@
 import micropython
 micropython.opt_level(2)
 
+# what is carried from one pulse to the next is in a BacklashState, the settings stay in the BacklashManager
+# openmv_host/filter_batch.py runs whole arrays through the same steps with the same BacklashState, the two must be kept in sync
+
+class BacklashState(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.value = 0 # pulse given in the current direction, up to the limit
+        self.state = 0 # which way the backlash has been taken up, 0 if not yet known
+
+    def copy(self):
+        st = BacklashState()
+        st.value = self.value
+        st.state = self.state
+        return st
+
 class BacklashManager(object):
 
     def __init__(self):
         self.hysteresis = 0
         self.max_limit  = 0
-        self.value      = 0
-        self.state      = 0
         self.reduction  = 0
         self.hard_lock  = False
+        self.st         = BacklashState()
 
     def neutralize(self):
-        self.value = 0
-        self.state = 0
+        self.st.reset()
 
     def filter(self, x, force_move = False):
         if force_move == False:
@@ -37,75 +53,76 @@ class BacklashManager(object):
             max_limit = 0
         if max_limit == 0:
             max_limit = self.hysteresis
+        st = self.st
         if self.hysteresis == 0 and self.max_limit == 0:
-            self.state = 0
-            self.value = 0
+            st.state = 0
+            st.value = 0
             return x
         #elif self.hysteresis == 0:
-        #    if (self.value > 0 or self.state >= 0) and x > 0:
-        #        self._value_add(x, max_limit)
-        #        self.state = 1
+        #    if (st.value > 0 or st.state >= 0) and x > 0:
+        #        self._value_add(st, x, max_limit)
+        #        st.state = 1
         #        return x
-        #    elif (self.value < 0 or self.state <= 0) and x < 0:
-        #        self._value_add(x, max_limit)
-        #        self.state = -1
+        #    elif (st.value < 0 or st.state <= 0) and x < 0:
+        #        self._value_add(st, x, max_limit)
+        #        st.state = -1
         #        return x
         #    else:
-        #        self._value_add(x, max_limit)
-        #        if self.value > 0:
-        #            self.state = 1
-        #        elif self.value < 0:
-        #            self.state = -1
+        #        self._value_add(st, x, max_limit)
+        #        if st.value > 0:
+        #            st.state = 1
+        #        elif st.value < 0:
+        #            st.state = -1
         #        return x * self.reduction
         #elif self.hysteresis != 0:
         else:
             x = int(round(x))
-            if self.state == 0:
-                self._value_add(x, max_limit)
+            if st.state == 0:
+                self._value_add(st, x, max_limit)
                 if self.hysteresis != 0:
-                    if self.value >= self.hysteresis:
-                        self.state = 1
-                    elif self.value <= -self.hysteresis:
-                        self.state = -1
+                    if st.value >= self.hysteresis:
+                        st.state = 1
+                    elif st.value <= -self.hysteresis:
+                        st.state = -1
                 else:
-                    if self.value > self.hysteresis:
-                        self.state = 1
-                    elif self.value < -self.hysteresis:
-                        self.state = -1
+                    if st.value > self.hysteresis:
+                        st.state = 1
+                    elif st.value < -self.hysteresis:
+                        st.state = -1
                 return x
-            elif self.state > 0:
+            elif st.state > 0:
                 if self.hard_lock == False or x > 0:
-                    self._value_add(x, max_limit)
+                    self._value_add(st, x, max_limit)
                 if x > 0:
                     return x
-                elif x < 0 and self.value <= -self.hysteresis:
-                    self.state = -1
+                elif x < 0 and st.value <= -self.hysteresis:
+                    st.state = -1
                     return x
                 else:
                     return x * self.reduction
-            elif self.state < 0:
+            elif st.state < 0:
                 if self.hard_lock == False or x < 0:
-                    self._value_add(x, max_limit)
+                    self._value_add(st, x, max_limit)
                 if x < 0:
                     return x
-                elif x > 0 and self.value >= self.hysteresis:
-                    self.state = 1
+                elif x > 0 and st.value >= self.hysteresis:
+                    st.state = 1
                     return x
                 else:
                     return x * self.reduction
 
-    def _value_add(self, x, max_limit):
-        self.value += x
-        self._limit_value(max_limit)
+    def _value_add(self, st, x, max_limit):
+        st.value += x
+        self._limit_value(st, max_limit)
 
-    def _limit_value(self, max_limit):
-        if self.value >=  max_limit:
-            self.value =  max_limit
-        if self.value <= -max_limit:
-            self.value = -max_limit
+    def _limit_value(self, st, max_limit):
+        if st.value >=  max_limit:
+            st.value =  max_limit
+        if st.value <= -max_limit:
+            st.value = -max_limit
 
 def report_state(mgr):
-    return "%u %u %d %d %s" % (mgr.hysteresis, mgr.max_limit, mgr.value, mgr.state, "locked" if mgr.hard_lock else " ")
+    return "%u %u %d %d %s" % (mgr.hysteresis, mgr.max_limit, mgr.st.value, mgr.st.state, "locked" if mgr.hard_lock else " ")
 
 if __name__ == "__main__":
     import pyb
@@ -0,0 +1,198 @@
+import micropython
+micropython.opt_level(2)
+
+import comutils
+import guider_calibration
+import exclogger
+import uos, ujson, math
+
+# many calibrations, each one remembered with where the telescope was pointing and which side of the pier it was on
+# going back to a target finds the calibration done nearest to it, so it doesn't need to be done again
+# the camera doesn't move on the telescope, so the angles stay the same, but the RA rate shrinks with cos(dec)
+# a calibration is only ever matched with one done on the same side of the pier, a meridian flip turns the camera around
+# the lookup goes through every entry, the directions are kept as unit vectors so this is only a few multiplications each
+
+STORE_FILE    = "calib_store.json"
+MAX_ENTRIES   = micropython.const(64) # the least recently used one is replaced past this
+MERGE_DIST    = 1.0   # degrees, a calibration this close to an old one on the same pier side replaces it
+MAX_SCALE_DEC = 85.0  # degrees, cos(dec) stops shrinking here, close to the pole RA barely moves the star at all
+
+def unit_vec(ra, dec):
+    # ra and dec in degrees
+    r = math.radians(ra)
+    d = math.radians(dec)
+    cd = math.cos(d)
+    return (cd * math.cos(r), cd * math.sin(r), math.sin(d))
+
+def dec_cos(dec):
+    dec = min(abs(dec), MAX_SCALE_DEC)
+    return math.cos(math.radians(dec))
+
+def scale_ra(cal, dec_from, dec_to):
+    # changes the rate of a RA calibration done at dec_from to what it would be at dec_to, in place
+    k = dec_cos(dec_to) / dec_cos(dec_from)
+    cal.pix_per_ms *= k
+    cal.pix_per_ms_ci *= k
+    cal.ms_per_pix /= k
+    cal.ms_per_pix_ci /= k
+    cal.farthest *= k
+
+def norm_pier(pier):
+    if pier is None:
+        return ""
+    pier = str(pier).lower()
+    if pier.startswith("e"):
+        return "east"
+    if pier.startswith("w"):
+        return "west"
+    return ""
+
+class CalibrationStore(object):
+
+    def __init__(self, filename = STORE_FILE):
+        self.filename = filename
+        self.entries = [] # {"ra", "dec", "pier", "used", "calib": [RA, DEC]}, the calibrations are as get_json_obj() gives them, or None
+        self.vecs = []    # unit vectors of the entries, in the same order
+        self.loaded = False
+
+    def load(self):
+        self.loaded = True
+        self.entries = []
+        self.vecs = []
+        try:
+            with open(self.filename, mode="rb") as f:
+                obj = ujson.load(f)
+            for e in obj["entries"]:
+                e["ra"]  = comutils.try_parse_setting(e["ra"])
+                e["dec"] = comutils.try_parse_setting(e["dec"])
+                e["pier"] = norm_pier(e["pier"] if "pier" in e else None)
+                if "used" not in e:
+                    e["used"] = 0
+                self.entries.append(e)
+                self.vecs.append(unit_vec(e["ra"], e["dec"]))
+            return True
+        except OSError:
+            # no file yet
+            return False
+        except Exception as exc:
+            exclogger.log_exception(exc)
+            return False
+
+    def save(self):
+        try:
+            with open(self.filename, mode="wb") as f:
+                ujson.dump({"entries": self.entries}, f)
+                f.flush()
+            uos.sync()
+            return True
+        except Exception as exc:
+            exclogger.log_exception(exc)
+            return False
+
+    def nearest(self, ra, dec, pier):
+        # returns (index, distance in degrees) of the nearest entry on the same pier side, index is -1 if there isn't one
+        if self.loaded == False:
+            self.load()
+        pier = norm_pier(pier)
+        v = unit_vec(ra, dec)
+        best = -1
+        best_dot = -2.0
+        i = 0
+        while i < len(self.entries):
+            if self.entries[i]["pier"] == pier:
+                u = self.vecs[i]
+                dot = (u[0] * v[0]) + (u[1] * v[1]) + (u[2] * v[2])
+                if dot > best_dot:
+                    best_dot = dot
+                    best = i
+            i += 1
+        if best < 0:
+            return -1, 180.0
+        return best, math.degrees(math.acos(max(-1.0, min(1.0, best_dot))))
+
+    def store(self, ra, dec, pier, cal_ra, cal_dec, now = 0):
+        # remembers the calibrations at this pointing, an axis without a calibration keeps the one already stored nearby, returns true if saved
+        if cal_ra is None and cal_dec is None:
+            return False
+        if self.loaded == False:
+            self.load()
+        pier = norm_pier(pier)
+        calib = [None, None]
+        idx, dist = self.nearest(ra, dec, pier)
+        if idx >= 0 and dist <= MERGE_DIST:
+            old = self.entries.pop(idx)
+            self.vecs.pop(idx)
+            calib = old["calib"]
+        elif len(self.entries) >= MAX_ENTRIES:
+            i = 0
+            oldest = 0
+            while i < len(self.entries):
+                if self.entries[i]["used"] < self.entries[oldest]["used"]:
+                    oldest = i
+                i += 1
+            self.entries.pop(oldest)
+            self.vecs.pop(oldest)
+        if cal_ra is not None:
+            calib[0] = cal_ra.get_json_obj(short = True)
+        if cal_dec is not None:
+            calib[1] = cal_dec.get_json_obj(short = True)
+        self.entries.append({"ra": ra, "dec": dec, "pier": pier, "used": now, "calib": calib})
+        self.vecs.append(unit_vec(ra, dec))
+        return self.save()
+
+    def recall(self, ra, dec, pier, max_dist, now = 0):
+        # the calibrations nearest to this pointing, RA rate scaled to this declination
+        # returns ([RA, DEC] as GuiderCalibration or None, distance in degrees), or (None, distance) if there isn't one close enough
+        idx, dist = self.nearest(ra, dec, pier)
+        if idx < 0 or dist > max_dist:
+            return None, dist
+        e = self.entries[idx]
+        res = [None, None]
+        i = 0
+        while i < 2:
+            obj = e["calib"][i]
+            if obj is not None:
+                cal = guider_calibration.GuiderCalibration(0, 0, 0)
+                cal.load_json_obj(obj)
+                if cal.has_cal:
+                    res[i] = cal
+            i += 1
+        if res[0] is None and res[1] is None:
+            return None, dist
+        if res[0] is not None:
+            scale_ra(res[0], e["dec"], dec)
+        e["used"] = now
+        return res, dist
+
+    def remove_all(self):
+        self.entries = []
+        self.vecs = []
+        self.loaded = True
+        try:
+            uos.remove(self.filename)
+        except OSError:
+            pass
+
+if __name__ == "__main__":
+    print("Calibration Store Test")
+    store = CalibrationStore(filename = "calib_store_test.json")
+    store.remove_all()
+    cal_ra = guider_calibration.GuiderCalibration(0, 0, 750)
+    cal_ra.append_all([[0, 10 * i] for i in range(1, 11)])
+    cal_ra.analyze()
+    cal_dec = guider_calibration.GuiderCalibration(0, 0, 750)
+    cal_dec.append_all([[10 * i, 0] for i in range(1, 11)])
+    cal_dec.analyze()
+    store.store(83.8, -5.4, "west", cal_ra, cal_dec)
+    store.store(10.7, 41.3, "east", cal_ra, cal_dec)
+    store.store(10.7, 41.3, "west", cal_ra, None)
+    tests = [(84.0, -5.0, "west"), (84.0, -5.0, "east"), (11.0, 60.0, "west"), (200.0, 30.0, "east")]
+    for t in tests:
+        res, dist = store.recall(t[0], t[1], t[2], 25.0)
+        if res is None:
+            print("(%0.1f , %0.1f , %s): none, nearest %0.1f deg" % (t[0], t[1], t[2], dist))
+        else:
+            print("(%0.1f , %0.1f , %s): %0.1f deg away, RA %s, DEC %s" % (t[0], t[1], t[2], dist,
+                ("%0.4f pix/ms" % res[0].pix_per_ms) if res[0] is not None else "none",
+                ("%0.4f pix/ms" % res[1].pix_per_ms) if res[1] is not None else "none"))
+    store.remove_all()
@@ -1,23 +1,63 @@
 import micropython
 micropython.opt_level(2)
 
+FILTKIND_PID    = micropython.const(0)
+FILTKIND_KALMAN = micropython.const(1)
+
+# the Kalman filter kind tracks the correction and how fast it is changing, per frame, in the same units as the input (milliseconds of pulse)
+# it is told about every pulse that was actually given with add_given(), and how noisy each measurement is with set_noise()
+# so a noisy frame moves the estimate less than a clean one, and a steady drift is followed without lagging a frame behind
+# kf_q is how much the rate of change can change from one frame to the next, a bigger number follows the mount faster but trusts the measurements more
+# kf_r is the smallest measurement noise that will be assumed, and the noise used when there is no estimate
+# kf_lead is how far ahead, in percent of a frame, the correction is predicted
+
+# everything that is carried from one frame to the next is in a FilterState, the settings stay in the GuideFilter
+# openmv_host/filter_batch.py runs whole arrays through the same steps with the same FilterState, the two must be kept in sync
+
+class FilterState(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sum_i    = 0
+        self.last_val = None
+        self.lpf_val  = None
+        self.last_out = 0
+        self.kf_x     = None # [correction, change per frame]
+        self.kf_p     = None # covariance, [p00, p01, p11]
+        self.kf_u     = 0    # pulses given since the last measurement
+
+    def copy(self):
+        st = FilterState()
+        st.sum_i    = self.sum_i
+        st.last_val = self.last_val
+        st.lpf_val  = self.lpf_val
+        st.last_out = self.last_out
+        st.kf_x     = list(self.kf_x) if self.kf_x is not None else None
+        st.kf_p     = list(self.kf_p) if self.kf_p is not None else None
+        st.kf_u     = self.kf_u
+        return st
+
 class GuideFilter(object):
 
     def __init__(self, axis, flttype):
         self.axis = axis.lower()
         self.filttype  = flttype.lower()
         self.term_i    = 0
-        self.sum_i     = 0
         self.limit_i   = 0
         self.decay_i   = 0
-        self.last_val  = None
         self.term_d    = 0
-        self.lpf_val   = None
         self.lpf_k     = 0
         self.lpf_mix   = 0
         self.scale     = 100
+        self.kind      = FILTKIND_PID
+        self.kf_q      = 5
+        self.kf_r      = 20
+        self.kf_lead   = 50
+        self.st        = FilterState()
+        self.noise     = None
         self.paused    = True
-        self.last_out  = 0
         if flttype == "preempfilt":
             self.scale = 25
         pass
@@ -39,6 +79,12 @@ class GuideFilter(object):
         self.lpf_k    = settings[n + "lpf_k"  ]
         self.lpf_mix  = settings[n + "lpf_mix"]
         self.scale    = settings[n + "scale"  ]
+        self.kind     = settings[n + "type"   ]
+        self.kf_q     = settings[n + "kf_q"   ]
+        self.kf_r     = settings[n + "kf_r"   ]
+        self.kf_lead  = settings[n + "kf_lead"]
+        self.kf_q     = abs(self.kf_q)
+        self.kf_r     = abs(self.kf_r)
         self.limit_i  = abs(self.limit_i)
         self.decay_i  = abs(self.decay_i)
         self.lpf_k    = abs(self.lpf_k)
@@ -57,45 +103,66 @@ class GuideFilter(object):
         settings.update({(n + "lpf_k"  ): self.lpf_k  })
         settings.update({(n + "lpf_mix"): self.lpf_mix})
         settings.update({(n + "scale"  ): self.scale  })
+        settings.update({(n + "type"   ): self.kind   })
+        settings.update({(n + "kf_q"   ): self.kf_q   })
+        settings.update({(n + "kf_r"   ): self.kf_r   })
+        settings.update({(n + "kf_lead"): self.kf_lead})
 
     def neutralize(self):
-        self.sum_i    = 0
-        self.last_val = None
-        self.lpf_val  = None
-        self.last_out = 0
+        self.st.reset()
+
+    def add_given(self, x):
+        # a pulse was given, after clamping and backlash compensation, in the same units as the input
+        self.st.kf_u += x
+
+    def set_noise(self, x):
+        # standard deviation of the next measurement, in the same units as the input, None if unknown
+        self.noise = x
+
+    def get_state(self):
+        # two numbers for logging, the integral and low pass filter values, or the Kalman filter's correction and change per frame
+        st = self.st
+        if self.kind == FILTKIND_KALMAN:
+            if st.kf_x is None:
+                return (0.0, 0.0)
+            return (float(st.kf_x[0]), float(st.kf_x[1]))
+        return (float(st.sum_i), float(st.lpf_val) if st.lpf_val is not None else 0.0)
 
     def filter(self, x):
         if self.paused:
             return x
+        if self.kind == FILTKIND_KALMAN:
+            return self._filter_kalman(x)
+        st = self.st
         total = x
-        self.sum_i += x
-        if self.sum_i > self.limit_i:
-            self.sum_i = self.limit_i
-        elif self.sum_i < -self.limit_i:
-            self.sum_i = -self.limit_i
-        i = self.sum_i * self.term_i
+        st.sum_i += x
+        if st.sum_i > self.limit_i:
+            st.sum_i = self.limit_i
+        elif st.sum_i < -self.limit_i:
+            st.sum_i = -self.limit_i
+        i = st.sum_i * self.term_i
         i /= 100
-        if self.sum_i > self.decay_i or self.sum_i < -self.decay_i:
-            self.sum_i -= self.decay_i
+        if st.sum_i > self.decay_i or st.sum_i < -self.decay_i:
+            st.sum_i -= self.decay_i
         else:
-            self.sum_i = 0
-        if self.last_val is None:
-            self.last_val = x
-        d = x - self.last_val
+            st.sum_i = 0
+        if st.last_val is None:
+            st.last_val = x
+        d = x - st.last_val
         d *= self.term_d
         d /= 100
-        self.last_val = x
+        st.last_val = x
         total += i + d
-        if self.lpf_val is None:
-            self.lpf_val = x
+        if st.lpf_val is None:
+            st.lpf_val = x
         if self.lpf_k >= 100:
             lpf_sum = x
         else:
-            lpf_old = self.lpf_val * (100 - self.lpf_k)
+            lpf_old = st.lpf_val * (100 - self.lpf_k)
             lpf_new = x * self.lpf_k
             lpf_sum = lpf_old + lpf_new
             lpf_sum /= 100
-        self.lpf_val = x
+        st.lpf_val = x
         if self.lpf_k > 0:
             mix_1 = total * (100 - self.lpf_mix)
             mix_2 = lpf_sum * self.lpf_mix
@@ -105,13 +172,51 @@ class GuideFilter(object):
             final_mix = total
         final_mix *= self.scale
         final_mix /= 100
-        self.last_out = final_mix
+        st.last_out = final_mix
         return final_mix
 
+    def _filter_kalman(self, z):
+        st = self.st
+        r = self.kf_r
+        if self.noise is not None and self.noise > r:
+            r = self.noise
+        r = r * r
+        u = st.kf_u
+        st.kf_u = 0
+        if st.kf_x is None:
+            st.kf_x = [z, 0]
+            st.kf_p = [r, 0, self.kf_q * self.kf_q * 4]
+        else:
+            # predict, the pulses that were given have removed that much of the correction
+            x0 = st.kf_x[0] + st.kf_x[1] - u
+            x1 = st.kf_x[1]
+            p00, p01, p11 = st.kf_p
+            q = self.kf_q * self.kf_q
+            p00 = p00 + (2 * p01) + p11 + (q / 4)
+            p01 = p01 + p11 + (q / 2)
+            p11 = p11 + q
+            # update
+            y = z - x0
+            s = p00 + r
+            k0 = p00 / s
+            k1 = p01 / s
+            x0 += k0 * y
+            x1 += k1 * y
+            p11 = p11 - (k1 * p01)
+            p01 = p01 - (k0 * p01)
+            p00 = p00 - (k0 * p00)
+            st.kf_x = [x0, x1]
+            st.kf_p = [p00, p01, p11]
+        out = st.kf_x[0] + (st.kf_x[1] * self.kf_lead / 100)
+        out *= self.scale
+        out /= 100
+        st.last_out = out
+        return out
+
     def get_preemp(self):
         if self.paused:
-            self.last_out = 0
+            self.st.last_out = 0
             return 0
-        ret = self.last_out
-        self.last_out = 0
+        ret = self.st.last_out
+        self.st.last_out = 0
         return ret
@@ -0,0 +1,416 @@
+import micropython
+micropython.opt_level(2)
+
+import math, array
+
+# periodic error correction
+# learns the RA axis' periodic error while guiding, and predicts it, so that it can be corrected before it shows up in a frame
+#
+# every guided frame gives the guide star's RA position relative to the origin, minus everything that the RA pulses have moved it
+# what is left is how the mount would have tracked without guiding, this is averaged into bins of BIN_MS and kept for a few worm cycles
+# the periods are found by scanning a periodogram of the binned data, or are the worm period from the settings and its harmonics
+# then the amplitude and phase of every period, plus a linear drift, are fitted together with least squares
+# the analysis is done a small piece at a time in task(), so it never holds up guiding
+#
+# the feed-forward pulse is how far the periodic part of the model moves between the last time a pulse was given and the middle of the next exposure
+
+BIN_MS          = micropython.const(5000)
+MAX_BINS        = micropython.const(512)
+MIN_BINS        = micropython.const(16)
+REFIT_BINS      = micropython.const(24)   # new bins needed before the model is fitted again
+SCAN_CNT        = micropython.const(64)   # number of periods tried by the periodogram
+SCAN_PER_STEP   = micropython.const(2)
+FIT_PER_STEP    = micropython.const(64)   # bins added to the least squares sums per step
+MAX_PERIODS     = micropython.const(4)
+MIN_EXPLAINED   = 0.2                     # the model is only used if it explains at least this much of the variance
+
+PECSTATE_IDLE = micropython.const(0)
+PECSTATE_SCAN = micropython.const(1)
+PECSTATE_FIT  = micropython.const(2)
+
+class PeriodicErrorCorrector(object):
+
+    def __init__(self):
+        self.enabled      = False
+        self.period       = 0   # seconds, 0 means it is found automatically
+        self.period_min   = 60
+        self.period_max   = 900
+        self.harmonics    = 3
+        self.gain         = 100 # percent
+        self.bin_t        = array.array('f', [0] * MAX_BINS)
+        self.bin_v        = array.array('f', [0] * MAX_BINS)
+        self.t_base       = None
+        self.model        = None # [[period, cos coefficient, sin coefficient], ...], in seconds and pixels
+        self.explained    = 0
+        self.fit_cnt      = 0
+        self.last_t       = None
+        self.pending      = 0   # pixels of predicted error that no pulse has corrected yet
+        self.periods      = []
+        self.reset()
+
+    def load_settings(self, settings):
+        self.enabled    = settings["pec_enable"]
+        self.period     = abs(settings["pec_period"])
+        self.period_min = abs(settings["pec_period_min"])
+        self.period_max = abs(settings["pec_period_max"])
+        self.harmonics  = max(1, min(MAX_PERIODS, int(settings["pec_harmonics"])))
+        self.gain       = settings["pec_gain"]
+        if self.period_max < self.period_min * 2:
+            self.period_max = self.period_min * 2
+
+    def fill_settings(self, settings):
+        settings.update({"pec_enable"    : self.enabled   })
+        settings.update({"pec_period"    : self.period    })
+        settings.update({"pec_period_min": self.period_min})
+        settings.update({"pec_period_max": self.period_max})
+        settings.update({"pec_harmonics" : self.harmonics })
+        settings.update({"pec_gain"      : self.gain      })
+
+    def reset(self):
+        # forgets the samples, but not the model, the mount's gears have not changed
+        self.bin_cnt   = 0
+        self.bin_head  = 0
+        self.new_bins  = 0
+        self.acc_t     = 0
+        self.acc_v     = 0
+        self.acc_n     = 0
+        self.acc_start = None
+        self.pulsed    = 0
+        self.origin    = None
+        self.state     = PECSTATE_IDLE
+
+    def forget(self):
+        self.reset()
+        self.model = None
+        self.explained = 0
+        self.last_t = None
+        self.pending = 0
+
+    def add_pulse(self, pix):
+        # pix is how far the RA pulse that was just given will move the star along the RA axis
+        self.pulsed += pix
+
+    def add_sample(self, t, pos, origin):
+        # t is the middle of the exposure in milliseconds, pos is the star's distance from the origin along the RA axis in pixels
+        if self.origin != origin:
+            # a new star, or a new guiding session, the old samples do not line up with the new ones
+            self.reset()
+            self.origin = origin
+        if self.t_base is None:
+            self.t_base = t
+        v = pos - self.pulsed
+        if self.acc_start is not None and t - self.acc_start >= BIN_MS:
+            self.push_bin()
+        if self.acc_start is None:
+            self.acc_start = t
+        self.acc_t += (t - self.t_base) / 1000.0
+        self.acc_v += v
+        self.acc_n += 1
+
+    def push_bin(self):
+        if self.acc_n > 0:
+            self.bin_t[self.bin_head] = self.acc_t / self.acc_n
+            self.bin_v[self.bin_head] = self.acc_v / self.acc_n
+            self.bin_head = (self.bin_head + 1) % MAX_BINS
+            if self.bin_cnt < MAX_BINS:
+                self.bin_cnt += 1
+            self.new_bins += 1
+        self.acc_t = 0
+        self.acc_v = 0
+        self.acc_n = 0
+        self.acc_start = None
+
+    def get_bin(self, i):
+        # oldest first
+        j = (self.bin_head - self.bin_cnt + i) % MAX_BINS
+        return self.bin_t[j], self.bin_v[j]
+
+    def get_span(self):
+        if self.bin_cnt < 2:
+            return 0
+        return self.get_bin(self.bin_cnt - 1)[0] - self.get_bin(0)[0]
+
+    def task(self):
+        # does one small piece of the analysis, returns True when a new model was made
+        if self.enabled == False:
+            return False
+        if self.state == PECSTATE_IDLE:
+            if self.bin_cnt < MIN_BINS or self.new_bins < REFIT_BINS:
+                return False
+            span = self.get_span()
+            if self.period > 0:
+                if span < self.period * 1.5:
+                    return False
+                self.periods = []
+                h = 1
+                while h <= self.harmonics:
+                    self.periods.append(self.period / h)
+                    h += 1
+                self.start_fit()
+                return False
+            if span < self.period_min * 2:
+                return False
+            self.start_scan(span)
+            return False
+        elif self.state == PECSTATE_SCAN:
+            self.scan_step()
+            return False
+        elif self.state == PECSTATE_FIT:
+            return self.fit_step()
+        return False
+
+    def set_center(self):
+        # the drift term uses time relative to the middle of the data, scaled to about -1 to 1
+        # otherwise the sums get too big for single precision floats
+        t0 = self.get_bin(0)[0]
+        t1 = self.get_bin(self.bin_cnt - 1)[0]
+        self.tc = (t0 + t1) / 2
+        self.ts = max(1, (t1 - t0) / 2)
+
+    def detrend(self):
+        # straight line fit, the scan works on what is left over
+        self.set_center()
+        n = self.bin_cnt
+        st = 0
+        sv = 0
+        stt = 0
+        stv = 0
+        i = 0
+        while i < n:
+            t, v = self.get_bin(i)
+            t = (t - self.tc) / self.ts
+            st += t
+            sv += v
+            stt += t * t
+            stv += t * v
+            i += 1
+        d = (n * stt) - (st * st)
+        b = ((n * stv) - (st * sv)) / d if d != 0 else 0
+        a = (sv - (b * st)) / n
+        self.resid = array.array('f', [0] * n)
+        self.resid_t = array.array('f', [0] * n)
+        i = 0
+        while i < n:
+            t, v = self.get_bin(i)
+            self.resid_t[i] = t
+            self.resid[i] = v - (a + (b * (t - self.tc) / self.ts))
+            i += 1
+
+    def start_scan(self, span):
+        self.new_bins = 0
+        self.detrend()
+        # periods are spaced geometrically, at least two cycles must fit in the data
+        self.scan_lo = self.period_min
+        self.scan_hi = min(self.period_max, span / 2)
+        if self.scan_hi <= self.scan_lo:
+            self.scan_hi = self.scan_lo * 1.01
+        self.scan_pwr = array.array('f', [0] * SCAN_CNT)
+        self.scan_idx = 0
+        self.state = PECSTATE_SCAN
+
+    def scan_period(self, i):
+        return self.scan_lo * math.pow(self.scan_hi / self.scan_lo, i / (SCAN_CNT - 1))
+
+    def scan_step(self):
+        k = 0
+        while k < SCAN_PER_STEP and self.scan_idx < SCAN_CNT:
+            w = 2 * math.pi / self.scan_period(self.scan_idx)
+            sc = 0
+            ss = 0
+            i = 0
+            n = len(self.resid)
+            while i < n:
+                x = w * self.resid_t[i]
+                sc += self.resid[i] * math.cos(x)
+                ss += self.resid[i] * math.sin(x)
+                i += 1
+            self.scan_pwr[self.scan_idx] = ((sc * sc) + (ss * ss)) / n
+            self.scan_idx += 1
+            k += 1
+        if self.scan_idx < SCAN_CNT:
+            return
+        # the strongest peaks, each one refined by fitting a parabola through it and its neighbours
+        peaks = []
+        i = 1
+        while i < SCAN_CNT - 1:
+            p = self.scan_pwr
+            if p[i] > p[i - 1] and p[i] >= p[i + 1]:
+                dnm = p[i - 1] - (2 * p[i]) + p[i + 1]
+                off = (0.5 * (p[i - 1] - p[i + 1]) / dnm) if dnm != 0 else 0
+                peaks.append([p[i], self.scan_period(i + off)])
+            i += 1
+        peaks.sort(key = lambda x: x[0], reverse = True)
+        self.periods = [x[1] for x in peaks[0:self.harmonics]]
+        self.resid = None
+        self.resid_t = None
+        self.scan_pwr = None
+        if len(self.periods) <= 0:
+            self.state = PECSTATE_IDLE
+            return
+        self.start_fit()
+
+    def start_fit(self):
+        self.new_bins = 0
+        self.set_center()
+        # a copy, new bins can arrive while the fit is still being worked on
+        n = self.bin_cnt
+        self.fit_t = array.array('f', [0] * n)
+        self.fit_v = array.array('f', [0] * n)
+        i = 0
+        while i < n:
+            self.fit_t[i], self.fit_v[i] = self.get_bin(i)
+            i += 1
+        m = 2 + (2 * len(self.periods))
+        self.ata = [[0] * m for i in range(m)]
+        self.atb = [0] * m
+        self.btb = 0
+        self.fit_n = 0
+        self.fit_idx = 0
+        self.state = PECSTATE_FIT
+
+    def get_row(self, t):
+        # constant, drift, then cosine and sine of every period
+        row = [1, (t - self.tc) / self.ts]
+        for p in self.periods:
+            x = 2 * math.pi * t / p
+            row.append(math.cos(x))
+            row.append(math.sin(x))
+        return row
+
+    def fit_step(self):
+        m = len(self.atb)
+        k = 0
+        n = len(self.fit_t)
+        while k < FIT_PER_STEP and self.fit_idx < n:
+            t = self.fit_t[self.fit_idx]
+            v = self.fit_v[self.fit_idx]
+            row = self.get_row(t)
+            i = 0
+            while i < m:
+                ri = row[i]
+                ata_i = self.ata[i]
+                j = i
+                while j < m:
+                    ata_i[j] += ri * row[j]
+                    j += 1
+                self.atb[i] += ri * v
+                i += 1
+            self.btb += v * v
+            self.fit_n += 1
+            self.fit_idx += 1
+            k += 1
+        if self.fit_idx < n:
+            return False
+        self.fit_t = None
+        self.fit_v = None
+        i = 0
+        while i < m:
+            j = 0
+            while j < i:
+                self.ata[i][j] = self.ata[j][i]
+                j += 1
+            i += 1
+        self.state = PECSTATE_IDLE
+        x = solve(self.ata, self.atb)
+        if x is None:
+            return False
+        # how much of the variance around the drift line is explained by the periodic part
+        # sum of squared residuals is b'b - x'A'b, the same without the periodic terms comes from the drift-only fit
+        ssr_all = self.btb - sum([x[i] * self.atb[i] for i in range(m)])
+        x2 = solve([[self.ata[0][0], self.ata[0][1]], [self.ata[1][0], self.ata[1][1]]], self.atb[0:2])
+        if x2 is None:
+            return False
+        ssr_drift = self.btb - ((x2[0] * self.atb[0]) + (x2[1] * self.atb[1]))
+        self.explained = 0 if ssr_drift <= 0 else max(0, 1.0 - (ssr_all / ssr_drift))
+        self.fit_cnt += 1
+        if self.explained < MIN_EXPLAINED:
+            self.model = None
+            return True
+        model = []
+        i = 0
+        while i < len(self.periods):
+            model.append([self.periods[i], x[2 + (i * 2)], x[3 + (i * 2)]])
+            i += 1
+        self.model = model
+        return True
+
+    def get_amplitude(self):
+        if self.model is None:
+            return 0
+        x = 0
+        for h in self.model:
+            x += math.sqrt((h[1] * h[1]) + (h[2] * h[2]))
+        return x
+
+    def predict(self, t):
+        # periodic part of the tracking error at time t (milliseconds), in pixels along the RA axis
+        if self.model is None or self.t_base is None:
+            return 0
+        ts = (t - self.t_base) / 1000.0
+        x = 0
+        for h in self.model:
+            a = 2 * math.pi * ts / h[0]
+            x += (h[1] * math.cos(a)) + (h[2] * math.sin(a))
+        return x
+
+    def get_pulse(self, t, lookahead, ms_per_pix):
+        # RA pulse in milliseconds that cancels the error that the model predicts from the last pulse until t + lookahead
+        # a pulse that is too short to be given is not lost, it is added to the next one, see used()
+        t += lookahead
+        if self.enabled == False or self.model is None:
+            self.last_t = None
+            self.pending = 0
+            return 0
+        if self.last_t is None or self.last_t > t:
+            self.last_t = t
+            return 0
+        self.pending += self.predict(t) - self.predict(self.last_t)
+        self.last_t = t
+        return -self.pending * ms_per_pix * self.gain / 100
+
+    def used(self):
+        # the pulse from get_pulse() was actually given
+        self.pending = 0
+
+    def get_state_obj(self):
+        if self.model is None:
+            return None
+        return [self.fit_cnt, self.explained, [[h[0], math.sqrt((h[1] * h[1]) + (h[2] * h[2]))] for h in self.model]]
+
+def solve(a, b):
+    # Gaussian elimination with partial pivoting, a is square, returns None if it is singular
+    n = len(b)
+    m = [list(a[i]) + [b[i]] for i in range(n)]
+    c = 0
+    while c < n:
+        p = c
+        r = c + 1
+        while r < n:
+            if abs(m[r][c]) > abs(m[p][c]):
+                p = r
+            r += 1
+        if abs(m[p][c]) < 1e-12:
+            return None
+        if p != c:
+            m[p], m[c] = m[c], m[p]
+        r = c + 1
+        while r < n:
+            f = m[r][c] / m[c][c]
+            if f != 0:
+                k = c
+                while k <= n:
+                    m[r][k] -= f * m[c][k]
+                    k += 1
+            r += 1
+        c += 1
+    x = [0] * n
+    r = n - 1
+    while r >= 0:
+        s = m[r][n]
+        k = r + 1
+        while k < n:
+            s -= m[r][k] * x[k]
+            k += 1
+        x[r] = s / m[r][r]
+        r -= 1
+    return x
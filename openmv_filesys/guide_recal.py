@@ -0,0 +1,250 @@
+import micropython
+micropython.opt_level(2)
+
+import math
+
+# continuous recalibration from the guide pulses
+# the star's move over two frames is modelled as M * p + c
+#   p is how much of the RA and DEC pulses (milliseconds) happened between those frames
+#   the columns of M are how far one millisecond of RA or DEC pulse moves the star, in pixels, which is the calibration
+#   c is the drift over two frames
+# M and c are estimated with recursive least squares, the calibration is the starting point
+# a forgetting factor lets the estimate follow the mount as it tracks across the sky
+# the image's X and Y share the same inputs, so they share one covariance matrix, it is kept in pixels squared so it is the uncertainty
+# the two frame fits overlap, every frame is in two of them, so each fit only counts for half
+# pulses overlap exposures, a pulse counts for how much of its move the star's centroid shows, averaged over the exposure
+
+FORGET         = 0.995  # forgetting factor, about the last 200 useful frames count
+GATE_SIGMA     = 4.0    # a move further than this many standard deviations from the prediction is thrown out, a gust or a bad frame
+REJECT_RESET   = micropython.const(5)  # this many thrown out in a row means the estimate is wrong, it starts over from the calibration
+MIN_UPDATES    = micropython.const(20) # nothing is changed before this many useful frames
+MIN_EXCITE     = 20     # milliseconds, a frame with less pulse than this can't teach anything, nothing is forgotten either
+PRIOR_REL_MIN  = 0.1    # the calibration is never trusted to be better than this fraction of its rate
+PRIOR_REL_MAX  = 0.3    # and the uncertainty never grows past this, so quiet nights don't wind it up
+PRIOR_DRIFT    = 2.0    # pixels per two frames
+NOISE_MIN      = 0.1    # pixels
+NOISE_INIT     = 0.5    # pixels, until it is learned
+NOISE_LEARN    = 0.05   # how fast the measurement noise follows the innovations
+MAX_REL_ERR    = 0.03   # the estimate is only used when its standard error is under this fraction of the rate
+MAX_ANGLE_CHG  = 15.0   # degrees away from the calibration that guiding started with, more than this means something moved, it is not used
+MAX_RATE_CHG   = 1.5    # the same, as a ratio of the rate
+
+RECAL_WAIT     = micropython.const(0) # not sure enough yet
+RECAL_APPLIED  = micropython.const(1)
+RECAL_TOO_FAR  = micropython.const(2) # sure, but too far from the calibration to be trusted, a new calibration is needed
+
+def pulse_fraction(start, dur, t0, t1):
+    # how much of a pulse the centroid of an exposure from t0 to t1 shows, the star moves at a constant speed during the pulse
+    if dur <= 0:
+        return 1.0
+    if t1 <= t0:
+        return pulse_done(start, dur, t1)
+    return (pulse_integral(start, dur, t1) - pulse_integral(start, dur, t0)) / (t1 - t0)
+
+def pulse_done(start, dur, t):
+    x = (t - start) / dur
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    return x
+
+def pulse_integral(start, dur, t):
+    # integral of pulse_done() up to t
+    x = t - start
+    if x <= 0:
+        return 0.0
+    if x < dur:
+        return (x * x) / (2 * dur)
+    return (dur / 2) + (x - dur)
+
+class OnlineCalibration(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ready    = False
+        self.cal      = [None, None] # the calibrations this started from, they get updated in place
+        self.base     = [None, None] # (angle, pix_per_ms) of those calibrations when guiding started
+        self.theta    = [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]] # for X and Y, the RA, DEC and drift terms
+        self.P        = [0.0] * 9
+        self.P_max    = [0.0] * 3
+        self.noise_sq = NOISE_INIT * NOISE_INIT
+        self.pulses   = [] # [start, ra, dec, RA fraction so far, DEC fraction so far, in the backlash]
+        self.taken_up = [0, 0] # pulse in the same direction since the last reversal, for each axis
+        self.last_pos = None
+        self.prev_frame = None # (x, y, RA pulse, DEC pulse, in the backlash, position the frame before)
+        self.updates  = 0
+        self.rejects  = 0
+
+    def start(self, cal_ra, cal_dec):
+        self.reset()
+        self.cal = [cal_ra, cal_dec]
+        i = 0
+        while i < 2:
+            c = self.cal[i]
+            if c is not None and c.pix_per_ms > 0:
+                self.base[i] = (c.angle, c.pix_per_ms)
+            i += 1
+        self.restart()
+
+    def restart(self):
+        # starts the estimate over from the calibrations as they are now
+        # apply() has already changed them in place, base is kept so the limits are still measured from the calibration guiding started with
+        cal = self.cal
+        base = self.base
+        self.reset()
+        self.cal = cal
+        self.base = base
+        i = 0
+        while i < 2:
+            c = self.cal[i]
+            if c is not None and c.pix_per_ms > 0:
+                a = math.radians(c.angle)
+                self.theta[0][i] = c.pix_per_ms * math.cos(a)
+                self.theta[1][i] = c.pix_per_ms * math.sin(a)
+                rel = PRIOR_REL_MIN
+                if c.ms_per_pix_ci > 0 and c.ms_per_pix > 0:
+                    rel = max(rel, c.ms_per_pix_ci / (1.96 * c.ms_per_pix))
+                self.P[(i * 3) + i] = (rel * c.pix_per_ms) ** 2
+                self.P_max[i] = (PRIOR_REL_MAX * c.pix_per_ms) ** 2
+            i += 1
+        self.P[8] = PRIOR_DRIFT * PRIOR_DRIFT
+        self.P_max[2] = self.P[8]
+        self.ready = True
+
+    def is_current(self, cal_ra, cal_dec):
+        # false if the calibrations have been replaced since start()
+        return self.ready and self.cal[0] is cal_ra and self.cal[1] is cal_dec
+
+    def add_pulse(self, t, ra, dec, backlash_ra = 0, backlash_dec = 0):
+        # every pulse given to the mount, backlash_* is how many milliseconds of pulse the backlash of each axis can swallow after a reversal
+        # a pulse that could have been swallowed by backlash doesn't move the star by a known amount, the frames it shows up in are not used
+        slack = False
+        pulse = [ra, dec]
+        lim = [backlash_ra, backlash_dec]
+        i = 0
+        while i < 2:
+            x = pulse[i]
+            if x != 0 and lim[i] > 0:
+                if (x > 0) != (self.taken_up[i] > 0):
+                    self.taken_up[i] = 0
+                if abs(self.taken_up[i]) < lim[i]:
+                    slack = True
+                self.taken_up[i] += x
+            i += 1
+        self.pulses.append([t, ra, dec, 0.0, 0.0, slack])
+
+    def update(self, t0, t1, pos):
+        # a new frame, exposed from t0 to t1, with the star at pos, returns true if the estimate changed
+        x_ra = 0.0
+        x_dec = 0.0
+        slack = False
+        i = 0
+        while i < len(self.pulses):
+            p = self.pulses[i]
+            f_ra = pulse_fraction(p[0], abs(p[1]), t0, t1)
+            f_dec = pulse_fraction(p[0], abs(p[2]), t0, t1)
+            if (f_ra > p[3] or f_dec > p[4]) and p[5]:
+                slack = True
+            x_ra += (f_ra - p[3]) * p[1]
+            x_dec += (f_dec - p[4]) * p[2]
+            p[3] = f_ra
+            p[4] = f_dec
+            if f_ra >= 1 and f_dec >= 1:
+                self.pulses.pop(i)
+            else:
+                i += 1
+        # the fit is done over two frames at a time
+        # each pulse is worked out from a star position that has some noise in it, the move it causes takes that noise back out in the next frame
+        # over one frame that makes the rate look bigger than it is, over two frames the next pulse cancels it out
+        prev = self.prev_frame
+        self.prev_frame = (pos[0], pos[1], x_ra, x_dec, slack, self.last_pos)
+        self.last_pos = (pos[0], pos[1])
+        if prev is None or prev[5] is None or slack or prev[4]:
+            return False
+        x_ra += prev[2]
+        x_dec += prev[3]
+        if (abs(x_ra) + abs(x_dec)) < MIN_EXCITE:
+            return False
+        dy = (pos[0] - prev[5][0], pos[1] - prev[5][1])
+        phi = (x_ra, x_dec, 1.0)
+        P = self.P
+        # P * phi, and the variance of the prediction
+        Pphi = [(P[0] * phi[0]) + (P[1] * phi[1]) + P[2], (P[3] * phi[0]) + (P[4] * phi[1]) + P[5], (P[6] * phi[0]) + (P[7] * phi[1]) + P[8]]
+        pvar = (phi[0] * Pphi[0]) + (phi[1] * Pphi[1]) + Pphi[2]
+        # the measurement noise, centroids and seeing, is learned from how far off the predictions are
+        s = self.noise_sq + pvar
+        s_fit = (2 * self.noise_sq) + pvar
+        err = [0.0, 0.0]
+        k = 0
+        while k < 2:
+            th = self.theta[k]
+            err[k] = dy[k] - ((th[0] * phi[0]) + (th[1] * phi[1]) + th[2])
+            k += 1
+        e_sq = (err[0] * err[0]) + (err[1] * err[1])
+        if e_sq > (GATE_SIGMA * GATE_SIGMA) * 2 * s:
+            self.rejects += 1
+            if self.rejects >= REJECT_RESET:
+                self.restart()
+            return False
+        self.rejects = 0
+        self.noise_sq += (max(NOISE_MIN * NOISE_MIN, (e_sq / 2) - pvar) - self.noise_sq) * NOISE_LEARN
+        k = 0
+        while k < 2:
+            th = self.theta[k]
+            j = 0
+            while j < 3:
+                th[j] += Pphi[j] * err[k] / s_fit
+                j += 1
+            k += 1
+        # P = (P - (P phi phi' P) / s_fit) / forget, the forgetting stops once the uncertainty is back to where it is allowed to go
+        forget = FORGET
+        j = 0
+        while j < 3:
+            if P[(j * 3) + j] >= self.P_max[j]:
+                forget = 1.0
+            j += 1
+        j = 0
+        while j < 3:
+            m = 0
+            while m < 3:
+                P[(j * 3) + m] = (P[(j * 3) + m] - (Pphi[j] * Pphi[m] / s_fit)) / forget
+                m += 1
+            j += 1
+        self.updates += 1
+        return True
+
+    def get_axis(self, axis):
+        # (angle in degrees, pixels per millisec, standard error as a fraction of the rate)
+        x = self.theta[0][axis]
+        y = self.theta[1][axis]
+        ppm = math.sqrt((x * x) + (y * y))
+        if ppm <= 0:
+            return 0, 0, 1.0
+        return math.degrees(math.atan2(y, x)), ppm, math.sqrt(max(0, self.P[(axis * 3) + axis])) / ppm
+
+    def apply(self, axis):
+        # updates the calibration of an axis in place if the estimate is good enough and not too different, returns RECAL_*
+        cal = self.cal[axis]
+        if cal is None or self.base[axis] is None or self.updates < MIN_UPDATES:
+            return RECAL_WAIT
+        ang, ppm, rel = self.get_axis(axis)
+        if rel > MAX_REL_ERR:
+            return RECAL_WAIT
+        base_ang, base_ppm = self.base[axis]
+        dang = ang - base_ang
+        while dang > 180.0:
+            dang -= 360.0
+        while dang < -180.0:
+            dang += 360.0
+        if abs(dang) > MAX_ANGLE_CHG or ppm > base_ppm * MAX_RATE_CHG or ppm < base_ppm / MAX_RATE_CHG:
+            return RECAL_TOO_FAR
+        cal.angle = ang
+        cal.pix_per_ms = ppm
+        cal.ms_per_pix = 1.0 / ppm
+        cal.angle_ci = math.degrees(1.96 * rel)
+        cal.ms_per_pix_ci = cal.ms_per_pix * 1.96 * rel
+        cal.pix_per_ms_ci = ppm * 1.96 * rel
+        return RECAL_APPLIED
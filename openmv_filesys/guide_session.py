@@ -0,0 +1,189 @@
+import micropython
+micropython.opt_level(2)
+
+import ustruct, ujson
+
+# append-only binary log of a guiding session
+# the file starts with SES_MAGIC and a version byte, then records, every record is REC_HEAD_FMT (type, payload length) and the payload
+# records are packed into a fixed buffer, it is written out when it is full, or when flush() is called at a quiet moment
+# if the file can't be written, records are counted as dropped and logging carries on, it never stops guiding
+# the reader is openmv_host/session_reader.py, the two must be kept in sync
+
+SES_MAGIC    = b"GSES"
+SES_VER      = micropython.const(1)
+REC_HEAD_FMT = "<BH"
+REC_HEAD_LEN = micropython.const(3)
+
+REC_INFO     = micropython.const(1) # JSON, settings and calibration, written when the log starts
+REC_FRAME    = micropython.const(2) # FRAME_FMT, then STAR_FMT for every star
+REC_PULSE    = micropython.const(3) # PULSE_FMT
+REC_MSG      = micropython.const(4) # uint32 timestamp, then UTF-8 text
+
+# timestamp, guide state, flags, exposure code, selected star, virtual star, target, move error, multi-star counts, number of stars
+# coordinates are NaN when they are not known
+FRAME_FMT    = "<IBBB7fHHH"
+FRAME_LEN    = micropython.const(41)
+FLAG_SHUTTER = micropython.const(0x01) # the camera's shutter was open
+FLAG_STARS   = micropython.const(0x02) # the star list is new, it is not written otherwise
+
+STAR_FMT     = "<HHHBB" # center in 1/STAR_SCALE pixels, radius, max brightness, rating
+STAR_LEN     = micropython.const(8)
+STAR_SCALE   = 16.0
+MAX_STARS    = micropython.const(64) # the best rated stars are kept if there are more
+
+# timestamp, kind, RA and DEC pulse before the backlash filter and after it (milliseconds), the filters' state for RA and DEC, the backlash value for RA and DEC
+PULSE_FMT    = "<IBhhhh4fhh"
+PULSE_LEN    = micropython.const(33)
+PULSE_PREEMP     = micropython.const(0)
+PULSE_CORRECTIVE = micropython.const(1)
+
+LOG_BUF_LEN  = micropython.const(4096)
+FLUSH_MS     = micropython.const(10000) # flush() only writes a partly full buffer this often
+
+NAN = float("nan")
+
+def clamp16(x):
+    x = int(round(x))
+    if x > 0x7FFF:
+        return 0x7FFF
+    if x < -0x7FFF:
+        return -0x7FFF
+    return x
+
+def clamp_u(x, hi):
+    x = int(x)
+    if x < 0:
+        return 0
+    if x > hi:
+        return hi
+    return x
+
+class SessionLog(object):
+
+    def __init__(self, buf_len = LOG_BUF_LEN):
+        self.buf     = bytearray(buf_len)
+        self.f       = None
+        self.path    = None
+        self.n       = 0 # bytes waiting in the buffer
+        self.written = 0
+        self.dropped = 0 # records that were lost
+        self.last_flush = 0
+
+    def is_open(self):
+        return self.f is not None
+
+    def start(self, path, info, now = 0):
+        # opens the log, appending if it already exists
+        self.stop()
+        self.path = path
+        self.n = 0
+        self.written = 0
+        self.dropped = 0
+        self.last_flush = now
+        try:
+            self.f = open(path, "ab")
+            if self.f.tell() <= 0:
+                self.f.write(SES_MAGIC + bytes([SES_VER]))
+        except OSError:
+            self.f = None
+            return False
+        self.add_info(info)
+        return True
+
+    def stop(self):
+        if self.f is None:
+            return
+        self.flush(force = True)
+        try:
+            self.f.close()
+        except OSError:
+            pass
+        self.f = None
+
+    def reserve(self, rec_type, length):
+        # makes room for a record, writes its header, returns where the payload goes, or -1 if the record has to be dropped
+        if self.f is None:
+            return -1
+        total = REC_HEAD_LEN + length
+        if total > len(self.buf) or length > 0xFFFF:
+            self.dropped += 1
+            return -1
+        if self.n + total > len(self.buf):
+            self.flush(force = True)
+            if self.n + total > len(self.buf):
+                self.dropped += 1
+                return -1
+        ustruct.pack_into(REC_HEAD_FMT, self.buf, self.n, rec_type, length)
+        i = self.n + REC_HEAD_LEN
+        self.n += total
+        return i
+
+    def add_bytes(self, rec_type, data):
+        if self.f is not None and REC_HEAD_LEN + len(data) > len(self.buf) and len(data) <= 0xFFFF:
+            # too big for the buffer, written straight to the file after what is already buffered
+            self.flush(force = True)
+            try:
+                self.f.write(ustruct.pack(REC_HEAD_FMT, rec_type, len(data)) + data)
+                self.written += REC_HEAD_LEN + len(data)
+            except OSError:
+                self.dropped += 1
+            return
+        i = self.reserve(rec_type, len(data))
+        if i >= 0:
+            self.buf[i:i + len(data)] = data
+
+    def add_info(self, obj):
+        self.add_bytes(REC_INFO, ujson.dumps(obj).encode("utf-8"))
+
+    def add_msg(self, ts, msg):
+        b = msg.encode("utf-8")
+        self.add_bytes(REC_MSG, ustruct.pack("<I", ts & 0xFFFFFFFF) + b[:512])
+
+    def add_frame(self, ts, state, flags, code, sel, virt, tgt, move_err, msc, stars):
+        if stars is None or (flags & FLAG_STARS) == 0:
+            stars = []
+        if len(stars) > MAX_STARS:
+            stars = sorted(stars, key = lambda s: s.star_rating(), reverse = True)[0:MAX_STARS]
+        i = self.reserve(REC_FRAME, FRAME_LEN + (len(stars) * STAR_LEN))
+        if i < 0:
+            return
+        ustruct.pack_into(FRAME_FMT, self.buf, i, ts & 0xFFFFFFFF, state, flags, code,
+            sel[0]  if sel  is not None else NAN, sel[1]  if sel  is not None else NAN,
+            virt[0] if virt is not None else NAN, virt[1] if virt is not None else NAN,
+            tgt[0]  if tgt  is not None else NAN, tgt[1]  if tgt  is not None else NAN,
+            move_err, clamp_u(msc[0], 0xFFFF), clamp_u(msc[1], 0xFFFF), len(stars))
+        i += FRAME_LEN
+        for s in stars:
+            ustruct.pack_into(STAR_FMT, self.buf, i,
+                clamp_u(round(s.cxf() * STAR_SCALE), 0xFFFF),
+                clamp_u(round(s.cyf() * STAR_SCALE), 0xFFFF),
+                clamp_u(s.r(), 0xFFFF),
+                clamp_u(s.max_brightness(), 0xFF),
+                clamp_u(s.star_rating(), 0xFF))
+            i += STAR_LEN
+
+    def add_pulse(self, ts, kind, req, fin, filt_ra, filt_dec, backlash):
+        i = self.reserve(REC_PULSE, PULSE_LEN)
+        if i < 0:
+            return
+        ustruct.pack_into(PULSE_FMT, self.buf, i, ts & 0xFFFFFFFF, kind,
+            clamp16(req[0]), clamp16(req[1]), clamp16(fin[0]), clamp16(fin[1]),
+            filt_ra[0], filt_ra[1], filt_dec[0], filt_dec[1],
+            clamp16(backlash[0]), clamp16(backlash[1]))
+
+    def flush(self, now = None, force = False):
+        # without force, a partly full buffer is only written once every FLUSH_MS, so the card isn't written to every frame
+        if self.f is None or self.n <= 0:
+            return False
+        if force == False and self.n < (len(self.buf) // 2) and (now is None or (now - self.last_flush) < FLUSH_MS):
+            return False
+        if now is not None:
+            self.last_flush = now
+        try:
+            self.f.write(memoryview(self.buf)[0:self.n])
+            self.f.flush()
+            self.written += self.n
+        except OSError:
+            self.dropped += 1
+        self.n = 0
+        return True
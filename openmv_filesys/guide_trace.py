@@ -0,0 +1,183 @@
+import micropython
+micropython.opt_level(2)
+
+import array
+
+# latency tracing for the guide loop
+# every frame gets a record of how long each span took, in milliseconds, the last TRACE_FRAMES records are kept in a ring buffer
+# every span also has a histogram that is never cleared, so the percentiles can cover a whole night, at the resolution of the buckets
+# spans that did not happen in a frame (no pulse, nothing sent) are left out of the statistics
+# everything is allocated up front, recording a span does not allocate memory
+
+SPAN_EXPO    = micropython.const(0) # end of the exposure until the analysis starts
+SPAN_HIST    = micropython.const(1) # histogram and statistics
+SPAN_FIND    = micropython.const(2) # star finder, find_blobs
+SPAN_PROCESS = micropython.const(3) # guidestar.process_list
+SPAN_MOTION  = micropython.const(4) # guidestar.get_multi_star_motion
+SPAN_PULSE   = micropython.const(5) # end of the exposure until the corrective pulse is issued
+SPAN_SEND    = micropython.const(6) # websocket send
+SPAN_CYCLE   = micropython.const(7) # frame to frame
+SPAN_CNT     = micropython.const(8)
+
+SPAN_NAMES   = ["expo", "hist", "find", "process", "motion", "pulse", "send", "cycle"]
+
+TRACE_FRAMES = micropython.const(256)
+NO_VALUE     = micropython.const(0xFFFF)
+MAX_VALUE    = micropython.const(0xFFFE)
+
+# upper edges of the histogram buckets, every millisecond up to 16, then 25% wider each time
+BUCKET_EDGES = []
+
+def build_buckets():
+    x = 0
+    while x < 16:
+        BUCKET_EDGES.append(x)
+        x += 1
+    y = float(x)
+    while x < MAX_VALUE:
+        BUCKET_EDGES.append(x)
+        y *= 1.25
+        x = int(y)
+    BUCKET_EDGES.append(MAX_VALUE)
+
+build_buckets()
+
+def find_bucket(v):
+    lo = 0
+    hi = len(BUCKET_EDGES) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if BUCKET_EDGES[mid] < v:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class LatencyTracer(object):
+
+    def __init__(self, frames = TRACE_FRAMES):
+        self.enabled = True
+        self.frames  = frames
+        self.dur     = array.array('H', [NO_VALUE] * (frames * SPAN_CNT))
+        self.ts      = array.array('L', [0] * frames)
+        self.hist    = array.array('L', [0] * (len(BUCKET_EDGES) * SPAN_CNT))
+        self.reset()
+
+    def reset(self):
+        i = 0
+        while i < len(self.dur):
+            self.dur[i] = NO_VALUE
+            i += 1
+        i = 0
+        while i < len(self.hist):
+            self.hist[i] = 0
+            i += 1
+        self.idx = -1 # ring buffer index of the current frame
+        self.cnt = 0  # frames recorded since the reset, can be more than the ring buffer holds
+
+    def begin(self, ts):
+        # starts a new frame record, ts is the time the exposure ended
+        if self.enabled == False:
+            return
+        self.idx = (self.idx + 1) % self.frames
+        self.cnt += 1
+        self.ts[self.idx] = ts & 0xFFFFFFFF
+        i = self.idx * SPAN_CNT
+        j = i + SPAN_CNT
+        while i < j:
+            self.dur[i] = NO_VALUE
+            i += 1
+
+    def set(self, span, ms):
+        if self.enabled == False or self.idx < 0:
+            return
+        ms = int(ms)
+        if ms < 0:
+            ms = 0
+        elif ms > MAX_VALUE:
+            ms = MAX_VALUE
+        i = (self.idx * SPAN_CNT) + span
+        if self.dur[i] != NO_VALUE:
+            # a span that happens twice in a frame adds up, its histogram count is moved over to the total
+            self.hist[(find_bucket(self.dur[i]) * SPAN_CNT) + span] -= 1
+            ms = min(MAX_VALUE, ms + self.dur[i])
+        self.dur[i] = ms
+        self.hist[(find_bucket(ms) * SPAN_CNT) + span] += 1
+
+    def get(self, span):
+        # the value from the current frame, None if the span did not happen
+        if self.idx < 0:
+            return None
+        x = self.dur[(self.idx * SPAN_CNT) + span]
+        return None if x == NO_VALUE else x
+
+    def get_recent(self, span):
+        # sorted values of a span from the ring buffer
+        res = []
+        n = min(self.cnt, self.frames)
+        i = 0
+        while i < n:
+            x = self.dur[(i * SPAN_CNT) + span]
+            if x != NO_VALUE:
+                res.append(x)
+            i += 1
+        res.sort()
+        return res
+
+    def hist_percentile(self, span, p):
+        # the upper edge of the bucket that holds the percentile, None if there is nothing recorded
+        total = 0
+        i = 0
+        while i < len(BUCKET_EDGES):
+            total += self.hist[(i * SPAN_CNT) + span]
+            i += 1
+        if total <= 0:
+            return None
+        want = (total * p) / 100.0
+        acc = 0
+        i = 0
+        while i < len(BUCKET_EDGES):
+            acc += self.hist[(i * SPAN_CNT) + span]
+            if acc >= want and acc > 0:
+                return BUCKET_EDGES[i]
+            i += 1
+        return BUCKET_EDGES[-1]
+
+    def get_summary(self, percentiles = (50, 90, 99)):
+        # {span name: {"n", "pXX", "max", "all_n", "all_pXX"}}, the "all" figures come from the histograms
+        obj = {}
+        span = 0
+        while span < SPAN_CNT:
+            x = {}
+            v = self.get_recent(span)
+            x.update({"n": len(v)})
+            for p in percentiles:
+                x.update({("p%u" % p): v[min(len(v) - 1, (len(v) * p) // 100)] if len(v) > 0 else None})
+            x.update({"max": v[-1] if len(v) > 0 else None})
+            total = 0
+            i = 0
+            while i < len(BUCKET_EDGES):
+                total += self.hist[(i * SPAN_CNT) + span]
+                i += 1
+            x.update({"all_n": total})
+            for p in percentiles:
+                x.update({("all_p%u" % p): self.hist_percentile(span, p)})
+            obj.update({SPAN_NAMES[span]: x})
+            span += 1
+        return obj
+
+    def iter_csv(self):
+        # the ring buffer, oldest frame first, one line at a time so a long export never needs one big string
+        yield "ts," + ",".join(SPAN_NAMES) + "\r\n"
+        n = min(self.cnt, self.frames)
+        k = 0
+        while k < n:
+            i = (self.idx - n + 1 + k) % self.frames
+            line = str(self.ts[i])
+            span = 0
+            while span < SPAN_CNT:
+                x = self.dur[(i * SPAN_CNT) + span]
+                line += "," + (str(x) if x != NO_VALUE else "")
+                span += 1
+            yield line + "\r\n"
+            k += 1
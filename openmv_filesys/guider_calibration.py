@@ -9,26 +9,65 @@ import exclogger
 
 RECOMMENDED_POINTS       = micropython.const(10)
 MINIMUM_REQUIRED_POINTS  = micropython.const(3)
+EARLY_MIN_POINTS         = micropython.const(5)   # good_enough() never stops a calibration with fewer points than this
+MINIMUM_SPAN             = micropython.const(100) # pixels the star must travel
+STEP_TOLERANCE           = 0.35                   # a step agrees with the hypothesis if it is off by less than this fraction of the step
+STEP_MIN_MAG             = 1.0                    # pixels, a hypothesis shorter than this is a step lost to backlash
+POINTS_PREALLOC          = micropython.const(64)  # room for this many points and steps is made up front, it grows if more are needed
+
+# two sided 95% t-distribution values, by degrees of freedom
+T95_TABLE = [12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23, 2.20, 2.18, 2.16, 2.14, 2.13, 2.12, 2.11, 2.10, 2.09, 2.09]
+
+def t95(dof):
+    if dof <= 0:
+        return 0
+    if dof <= len(T95_TABLE):
+        return T95_TABLE[dof - 1]
+    if dof <= 40:
+        return 2.04
+    return 1.96
 
 class GuiderCalibration(object):
     def __init__(self, x, y, pulse_width):
-        self.points = [[x, y]]
+        self.set_origin(x, y)
         self.pulse_width = pulse_width
         self.has_cal = False
         self.time = 0
 
-        self.accepted_points = []
+        self.accepted_cnt = 0
+        self.accepted_mask = None # which points were accepted, None if all of them were
         self.points_cnt = 0
         self.farthest = 0
         self.angle = 0
         self.pix_per_ms = 0
         self.ms_per_pix = 0
+        self.inlier_cnt = 0
+        # half widths of the 95% confidence intervals
+        self.angle_ci = 180.0
+        self.pix_per_ms_ci = 0
+        self.ms_per_pix_ci = 0
 
         self.timestamp = pyb.millis()
         self.success = "init"
 
     def set_origin(self, x, y):
-        self.points = [[x, y]]
+        # the points are kept in arrays made up front, the first point is the origin
+        self.pt_x = [0.0] * POINTS_PREALLOC
+        self.pt_y = [0.0] * POINTS_PREALLOC
+        self.pt_x[0] = x
+        self.pt_y[0] = y
+        self.pt_cnt = 1
+        self.reset_stats()
+
+    def reset_stats(self):
+        # the steps between points, and sums that analyze() would otherwise have to go over all the points for, are kept as the points come in
+        # the point sums are relative to the first point so they stay small and don't lose precision
+        self.step_x   = [0.0] * POINTS_PREALLOC
+        self.step_y   = [0.0] * POINTS_PREALLOC
+        self.step_cnt = 0
+        self.pt_sums  = [0.0] * 5 # x, y, x*x, y*y, x*y
+        self.st_sums  = [0.0] * 5 # the same for the steps
+        self.span     = 0         # farthest point from the first point
 
     def append(self, x, y):
         self.append_pt([x, y])
@@ -36,7 +75,29 @@ class GuiderCalibration(object):
 
     def append_pt(self, pt):
         self.success = "wait"
-        self.points.append(pt)
+        n = self.pt_cnt
+        if n >= len(self.pt_x):
+            self.pt_x.extend([0.0] * len(self.pt_x))
+            self.pt_y.extend([0.0] * len(self.pt_y))
+        self.pt_x[n] = pt[0]
+        self.pt_y[n] = pt[1]
+        self.pt_cnt = n + 1
+        dx = pt[0] - self.pt_x[0]
+        dy = pt[1] - self.pt_y[0]
+        add_sums(self.pt_sums, dx, dy)
+        mag = math.sqrt((dx * dx) + (dy * dy))
+        if mag > self.span:
+            self.span = mag
+        sx = pt[0] - self.pt_x[n - 1]
+        sy = pt[1] - self.pt_y[n - 1]
+        add_sums(self.st_sums, sx, sy)
+        i = self.step_cnt
+        if i >= len(self.step_x):
+            self.step_x.extend([0.0] * len(self.step_x))
+            self.step_y.extend([0.0] * len(self.step_y))
+        self.step_x[i] = sx
+        self.step_y[i] = sy
+        self.step_cnt = i + 1
 
     def append_all(self, pts):
         for i in pts:
@@ -44,14 +105,31 @@ class GuiderCalibration(object):
         #self.points.extend(pts)
 
     def reset_pts(self):
-        self.points = [self.points[0]]
+        self.pt_cnt = 1
+        self.reset_stats()
+
+    def get_points(self, mask = None):
+        # the points as a list of [x, y], only the ones marked in the mask if there is one
+        res = []
+        i = 0
+        while i < self.pt_cnt:
+            if mask is None or mask[i]:
+                res.append([self.pt_x[i], self.pt_y[i]])
+            i += 1
+        return res
+
+    def get_accepted_points(self):
+        if self.accepted_cnt <= 0:
+            return []
+        return self.get_points(self.accepted_mask)
 
     def get_span(self):
-        p0 = self.points[0]
+        # farthest any point got from the first point
+        return self.span
 
     def get_span_between(self, p0, point_list = None):
         if point_list is None:
-            point_list = self.points
+            point_list = self.get_points()
         max_mag = 0
         i = 0
         while i < len(point_list):
@@ -63,83 +141,124 @@ class GuiderCalibration(object):
         return max_mag
 
     def get_span_all(self, point_list = None):
+        # farthest apart any two points are, every pair is only checked once
         if point_list is None:
-            point_list = self.points
+            point_list = self.get_points()
         i = 0
         max_mag = 0
-        while i < len(point_list):
-            x = get_span_between(point_list[i], point_list = point_list)
+        while i < len(point_list) - 1:
+            x = self.get_span_between(point_list[i], point_list = point_list[i + 1:])
             if x > max_mag:
                 max_mag = x
             i += 1
         return max_mag
 
     def analyze(self):
-        i = 0
-        min_mag = 10000
-        max_mag = 0
-        mag_sum = 0
-        all_mags = []
-        # this first loop simply figures out the farthest distance between any two consecutive points
-        while i < len(self.points) - 1:
-            p1 = self.points[i]
-            p2 = self.points[i + 1]
-            mag = comutils.vector_between(p1, p2, mag_only = True)
-            if mag > max_mag:
-                max_mag = mag
-            if mag < min_mag:
-                min_mag = mag
-            all_mags.append(mag)
-            i += 1
-        # now we figure out which moves were inhibited by backlash
-        d_mag = max_mag - min_mag
-        mag_limit = min_mag + (d_mag / 4)
-        mag_sum = 0
-        mag_sum_cnt = 0
-        for i in all_mags:
-            # only count the ones that are not affected by backlash
-            if i >= mag_limit:
-                mag_sum += i
-                mag_sum_cnt += 1
-        # we can figure out the pixels per millisec, and millisec per pixel
-        self.avg_step_mag = mag_sum / mag_sum_cnt
-        self.pix_per_ms = self.avg_step_mag / self.pulse_width
-        self.ms_per_pix = self.pulse_width / self.avg_step_mag
-        i = 1
-        self.accepted_points = []
-        farthest_point = None
-        farthest = 0
-        pstart = self.points[0]
-        # now we go through the points again, find the ones not affected by backlash
-        # these "good" points will be used to calculate a line-of-best-fit
-        while i < len(self.points) - 1:
-            p0 = self.points[i - 1]
-            p1 = self.points[i]
-            p2 = self.points[i + 1]
-            mag1 = comutils.vector_between(p0, p1, mag_only = True)
-            mag2 = comutils.vector_between(p1, p2, mag_only = True)
-            mag_start = comutils.vector_between(pstart, p2, mag_only = True)
-            if mag1 >= mag_limit and mag2 >= mag_limit: # "good" point
-                self.accepted_points.append(p1)
-            if i == 0 and mag1 >= mag_limit: # "good" point
-                self.accepted_points.append(p0)
-            if i == len(self.points) - 2 and mag2 >= mag_limit: # "good" point
-                self.accepted_points.append(p2)
-            if mag_start > farthest:
-                farthest = mag_start
-                farthest_point = p2
-            i += 1
-        self.line_est_center, self.angle = line_est(self.accepted_points)
-        # we have a line-of-best-fit but there are two possible directions
-        # use the start point and the farthest point to see if the direction needs to be flipped
-        mag, ang = comutils.vector_between(pstart, farthest_point)
-        dang = comutils.angle_diff(ang, self.angle)
-        if abs(dang) > 90: # direction needs flipping
+        # the steps between consecutive points should all be about the same vector, the pulse width times the guide rate
+        # steps shortened by backlash, and steps into or out of a bad frame or a gust, are thrown out by a consensus (RANSAC) over the steps
+        # every step is tried as the hypothesis, there are only a few of them
+        # usually every step agrees with the average step, that is checked first, then the running sums already have everything and nothing is gone over again
+        self.accepted_cnt = 0
+        self.accepted_mask = None
+        self.inlier_cnt = 0
+        self.angle_ci = 180.0
+        self.pix_per_ms_ci = 0
+        self.ms_per_pix_ci = 0
+        n = self.step_cnt
+        step_x = self.step_x
+        step_y = self.step_y
+        all_good = False
+        if n > 0:
+            mx = self.st_sums[0] / n
+            my = self.st_sums[1] / n
+            hm_sq = (mx * mx) + (my * my)
+            if hm_sq >= STEP_MIN_MAG * STEP_MIN_MAG:
+                # no single step can be further from the average than all of them together
+                dev_sq = self.st_sums[2] + self.st_sums[3] - (n * hm_sq)
+                if dev_sq <= (STEP_TOLERANCE * STEP_TOLERANCE) * hm_sq:
+                    all_good = True
+                else:
+                    inl, err = step_consensus(step_x, step_y, n, mx, my)
+                    all_good = len(inl) >= n
+        if all_good:
+            self.inlier_cnt = n
+            self.accepted_cnt = self.pt_cnt
+            self.farthest = self.span
+            c, self.angle, ang_se = line_est_sums(self.pt_cnt, self.pt_sums)
+            self.line_est_center = [self.pt_x[0] + c[0], self.pt_y[0] + c[1]]
+            mag_sums = None
+        else:
+            best_inl = []
+            best_err = 0
+            h = 0
+            while h < n:
+                inl, err = step_consensus(step_x, step_y, n, step_x[h], step_y[h])
+                if len(inl) >= 2:
+                    # refine the hypothesis with the average of its inliers, keep it only if it doesn't lose any
+                    mx, my = step_mean(step_x, step_y, inl)
+                    inl2, err2 = step_consensus(step_x, step_y, n, mx, my)
+                    if len(inl2) >= len(inl):
+                        inl = inl2
+                        err = err2
+                if len(inl) > len(best_inl) or (len(inl) == len(best_inl) and err < best_err):
+                    best_inl = inl
+                    best_err = err
+                h += 1
+            self.inlier_cnt = len(best_inl)
+            if self.inlier_cnt <= 0:
+                self.farthest = 0
+                self.success = "failed"
+                return False
+
+            # the points at either end of a good step are the accepted points, a point that jumped off the line has no good steps
+            used = [False] * self.pt_cnt
+            for j in best_inl:
+                used[j] = True
+                used[j + 1] = True
+            accepted = self.get_points(used)
+            self.accepted_mask = used
+            self.accepted_cnt = len(accepted)
+            pstart = [self.pt_x[0], self.pt_y[0]]
+            farthest = 0
+            for p in accepted:
+                mag = comutils.vector_between(pstart, p, mag_only = True)
+                if mag > farthest:
+                    farthest = mag
+            self.farthest = farthest
+            self.line_est_center, self.angle, ang_se = line_est_tls(accepted)
+            mx, my = step_mean(step_x, step_y, best_inl)
+            mag_sums = [0.0] * 5
+            for j in best_inl:
+                add_sums(mag_sums, step_x[j], step_y[j])
+        farthest = self.farthest
+
+        # a total least squares line works at any angle, it has two possible directions, the average good step picks one
+        if abs(comutils.angle_diff(math.degrees(math.atan2(my, mx)), self.angle)) > 90: # direction needs flipping
             self.angle += 180.0
         self.angle = comutils.ang_normalize(self.angle)
-        self.farthest = farthest
+        if ang_se is not None:
+            self.angle_ci = min(180.0, math.degrees(t95(self.accepted_cnt - 2) * ang_se))
 
-        if len(self.accepted_points) < MINIMUM_REQUIRED_POINTS or farthest < 100:
+        # the length of every good step along the line gives the pixels per millisec
+        ux = math.cos(math.radians(self.angle))
+        uy = math.sin(math.radians(self.angle))
+        if mag_sums is None:
+            mag_sums = self.st_sums
+        mag_sum = (mag_sums[0] * ux) + (mag_sums[1] * uy)
+        mag_sq_sum = (mag_sums[2] * ux * ux) + (mag_sums[3] * uy * uy) + (2 * mag_sums[4] * ux * uy)
+        k = self.inlier_cnt
+        self.avg_step_mag = mag_sum / k
+        if self.avg_step_mag <= 0:
+            self.success = "failed"
+            return False
+        self.pix_per_ms = self.avg_step_mag / self.pulse_width
+        self.ms_per_pix = self.pulse_width / self.avg_step_mag
+        if k >= 2:
+            var = max(0, (mag_sq_sum - (mag_sum * mag_sum / k)) / (k - 1))
+            self.pix_per_ms_ci = t95(k - 1) * math.sqrt(var / k) / self.pulse_width
+            self.ms_per_pix_ci = self.ms_per_pix * self.pix_per_ms_ci / self.pix_per_ms
+
+        if self.accepted_cnt < MINIMUM_REQUIRED_POINTS or k < 2 or farthest < MINIMUM_SPAN:
             self.success = "failed"
             return False
         else:
@@ -147,8 +266,20 @@ class GuiderCalibration(object):
             self.success = "done"
             return True
 
+    def good_enough(self, max_angle_ci, max_rate_ci):
+        # analyzes the points so far, true if the confidence intervals are already narrow enough to stop pulsing
+        # max_angle_ci is in degrees, max_rate_ci is in percent of ms_per_pix, 0 disables this
+        if max_angle_ci <= 0 or max_rate_ci <= 0 or self.pt_cnt < EARLY_MIN_POINTS:
+            return False
+        if self.analyze():
+            if self.angle_ci <= max_angle_ci and (self.ms_per_pix_ci * 100.0) <= (self.ms_per_pix * max_rate_ci):
+                return True
+        self.has_cal = False
+        self.success = "wait"
+        return False
+
     def summary(self):
-        return len(self.accepted_points), self.farthest, self.angle, self.line_est_center, self.points[0]
+        return self.accepted_cnt, self.farthest, self.angle, self.line_est_center, [self.pt_x[0], self.pt_y[0]]
 
     def get_json_obj(self, short = False):
         obj = {}
@@ -156,19 +287,20 @@ class GuiderCalibration(object):
         obj.update({"pulse_width"  : self.pulse_width})
         if self.success == "done":
             if short == False:
-                obj.update({"points" : self.accepted_points})
-            obj.update({"points_cnt" : self.points_cnt if self.points_cnt > 0 else len(self.accepted_points)})
+                obj.update({"points" : self.get_accepted_points()})
+            obj.update({"points_cnt" : self.points_cnt if self.points_cnt > 0 else self.accepted_cnt})
         else:
             if short == False:
-                obj.update({"points" : self.points})
-            obj.update({"points_cnt" : self.points_cnt if self.points_cnt > 0 else len(self.points)})
-        #obj.update({"start_coord"    : self.points[0]})
-        obj.update({"start_x"        : self.points[0][0]})
-        obj.update({"start_y"        : self.points[0][1]})
+                obj.update({"points" : self.get_points()})
+            obj.update({"points_cnt" : self.points_cnt if self.points_cnt > 0 else self.pt_cnt})
+        obj.update({"start_x"        : self.pt_x[0]})
+        obj.update({"start_y"        : self.pt_y[0]})
         obj.update({"pix_per_ms"     : self.pix_per_ms})
         obj.update({"ms_per_pix"     : self.ms_per_pix})
         obj.update({"farthest"       : self.farthest})
         obj.update({"angle"          : self.angle})
+        obj.update({"angle_ci"       : self.angle_ci})
+        obj.update({"ms_per_pix_ci"  : self.ms_per_pix_ci})
         obj.update({"time"           : self.timestamp})
         return obj
 
@@ -177,8 +309,9 @@ class GuiderCalibration(object):
             obj = ujson.loads(obj)
         self.has_cal = True
         self.pulse_width = comutils.try_parse_setting(obj["pulse_width"])
-        self.accepted_points = []
-        self.points = [[comutils.try_parse_setting(obj["start_x"]),  comutils.try_parse_setting(obj["start_y"])]]
+        self.accepted_cnt = 0
+        self.accepted_mask = None
+        self.set_origin(comutils.try_parse_setting(obj["start_x"]), comutils.try_parse_setting(obj["start_y"]))
         self.points_cnt = comutils.try_parse_setting(obj["points_cnt"])
         pix_per_ms = comutils.try_parse_setting(obj["pix_per_ms"])
         ms_per_pix = comutils.try_parse_setting(obj["ms_per_pix"])
@@ -198,26 +331,91 @@ class GuiderCalibration(object):
         self.angle = comutils.ang_normalize(comutils.try_parse_setting(obj["angle"]))
         self.farthest = comutils.try_parse_setting(obj["farthest"])
         self.timestamp = comutils.try_parse_setting(obj["time"])
+        # calibrations saved before the confidence intervals existed don't have them
+        self.angle_ci = comutils.try_parse_setting(obj["angle_ci"]) if "angle_ci" in obj else 180.0
+        self.ms_per_pix_ci = comutils.try_parse_setting(obj["ms_per_pix_ci"]) if "ms_per_pix_ci" in obj else 0
+        self.pix_per_ms_ci = self.pix_per_ms * self.ms_per_pix_ci / self.ms_per_pix if self.has_cal else 0
+
+def add_sums(sums, x, y):
+    sums[0] += x
+    sums[1] += y
+    sums[2] += x * x
+    sums[3] += y * y
+    sums[4] += x * y
+
+def line_est_sums(cnt, sums):
+    # line_est_tls() from the running sums that add_sums() keeps
+    avg_x = sums[0] / cnt
+    avg_y = sums[1] / cnt
+    sxx = max(0, sums[2] - (sums[0] * avg_x))
+    syy = max(0, sums[3] - (sums[1] * avg_y))
+    sxy = sums[4] - (sums[0] * avg_y)
+    return line_est_scatter(cnt, avg_x, avg_y, sxx, syy, sxy)
 
-def line_est(points):
+def line_est_tls(points):
+    # total least squares, the line that minimizes the perpendicular distances, so it does not matter which way it points
+    # returns the center, the angle in degrees (between -90 and 90) and the standard error of the angle in radians (None if there are too few points)
     cnt = len(points)
-    sum_x   = 0
-    sum_y   = 0
-    sum_xx = 0
-    sum_xy  = 0
+    sum_x = 0
+    sum_y = 0
     for p in points:
-        sum_x  += p[0]
-        sum_y  += p[1]
-        sum_xx += p[0] * p[0]
-        sum_xy += p[0] * p[1]
+        sum_x += p[0]
+        sum_y += p[1]
     avg_x = sum_x / cnt
     avg_y = sum_y / cnt
-    dy = (sum_xy / cnt) - (avg_x * avg_y)
-    dx = (sum_xx / cnt) - (avg_x * avg_x)
-    #print("%u %f %f %f %f %f %f %f %f" % (cnt, sum_x, sum_y, sum_xx, sum_xy, avg_x, avg_y, dy, dx))
-    if dy == 0 and dx == 0:
-        return [avg_x, avg_y], 90
-    return [avg_x, avg_y], math.degrees(math.atan2(dy, dx))
+    sxx = 0
+    syy = 0
+    sxy = 0
+    for p in points:
+        dx = p[0] - avg_x
+        dy = p[1] - avg_y
+        sxx += dx * dx
+        syy += dy * dy
+        sxy += dx * dy
+    return line_est_scatter(cnt, avg_x, avg_y, sxx, syy, sxy)
+
+def line_est_scatter(cnt, avg_x, avg_y, sxx, syy, sxy):
+    if sxx == 0 and syy == 0:
+        return [avg_x, avg_y], 90, None
+    ang = 0.5 * math.atan2(2 * sxy, sxx - syy)
+    # the eigenvalues of the scatter matrix are the spread along the line and across it
+    half = (sxx + syy) / 2
+    disc = math.sqrt((((sxx - syy) / 2) ** 2) + (sxy * sxy))
+    along = half + disc
+    across = max(0, half - disc)
+    se = None
+    if cnt > 2 and along > 0:
+        se = math.sqrt(across / (cnt - 2)) / math.sqrt(along)
+    return [avg_x, avg_y], math.degrees(ang), se
+
+def step_consensus(step_x, step_y, n, hx, hy):
+    # the first n steps that agree with the hypothesis step, and their total error relative to the hypothesis
+    inl = []
+    err = 0
+    hm = math.sqrt((hx * hx) + (hy * hy))
+    if hm < STEP_MIN_MAG:
+        return inl, err
+    ux = hx / hm
+    uy = hy / hm
+    tol = STEP_TOLERANCE * hm
+    j = 0
+    while j < n:
+        a = (step_x[j] * ux) + (step_y[j] * uy) - hm
+        b = (step_y[j] * ux) - (step_x[j] * uy)
+        e = math.sqrt((a * a) + (b * b))
+        if e <= tol:
+            inl.append(j)
+            err += e / hm
+        j += 1
+    return inl, err
+
+def step_mean(step_x, step_y, idx):
+    sx = 0
+    sy = 0
+    for j in idx:
+        sx += step_x[j]
+        sy += step_y[j]
+    return sx / len(idx), sy / len(idx)
 
 if __name__ == "__main__":
     tests = []
@@ -232,6 +430,8 @@ if __name__ == "__main__":
     tests.append([[0,   1], [0,  20], [0,  30], [0,  40], [0,  50], [0, 60], [0, 70], [0, 80]])
     tests.append([[0,  10], [0,  20], [0,  30], [0,  40], [0,  50], [0, 60], [0, 70], [0, 80]])
     tests.append([[0,   1], [0,  20], [0,  30], [0,  40], [0,  50], [0, 60], [0, 70], [0, 71]])
+    tests.append([[0,  30], [0,  60], [0,  90], [40, 120], [0, 150], [0, 180]])
+    tests.append([[1,  30], [-1, 60], [1,  90], [-1, 120], [1, 150]])
 
     print("Guider Calibration Test")
     i = 0
@@ -240,6 +440,6 @@ if __name__ == "__main__":
         cali.append_all(tests[i])
         cali.analyze()
         cnt, farthest, angle, line_center, start_pt = cali.summary()
-        print("test [%u]: %u , %f , %f , ( %f , %f ) , ( %f , %f ), %f , %f" % (i, cnt, farthest, angle, line_center[0], line_center[1], start_pt[0], start_pt[1], cali.pix_per_ms, cali.ms_per_pix))
+        print("test [%u]: %s %u , %f , %f , ( %f , %f ) , ( %f , %f ), %f , %f , +/- %f deg , +/- %f ms/pix" % (i, cali.success, cnt, farthest, angle, line_center[0], line_center[1], start_pt[0], start_pt[1], cali.pix_per_ms, cali.ms_per_pix, cali.angle_ci, cali.ms_per_pix_ci))
         i += 1
 
@@ -0,0 +1,214 @@
+import micropython
+micropython.opt_level(2)
+
+import ustruct, ujson
+
+# binary framing for the autoguider's state packets
+# the JSON state has to be built as one big string every frame, this is a lot smaller, and the star list can be sent in pieces
+#
+# a packet starts with PKT_HEAD_FMT: packet type, protocol version, sequence number, base sequence number, field count
+# then every field is: field ID (byte), field type (byte), the value
+# the base is the packet that the client last acknowledged, only fields that changed since then are included
+# a base of BASE_NONE means that the packet holds the full state
+# the star list, if it is included, is always the last field, its records follow the rest of the packet
+#
+# the decoder is decodeStatePacket() in web/autoguider_utils.js, the two must be kept in sync
+
+PKT_STATE    = micropython.const(1)
+PROTO_VER    = micropython.const(1)
+BASE_NONE    = micropython.const(0xFFFF)
+PKT_HEAD_FMT = "<BBHHH"
+
+FTYPE_NONE   = micropython.const(0)
+FTYPE_FALSE  = micropython.const(1)
+FTYPE_TRUE   = micropython.const(2)
+FTYPE_INT    = micropython.const(3) # int32
+FTYPE_FLOAT  = micropython.const(4) # float32
+FTYPE_STR    = micropython.const(5) # uint16 length, UTF-8
+FTYPE_JSON   = micropython.const(6) # uint16 length, JSON text, for anything that doesn't fit the other types
+FTYPE_NUMS   = micropython.const(7) # uint8 count, float32 each
+FTYPE_STARS  = micropython.const(8) # uint16 count, STAR_FMT each
+FTYPE_DEL    = micropython.const(9) # the field is no longer in the state
+
+STAR_FMT     = "<HHHBB" # center in 1/STAR_SCALE pixels, radius, max brightness, rating
+STAR_LEN     = micropython.const(8)
+STAR_SCALE   = 16.0
+STAR_CHUNK   = micropython.const(32) # stars are packed and sent this many at a time
+PENDING_MAX  = micropython.const(4)  # packets that are remembered while waiting for the client to acknowledge them
+
+# the index in this list is the field ID
+FIELD_NAMES = ["time", "session_rand_id", "ws_rand_id", "guide_state", "interval_state", "blub_remaining", "dither_interval", "expo_code",
+               "img", "img_mean", "img_stdev", "img_max", "img_min",
+               "stars", "sel_star", "sel_star_profile", "tgt_coord", "ori_coord", "last_move_err", "multistar_cnt",
+               "calib_ra", "calib_dec", "hotpix", "hotpix_used", "hotpix_cnt", "hotpix_last", "hw_err", "analysis_dur", "stage_dur"]
+FIELD_STARS = micropython.const(13)
+FIELD_EXTRA = micropython.const(63) # JSON object holding every key that is not in FIELD_NAMES
+
+# the "logs" object is flattened, key k of log slot i is field ID LOG_FIELD_BASE + (i * len(LOG_KEYS)) + k
+LOG_KEYS = ["msg_tick", "msg_time", "msg_str", "pulse_time", "pulse_ra", "pulse_dec", "pulse_sum", "pulse_shutter"]
+LOG_FIELD_BASE = micropython.const(64)
+LOG_SLOTS      = micropython.const(8)
+
+FIELD_IDS = {}
+LOG_IDS = {}
+
+def build_ids():
+    i = 0
+    while i < len(FIELD_NAMES):
+        FIELD_IDS.update({FIELD_NAMES[i]: i})
+        i += 1
+    i = 0
+    while i < LOG_SLOTS:
+        k = 0
+        while k < len(LOG_KEYS):
+            LOG_IDS.update({"%s_%u" % (LOG_KEYS[k], i): LOG_FIELD_BASE + (i * len(LOG_KEYS)) + k})
+            k += 1
+        i += 1
+
+build_ids()
+
+def encode_str(ftype, s):
+    b = s.encode("utf-8")
+    if len(b) > 0xFFFF:
+        raise ValueError("string too long for state packet")
+    return ustruct.pack("<BH", ftype, len(b)) + b
+
+def encode_value(v):
+    # returns the field type and value as bytes
+    if v is None:
+        return bytes([FTYPE_NONE])
+    if v is False:
+        return bytes([FTYPE_FALSE])
+    if v is True:
+        return bytes([FTYPE_TRUE])
+    t = type(v)
+    if t == int and v >= -0x80000000 and v <= 0x7FFFFFFF:
+        return ustruct.pack("<Bi", FTYPE_INT, v)
+    if t == float:
+        return ustruct.pack("<Bf", FTYPE_FLOAT, v)
+    if t == str:
+        return encode_str(FTYPE_STR, v)
+    if (t == list or t == tuple) and len(v) <= 0xFF:
+        # short lists of numbers, like coordinates and timing, anything a float32 can hold exactly
+        is_nums = True
+        for i in v:
+            ti = type(i)
+            if i is True or i is False or (ti != int and ti != float) or (ti == int and (i > 0xFFFFFF or i < -0xFFFFFF)):
+                is_nums = False
+                break
+        if is_nums:
+            return ustruct.pack("<BB%uf" % len(v), FTYPE_NUMS, len(v), *v)
+    return encode_str(FTYPE_JSON, ujson.dumps(v))
+
+def clamp(x, hi):
+    if x < 0:
+        return 0
+    if x > hi:
+        return hi
+    return x
+
+class StateEncoder(object):
+
+    def __init__(self):
+        self.buf = bytearray(STAR_LEN * STAR_CHUNK)
+        self.reset()
+
+    def reset(self):
+        self.seq = 0
+        self.acked = None   # [seq, fields] of the packet that the client has confirmed
+        self.pending = []   # [seq, fields] of packets that are sent but not confirmed yet
+
+    def ack(self, seq):
+        # the client confirms that it has decoded the packet, later packets are sent as differences against it
+        # a negative number means that the client has lost track, the next packet will be the full state
+        if seq < 0:
+            self.acked = None
+            self.pending = []
+            return True
+        i = 0
+        while i < len(self.pending):
+            if self.pending[i][0] == seq:
+                self.acked = self.pending[i]
+                self.pending = self.pending[i + 1:]
+                return True
+            i += 1
+        return False
+
+    def encode(self, state, stars = None, stars_serial = 0):
+        # state is the object from AutoGuider.get_state_obj(), without the star list
+        # stars_serial must change whenever the star list changes, so the records are only sent when needed
+        # returns the packet, and the star list if its records must be sent right after it with write_stars()
+        fields = {}
+        extra = None
+        for k in state.keys():
+            v = state[k]
+            if k == "logs":
+                for lk in v.keys():
+                    fid = LOG_IDS.get(lk, -1)
+                    if fid >= 0:
+                        fields.update({fid: encode_value(v[lk])})
+                continue
+            fid = FIELD_IDS.get(k, -1)
+            if fid < 0:
+                if k == "pkt_type":
+                    continue
+                if extra is None:
+                    extra = {}
+                extra.update({k: v})
+                continue
+            fields.update({fid: encode_value(v)})
+        if extra is not None:
+            fields.update({FIELD_EXTRA: encode_str(FTYPE_JSON, ujson.dumps(extra))})
+        if stars is None:
+            fields.update({FIELD_STARS: bytes([FTYPE_NONE])})
+        else:
+            # not the actual records, only used to tell if the list changed
+            fields.update({FIELD_STARS: ustruct.pack("<BI", FTYPE_STARS, stars_serial & 0xFFFFFFFF)})
+
+        base = self.acked
+        parts = []
+        send_stars = False
+        for fid in fields.keys():
+            x = fields[fid]
+            if base is not None and base[1].get(fid, None) == x:
+                continue
+            if fid == FIELD_STARS and stars is not None:
+                send_stars = True
+                continue
+            parts.append(bytes([fid]) + x)
+        if base is not None:
+            for fid in base[1].keys():
+                if fid not in fields:
+                    parts.append(bytes([fid, FTYPE_DEL]))
+        if send_stars:
+            parts.append(ustruct.pack("<BBH", FIELD_STARS, FTYPE_STARS, len(stars)))
+
+        self.seq = (self.seq + 1) % BASE_NONE
+        head = ustruct.pack(PKT_HEAD_FMT, PKT_STATE, PROTO_VER, self.seq, base[0] if base is not None else BASE_NONE, len(parts))
+        self.pending.append([self.seq, fields])
+        if len(self.pending) > PENDING_MAX:
+            self.pending.pop(0)
+        return head + b"".join(parts), (stars if send_stars else None)
+
+    def write_stars(self, sock, stars):
+        # packs the records into a small reused buffer, so a long star list never needs one big allocation
+        buf = self.buf
+        j = 0
+        for s in stars:
+            ustruct.pack_into(STAR_FMT, buf, j * STAR_LEN,
+                clamp(int(round(s.cxf() * STAR_SCALE)), 0xFFFF),
+                clamp(int(round(s.cyf() * STAR_SCALE)), 0xFFFF),
+                clamp(int(s.r()), 0xFFFF),
+                clamp(int(s.max_brightness()), 0xFF),
+                clamp(int(s.star_rating()), 0xFF))
+            j += 1
+            if j >= STAR_CHUNK:
+                sock.send(buf)
+                j = 0
+        if j > 0:
+            sock.send(memoryview(buf)[0:j * STAR_LEN])
+
+def packet_len(head, stars):
+    if stars is None:
+        return len(head)
+    return len(head) + (len(stars) * STAR_LEN)
@@ -37,6 +37,7 @@ class PolarScope(object):
         self.tick_all    = t
         self.dur_all     = -1
         self.solu_dur    = -1
+        self.track_cnt   = 0
         self.snap_millis = 0
 
         self.settings = {}
@@ -51,11 +52,23 @@ class PolarScope(object):
         self.settings.update({"use_refraction": False})
         self.settings.update({"force_solve": False})
         self.settings.update({"max_stars":   0})
+        self.settings.update({"tracking":    True})
+        self.settings.update({"hash_stars":  pole_finder.HASH_STARS}) # brightest blobs looked up in the hash, 0 for all
+        self.settings.update({"search_limit": 3})                     # Polaris candidates that are fully matched
+        self.settings.update({"net_async":   False})
         self.load_settings()
         self.time_mgr.readiness = False
         exclogger.log_exception("Time Guessed (%u)" % pyb.millis(), time_str=comutils.fmt_time(self.time_mgr.get_time()))
 
-        self.portal = captive_portal.CaptivePortal(debug = self.debug)
+        self.portal = None
+        if self.settings["net_async"]:
+            try:
+                import captive_portal_async
+                self.portal = captive_portal_async.AsyncCaptivePortal(debug = self.debug)
+            except ImportError as exc:
+                exclogger.log_exception(exc)
+        if self.portal is None:
+            self.portal = captive_portal.CaptivePortal(debug = self.debug)
 
         self.img = None
         self.img_compressed = None
@@ -208,6 +221,7 @@ class PolarScope(object):
             state.update({"diag_cnt":        self.diag_cnt})
             state.update({"diag_dur_all":    self.dur_all})
             state.update({"diag_dur_sol":    self.solu_dur})
+            state.update({"diag_track_cnt":  self.track_cnt})
             state.update({"diag_mem_alloc":  gc.mem_alloc()})
             state.update({"diag_mem_free":   gc.mem_free()})
         if self.img_stats is not None:
@@ -565,8 +579,16 @@ class PolarScope(object):
     def solve_full(self):
         prev_sol = self.stable_solution()
         if self.expo_code == star_finder.EXPO_JUST_RIGHT:
-            self.solution = pole_finder.PoleSolution(self.stars, hot_pixels = self.hot_pixels)
-            if self.solution.solve(self.time_mgr.get_polaris()):
+            self.solution = pole_finder.PoleSolution(self.stars, hot_pixels = self.hot_pixels, search_limit = self.settings["search_limit"], hash_stars = self.settings["hash_stars"])
+            solved = False
+            if prev_sol is not None and self.settings["tracking"]:
+                # the field barely moves between frames, start from the previous solution
+                solved = self.solution.track(prev_sol, self.time_mgr.get_polaris())
+                if solved:
+                    self.track_cnt += 1
+            if solved == False:
+                solved = self.solution.solve(self.time_mgr.get_polaris())
+            if solved:
                 self.solu_dur = pyb.elapsed_millis(self.t) # debug solution speed
                 self.solution.accel_sec = self.accel_sec
                 self.solution.get_pole_coords() # this caches x and y
@@ -47,14 +47,41 @@ DIST_TOL = micropython.const(0.1)     # percentage
 SCORE_REQUIRED = micropython.const(4) # must have this many stars that match their estimated coordinates
 ENABLE_PENALTY = micropython.const(True)
 
+# geometric hash of the table above, every pair of stars as seen from Polaris is described by
+# the ratio of their distances and the angle between them, which do not change with rotation or scale
+HASH_STARS     = micropython.const(12)   # default for how many of the brightest blobs are used to look up the hash, 0 for all of them
+HASH_RATIO_TOL = micropython.const(0.03)
+HASH_ANGLE_TOL = micropython.const(2.0)  # degrees
+HASH_MIN_DIST  = micropython.const(40)   # pixels, pairs too close to Polaris have imprecise angles
+HASH_SCALE_MIN = micropython.const(0.5)
+HASH_SCALE_MAX = micropython.const(2.0)
+HASH_ROT_BIN   = micropython.const(10)   # degrees, votes for a rotation are grouped this coarsely
+HASH_SCALE_BIN = micropython.const(0.05) # votes for a scale are grouped by this ratio
+hash_index = None
+
+# lookups used by the penalty pass
+PENALTY_ANG_BIN = micropython.const(2.0) # degrees, must be at least twice the angle_match tolerance
+HOT_PIXEL_DIST  = micropython.const(2.0) # pixels, a blob this close to a hot pixel is the hot pixel
+HOT_PIXEL_CELL  = micropython.const(4)   # pixels, size of each cell of the hot pixel grid
+penalty_index = None
+
+# tracking a previous solution, instead of solving from scratch
+TRACK_POLARIS_WIN  = micropython.const(100) # pixels, how far Polaris may move between frames
+TRACK_MATCH_WIN    = micropython.const(8)   # pixels, how far a star may be from its predicted position
+TRACK_RESIDUAL_MAX = micropython.const(3.0) # pixels, average error of the fit, above this a full search is required
+
 class PoleSolution(object):
-    def __init__(self, star_list, hot_pixels = [], search_limit = 3, debug = False):
+    def __init__(self, star_list, hot_pixels = [], search_limit = 3, debug = False, hash_stars = HASH_STARS):
         self.solved = False
         self.star_list = star_list
         self.search_limit = search_limit
+        # every pair of these blobs is looked up from each of them, so the work grows with the cube of this number
+        self.hash_stars = hash_stars
         self.hot_pixels = hot_pixels
         self.accel_sec = 0
         self.debug = debug
+        self.tracked = False
+        self.residual = 0
 
     def solve(self, polaris_ra_dec = (2.960856, 89.349278)):
 
@@ -70,158 +97,37 @@ class PoleSolution(object):
         if len(self.star_list) < SCORE_REQUIRED:
             return False # impossible to have a solution if not enough stars
 
+        # built once here instead of searching the whole hot pixel list for every blob of every candidate
+        self.hot_grid = build_hot_pixel_grid(self.hot_pixels)
+
         # Polaris is the brightest object in the potential field of view, so it's faster to start with it
         brite_sorted = blobstar.sort_brightness(self.star_list)
-        # limit the search for the first few possibilities
-        if len(brite_sorted) > self.search_limit:
-            brite_sorted = brite_sorted[0:self.search_limit]
 
-        # iterate through all posibilities, brightest first
+        # the geometric hash suggests which blobs could be Polaris, along with the rotation and scale
+        # the brightest blobs fill the remaining slots, same as before the hash existed
+        candidates = self.find_candidates(brite_sorted)
         for i in brite_sorted:
-            # we are guessing "i" is Polaris for this iteration
-            i.score_list = []
-            i.score = 0
-            i.penalty = 0
-            i.rotation = 0
-            i.rot_angi_sum = 0
-            i.rot_angj_sum = 0
-            i.rot_dist_sum = 0
-            i.pix_calibration = []
-            i.lam_umi = None
-            ang_tol = 4
-
-            for j in self.star_list:
-                j.set_ref_star(i) # this is required for all entries in the list, so that sort_dist can work
-                # set_ref_star also computes the vector to the ref star and caches the result
-            dist_sorted = blobstar.sort_dist(self.star_list) # sorted closest-to-Polaris first
-
-            if self.debug:
-                print("center star (%.1f , %.1f)" % (i.cx, i.cy))
-                dbgi = 0
-                for dbg in dist_sorted:
-                    print("[%u]: (%.1f , %.1f) -> (%.1f , %.1f)" % (dbgi, dbg.cx, dbg.cy, dbg.ref_star_dist, dbg.ref_star_angle))
-                    dbgi += 1
-
-            rot_ang = None # without a known reference angle, use the first angle we encounter to establish a reference angle
-            # rot_ang is set after the match is made
-
-            # these are used for the penalizing later
-            max_dist = 0
-            min_brite = -1
-
-            idx_tbl = 0
-            idx_blobs_start = 1 # start at [1] because [0] is supposed to be Polaris
-            len_tbl = len(STARS_NEAR_POLARIS)
-            len_blobs = len(dist_sorted)
-            while idx_tbl < len_tbl:
-
-                # skip stars that might have too similar of a vector distance if the reference angle is not established yet
-                # it is unlikely that this logic is actually useful in real life
-                if rot_ang is None and idx_tbl >= 1:
-                    if abs(STARS_NEAR_POLARIS[idx_tbl][1] - STARS_NEAR_POLARIS[idx_tbl - 1][1]) <= 2:
-                        idx_tbl += 1
-                        continue
-
-                idx_blobs = idx_blobs_start # previous blobs (closer-to-Polaris) will be ignored
-                while idx_blobs < len_blobs:
-                    k = dist_sorted[idx_blobs]
-                    match = False
-                    if dist_match(k.ref_star_dist, STARS_NEAR_POLARIS[idx_tbl][1]):
-
-                        if self.debug:
-                            print("dist matched [%s , %u] %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][1], k.ref_star_dist, abs(k.ref_star_dist - STARS_NEAR_POLARIS[idx_tbl][1])))
-
-                        if rot_ang is None:
-                            # without a known reference angle, use the first angle we encounter to establish a reference angle
-                            # rot_ang is set after the match is made
-                            match = True
-                            if self.debug:
-                                print("first angle match [%s , %u] %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][2], k.ref_star_angle, angle_diff(k.ref_star_angle, STARS_NEAR_POLARIS[idx_tbl][2])))
-                        else:
-                            adj_ang = ang_normalize(STARS_NEAR_POLARIS[idx_tbl][2] + rot_ang)
-                            if angle_match(k.ref_star_angle, adj_ang, tol = ang_tol):
-                                match = True
-                                if ang_tol > 1:
-                                    ang_tol -= 1
-                                if self.debug:
-                                    print("angle matched ", end="")
-                            else:
-                                if self.debug:
-                                    print("angle match failed ", end="")
-                            if self.debug:
-                                print("[%s , %u] %.1f %.1f %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][2], k.ref_star_angle, angle_diff(k.ref_star_angle, adj_ang), rot_ang, adj_ang))
-                    if match:
-                        # each match is a further star, which means more precise angle
-                        # compute (and update) the weighted average of the angle offset
-                        rot_ang = angle_diff(k.ref_star_angle, STARS_NEAR_POLARIS[idx_tbl][2])
-                        unitvector = [math.cos(math.radians(rot_ang)), math.sin(math.radians(rot_ang))]
-                        i.rot_angi_sum += unitvector[0] * k.ref_star_dist
-                        i.rot_angj_sum += unitvector[1] * k.ref_star_dist
-                        i.rot_dist_sum += k.ref_star_dist
-                        rot_ang = math.degrees(math.atan2(i.rot_angj_sum / i.rot_dist_sum, i.rot_angi_sum / i.rot_dist_sum))
-                        i.rotation = rot_ang
-
-                        if STARS_NEAR_POLARIS[idx_tbl][0] == "* lam UMi":
-                            i.lam_umi = k
-
-                        if k.ref_star_dist > max_dist:
-                            max_dist = k.ref_star_dist # establishes maximum matching area
-                        if k.brightness < min_brite or min_brite < 0:
-                            min_brite = k.brightness # establishes minimum matching brightness
-
-                        # measured vs supposed distances may be different, track the differences
-                        # this will account for distortion and focus-breathing
-                        i.pix_calibration.append(k.ref_star_dist / STARS_NEAR_POLARIS[idx_tbl][1])
-
-                        # all previous (closer-to-Polaris) entries to be ignored on the next loop
-                        idx_blobs_start = idx_blobs # doing this will prevent potential out-of-order matches
-
-                        #i.score_list.append(STARS_NEAR_POLARIS[idx_tbl][0]) # save the name to the list of matches (score)
-                        i.score_list.append(k)
-
-                        if self.debug:
-                            print("score %u , new rotation %.1f" % (len(i.score_list), rot_ang))
-
-                    idx_blobs += 1
-                idx_tbl += 1
-
-            # penalty function is optional
-            if ENABLE_PENALTY:
-                # go through all blobs again to see if we should penalize for mystery stars
-                # if a star is brighter than some of the stars we've been able to match against
-                # then it's a mystery star, and makes the solution less confident
-                idx_blobs = 1
-                while idx_blobs < len_blobs:
-                    k = dist_sorted[idx_blobs]
-                    if k.ref_star_dist < max_dist and k.brightness > min_brite:
-                        # within the area and also brighter than expected
-                        # does it match an entry in the table? (some of the table entries were ignored previously, so we have to do the whole check again)
-                        in_database = False
-                        idx_tbl = 0
-                        len_tbl = len(STARS_NEAR_POLARIS)
-                        while idx_tbl < len_tbl:
-                            if dist_match(k.ref_star_dist, STARS_NEAR_POLARIS[idx_tbl][1]) and angle_match(k.ref_star_angle, ang_normalize(STARS_NEAR_POLARIS[idx_tbl][2] + rot_ang)):
-                                in_database = True
-                                break
-                            idx_tbl += 1
-
-                        if in_database == False:
-                            is_hot = False
-                            # check if it's a hot pixel
-                            for hp in self.hot_pixels:
-                                d = math.sqrt(((k.cx - hp[0]) ** 2) + ((k.cy - hp[1]) ** 2))
-                                if d < 2.0:
-                                    is_hot = True
-                                    break
-                            if is_hot == False:
-                                i.penalty += 1
-                                if self.debug:
-                                    print("penalty (%.1f , %.1f)" % (k.cx, k.cy))
-                    idx_blobs += 1
-                # calculate score accounting for penalty
-                i.score = len(i.score_list) - i.penalty
-
-        # end of the for loop that goes from brightest to dimmest
+            if len(candidates) >= self.search_limit:
+                break
+            dup = False
+            for c in candidates:
+                if c[0] is i:
+                    dup = True
+                    break
+            if dup == False:
+                candidates.append([i, None, 1.0, 0])
+
+        brite_sorted = []
+        # iterate through all posibilities, most likely first
+        for cand in candidates:
+            i = cand[0]
+            self.match_candidate(i, cand[1], cand[2], cand[3])
+            if i.score < SCORE_REQUIRED and cand[1] is not None:
+                # the guess from the hash might be wrong, try again without it
+                self.match_candidate(i)
+            brite_sorted.append(i)
+
+        # end of the for loop that goes from most likely to least likely
         # each entry of that list will now have a "score" (number of matches)
         # find the one that has the most matches
         score_sorted = sorted(brite_sorted, key = sort_score_func, reverse = True)
@@ -244,6 +150,328 @@ class PoleSolution(object):
         self.pix_per_deg = PIXELS_PER_DEGREE * dist_calibration
         return True
 
+    def track(self, prev_sol, polaris_ra_dec = (2.960856, 89.349278)):
+        # uses the previous solution to predict where Polaris and the stars near it should be
+        # only the blobs close to those predictions are considered
+        # returns False if the prediction does not fit well, a full solve() is then required
+        # the star list is left intact so that solve() can be called on the same object afterwards
+        if prev_sol is None or prev_sol.solved == False:
+            return False
+        if len(self.star_list) < SCORE_REQUIRED:
+            return False
+
+        # Polaris is the brightest blob near where it used to be
+        px = prev_sol.Polaris.cx
+        py = prev_sol.Polaris.cy
+        p = None
+        for j in self.star_list:
+            if abs(j.cx - px) <= TRACK_POLARIS_WIN and abs(j.cy - py) <= TRACK_POLARIS_WIN:
+                if p is None or blobstar.sort_brightness_func(j) > blobstar.sort_brightness_func(p):
+                    p = j
+        if p is None:
+            return False
+
+        rot_ang = ang_normalize(prev_sol.get_rotation() - 180.0) # undo the flip that solve() does
+        scale = prev_sol.pix_per_deg / PIXELS_PER_DEGREE
+        p.score_list = []
+        p.score = 0
+        p.penalty = 0
+        p.rotation = rot_ang
+        p.rot_angi_sum = 0
+        p.rot_angj_sum = 0
+        p.rot_dist_sum = 0
+        p.pix_calibration = []
+        p.lam_umi = None
+        matched_tbl = []
+
+        # closest stars first, every match refines the rotation and scale for the further stars
+        for tbl in STARS_NEAR_POLARIS:
+            d = tbl[1] * scale
+            a = math.radians(tbl[2] + rot_ang)
+            ex = p.cx - (d * math.cos(a))
+            ey = p.cy - (d * math.sin(a))
+            best = None
+            best_err = TRACK_MATCH_WIN
+            for k in self.star_list:
+                if k is p:
+                    continue
+                dx = abs(k.cx - ex)
+                dy = abs(k.cy - ey)
+                if dx > TRACK_MATCH_WIN or dy > TRACK_MATCH_WIN:
+                    continue
+                err = math.sqrt((dx * dx) + (dy * dy))
+                if err <= best_err:
+                    best = k
+                    best_err = err
+            if best is None:
+                continue
+            best.set_ref_star(p)
+            ang = angle_diff(best.ref_star_angle, tbl[2])
+            p.rot_angi_sum += math.cos(math.radians(ang)) * best.ref_star_dist
+            p.rot_angj_sum += math.sin(math.radians(ang)) * best.ref_star_dist
+            p.rot_dist_sum += best.ref_star_dist
+            rot_ang = math.degrees(math.atan2(p.rot_angj_sum / p.rot_dist_sum, p.rot_angi_sum / p.rot_dist_sum))
+            p.pix_calibration.append(best.ref_star_dist / tbl[1])
+            scale = sum(p.pix_calibration) / len(p.pix_calibration)
+            p.score_list.append(best)
+            matched_tbl.append(tbl)
+            if tbl[0] == "* lam UMi":
+                p.lam_umi = best
+
+        if len(p.score_list) < SCORE_REQUIRED:
+            if self.debug:
+                print("tracking lost, only %u matches" % len(p.score_list))
+            return False
+
+        # how well does the final rotation and scale fit all of the matched stars
+        residual = 0
+        idx = 0
+        while idx < len(matched_tbl):
+            k = p.score_list[idx]
+            d = matched_tbl[idx][1] * scale
+            a = math.radians(matched_tbl[idx][2] + rot_ang)
+            residual += math.sqrt(((k.cx - (p.cx - (d * math.cos(a)))) ** 2) + ((k.cy - (p.cy - (d * math.sin(a)))) ** 2))
+            idx += 1
+        residual /= len(matched_tbl)
+        self.residual = residual
+        if residual > TRACK_RESIDUAL_MAX:
+            if self.debug:
+                print("tracking residual too high %.1f" % residual)
+            return False
+
+        # tracking does not look for mystery stars, the full solve does that when it is needed
+        p.rotation = rot_ang
+        p.score = len(p.score_list)
+        self.polaris_ra_dec = polaris_ra_dec
+        self.x = None
+        self.y = None
+        self.solu_time = int(round(pyb.millis() // 1000))
+        self.star_list = None # garbage collect
+        self.solved = True
+        self.tracked = True
+        self.Polaris = p
+        self.rotation = ang_normalize(rot_ang + 180.0) # everything needs to be flipped
+        self.stars_matched = p.score_list
+        self.penalty = 0
+        self.lam_umi = p.lam_umi
+        self.pix_per_deg = PIXELS_PER_DEGREE * scale
+        return True
+
+    def match_candidate(self, i, rot_ang = None, scale = 1.0, votes = 0):
+        # we are guessing "i" is Polaris, rot_ang and scale are guesses from the hash if available
+        i.score_list = []
+        i.score = 0
+        i.penalty = 0
+        i.rotation = 0
+        i.rot_angi_sum = 0
+        i.rot_angj_sum = 0
+        i.rot_dist_sum = 0
+        i.pix_calibration = []
+        i.lam_umi = None
+        ang_tol = 4
+
+        for j in self.star_list:
+            j.set_ref_star(i) # this is required for all entries in the list, so that sort_dist can work
+            # set_ref_star also computes the vector to the ref star and caches the result
+        dist_sorted = blobstar.sort_dist(self.star_list) # sorted closest-to-Polaris first
+
+        if self.debug:
+            print("center star (%.1f , %.1f) votes %u" % (i.cx, i.cy, votes))
+            dbgi = 0
+            for dbg in dist_sorted:
+                print("[%u]: (%.1f , %.1f) -> (%.1f , %.1f)" % (dbgi, dbg.cx, dbg.cy, dbg.ref_star_dist, dbg.ref_star_angle))
+                dbgi += 1
+
+        # if the hash did not provide rot_ang, use the first angle we encounter to establish a reference angle
+        # rot_ang is set after the match is made
+
+        # these are used for the penalizing later
+        max_dist = 0
+        min_brite = -1
+
+        idx_tbl = 0
+        idx_blobs_start = 1 # start at [1] because [0] is supposed to be Polaris
+        len_tbl = len(STARS_NEAR_POLARIS)
+        while idx_tbl < len_tbl:
+
+            # skip stars that might have too similar of a vector distance if the reference angle is not established yet
+            # it is unlikely that this logic is actually useful in real life
+            if rot_ang is None and idx_tbl >= 1:
+                if abs(STARS_NEAR_POLARIS[idx_tbl][1] - STARS_NEAR_POLARIS[idx_tbl - 1][1]) <= 2:
+                    idx_tbl += 1
+                    continue
+
+            tbl_dist = STARS_NEAR_POLARIS[idx_tbl][1] * scale
+            # only the blobs within the distance tolerance need to be checked, find them with a binary search
+            idx_blobs = bisect_dist(dist_sorted, (tbl_dist / (1.0 + DIST_TOL)) - 1.0)
+            if idx_blobs < idx_blobs_start:
+                idx_blobs = idx_blobs_start # previous blobs (closer-to-Polaris) will be ignored
+            idx_blobs_end = bisect_dist(dist_sorted, (tbl_dist / (1.0 - DIST_TOL)) + 1.0)
+            while idx_blobs < idx_blobs_end:
+                k = dist_sorted[idx_blobs]
+                match = False
+                if dist_match(k.ref_star_dist, tbl_dist):
+
+                    if self.debug:
+                        print("dist matched [%s , %u] %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, tbl_dist, k.ref_star_dist, abs(k.ref_star_dist - tbl_dist)))
+
+                    if rot_ang is None:
+                        # without a known reference angle, use the first angle we encounter to establish a reference angle
+                        # rot_ang is set after the match is made
+                        match = True
+                        if self.debug:
+                            print("first angle match [%s , %u] %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][2], k.ref_star_angle, angle_diff(k.ref_star_angle, STARS_NEAR_POLARIS[idx_tbl][2])))
+                    else:
+                        adj_ang = ang_normalize(STARS_NEAR_POLARIS[idx_tbl][2] + rot_ang)
+                        if angle_match(k.ref_star_angle, adj_ang, tol = ang_tol):
+                            match = True
+                            if ang_tol > 1:
+                                ang_tol -= 1
+                            if self.debug:
+                                print("angle matched ", end="")
+                        else:
+                            if self.debug:
+                                print("angle match failed ", end="")
+                        if self.debug:
+                            print("[%s , %u] %.1f %.1f %.1f %.1f %.1f" % (STARS_NEAR_POLARIS[idx_tbl][0], idx_blobs, STARS_NEAR_POLARIS[idx_tbl][2], k.ref_star_angle, angle_diff(k.ref_star_angle, adj_ang), rot_ang, adj_ang))
+                if match:
+                    # each match is a further star, which means more precise angle
+                    # compute (and update) the weighted average of the angle offset
+                    rot_ang = angle_diff(k.ref_star_angle, STARS_NEAR_POLARIS[idx_tbl][2])
+                    unitvector = [math.cos(math.radians(rot_ang)), math.sin(math.radians(rot_ang))]
+                    i.rot_angi_sum += unitvector[0] * k.ref_star_dist
+                    i.rot_angj_sum += unitvector[1] * k.ref_star_dist
+                    i.rot_dist_sum += k.ref_star_dist
+                    rot_ang = math.degrees(math.atan2(i.rot_angj_sum / i.rot_dist_sum, i.rot_angi_sum / i.rot_dist_sum))
+                    i.rotation = rot_ang
+
+                    if STARS_NEAR_POLARIS[idx_tbl][0] == "* lam UMi":
+                        i.lam_umi = k
+
+                    if k.ref_star_dist > max_dist:
+                        max_dist = k.ref_star_dist # establishes maximum matching area
+                    if k.brightness < min_brite or min_brite < 0:
+                        min_brite = k.brightness # establishes minimum matching brightness
+
+                    # measured vs supposed distances may be different, track the differences
+                    # this will account for distortion and focus-breathing
+                    i.pix_calibration.append(k.ref_star_dist / STARS_NEAR_POLARIS[idx_tbl][1])
+
+                    # all previous (closer-to-Polaris) entries to be ignored on the next loop
+                    idx_blobs_start = idx_blobs # doing this will prevent potential out-of-order matches
+
+                    #i.score_list.append(STARS_NEAR_POLARIS[idx_tbl][0]) # save the name to the list of matches (score)
+                    i.score_list.append(k)
+
+                    if self.debug:
+                        print("score %u , new rotation %.1f" % (len(i.score_list), rot_ang))
+
+                idx_blobs += 1
+            idx_tbl += 1
+
+        # penalty function is optional
+        if ENABLE_PENALTY:
+            # go through all blobs again to see if we should penalize for mystery stars
+            # if a star is brighter than some of the stars we've been able to match against
+            # then it's a mystery star, and makes the solution less confident
+            # only blobs closer than max_dist are considered, the list is sorted so the rest can be skipped
+            idx_blobs = 1
+            idx_blobs_end = bisect_dist(dist_sorted, max_dist)
+            while idx_blobs < idx_blobs_end:
+                k = dist_sorted[idx_blobs]
+                if k.ref_star_dist < max_dist and k.brightness > min_brite:
+                    # within the area and also brighter than expected
+                    # does it match an entry in the table? (some of the table entries were ignored previously, so we have to do the whole check again)
+                    if in_database(k, rot_ang, scale) == False:
+                        # check if it's a hot pixel
+                        if is_hot_pixel(self.hot_grid, k.cx, k.cy) == False:
+                            i.penalty += 1
+                            if self.debug:
+                                print("penalty (%.1f , %.1f)" % (k.cx, k.cy))
+                idx_blobs += 1
+            # calculate score accounting for penalty
+            i.score = len(i.score_list) - i.penalty
+
+    def find_candidates(self, brite_sorted):
+        # every pair of bright blobs seen from a potential Polaris is looked up in the hash
+        # each hit is a vote for that blob being Polaris, at a particular rotation and scale
+        # returns a list of [star, rotation, scale, votes], most votes first, at most one entry per star
+        global hash_index
+        if hash_index is None:
+            hash_index = build_hash_index()
+        bright = brite_sorted
+        if self.hash_stars > 0:
+            bright = brite_sorted[0:self.hash_stars]
+        rot_bins = 360 // HASH_ROT_BIN
+        scale_bins = int(math.ceil(math.log(HASH_SCALE_MAX / HASH_SCALE_MIN) / math.log(1.0 + HASH_SCALE_BIN)))
+        votes = {}
+        pi = 0
+        for p in bright:
+            vecs = []
+            for j in bright:
+                if j is p:
+                    continue
+                mag, ang = comutils.vector_between([j.cx, j.cy], [p.cx, p.cy])
+                if mag >= HASH_MIN_DIST:
+                    vecs.append((mag, ang))
+            vecs.sort() # closest first, same as the table
+            ja = 0
+            while ja < len(vecs):
+                da, aa = vecs[ja]
+                jb = ja + 1
+                while jb < len(vecs):
+                    db, ab = vecs[jb]
+                    hits = hash_index.get(hash_key(da / db, ang_normalize(ab - aa)))
+                    if hits is not None:
+                        for h in hits:
+                            scale = db / STARS_NEAR_POLARIS[h[1]][1]
+                            if scale < HASH_SCALE_MIN or scale >= HASH_SCALE_MAX:
+                                continue
+                            rot = angle_diff(aa, STARS_NEAR_POLARIS[h[0]][2])
+                            rb = int(math.floor((rot + 180.0) / HASH_ROT_BIN)) % rot_bins
+                            sb = int(math.log(scale / HASH_SCALE_MIN) / math.log(1.0 + HASH_SCALE_BIN))
+                            key = (((pi * rot_bins) + rb) * scale_bins) + sb
+                            v = votes.get(key)
+                            if v is None:
+                                v = [0, 0.0, 0.0, 0.0, pi, rb, sb]
+                                votes[key] = v
+                            v[0] += 1
+                            v[1] += math.cos(math.radians(rot))
+                            v[2] += math.sin(math.radians(rot))
+                            v[3] += scale
+                    jb += 1
+                ja += 1
+            pi += 1
+
+        # the true rotation and scale may straddle two bins, so neighbouring bins are counted too
+        ranked = []
+        for key in votes:
+            v = votes[key]
+            n = 0
+            for drb in [rot_bins - 1, 0, 1]:
+                for dsb in [-1, 0, 1]:
+                    sb = v[6] + dsb
+                    if sb < 0 or sb >= scale_bins:
+                        continue
+                    w = votes.get((((v[4] * rot_bins) + ((v[5] + drb) % rot_bins)) * scale_bins) + sb)
+                    if w is not None:
+                        n += w[0]
+            ranked.append([n, v])
+        ranked.sort(key = sort_votes_func, reverse = True)
+
+        # the rotation and scale are averaged only from the center bin, which is unlikely to contain false hits
+        res = []
+        used = []
+        for r in ranked:
+            v = r[1]
+            if v[4] in used:
+                continue
+            used.append(v[4])
+            res.append([bright[v[4]], math.degrees(math.atan2(v[2], v[1])), v[3] / v[0], r[0]])
+            if len(res) >= self.search_limit:
+                break
+        return res
+
     def get_rotation(self, compensate = True, offset = 0):
         if self.solu_time == 0 or compensate == False:
             return self.rotation
@@ -319,6 +547,120 @@ def angle_match(x, y, tol = 1.0):
 def sort_score_func(x):
     return x.score
 
+def sort_votes_func(x):
+    return x[0]
+
+def bisect_dist(dist_sorted, d):
+    # index of the first star that is at least d away from the reference star
+    lo = 0
+    hi = len(dist_sorted)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if dist_sorted[mid].ref_star_dist < d:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def hash_key(ratio, ang):
+    rbin = int(ratio / (HASH_RATIO_TOL * 2))
+    abin = int(math.floor((ang + 180.0) / (HASH_ANGLE_TOL * 2)))
+    return (rbin * 1000) + (abin % int(360 / (HASH_ANGLE_TOL * 2)))
+
+def hash_insert(idx, ratio, ang, val):
+    # the entry goes into every bin that a measurement within tolerance could land in
+    r = ratio - HASH_RATIO_TOL
+    while True:
+        a = ang - HASH_ANGLE_TOL
+        while True:
+            key = hash_key(r, a)
+            lst = idx.get(key)
+            if lst is None:
+                lst = []
+                idx[key] = lst
+            if val not in lst:
+                lst.append(val)
+            if a >= ang + HASH_ANGLE_TOL:
+                break
+            a = min(a + (HASH_ANGLE_TOL * 2), ang + HASH_ANGLE_TOL)
+        if r >= ratio + HASH_RATIO_TOL:
+            break
+        r = min(r + (HASH_RATIO_TOL * 2), ratio + HASH_RATIO_TOL)
+
+def build_penalty_index():
+    # table entries grouped by their angle from Polaris, each entry is placed in every bin that angle_match could accept
+    idx = {}
+    nbins = int(360 / PENALTY_ANG_BIN)
+    for tbl in STARS_NEAR_POLARIS:
+        for a in [tbl[2] - 1.0, tbl[2], tbl[2] + 1.0]:
+            b = int(math.floor((ang_normalize(a) + 180.0) / PENALTY_ANG_BIN)) % nbins
+            lst = idx.get(b)
+            if lst is None:
+                lst = []
+                idx[b] = lst
+            if tbl not in lst:
+                lst.append(tbl)
+    return idx
+
+def in_database(k, rot_ang, scale):
+    # same test as comparing against every entry of STARS_NEAR_POLARIS, but only the entries at a similar angle are checked
+    global penalty_index
+    if penalty_index is None:
+        penalty_index = build_penalty_index()
+    nbins = int(360 / PENALTY_ANG_BIN)
+    b = int(math.floor((ang_normalize(k.ref_star_angle - rot_ang) + 180.0) / PENALTY_ANG_BIN)) % nbins
+    lst = penalty_index.get(b)
+    if lst is None:
+        return False
+    for tbl in lst:
+        if dist_match(k.ref_star_dist, tbl[1] * scale) and angle_match(k.ref_star_angle, ang_normalize(tbl[2] + rot_ang)):
+            return True
+    return False
+
+def build_hot_pixel_grid(hot_pixels):
+    grid = {}
+    for hp in hot_pixels:
+        key = ((int(hp[0]) // HOT_PIXEL_CELL) * 10000) + (int(hp[1]) // HOT_PIXEL_CELL)
+        lst = grid.get(key)
+        if lst is None:
+            lst = []
+            grid[key] = lst
+        lst.append(hp)
+    return grid
+
+def is_hot_pixel(grid, x, y):
+    if len(grid) <= 0:
+        return False
+    cx = int(x) // HOT_PIXEL_CELL
+    cy = int(y) // HOT_PIXEL_CELL
+    for gx in [cx - 1, cx, cx + 1]:
+        for gy in [cy - 1, cy, cy + 1]:
+            lst = grid.get((gx * 10000) + gy)
+            if lst is None:
+                continue
+            for hp in lst:
+                if math.sqrt(((x - hp[0]) ** 2) + ((y - hp[1]) ** 2)) < HOT_PIXEL_DIST:
+                    return True
+    return False
+
+def build_hash_index():
+    idx = {}
+    n = len(STARS_NEAR_POLARIS)
+    a = 0
+    while a < n:
+        b = a + 1
+        while b < n:
+            # the table is sorted closest first, so "a" is always the closer star
+            ratio = STARS_NEAR_POLARIS[a][1] / STARS_NEAR_POLARIS[b][1]
+            ang = ang_normalize(STARS_NEAR_POLARIS[b][2] - STARS_NEAR_POLARIS[a][2])
+            hash_insert(idx, ratio, ang, (a, b))
+            if ratio >= 1.0 - HASH_RATIO_TOL:
+                # the measured distances might end up in the opposite order
+                hash_insert(idx, 1.0 / ratio, -ang, (b, a))
+            b += 1
+        a += 1
+    return idx
+
 if __name__ == "__main__":
     import test_bench
     test_bench.test()
@@ -82,6 +82,9 @@ function fmtDate(x)
 
 function parseStarsStr(x)
 {
+    if (Array.isArray(x)) {
+        return x; // already decoded from a binary state packet
+    }
     var stars = [];
     var chunks = x.split(";");
     var i;
@@ -106,6 +109,165 @@ function parseStarsStr(x)
     return stars;
 }
 
+// decoder for the binary state packets, the encoder is guider_wsproto.py, the two must be kept in sync
+const WSPROTO_PKT_STATE    = 1;
+const WSPROTO_VER          = 1;
+const WSPROTO_BASE_NONE    = 0xFFFF;
+const WSPROTO_FTYPE_NONE   = 0;
+const WSPROTO_FTYPE_FALSE  = 1;
+const WSPROTO_FTYPE_TRUE   = 2;
+const WSPROTO_FTYPE_INT    = 3;
+const WSPROTO_FTYPE_FLOAT  = 4;
+const WSPROTO_FTYPE_STR    = 5;
+const WSPROTO_FTYPE_JSON   = 6;
+const WSPROTO_FTYPE_NUMS   = 7;
+const WSPROTO_FTYPE_STARS  = 8;
+const WSPROTO_FTYPE_DEL    = 9;
+const WSPROTO_STAR_LEN     = 8;
+const WSPROTO_STAR_SCALE   = 16.0;
+const WSPROTO_FIELD_EXTRA  = 63;
+const WSPROTO_LOG_BASE     = 64;
+const WSPROTO_HISTORY_LEN  = 8;
+
+var wsproto_field_names = ["time", "session_rand_id", "ws_rand_id", "guide_state", "interval_state", "blub_remaining", "dither_interval", "expo_code",
+                           "img", "img_mean", "img_stdev", "img_max", "img_min",
+                           "stars", "sel_star", "sel_star_profile", "tgt_coord", "ori_coord", "last_move_err", "multistar_cnt",
+                           "calib_ra", "calib_dec", "hotpix", "hotpix_used", "hotpix_cnt", "hotpix_last", "hw_err", "analysis_dur", "stage_dur"];
+var wsproto_log_keys = ["msg_tick", "msg_time", "msg_str", "pulse_time", "pulse_ra", "pulse_dec", "pulse_sum", "pulse_shutter"];
+var wsproto_history = []; // [seq, fields] of the last few decoded packets, deltas are applied on top of one of these
+var wsproto_text = new TextDecoder("utf-8");
+
+function decodeStatePacket(buf)
+{
+    // returns the same object that the JSON state packet would have been, with "state_seq" added
+    // returns null if the packet can't be decoded, the device must then be told to send the full state
+    var dv = new DataView(buf);
+    if (dv.byteLength < 8 || dv.getUint8(0) != WSPROTO_PKT_STATE || dv.getUint8(1) != WSPROTO_VER) {
+        return null;
+    }
+    var seq  = dv.getUint16(2, true);
+    var base = dv.getUint16(4, true);
+    var cnt  = dv.getUint16(6, true);
+    var fields = {};
+    var i;
+    if (base != WSPROTO_BASE_NONE) {
+        var found = null;
+        for (i = 0; i < wsproto_history.length; i++) {
+            if (wsproto_history[i][0] == base) {
+                found = wsproto_history[i][1];
+            }
+        }
+        if (found == null) {
+            return null;
+        }
+        Object.assign(fields, found);
+    }
+
+    var pos = 8;
+    for (i = 0; i < cnt; i++)
+    {
+        var fid   = dv.getUint8(pos);
+        var ftype = dv.getUint8(pos + 1);
+        pos += 2;
+        var v = null, n, j;
+        if (ftype == WSPROTO_FTYPE_NONE) {
+            v = null;
+        }
+        else if (ftype == WSPROTO_FTYPE_FALSE) {
+            v = false;
+        }
+        else if (ftype == WSPROTO_FTYPE_TRUE) {
+            v = true;
+        }
+        else if (ftype == WSPROTO_FTYPE_INT) {
+            v = dv.getInt32(pos, true);
+            pos += 4;
+        }
+        else if (ftype == WSPROTO_FTYPE_FLOAT) {
+            v = dv.getFloat32(pos, true);
+            pos += 4;
+        }
+        else if (ftype == WSPROTO_FTYPE_STR || ftype == WSPROTO_FTYPE_JSON) {
+            n = dv.getUint16(pos, true);
+            v = wsproto_text.decode(new Uint8Array(buf, pos + 2, n));
+            pos += 2 + n;
+            if (ftype == WSPROTO_FTYPE_JSON) {
+                v = JSON.parse(v);
+            }
+        }
+        else if (ftype == WSPROTO_FTYPE_NUMS) {
+            n = dv.getUint8(pos);
+            pos += 1;
+            v = [];
+            for (j = 0; j < n; j++) {
+                v.push(dv.getFloat32(pos, true));
+                pos += 4;
+            }
+        }
+        else if (ftype == WSPROTO_FTYPE_STARS) {
+            n = dv.getUint16(pos, true);
+            pos += 2;
+            v = [];
+            for (j = 0; j < n; j++) {
+                var star = {};
+                star["cx"]        = dv.getUint16(pos + 0, true) / WSPROTO_STAR_SCALE;
+                star["cy"]        = dv.getUint16(pos + 2, true) / WSPROTO_STAR_SCALE;
+                star["r"]         = dv.getUint16(pos + 4, true);
+                star["max_brite"] = dv.getUint8(pos + 6);
+                star["rating"]    = dv.getUint8(pos + 7);
+                v.push(star);
+                pos += WSPROTO_STAR_LEN;
+            }
+        }
+        else if (ftype == WSPROTO_FTYPE_DEL) {
+            delete fields[fid];
+            continue;
+        }
+        else {
+            console.log("state packet has unknown field type " + ftype);
+            return null;
+        }
+        fields[fid] = v;
+    }
+
+    wsproto_history.push([seq, fields]);
+    while (wsproto_history.length > WSPROTO_HISTORY_LEN) {
+        wsproto_history.shift();
+    }
+
+    var obj = {"pkt_type": "state", "state_seq": seq};
+    var logs = null;
+    Object.keys(fields).forEach(function (k) {
+        var fid = parseInt(k);
+        if (fid == WSPROTO_FIELD_EXTRA) {
+            Object.assign(obj, fields[k]);
+        }
+        else if (fid >= WSPROTO_LOG_BASE) {
+            var li = fid - WSPROTO_LOG_BASE;
+            if (logs == null) {
+                logs = {};
+            }
+            logs[wsproto_log_keys[li % wsproto_log_keys.length] + "_" + Math.floor(li / wsproto_log_keys.length).toString()] = fields[k];
+        }
+        else if (fid < wsproto_field_names.length) {
+            obj[wsproto_field_names[fid]] = fields[k];
+        }
+    });
+    if (logs != null) {
+        obj["logs"] = logs;
+    }
+    return obj;
+}
+
+function stateAck(seq)
+{
+    // lets the device send only what changed since this packet, -1 asks for the full state
+    // not sent with websock_send() because it must not replace what websock_retransmit() would send
+    if (socket != null) {
+        socket.send(JSON.stringify({"pkt_type": "state_ack", "seq": seq}));
+    }
+}
+
 var ui_list = {};
 var autopopulate_func_list = {};
 var autopopulate_dict_list = {};
@@ -15,6 +15,7 @@ function websocket_init(page)
     var sock_url = "ws://" + domain + "/" + page;
     console.log("websocket init to " + sock_url);
     socket = new WebSocket(sock_url);
+    socket.binaryType = "arraybuffer";
     socket_state = 1;
 
     socket.onopen = function (evt) {
@@ -0,0 +1,273 @@
+# Monte Carlo tuner for the guide filter and backlash settings
+#
+# every candidate set of settings guides through the same simulated nights, mount_sim.MountSim with the same seeds, and is scored by
+#   RMS tracking error in pixels + (effort weight * average pulse milliseconds per frame)
+# the first round samples the whole search space at random, every round after that samples around the best candidates so far, with less spread each time
+# the starting settings are always one of the candidates, so the result is never worse than what was there before, at least in the simulator
+# candidates are evaluated in parallel, one process per core
+# the best settings are merged into the starting settings and written out as a settings_autoguider.json that the autoguider loads as is
+#
+# the mount's errors can come from a recording instead of the simulator's periodic error and drift
+# --trace takes a session file made by replay.Recorder, or a CSV file, see mount_sim.load_error_trace()
+#
+# usage:
+#   python autotune.py [--settings settings_autoguider.json] [--out settings_autoguider.json] [--trace session.jsonl]
+#                      [--samples 200] [--rounds 4] [--keep 10] [--frames 1500] [--seeds 3] [--effort 0.002]
+#                      [--params name,name,...] [--workers N] [--sim name=value,...]
+# --sim passes parameters to MountSim, values are JSON, for example --sim "backlash=[0,1500],ra_rate=0.008"
+
+import os, sys, io, json, random, time, tempfile, contextlib, multiprocessing
+
+# name: (low, high, is integer)
+PARAM_SPACE = {}
+for ax in ["ra", "dec"]:
+    for ft in ["advfilt", "preempfilt"]:
+        PARAM_SPACE.update({"%s_%s_term_i"  % (ft, ax): (0   , 100 , True)})
+        PARAM_SPACE.update({"%s_%s_limit_i" % (ft, ax): (0   , 3000, True)})
+        PARAM_SPACE.update({"%s_%s_decay_i" % (ft, ax): (0   , 200 , True)})
+        PARAM_SPACE.update({"%s_%s_term_d"  % (ft, ax): (-50 , 100 , True)})
+        PARAM_SPACE.update({"%s_%s_lpf_k"   % (ft, ax): (0   , 100 , True)})
+        PARAM_SPACE.update({"%s_%s_lpf_mix" % (ft, ax): (0   , 100 , True)})
+        PARAM_SPACE.update({"%s_%s_type"    % (ft, ax): (0   , 1   , True)})
+        PARAM_SPACE.update({"%s_%s_kf_q"    % (ft, ax): (0   , 100 , True)})
+        PARAM_SPACE.update({"%s_%s_kf_r"    % (ft, ax): (0   , 500 , True)})
+        PARAM_SPACE.update({"%s_%s_kf_lead" % (ft, ax): (0   , 100 , True)})
+    PARAM_SPACE.update({"advfilt_%s_scale"    % ax: (30 , 150 , True )})
+    PARAM_SPACE.update({"preempfilt_%s_scale" % ax: (0  , 100 , True )})
+    PARAM_SPACE.update({"backlash_hyster_%s"  % ax: (0  , 3000, True )})
+    PARAM_SPACE.update({"backlash_limit_%s"   % ax: (0  , 6000, True )})
+    PARAM_SPACE.update({"backlash_reduc_%s"   % ax: (0.0, 1.0 , False)})
+
+# the preemptive filter's own PID and LPF terms only shape what it replays, they are left alone unless asked for
+# so are the filter type and the Kalman filter's terms, try --params advfilt_ra_type,advfilt_ra_kf_q,advfilt_ra_kf_r,...
+DEFAULT_PARAMS = []
+for ax in ["ra", "dec"]:
+    DEFAULT_PARAMS += ["advfilt_%s_%s" % (ax, k) for k in ["term_i", "limit_i", "decay_i", "term_d", "lpf_k", "lpf_mix", "scale"]]
+    DEFAULT_PARAMS += ["preempfilt_%s_scale" % ax, "backlash_hyster_%s" % ax, "backlash_limit_%s" % ax, "backlash_reduc_%s" % ax]
+
+DEFAULT_EFFORT_WEIGHT = 0.002 # 100 ms of pulse per frame costs as much as 0.2 pixels of error
+
+# state of a worker process, set by init_worker()
+_worker = {}
+
+def init_worker(base_settings, sim_kwargs, frames, seeds, effort_weight):
+    import hostenv
+    if hostenv.installed == False:
+        hostenv.install(flash_dir = tempfile.mkdtemp(prefix = "autotune_"), virtual_clock = True, seed = 1)
+    import autoguider
+    with contextlib.redirect_stdout(io.StringIO()):
+        guider = autoguider.AutoGuider()
+    guider.simulator = None
+    _worker.update({"guider": guider, "base": base_settings, "sim": sim_kwargs, "frames": frames, "seeds": seeds, "effort": effort_weight})
+
+def evaluate(cand):
+    # returns (score, RMS error, effort), averaged over all of the seeds
+    import guidepulser, mount_sim
+    guider = _worker["guider"]
+    frames = _worker["frames"]
+    settle = frames // 10 # the first frames are spent finding the target
+    rms = 0
+    effort = 0
+    for seed in _worker["seeds"]:
+        guider.settings.update(_worker["base"])
+        guider.settings.update(cand)
+        guider.apply_settings()
+        guider.backlash_ra.neutralize()
+        guider.backlash_dec.neutralize()
+        guider.advfilt_ra.pause(True)
+        guider.advfilt_dec.pause(True)
+        guider.preempfilt_ra.pause(True)
+        guider.preempfilt_dec.pause(True)
+        guider.last_pulse_dur = 0
+        guidepulser.init()
+        sim = mount_sim.MountSim(seed = seed, **_worker["sim"])
+        sim.apply_calibration(guider)
+        try:
+            trace = mount_sim.run_guiding(guider, sim, frames)
+        finally:
+            sim.detach()
+        rms += trace.rms(start = settle)
+        effort += trace.effort(start = settle)
+    n = len(_worker["seeds"])
+    rms /= n
+    effort /= n
+    return (rms + (_worker["effort"] * effort), rms, effort)
+
+def sample_uniform(rand, params):
+    cand = {}
+    for k in params:
+        lo, hi, is_int = PARAM_SPACE[k]
+        cand.update({k: rand.randint(lo, hi) if is_int else rand.uniform(lo, hi)})
+    return cand
+
+def sample_near(rand, params, parent, spread):
+    cand = {}
+    for k in params:
+        lo, hi, is_int = PARAM_SPACE[k]
+        x = parent[k] + rand.gauss(0, (hi - lo) * spread)
+        x = min(hi, max(lo, x))
+        cand.update({k: int(round(x)) if is_int else x})
+    return cand
+
+class Tuner(object):
+
+    def __init__(self, base_settings, params = None, sim_kwargs = None, frames = 1500, seeds = 3, effort_weight = DEFAULT_EFFORT_WEIGHT, workers = None, seed = 1):
+        self.base = dict(base_settings)
+        self.params = list(params) if params is not None else list(DEFAULT_PARAMS)
+        for k in self.params:
+            if k not in PARAM_SPACE:
+                raise ValueError("unknown tuning parameter: " + k)
+        self.sim_kwargs = dict(sim_kwargs) if sim_kwargs is not None else {}
+        self.frames = frames
+        self.seeds = [1000 + i for i in range(seeds)]
+        self.effort_weight = effort_weight
+        self.workers = workers if workers is not None else multiprocessing.cpu_count()
+        self.rand = random.Random(seed)
+        self.results = [] # (score, rms, effort, candidate), best first
+        self.pool = None
+
+    def start(self):
+        initargs = (self.base, self.sim_kwargs, self.frames, self.seeds, self.effort_weight)
+        if self.workers > 1:
+            self.pool = multiprocessing.Pool(processes = self.workers, initializer = init_worker, initargs = initargs)
+        else:
+            init_worker(*initargs)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def evaluate_all(self, cands):
+        if self.pool is not None:
+            scores = self.pool.map(evaluate, cands, chunksize = 1)
+        else:
+            scores = [evaluate(c) for c in cands]
+        for i in range(len(cands)):
+            self.results.append((scores[i][0], scores[i][1], scores[i][2], cands[i]))
+        self.results.sort(key = lambda x: x[0])
+
+    def get_start(self):
+        # the parameters as they are in the starting settings, clamped into the search space
+        cand = {}
+        for k in self.params:
+            lo, hi, is_int = PARAM_SPACE[k]
+            x = self.base.get(k, lo)
+            if x is True or x is False or isinstance(x, (int, float)) == False:
+                x = lo
+            cand.update({k: min(hi, max(lo, x))})
+        return cand
+
+    def run(self, samples = 200, rounds = 4, keep = 10, quiet = False):
+        self.start()
+        try:
+            t = time.perf_counter()
+            cands = [self.get_start()] + [sample_uniform(self.rand, self.params) for i in range(samples - 1)]
+            self.evaluate_all(cands)
+            self.start_score = [r for r in self.results if r[3] is cands[0]][0]
+            if quiet == False:
+                print("round 1/%u, best %s, %0.1f s" % (rounds, fmt_score(self.results[0]), time.perf_counter() - t))
+            spread = 0.25
+            r = 1
+            while r < rounds:
+                parents = [x[3] for x in self.results[0:keep]]
+                cands = [sample_near(self.rand, self.params, parents[i % len(parents)], spread) for i in range(samples)]
+                self.evaluate_all(cands)
+                if quiet == False:
+                    print("round %u/%u, best %s, %0.1f s" % (r + 1, rounds, fmt_score(self.results[0]), time.perf_counter() - t))
+                spread *= 0.5
+                r += 1
+        finally:
+            self.stop()
+        return self.results[0]
+
+    def get_settings(self):
+        # the starting settings with the best candidate's values in them
+        x = dict(self.base)
+        x.update(self.results[0][3])
+        return x
+
+def fmt_score(r):
+    return "score %0.4f (RMS %0.3f px, effort %0.1f ms/frame)" % (r[0], r[1], r[2])
+
+def get_default_settings():
+    import hostenv
+    if hostenv.installed == False:
+        hostenv.install(flash_dir = tempfile.mkdtemp(prefix = "autotune_"), virtual_clock = True, seed = 1)
+    import autoguider
+    with contextlib.redirect_stdout(io.StringIO()):
+        guider = autoguider.AutoGuider()
+    return dict(guider.settings)
+
+def get_arg(name, default):
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+def parse_sim_args(s):
+    # name=value pairs separated by commas outside of brackets, values are JSON
+    res = {}
+    depth = 0
+    item = ""
+    for c in s + ",":
+        if c in "[(":
+            depth += 1
+        elif c in "])":
+            depth -= 1
+        if c == "," and depth == 0:
+            if "=" in item:
+                k, v = item.split("=", 1)
+                res.update({k.strip(): json.loads(v.replace("(", "[").replace(")", "]"))})
+            item = ""
+        else:
+            item += c
+    return res
+
+def main():
+    if "--help" in sys.argv or "-h" in sys.argv:
+        print("usage: %s [--settings in.json] [--out settings_autoguider.json] [--trace session.jsonl] [--samples 200] [--rounds 4] [--keep 10] [--frames 1500] [--seeds 3] [--effort %s] [--params a,b,...] [--workers N] [--sim name=value,...]" % (os.path.basename(sys.argv[0]), str(DEFAULT_EFFORT_WEIGHT)))
+        return 0
+    # hostenv changes the working directory, so every path is made absolute first
+    in_path = get_arg("--settings", None)
+    in_path = os.path.abspath(in_path) if in_path is not None else None
+    out_path = os.path.abspath(get_arg("--out", "settings_autoguider.json"))
+    trace_path = get_arg("--trace", None)
+    trace_path = os.path.abspath(trace_path) if trace_path is not None else None
+    params = get_arg("--params", None)
+    params = [p.strip() for p in params.split(",")] if params is not None else None
+    workers = get_arg("--workers", None)
+    workers = int(workers) if workers is not None else None
+
+    base = get_default_settings()
+    if in_path is not None:
+        with open(in_path, "r") as f:
+            base.update(json.load(f))
+
+    import mount_sim
+    sim_kwargs = {}
+    if trace_path is not None:
+        # the recording replaces the simulated periodic error and drift
+        sim_kwargs.update({"disturbance": mount_sim.load_error_trace(trace_path), "pe": [], "drift": (0, 0)})
+        print("loaded %u points of tracking error from %s" % (len(sim_kwargs["disturbance"]), trace_path))
+    sim_kwargs.update(parse_sim_args(get_arg("--sim", "")))
+
+    tuner = Tuner(base, params = params, sim_kwargs = sim_kwargs,
+                  frames = int(get_arg("--frames", 1500)), seeds = int(get_arg("--seeds", 3)),
+                  effort_weight = float(get_arg("--effort", DEFAULT_EFFORT_WEIGHT)), workers = workers)
+    print("tuning %u parameters, %u workers" % (len(tuner.params), tuner.workers))
+    best = tuner.run(samples = int(get_arg("--samples", 200)), rounds = int(get_arg("--rounds", 4)), keep = int(get_arg("--keep", 10)))
+
+    print("start: %s" % fmt_score(tuner.start_score))
+    print("best:  %s" % fmt_score(best))
+    for k in tuner.params:
+        print("  %-24s %10s => %s" % (k, str(base.get(k)), str(best[3][k])))
+    with open(out_path, "w") as f:
+        json.dump(tuner.get_settings(), f)
+    print("saved " + out_path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+# vectorized blob detection, used by the host stand-in of image.find_blobs and directly by host-side tools
+# a full resolution 2592x1944 frame is thresholded, labeled, and measured in one pass,
+# the results are parallel NumPy arrays instead of one Python object per blob
+# the semantics follow the custom firmware:
+#  * a negative area/pixel/width/height threshold is an upper limit instead of a lower limit
+#  * the search only visits every x_stride-th pixel of every y_stride-th row, a blob that does not cover any visited pixel is not found
+#  * blobs are 4-connected, centroids are the unweighted average of the blob's pixel coordinates
+
+import numpy as np
+
+EXPO_NO_IMG       = -2
+EXPO_TOO_LOW      = -1
+EXPO_JUST_RIGHT   = 0
+EXPO_TOO_HIGH     = 1
+EXPO_TOO_NOISY    = 2
+EXPO_TOO_MANY     = 5
+
+STAR_LIMIT = 125
+
+class BlobArrays(object):
+
+    FIELDS = ["x", "y", "w", "h", "pixels", "cx", "cy", "brightness"]
+
+    def __init__(self, x, y, w, h, pixels, cx, cy, brightness, mask = None, roi = None):
+        self.x          = x
+        self.y          = y
+        self.w          = w
+        self.h          = h
+        self.pixels     = pixels
+        self.cx         = cx
+        self.cy         = cy
+        self.brightness = brightness
+        # the thresholded mask, relative to the ROI, kept for guidestarmode
+        self.mask       = mask
+        self.roi        = roi
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def r(self):
+        # same radius estimate that star_finder uses
+        return (self.w + self.h) / 3.0
+
+    def take(self, idx):
+        vals = [getattr(self, f)[idx] for f in BlobArrays.FIELDS]
+        return BlobArrays(*vals, mask = self.mask, roi = self.roi)
+
+    def sort_brightness(self):
+        return self.take(np.argsort(-self.brightness, kind = "stable"))
+
+    def to_blobstars(self):
+        import blobstar
+        r = self.r
+        return [blobstar.BlobStar(float(self.cx[i]), float(self.cy[i]), float(r[i]), int(self.brightness[i])) for i in range(len(self))]
+
+def empty(mask = None, roi = None):
+    z = np.zeros(0, dtype = np.int64)
+    f = np.zeros(0, dtype = np.float64)
+    return BlobArrays(z, z.copy(), z.copy(), z.copy(), z.copy(), f, f.copy(), z.copy(), mask = mask, roi = roi)
+
+def clip_roi(roi, width, height):
+    x, y, w, h = [int(i) for i in roi]
+    if x < 0:
+        w += x
+        x = 0
+    if y < 0:
+        h += y
+        y = 0
+    w = max(0, min(w, width - x))
+    h = max(0, min(h, height - y))
+    return x, y, w, h
+
+def threshold_mask(data, thresholds, invert = False):
+    mask = np.zeros(data.shape, dtype = bool)
+    for t in thresholds:
+        lo = min(t[0], t[1])
+        hi = max(t[0], t[1])
+        mask |= (data >= lo) & (data <= hi)
+    if invert:
+        mask = ~mask
+    return mask
+
+def passes_threshold(value, thresh):
+    # custom firmware: a negative threshold is an upper limit instead of a lower limit
+    # works on scalars and on arrays
+    if thresh is None or thresh == 0:
+        return np.ones(np.shape(value), dtype = bool) if np.ndim(value) > 0 else True
+    if thresh < 0:
+        return value <= -thresh
+    return value >= thresh
+
+def label(mask):
+    # connected component labeling that only touches the thresholded pixels, which are sparse in a star field
+    # returns the flat indices of the thresholded pixels (in raster order), their labels, and the number of labels
+    # labels are numbered in the order the firmware's raster scan would first encounter each blob
+    width = mask.shape[1]
+    idx = np.flatnonzero(mask)
+    k = len(idx)
+    if k <= 0:
+        return idx, np.zeros(0, dtype = np.int64), 0
+
+    # 4-connected neighbours, found by searching the sorted index list
+    pos = np.minimum(np.searchsorted(idx, idx + 1), k - 1)
+    right = (idx[pos] == idx + 1) & ((idx % width) != (width - 1))
+    pos_r = pos
+    pos = np.minimum(np.searchsorted(idx, idx + width), k - 1)
+    down = idx[pos] == idx + width
+    a = np.concatenate((np.flatnonzero(right), np.flatnonzero(down)))
+    b = np.concatenate((pos_r[right], pos[down]))
+
+    # vectorized union-find, hook the larger root onto the smaller root, then compress paths
+    parent = np.arange(k)
+    while True:
+        pa = parent[a]
+        pb = parent[b]
+        diff = pa != pb
+        if not diff.any():
+            break
+        np.minimum.at(parent, np.maximum(pa[diff], pb[diff]), np.minimum(pa[diff], pb[diff]))
+        while True:
+            pp = parent[parent]
+            if np.array_equal(pp, parent):
+                break
+            parent = pp
+    roots, lab = np.unique(parent, return_inverse = True)
+    return idx, lab.ravel(), len(roots)
+
+def measure(idx, lab, n, width, data, x_stride = 1, y_stride = 1):
+    # moments and bounding boxes of every label, all coordinates are relative to the labeled array
+    # returns pixels, sum_x, sum_y, brightness_sum, min_x, min_y, max_x, max_y, seeded
+    ys, xs = np.divmod(idx, width)
+    pixels = np.bincount(lab, minlength = n)
+    sum_x = np.bincount(lab, weights = xs, minlength = n)
+    sum_y = np.bincount(lab, weights = ys, minlength = n)
+    bright = np.bincount(lab, weights = data[ys, xs], minlength = n).astype(np.int64)
+    sample = ((xs % x_stride) == 0) & ((ys % y_stride) == 0)
+    seeded = np.bincount(lab, weights = sample, minlength = n) > 0
+
+    # group pixels by label, the raster order inside each group is kept so the first and last rows are the y extents
+    order = np.argsort(lab, kind = "stable")
+    starts = np.concatenate(([0], np.cumsum(pixels)[:-1]))
+    xs_sorted = xs[order]
+    ys_sorted = ys[order]
+    min_x = np.minimum.reduceat(xs_sorted, starts)
+    max_x = np.maximum.reduceat(xs_sorted, starts)
+    min_y = ys_sorted[starts]
+    max_y = ys_sorted[starts + pixels - 1]
+    return pixels, sum_x, sum_y, bright, min_x, min_y, max_x, max_y, seeded
+
+def find_blobs(data, thresholds, invert = False, roi = None, x_stride = 2, y_stride = 1,
+               area_threshold = 10, pixel_threshold = 10, width_threshold = 0, height_threshold = 0):
+    # data is a grayscale (height, width) array, results are in image coordinates
+    if roi is None:
+        roi = (0, 0, data.shape[1], data.shape[0])
+    rx, ry, rw, rh = clip_roi(roi, data.shape[1], data.shape[0])
+    data = data[ry:ry + rh, rx:rx + rw]
+    mask = threshold_mask(data, thresholds, invert)
+    if rw <= 0 or rh <= 0:
+        return empty(mask, (rx, ry, rw, rh))
+    idx, lab, n = label(mask)
+    if n <= 0:
+        return empty(mask, (rx, ry, rw, rh))
+    pixels, sum_x, sum_y, bright, x0, y0, x1, y1, seeded = measure(idx, lab, n, rw, data, x_stride, y_stride)
+    w = x1 - x0 + 1
+    h = y1 - y0 + 1
+    keep = seeded
+    keep &= passes_threshold(w * h, area_threshold)
+    keep &= passes_threshold(pixels, pixel_threshold)
+    keep &= passes_threshold(w, width_threshold)
+    keep &= passes_threshold(h, height_threshold)
+    pixels = pixels[keep]
+    return BlobArrays(x0[keep] + rx, y0[keep] + ry, w[keep], h[keep], pixels,
+                      (sum_x[keep] / pixels) + rx, (sum_y[keep] / pixels) + ry, bright[keep],
+                      mask = mask, roi = (rx, ry, rw, rh))
+
+def find_stars(img, hist = None, stats = None, thresh = 0, max_dia = 100, region = None, force_solve = False):
+    # same checks and thresholds as star_finder.find_stars, but returns a BlobArrays instead of a list of BlobStar
+    # img can be an image.Image or a grayscale array
+    data = img.ndarray() if hasattr(img, "ndarray") else img
+    if data is None:
+        return empty(), EXPO_NO_IMG
+    if data.ndim == 3:
+        data = (((data[:, :, 0].astype(np.uint32) * 38) + (data[:, :, 1].astype(np.uint32) * 75) + (data[:, :, 2].astype(np.uint32) * 15)) >> 7).astype(np.uint8)
+
+    if stats is None:
+        if hist is None:
+            import image
+            hist = image.Image(data).get_histogram()
+        stats = hist.get_statistics()
+
+    if force_solve == False:
+        if stats.mean() >= 20:
+            return empty(), EXPO_TOO_HIGH
+        if stats.stdev() >= 7:
+            return empty(), EXPO_TOO_NOISY
+        if stats.mean() >= thresh * 0.75 and thresh != 0:
+            return empty(), EXPO_TOO_MANY
+
+    thresh_a = stats.mean() * 3
+    if thresh < thresh_a:
+        thresh = thresh_a
+
+    if region is None:
+        region = (0, 0, data.shape[1] - 150, data.shape[0])
+
+    max_star_width = int(round(max_dia))
+    area = int(max_star_width * max_star_width)
+    maxpix = int(round(((float(max_star_width) / 2.0) ** 2) * 3.14159))
+
+    blobs = find_blobs(data, [(thresh, 255)], x_stride = 2, y_stride = 2, roi = region, area_threshold = -area, pixel_threshold = -maxpix, width_threshold = -max_star_width, height_threshold = -max_star_width)
+    if force_solve == False and len(blobs) > STAR_LIMIT:
+        return blobs, EXPO_TOO_MANY
+    return blobs, EXPO_JUST_RIGHT
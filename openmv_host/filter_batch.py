@@ -0,0 +1,415 @@
+# runs whole arrays through a GuideFilter or a BacklashManager in one call, for tuning and replaying sessions offline
+#
+# the results are exactly the same as calling filter() once per element, bit for bit, because the same steps are done in the same order
+# the steps are written out here with local variables instead of going through the objects, which is where the time goes on a PC
+# the PID integral clamps and decays, so it is still done one element at a time, NumPy's running sum is only used when decay_i is 0 and limit_i is never reached
+# the Kalman filter and the backlash manager feed back on themselves, so they can't be turned into NumPy array operations without changing the rounding
+# the state is the same FilterState or BacklashState the device code uses, so a batch can start where the object is, and the object can carry on from where the batch ended
+# the steps must be kept in sync with openmv_filesys/guide_filter.py and openmv_filesys/backlash_mgr.py, run python filter_batch.py to check
+#
+#   import filter_batch
+#   out, st = filter_batch.run_filter(guider.advfilt_ra, errors)            # guider.advfilt_ra is not changed
+#   out, st = filter_batch.run_filter(filt, errors, given = pulses, noise = noise)
+#   filt.st = st                                                               # carry on from the end of the batch
+#   fin, st = filter_batch.run_backlash(guider.backlash_dec, out, force_move = False)
+
+import math
+import numpy as np
+
+def as_values(x, n = None):
+    # Python ints and floats, the same kind of numbers the device code is given
+    if x is None:
+        return None
+    a = np.asarray(x)
+    if a.ndim == 0:
+        return [a.item()] * (n if n is not None else 1)
+    return a.tolist()
+
+def run_filter(filt, x, given = None, noise = None, state = None):
+    # the same as filt.filter(x[i]) for every element, returns (outputs, final FilterState), filt itself is not changed
+    # given[i] is the pulse that was given after output i, as add_given() is told, it counts towards the next output
+    # noise[i] is what set_noise() was told before x[i], NaN for None, if there is no noise array filt.noise is used for all of them
+    # state is where to start from, the filter's own state if it is None
+    xs = as_values(x)
+    n = len(xs)
+    gs = as_values(given, n)
+    ns = as_values(noise, n)
+    st = (state if state is not None else filt.st).copy()
+    if n <= 0:
+        return np.empty(0, dtype = np.float64), st
+    if filt.paused:
+        out = np.array(xs, dtype = np.float64)
+        if gs is not None:
+            kf_u = st.kf_u
+            for g in gs:
+                kf_u += g
+            st.kf_u = kf_u
+        return out, st
+    import guide_filter
+    if filt.kind == guide_filter.FILTKIND_KALMAN:
+        return kalman_batch(filt, xs, gs, ns, st)
+    # the array math has to be done in the same kind of numbers as the Python math, so not in float32, and not in integers that can wrap around
+    xa = np.asarray(x)
+    if xa.ndim == 1 and xa.dtype.kind in "iu":
+        xa = xa.astype(np.int64)
+    else:
+        xa = np.array(xs, dtype = np.float64)
+    return pid_batch(filt, xa, xs, gs, st)
+
+def pid_batch(filt, x, xs, gs, st):
+    # the integral clamps and decays from one frame to the next, so it is done one element at a time, unless neither can happen
+    # the rest only looks at this input and the one before it, so it is done on whole arrays, with the same operations in the same order
+    term_i  = filt.term_i
+    limit_i = filt.limit_i
+    decay_i = filt.decay_i
+    term_d  = filt.term_d
+    lpf_k   = filt.lpf_k
+    lpf_mix = filt.lpf_mix
+    scale   = filt.scale
+    res = integral_sums(x, st.sum_i, term_i, limit_i, decay_i)
+    if res is None:
+        res = integral_loop(xs, st.sum_i, term_i, limit_i, decay_i)
+    i, sum_i = res
+    prev_d = np.empty_like(x)
+    prev_d[1:] = x[:-1]
+    prev_d[0] = st.last_val if st.last_val is not None else x[0]
+    prev_l = prev_d.copy()
+    prev_l[0] = st.lpf_val if st.lpf_val is not None else x[0]
+    d = x - prev_d
+    d = d * term_d
+    d = d / 100
+    total = x + (i + d)
+    if lpf_k >= 100:
+        lpf_sum = x
+    else:
+        lpf_old = prev_l * (100 - lpf_k)
+        lpf_new = x * lpf_k
+        lpf_sum = lpf_old + lpf_new
+        lpf_sum = lpf_sum / 100
+    if lpf_k > 0:
+        mix_1 = total * (100 - lpf_mix)
+        mix_2 = lpf_sum * lpf_mix
+        final_mix = mix_1 + mix_2
+        final_mix = final_mix / 100
+    else:
+        final_mix = total
+    final_mix = final_mix * scale
+    final_mix = (final_mix / 100).astype(np.float64)
+    st.sum_i    = sum_i
+    st.last_val = xs[-1]
+    st.lpf_val  = xs[-1]
+    st.last_out = final_mix[-1].item()
+    if gs is not None:
+        kf_u = st.kf_u
+        for g in gs:
+            kf_u += g
+        st.kf_u = kf_u
+    return final_mix, st
+
+def integral_loop(xs, sum_i, term_i, limit_i, decay_i):
+    # the integral one element at a time, returns (integral terms, final sum)
+    iv = [0.0] * len(xs)
+    j = 0
+    for v in xs:
+        sum_i += v
+        if sum_i > limit_i:
+            sum_i = limit_i
+        elif sum_i < -limit_i:
+            sum_i = -limit_i
+        i = sum_i * term_i
+        i /= 100
+        iv[j] = i
+        if sum_i > decay_i or sum_i < -decay_i:
+            sum_i -= decay_i
+        else:
+            sum_i = 0
+        j += 1
+    return np.array(iv, dtype = np.float64), sum_i
+
+def integral_sums(x, sum_i, term_i, limit_i, decay_i):
+    # without decay, and as long as the limit is never reached, the integral is only a running sum, np.cumsum() adds in the same order
+    # returns (integral terms, final sum), or None if the loop has to do it
+    if decay_i != 0 or len(x) == 0:
+        return None
+    sums = np.cumsum(np.concatenate((np.array([sum_i]), x)))[1:]
+    big = np.abs(sums).max()
+    if not (big <= limit_i):
+        # this also catches NaN, which the loop turns into a zero sum
+        return None
+    if sums.dtype.kind in "iu" and int(big) * abs(term_i) >= (1 << 53):
+        # the integer products have to turn into floats exactly, or the division rounds differently than Python does
+        return None
+    i = sums * term_i
+    i = (i / 100).astype(np.float64)
+    return i, sums[-1].item()
+
+def kalman_batch(filt, xs, gs, ns, st):
+    out = [0.0] * len(xs)
+    kf_q    = filt.kf_q
+    kf_r    = filt.kf_r
+    kf_lead = filt.kf_lead
+    scale   = filt.scale
+    noise   = filt.noise
+    u = st.kf_u
+    if st.kf_x is not None:
+        x0, x1 = st.kf_x
+        p00, p01, p11 = st.kf_p
+    started = st.kf_x is not None
+    o = st.last_out
+    j = 0
+    for z in xs:
+        if ns is not None:
+            noise = ns[j]
+            if noise != noise:
+                noise = None
+        r = kf_r
+        if noise is not None and noise > r:
+            r = noise
+        r = r * r
+        if started == False:
+            x0 = z
+            x1 = 0
+            p00 = r
+            p01 = 0
+            p11 = kf_q * kf_q * 4
+            started = True
+        else:
+            x0 = x0 + x1 - u
+            q = kf_q * kf_q
+            p00 = p00 + (2 * p01) + p11 + (q / 4)
+            p01 = p01 + p11 + (q / 2)
+            p11 = p11 + q
+            y = z - x0
+            s = p00 + r
+            k0 = p00 / s
+            k1 = p01 / s
+            x0 += k0 * y
+            x1 += k1 * y
+            p11 = p11 - (k1 * p01)
+            p01 = p01 - (k0 * p01)
+            p00 = p00 - (k0 * p00)
+        u = 0
+        o = x0 + (x1 * kf_lead / 100)
+        o *= scale
+        o /= 100
+        out[j] = o
+        if gs is not None:
+            u += gs[j]
+        j += 1
+    if started:
+        st.kf_x = [x0, x1]
+        st.kf_p = [p00, p01, p11]
+    st.kf_u = u
+    st.last_out = o
+    return np.array(out, dtype = np.float64), st
+
+def run_backlash(mgr, x, force_move = False, state = None):
+    # the same as mgr.filter(x[i], force_move[i]) for every element, returns (outputs, final BacklashState), mgr itself is not changed
+    # force_move can be one value for all of them or an array
+    xs = as_values(x)
+    n = len(xs)
+    fs = as_values(force_move, n)
+    st = (state if state is not None else mgr.st).copy()
+    out = [0] * n
+    # _filter() makes the settings positive the first time it runs
+    max_limit_set = mgr.max_limit
+    if max_limit_set is not None and max_limit_set < 0:
+        max_limit_set *= -1
+    hyst = mgr.hysteresis
+    if hyst < 0:
+        hyst *= -1
+    max_limit = max_limit_set
+    if max_limit is None:
+        max_limit = 0
+    if max_limit == 0:
+        max_limit = hyst
+    passthrough = hyst == 0 and max_limit_set == 0
+    reduction = mgr.reduction
+    hard_lock = mgr.hard_lock
+    value = st.value
+    state = st.state
+    j = 0
+    for x0 in xs:
+        x = x0
+        # _filter()
+        if passthrough:
+            state = 0
+            value = 0
+            y = x
+        else:
+            x = int(round(x))
+            if state == 0:
+                value += x
+                if value >=  max_limit:
+                    value =  max_limit
+                if value <= -max_limit:
+                    value = -max_limit
+                if hyst != 0:
+                    if value >= hyst:
+                        state = 1
+                    elif value <= -hyst:
+                        state = -1
+                else:
+                    if value > hyst:
+                        state = 1
+                    elif value < -hyst:
+                        state = -1
+                y = x
+            elif state > 0:
+                if hard_lock == False or x > 0:
+                    value += x
+                    if value >=  max_limit:
+                        value =  max_limit
+                    if value <= -max_limit:
+                        value = -max_limit
+                if x > 0:
+                    y = x
+                elif x < 0 and value <= -hyst:
+                    state = -1
+                    y = x
+                else:
+                    y = x * reduction
+            else:
+                if hard_lock == False or x < 0:
+                    value += x
+                    if value >=  max_limit:
+                        value =  max_limit
+                    if value <= -max_limit:
+                        value = -max_limit
+                if x < 0:
+                    y = x
+                elif x > 0 and value >= hyst:
+                    state = 1
+                    y = x
+                else:
+                    y = x * reduction
+        # filter()
+        if fs[j] and y == 0:
+            value = 0
+            state = 0
+            y = x0 + (2 * hyst * (1 if x0 > 0 else -1))
+        out[j] = int(round(y))
+        j += 1
+    st.value = value
+    st.state = state
+    return np.array(out, dtype = np.int64), st
+
+def check(n = 20000, seed = 1):
+    # runs random settings and inputs through both versions, returns the number of outputs or states that differed
+    import guide_filter, backlash_mgr
+    rnd = np.random.default_rng(seed)
+    bad = 0
+    trial = 0
+    while trial < 200:
+        f = guide_filter.GuideFilter("ra", "advfilt")
+        f.paused = trial % 17 == 0
+        f.kind = guide_filter.FILTKIND_KALMAN if trial % 2 else guide_filter.FILTKIND_PID
+        f.term_i  = int(rnd.integers(-50, 100))
+        f.limit_i = int(rnd.integers(0, 3000))
+        f.decay_i = int(rnd.integers(0, 200))
+        f.term_d  = int(rnd.integers(-50, 100))
+        f.lpf_k   = int(rnd.integers(0, 101))
+        f.lpf_mix = int(rnd.integers(0, 101))
+        f.scale   = int(rnd.integers(10, 150))
+        f.kf_q    = float(rnd.uniform(0.5, 20))
+        f.kf_r    = float(rnd.uniform(1, 50))
+        f.kf_lead = int(rnd.integers(0, 100))
+        if trial % 4 == 0:
+            # no decay and a limit that is never reached, the integral is done as a running sum
+            f.decay_i = 0
+            f.limit_i = 10 ** 7
+        elif trial % 4 == 2 and trial % 3 == 0:
+            # no decay but the limit is reached, the integral is done in the loop
+            f.decay_i = 0
+        m = n // 100
+        if trial % 3 == 0:
+            x = rnd.integers(-2000, 2000, m)
+        elif trial % 5 == 0:
+            x = rnd.normal(0, 500, m).astype(np.float32)
+        else:
+            x = rnd.normal(0, 500, m)
+        given = np.round(rnd.normal(0, 300, m))
+        noise = rnd.uniform(0, 80, m)
+        noise[rnd.uniform(0, 1, m) < 0.2] = np.nan
+        st0 = f.st.copy()
+        # in two batches, the second one starting where the first one ended
+        h = m // 2
+        out1, st = run_filter(f, x[0:h], given = given[0:h], noise = noise[0:h])
+        out2, st = run_filter(f, x[h:], given = given[h:], noise = noise[h:], state = st)
+        out = np.concatenate((out1, out2))
+        f.st = st0
+        i = 0
+        while i < m:
+            nv = noise[i].item()
+            f.set_noise(None if math.isnan(nv) else nv)
+            y = f.filter(x[i].item())
+            if y != out[i] or type(y)(out[i]) != y:
+                bad += 1
+            f.add_given(given[i].item())
+            i += 1
+        if f.get_state() != filter_state(f.kind, st) or f.st.kf_u != st.kf_u or f.st.last_out != st.last_out:
+            bad += 1
+
+        b = backlash_mgr.BacklashManager()
+        b.hysteresis = int(rnd.integers(-1, 2)) * int(rnd.integers(0, 500))
+        b.max_limit  = int(rnd.integers(-1, 2)) * int(rnd.integers(0, 1000))
+        b.reduction  = float(rnd.uniform(0, 1)) if trial % 2 else 0
+        b.hard_lock  = trial % 4 == 1
+        force = rnd.uniform(0, 1, m) < 0.1
+        out, st = run_backlash(b, x, force_move = force)
+        i = 0
+        while i < m:
+            y = b.filter(x[i].item(), force_move = bool(force[i]))
+            if y != out[i]:
+                bad += 1
+            i += 1
+        if b.st.value != st.value or b.st.state != st.state:
+            bad += 1
+        trial += 1
+    return bad
+
+def filter_state(kind, st):
+    # the same as GuideFilter.get_state(), for a FilterState
+    import guide_filter
+    if kind == guide_filter.FILTKIND_KALMAN:
+        if st.kf_x is None:
+            return (0.0, 0.0)
+        return (float(st.kf_x[0]), float(st.kf_x[1]))
+    return (float(st.sum_i), float(st.lpf_val) if st.lpf_val is not None else 0.0)
+
+def main():
+    # quick check, random settings and inputs through both versions, then how long a million samples take
+    import time
+    import hostenv
+    if hostenv.installed == False:
+        hostenv.install()
+    import guide_filter
+    bad = check()
+    print("batch vs one at a time: %u differences" % bad)
+    f = guide_filter.GuideFilter("ra", "advfilt")
+    f.paused  = False
+    f.term_i  = 30
+    f.limit_i = 2000
+    f.decay_i = 20
+    f.lpf_k   = 50
+    f.lpf_mix = 30
+    x = np.random.default_rng(2).normal(0, 300, 1000000)
+    t = time.perf_counter()
+    run_filter(f, x)
+    t_batch = time.perf_counter() - t
+    xs = x[0:100000].tolist()
+    t = time.perf_counter()
+    for v in xs:
+        f.filter(v)
+    t_one = (time.perf_counter() - t) * 10
+    print("1000000 samples: batch %0.2f s, one at a time %0.2f s" % (t_batch, t_one))
+    f.decay_i = 0
+    f.limit_i = 10 ** 9
+    t = time.perf_counter()
+    run_filter(f, x)
+    print("1000000 samples without decay or limit: batch %0.2f s" % (time.perf_counter() - t))
+    return 1 if bad else 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
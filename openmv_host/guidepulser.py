@@ -0,0 +1,145 @@
+# host stand-in for the custom firmware's "guidepulser" module (written in C on the device)
+# on the device, this drives the ST-4 guide port and the camera shutter through an I2C port expander
+# here, pulses and shutter activity are timed on the pyb clock, recorded in a log,
+# and reported to listeners so that a mount simulator can react to them
+
+import pyb
+
+_flip_ra    = 1
+_flip_dec   = 1
+_panic      = False
+_hw_err     = 0
+_led        = False
+_move_ra    = 0
+_move_dec   = 0
+_move_start = 0
+_move_end   = 0
+_moving     = False
+_shutter_end   = 0
+_shutter_open  = False
+_listeners  = []
+_log        = []
+LOG_LIMIT   = 1000
+
+def init():
+    global _panic, _moving, _shutter_open
+    _panic = False
+    _moving = False
+    _shutter_open = False
+
+def add_listener(cb):
+    # cb(event, args), event is "move", "stop", "shutter", or "shutter_close"
+    if cb not in _listeners:
+        _listeners.append(cb)
+
+def remove_listener(cb):
+    if cb in _listeners:
+        _listeners.remove(cb)
+
+def get_log(clear = False):
+    global _log
+    x = _log
+    if clear:
+        _log = []
+    return x
+
+def _event(name, args):
+    _log.append((pyb.millis(), name, args))
+    if len(_log) > LOG_LIMIT:
+        del _log[0]
+    for cb in _listeners:
+        cb(name, args)
+
+def set_hw_err(x):
+    global _hw_err
+    _hw_err = x
+
+def get_hw_err():
+    return _hw_err
+
+def panic(x):
+    global _panic
+    _panic = x
+    if x:
+        stop()
+
+def is_panic():
+    return _panic
+
+def set_flip_ra(x):
+    global _flip_ra
+    _flip_ra = x
+
+def set_flip_dec(x):
+    global _flip_dec
+    _flip_dec = x
+
+def enable_led():
+    global _led
+    _led = True
+
+def disable_led():
+    global _led
+    _led = False
+
+def move(ra, dec, grace = 0):
+    # ra and dec are signed pulse durations in milliseconds, both axis run simultaneously
+    # returns the time that the pulse is expected to finish, including the grace period
+    global _move_ra, _move_dec, _move_start, _move_end, _moving
+    if _panic:
+        return pyb.millis()
+    _move_ra = int(round(ra * _flip_ra))
+    _move_dec = int(round(dec * _flip_dec))
+    _move_start = pyb.millis()
+    _move_end = _move_start + max(abs(_move_ra), abs(_move_dec))
+    _moving = _move_end > _move_start
+    if _moving:
+        _event("move", (_move_ra, _move_dec))
+    return _move_end + grace
+
+def get_move():
+    return (_move_ra, _move_dec, _move_start, _move_end)
+
+def is_moving():
+    task()
+    return _moving
+
+def stop():
+    global _moving
+    if _moving:
+        # report how much of the pulse actually happened
+        done = pyb.millis() - _move_start
+        ra = max(-done, min(done, _move_ra))
+        dec = max(-done, min(done, _move_dec))
+        _moving = False
+        _event("stop", (ra, dec))
+
+def shutter(secs):
+    global _shutter_end, _shutter_open
+    _shutter_end = pyb.millis() + int(round(secs * 1000))
+    _shutter_open = True
+    _event("shutter", (secs, ))
+
+def shutter_remaining():
+    if _shutter_open == False:
+        return 0
+    return max(0, _shutter_end - pyb.millis())
+
+def is_shutter_open():
+    task()
+    return _shutter_open
+
+def halt_shutter():
+    global _shutter_open
+    if _shutter_open:
+        _shutter_open = False
+        _event("shutter_close", ())
+
+def task():
+    global _moving, _shutter_open
+    now = pyb.millis()
+    if _moving and now >= _move_end:
+        _moving = False
+    if _shutter_open and now >= _shutter_end:
+        _shutter_open = False
+        _event("shutter_close", ())
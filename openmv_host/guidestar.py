@@ -0,0 +1,465 @@
+# host stand-in for the custom firmware's "guidestar" module (written in C on the device)
+# the list processing and motion analysis are ported line for line from the firmware's py_guidestar.c,
+# so the host makes the same decisions the camera does, see doc/Star-Tracking-and-Analysis.md
+# the device does the math in 32 bit floats and the host in doubles, results can differ in the last digits
+# the sub-pixel analysis in blob2guidestar() is done by find_blobs() in guidestarmode on the device
+
+import math
+
+SENSOR_WIDTH   = 2592
+SENSOR_HEIGHT  = 1944
+SENSOR_DIAG    = 3240
+BEST_MAXBRIGHT = 256 - 64
+PROFILE_LEN    = 8
+
+def c_div(a, b):
+    # C integer division, truncates towards zero, the Cortex-M divider gives 0 when dividing by 0
+    if b == 0:
+        return 0
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        return -q
+    return q
+
+def map_val_int(x, in_min, in_max, out_min, out_max):
+    # same as py_mathhelper.c
+    y = (x - in_min) * (out_max - out_min)
+    div = in_max - in_min
+    y += c_div(div, 2)
+    y = c_div(y, div)
+    y += out_min
+    return y
+
+def fast_roundf(x):
+    # the FPU rounds half to even, so does Python
+    return int(round(x))
+
+def calc_dist_float(x1, y1, x2, y2):
+    dx = x1 - x2
+    dy = y1 - y2
+    return math.sqrt((dx * dx) + (dy * dy))
+
+class GuideStar(object):
+
+    def __init__(self, cx, cy, r, max_brightness, profile, pointiness = 0, saturation = 0, pixels = 0, brightness = 0):
+        self.x = cx
+        self.y = cy
+        self.radius = r
+        self.maxb = max_brightness
+        self.profile = profile
+        self.pointiness = pointiness
+        self.saturation = saturation # count of saturated pixels
+        if pixels <= 0:
+            # made up by a simulator, the star is about this big
+            pixels = max(1, int(round(math.pi * r * r)))
+        self.npix = pixels
+        self.bsum = brightness
+        self.rating = 0
+        self.clust = 0
+
+    def cxf(self):
+        return self.x
+
+    def cyf(self):
+        return self.y
+
+    def cx(self):
+        return int(round(self.x))
+
+    def cy(self):
+        return int(round(self.y))
+
+    def r(self):
+        return self.radius
+
+    def coord(self):
+        return (self.x, self.y)
+
+    def pixels(self):
+        return self.npix
+
+    def max_brightness(self):
+        return self.maxb
+
+    def brightness_sum(self):
+        return self.bsum
+
+    def star_profile(self):
+        return self.profile
+
+    def star_pointiness(self):
+        return self.pointiness
+
+    def clustered(self):
+        return self.clust
+
+    def star_rating(self):
+        return self.rating
+
+    def set_rating(self, x):
+        self.rating = x
+
+    def eval(self):
+        b = self.maxb
+        if b >= BEST_MAXBRIGHT and b != 254:
+            score_maxbright = 100
+        elif b < BEST_MAXBRIGHT:
+            score_maxbright = map_val_int(b, 0, BEST_MAXBRIGHT, 0, 100)
+        else:
+            score_maxbright = 75
+
+        satcnt = self.saturation
+        score_saturation = 100
+        if satcnt > 1:
+            score_saturation -= map_val_int(satcnt, 0, self.npix, 0, 100)
+
+        total = (self.pointiness * 66) + (score_maxbright * 17) + (score_saturation * 17)
+        if self.clust > 0:
+            total = c_div(total, 4)
+        if satcnt >= 9:
+            total = c_div(total, 2)
+        total += 50
+        total = c_div(total, 100)
+        self.rating = total
+        return self.rating
+
+    def move_coord(self, cx, cy):
+        self.x = cx
+        self.y = cy
+
+    def clone(self):
+        s = GuideStar(self.x, self.y, self.radius, self.maxb, self.profile, self.pointiness, self.saturation, self.npix, self.bsum)
+        s.rating = self.rating
+        s.clust = self.clust
+        return s
+
+    def __repr__(self):
+        return "GuideStar(%0.1f, %0.1f, r=%u, rating=%u)" % (self.x, self.y, self.radius, self.rating)
+
+def blobs2guidestars(blobs):
+    res = []
+    for b in blobs:
+        res.append(blob2guidestar(b))
+    return res
+
+def blob2guidestar(b):
+    patch = getattr(b, "patch", None)
+    r = (b.w() + b.h()) // 3
+    if patch is None:
+        # blob was not found in guidestarmode, no pixels to analyze
+        return GuideStar(b.cxf(), b.cyf(), r, 0, [0], 0, 0, b.pixels(), b.brightness_sum())
+    rows = len(patch)
+    cols = len(patch[0])
+    total = 0
+    sum_x = 0
+    sum_y = 0
+    maxb = 0
+    peak = (0, 0)
+    saturated = 0
+    for j in range(rows):
+        for i in range(cols):
+            if b.patch_mask[j][i] == False:
+                continue
+            v = int(patch[j][i])
+            total += v
+            sum_x += v * i
+            sum_y += v * j
+            if v > maxb:
+                maxb = v
+                peak = (i, j)
+            if v >= 255:
+                saturated += 1
+    if total <= 0:
+        return GuideStar(b.cxf(), b.cyf(), r, 0, [0], 0, 0, b.pixels(), b.brightness_sum())
+    cx = (sum_x / total) + b.x()
+    cy = (sum_y / total) + b.y()
+    # radial profile, average brightness at each integer distance from the brightest pixel
+    ring_sum = [0] * PROFILE_LEN
+    ring_cnt = [0] * PROFILE_LEN
+    for j in range(rows):
+        for i in range(cols):
+            d = int(round(math.sqrt(((i - peak[0]) ** 2) + ((j - peak[1]) ** 2))))
+            if d < PROFILE_LEN:
+                ring_sum[d] += int(patch[j][i])
+                ring_cnt[d] += 1
+    profile = []
+    for k in range(PROFILE_LEN):
+        if ring_cnt[k] <= 0:
+            break
+        profile.append(ring_sum[k] // ring_cnt[k])
+    pointiness = 0
+    if len(profile) >= 2 and profile[0] > 0:
+        k = min(len(profile) - 1, max(1, r // 2))
+        pointiness = ((profile[0] - profile[k]) * 100) // profile[0]
+    return GuideStar(cx, cy, r, maxb, profile, pointiness, saturated, b.pixels(), total)
+
+def guidestar_sort(stars):
+    # best rating first, the firmware uses qsort(), which leaves equal ratings in no particular order, this keeps them in order
+    stars.sort(key = lambda s: s.rating, reverse = True)
+
+def mark_clusters(stars, tol):
+    tol = int(tol)
+    lim = len(stars)
+    for i in range(lim):
+        for j in range(lim):
+            if i != j:
+                star_a = stars[i]
+                star_b = stars[j]
+                mag = fast_roundf(calc_dist_float(star_a.x, star_a.y, star_b.x, star_b.y))
+                if mag < tol:
+                    star_a.clust = tol
+                    star_b.clust = tol
+
+def filter_hotpixels(stars, hotpixs, tol):
+    # removes stars from the list, in place
+    if hotpixs is None:
+        return
+    # the firmware only reads the tolerance when it is not given (and then fails to convert None), it is always 2
+    if tol is None:
+        raise TypeError("can't convert NoneType to int")
+    tol = 2
+    i = 0
+    while i < len(stars):
+        j = 0
+        while j < len(hotpixs):
+            # after a removal the firmware carries on with the star before it, which was already tested against every hot pixel
+            # before the first star, it reads outside of the list, that is skipped here
+            if i >= 0:
+                star_a = stars[i]
+                star_b = hotpixs[j]
+                mag = fast_roundf(calc_dist_float(star_a.x, star_a.y, int(star_b[0]), int(star_b[1])))
+                if mag <= tol:
+                    del stars[i]
+                    i -= 1
+            j += 1
+        i += 1
+
+def stars2hotpixels(stars):
+    res = []
+    for s in stars:
+        res.append((fast_roundf(s.x), fast_roundf(s.y)))
+    return res
+
+def process_list(stars, cluster_tol = None, hotpixels = None, hotpixel_tol = None, min_rating = None):
+    # removes hot pixels in place, marks clusters, rates the stars relative to the best one, then sorts the list by rating
+    # returns (list, length before, length after, how many are rated at least min_rating)
+    b4len = len(stars)
+    if hotpixels is not None:
+        filter_hotpixels(stars, hotpixels, hotpixel_tol)
+    if cluster_tol is not None:
+        mark_clusters(stars, cluster_tol)
+    length = len(stars)
+    max_score = 0
+    for s in stars:
+        score = s.eval()
+        if score > max_score:
+            max_score = score
+    if min_rating is None:
+        min_rating = 0
+    good_enough = 0
+    for s in stars:
+        score = s.rating
+        score *= 100
+        score += c_div(max_score, 2)
+        score = c_div(score, max_score)
+        s.rating = score
+        if score >= min_rating:
+            good_enough += 1
+    guidestar_sort(stars)
+    return (stars, b4len, length, good_enough)
+
+def select_first(stars, boundary = 50):
+    # the first star (best rated, if the list is sorted) inside a central region
+    # the firmware calls itself again with a smaller border if none is found, but it passes on the border and not the percentage,
+    # so it only ever tries two regions, back and forth, until the stack runs out, that is where the RuntimeError comes from
+    tried = []
+    while True:
+        boundary = 100 - int(boundary)
+        if boundary in tried:
+            raise RuntimeError("maximum recursion depth exceeded")
+        tried.append(boundary)
+        region = c_div(SENSOR_HEIGHT * boundary, 200)
+        left   = region
+        right  = SENSOR_WIDTH - region
+        top    = region
+        bottom = SENSOR_HEIGHT - region
+        for star in stars:
+            x = fast_roundf(star.x)
+            y = fast_roundf(star.y)
+            if x >= left and x <= right and y >= top and y <= bottom:
+                return star
+        boundary = boundary + 10
+
+class PossibleMove(object):
+
+    def __init__(self, idx, star, dx, dy, mag):
+        self.star_idx = idx
+        self.star = star
+        self.dx = dx
+        self.dy = dy
+        self.mag = mag
+        self.nearby = 0
+        self.err_sum = 0 # an int in the firmware
+        self.err_avg = 0.0
+        self.score = 0
+
+def eval_move(move, tolerance, old_list, new_list):
+    move.nearby = 0
+    move.err_sum = 0
+    move.err_avg = 0.0
+    move.score = 0
+    for star in old_list:
+        # if this is the movement, then where should the new star be, referencing the old star
+        nx = star.x + move.dx
+        ny = star.y + move.dy
+        min_dist = float(SENSOR_DIAG)
+        # find the closest match in the new list to the new star
+        for new_star in new_list:
+            mag = calc_dist_float(nx, ny, new_star.x, new_star.y)
+            if mag < min_dist:
+                min_dist = mag
+        if fast_roundf(min_dist) < tolerance:
+            move.nearby += 1
+            move.err_sum = int(move.err_sum + min_dist)
+    if move.nearby > 0:
+        move.err_avg = move.err_sum / float(move.nearby)
+
+def get_single_star_motion(old_list, new_list, selected_star, tolerance, fast_mode):
+    # returns (star, average error, number of stars that moved the same way)
+    if old_list is None or new_list is None or selected_star is None:
+        return (None, SENSOR_DIAG, 0)
+    new_list_len = len(new_list)
+    if new_list_len < 1:
+        return (None, SENSOR_DIAG - 1, 0)
+    elif new_list_len == 1:
+        return (new_list[0], 0, 1)
+    fast_mode = int(fast_mode)
+    quick_match_required = c_div(new_list_len * fast_mode, 100)
+    tolerance = int(tolerance)
+
+    # each star in the new list is a possible movement vector
+    move_list = []
+    closest_mag = float(SENSOR_DIAG)
+    closest_star = None
+    for i in range(new_list_len):
+        new_star = new_list[i]
+        dx = new_star.x - selected_star.x
+        dy = new_star.y - selected_star.y
+        mag = math.sqrt((dx * dx) + (dy * dy))
+        move = PossibleMove(i, new_star, dx, dy, mag)
+        move_list.append(move)
+        if mag < closest_mag:
+            closest_mag = mag
+            closest_star = new_star
+        if fast_mode > 0:
+            # fast mode means do not care about all other results if one looks great
+            eval_move(move, tolerance, old_list, new_list)
+            err_avg = fast_roundf(move.err_avg)
+            if err_avg < tolerance and move.nearby >= quick_match_required:
+                return (new_star, err_avg, move.nearby)
+
+    if len(old_list) <= 1:
+        if closest_star is not None:
+            return (closest_star, 0, 1)
+
+    if fast_mode <= 0:
+        for move in move_list:
+            eval_move(move, tolerance, old_list, new_list)
+
+    # find the criteria for calculating score
+    best_nearby = quick_match_required
+    for move in move_list:
+        if move.nearby > best_nearby:
+            best_nearby = move.nearby
+
+    best_score = 0
+    best_err = SENSOR_DIAG
+    best_move_nearby = 0
+    best_star = None
+    best_move = None
+    # score all possible moves and find the best one
+    for move in move_list:
+        nb = move.nearby
+        err_avg = fast_roundf(move.err_avg)
+        if err_avg >= tolerance:
+            continue
+        score_nearby = map_val_int(nb, 0, best_nearby, 0, 100) * 50
+        score_erravg = (100 - map_val_int(err_avg, 0, tolerance, 0, 100)) * 50
+        score_total = c_div(score_nearby + score_erravg, 100)
+        move.score = score_total
+        if score_total > best_score:
+            best_score = score_total
+            best_err = err_avg
+            best_move_nearby = nb
+            best_star = move.star
+            best_move = move
+    if best_move is not None and best_move_nearby > 0:
+        return (best_star, best_err, best_move_nearby)
+    return (None, SENSOR_DIAG - 2, 0)
+
+def get_multi_star_motion(old_list, new_list, selected_star, tolerance, fast_mode, rating_thresh, mstarcnt_min, mstarcnt_max):
+    # returns (real star, virtual star x, virtual star y, move error, correctly moved count, multi-star count)
+    # the real star is None if no match is found, with 3240 as the error
+    single_res = get_single_star_motion(old_list, new_list, selected_star, tolerance, fast_mode)
+    star = single_res[0]
+    if star is None:
+        return (None, -1.0, -1.0, SENSOR_DIAG, 0, 0)
+    mstarcnt_max = int(mstarcnt_max)
+    new_list_len = len(new_list)
+    if mstarcnt_max <= 1 or new_list_len <= 1:
+        return (star, star.x, star.y, int(single_res[1]), int(single_res[2]), 1)
+    tolerance = int(tolerance)
+    rating_thresh = int(rating_thresh)
+    mstarcnt_min = int(mstarcnt_min)
+    ssx = selected_star.x
+    ssy = selected_star.y
+    dx = star.x - ssx
+    dy = star.y - ssy
+    dx_sum = 0.0
+    dy_sum = 0.0
+    avg_cnt = 0
+    avg_weight = 0.0
+    for old_star in old_list:
+        ox = old_star.x
+        oy = old_star.y
+        onx = ox + dx
+        ony = oy + dy
+        nearest_rating = -1
+        nearest_mag = float(SENSOR_DIAG)
+        best_dx = 0.0
+        best_dy = 0.0
+        for new_star in new_list:
+            ndx = new_star.x - onx
+            ndy = new_star.y - ony
+            mag = math.sqrt((ndx * ndx) + (ndy * ndy))
+            if mag < nearest_mag:
+                # if we find the one closest to the new predicted coordinate, remember the actual movement between the old and new coordinate
+                nearest_mag = mag
+                nearest_rating = new_star.rating
+                best_dx = ndx
+                best_dy = ndy
+        # if confidently found one closest to the new predicted coordinate
+        # use it in the average movement if it meets the criteria
+        if nearest_rating >= 0 and fast_roundf(nearest_mag) < tolerance and (avg_cnt < mstarcnt_min or (old_star.rating >= rating_thresh and nearest_rating >= rating_thresh)):
+            ssdistx = ssx - ox
+            ssdisty = ssy - oy
+            dist_ori = math.sqrt((ssdistx * ssdistx) + (ssdisty * ssdisty))
+            dist_weight = SENSOR_DIAG - dist_ori
+            # the average movement is computed with a weight
+            # the closer it is to selected_star, the more weight it has
+            dx_sum += best_dx * dist_weight
+            dy_sum += best_dy * dist_weight
+            avg_cnt += 1
+            avg_weight += dist_weight
+            if avg_cnt >= mstarcnt_max:
+                break
+
+    if avg_cnt <= 0:
+        # all stars have bad rating, fall back on using the original calculated move
+        dx_avg = dx
+        dy_avg = dy
+    else:
+        # average all of the movements
+        dx_avg = dx_sum / avg_weight
+        dy_avg = dy_sum / avg_weight
+    return (star, star.x + dx_avg, star.y + dy_avg, int(single_res[1]), int(single_res[2]), avg_cnt)
@@ -0,0 +1,73 @@
+# sets up a CPython process so that the device code in openmv_mpy and openmv_filesys can run unmodified
+# usage:
+#   import hostenv
+#   hostenv.install(flash_dir = "/tmp/flash", virtual_clock = True)
+#   import autoguider
+
+import os, sys, gc, time, traceback
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(HOST_DIR)
+MPY_DIR  = os.path.join(ROOT_DIR, "openmv_mpy")
+FS_DIR   = os.path.join(ROOT_DIR, "openmv_filesys")
+
+HEAP_SIZE = 256 * 1024
+
+installed = False
+
+def _print_exception(exc, file = None):
+    traceback.print_exception(type(exc), exc, exc.__traceback__, file = file if file is not None else sys.stdout)
+
+def _mem_free():
+    return HEAP_SIZE // 2
+
+def _mem_alloc():
+    return HEAP_SIZE // 2
+
+class _Clock(object):
+    # MicroPython's time.clock(), used by the frame rate tests
+    def __init__(self):
+        import pyb
+        self.t = pyb.millis()
+        self.dt = 0
+
+    def tick(self):
+        import pyb
+        now = pyb.millis()
+        self.dt = now - self.t
+        self.t = now
+
+    def fps(self):
+        if self.dt <= 0:
+            return 0.0
+        return 1000.0 / self.dt
+
+    def avg(self):
+        return self.dt
+
+def install(flash_dir = None, virtual_clock = False, clock_step_ms = 1, seed = None, port_map = None):
+    global installed
+    for p in [FS_DIR, MPY_DIR, HOST_DIR]:
+        if p not in sys.path:
+            sys.path.insert(0, p)
+    if hasattr(sys, "print_exception") == False:
+        sys.print_exception = _print_exception
+    if hasattr(gc, "mem_free") == False:
+        gc.mem_free = _mem_free
+    if hasattr(gc, "mem_alloc") == False:
+        gc.mem_alloc = _mem_alloc
+    if hasattr(time, "clock") == False:
+        time.clock = _Clock
+    import pyb
+    pyb.set_virtual_clock(virtual_clock, step_ms = clock_step_ms)
+    if seed is not None:
+        pyb.seed(seed)
+    if port_map is not None:
+        import usocket
+        usocket.PORT_MAP.update(port_map)
+    if flash_dir is not None:
+        # the device code uses paths relative to the root of its flash drive
+        if os.path.isdir(flash_dir) == False:
+            os.makedirs(flash_dir)
+        os.chdir(flash_dir)
+    installed = True
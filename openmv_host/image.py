@@ -0,0 +1,573 @@
+# host stand-in for the OpenMV "image" module
+# images are backed by NumPy arrays, grayscale is (height, width) uint8 and RGB565 is stored as (height, width, 3) uint8
+# only the parts of the API used by this project are implemented, with the custom firmware extensions to find_blobs
+
+import struct
+import numpy as np
+import blob_engine
+
+try:
+    from PIL import Image as PilImage
+except ImportError:
+    PilImage = None
+
+BINARY    = 1
+GRAYSCALE = 2
+RGB565    = 3
+BAYER     = 4
+JPEG      = 5
+
+class Image(object):
+
+    def __init__(self, arg, copy_to_fb = False, pixformat = GRAYSCALE):
+        # arg can be a file path, a NumPy array, or a (width, height) tuple for a blank image
+        self.ts = 0
+        if isinstance(arg, str):
+            self.data = load_file(arg)
+        elif isinstance(arg, np.ndarray):
+            self.data = np.ascontiguousarray(arg, dtype = np.uint8)
+        elif isinstance(arg, Image):
+            self.data = arg.data.copy()
+        else:
+            w, h = arg
+            if pixformat == RGB565:
+                self.data = np.zeros((h, w, 3), dtype = np.uint8)
+            else:
+                self.data = np.zeros((h, w), dtype = np.uint8)
+
+    def width(self):
+        return self.data.shape[1]
+
+    def height(self):
+        return self.data.shape[0]
+
+    def format(self):
+        return RGB565 if self.data.ndim == 3 else GRAYSCALE
+
+    def size(self):
+        if self.data.ndim == 3:
+            return self.data.shape[0] * self.data.shape[1] * 2
+        return self.data.size
+
+    def is_grayscale(self):
+        return self.data.ndim == 2
+
+    def timestamp(self):
+        return self.ts
+
+    def set_timestamp(self, ts):
+        self.ts = ts
+
+    def bytearray(self):
+        return bytearray(self.data.tobytes())
+
+    def ndarray(self):
+        # host-only accessor, grants direct access to the pixel array
+        return self.data
+
+    def copy(self, roi = None, copy_to_fb = None):
+        if roi is None:
+            img = Image(self.data.copy())
+        else:
+            img = Image(self.data[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]].copy())
+        img.ts = self.ts
+        return img
+
+    def replace(self, img, **kwargs):
+        self.data = img.data.copy()
+        self.ts = img.ts
+        return self
+
+    def to_grayscale(self, copy = False):
+        if self.data.ndim == 3:
+            # same integer luma approximation as imlib's COLOR_RGB888_TO_Y
+            r = self.data[:, :, 0].astype(np.uint32)
+            g = self.data[:, :, 1].astype(np.uint32)
+            b = self.data[:, :, 2].astype(np.uint32)
+            y = ((r * 38) + (g * 75) + (b * 15)) >> 7
+            data = y.astype(np.uint8)
+        else:
+            data = self.data
+        if copy:
+            img = Image(data.copy())
+            img.ts = self.ts
+            return img
+        self.data = data
+        return self
+
+    def _gray(self):
+        if self.data.ndim == 3:
+            return self.to_grayscale(copy = True).data
+        return self.data
+
+    def get_pixel(self, x, y):
+        if x < 0 or y < 0 or x >= self.width() or y >= self.height():
+            return None
+        v = self.data[y, x]
+        if self.data.ndim == 3:
+            return tuple(int(i) for i in v)
+        return int(v)
+
+    def set_pixel(self, x, y, c):
+        if x < 0 or y < 0 or x >= self.width() or y >= self.height():
+            return self
+        self.data[y, x] = c
+        return self
+
+    def get_histogram(self, roi = None, bins = 256, thresholds = None, invert = False):
+        data = self._gray()
+        if roi is not None:
+            data = data[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]]
+        counts = np.bincount(data.ravel(), minlength = 256).astype(np.float64)
+        if bins != 256:
+            counts = np.add.reduceat(counts, np.linspace(0, 256, bins, endpoint = False).astype(np.int64))
+        total = counts.sum()
+        if total > 0:
+            counts /= total
+        return Histogram(counts)
+
+    def get_statistics(self, roi = None, bins = 256):
+        return self.get_histogram(roi = roi, bins = bins).get_statistics()
+
+    def find_blobs(self, thresholds, invert = False, roi = None, x_stride = 2, y_stride = 1,
+                   area_threshold = 10, pixels_threshold = 10, merge = False, margin = 0,
+                   threshold_cb = None, merge_cb = None,
+                   pixel_threshold = None, width_threshold = 0, height_threshold = 0, guidestarmode = False):
+        # the custom firmware spells the pixel count threshold as "pixel_threshold"
+        if pixel_threshold is not None:
+            pixels_threshold = pixel_threshold
+        found = blob_engine.find_blobs(self._gray(), thresholds, invert, roi, x_stride, y_stride,
+                                       area_threshold, pixels_threshold, width_threshold, height_threshold)
+        rx, ry = found.roi[0], found.roi[1]
+        blobs = []
+        for i in range(len(found)):
+            x, y, w, h = int(found.x[i]), int(found.y[i]), int(found.w[i]), int(found.h[i])
+            b = Blob(x, y, w, h, int(found.pixels[i]), float(found.cx[i]), float(found.cy[i]), int(found.brightness[i]))
+            if guidestarmode:
+                b.attach_pixels(self._gray(), found.mask[y - ry:y - ry + h, x - rx:x - rx + w])
+            if threshold_cb is not None and threshold_cb(b) == False:
+                continue
+            blobs.append(b)
+        if merge:
+            blobs = merge_blobs(blobs, margin, merge_cb)
+        return blobs
+
+    def scale(self, x_scale = 1.0, y_scale = 1.0, roi = None, copy_to_fb = None, copy = False, **kwargs):
+        data = self.data
+        if roi is not None:
+            data = data[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]]
+        data = resize(data, x_scale, y_scale)
+        if copy_to_fb is not None or copy:
+            img = Image(data)
+            img.ts = self.ts
+            if isinstance(copy_to_fb, Image):
+                copy_to_fb.data = img.data
+                copy_to_fb.ts = img.ts
+                return copy_to_fb
+            return img
+        self.data = data
+        return self
+
+    def crop(self, roi = None, x_scale = 1.0, y_scale = 1.0, copy_to_fb = None, copy = False, **kwargs):
+        return self.scale(x_scale = x_scale, y_scale = y_scale, roi = roi, copy_to_fb = copy_to_fb, copy = copy)
+
+    def compress(self, quality = 50):
+        return CompressedImage(encode_jpeg(self.data, quality), self.width(), self.height())
+
+    def compressed(self, quality = 50):
+        return self.compress(quality = quality)
+
+    def save(self, path, roi = None, quality = 50):
+        data = self.data
+        if roi is not None:
+            data = data[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]]
+        save_file(path, data, quality)
+        return self
+
+    def draw_line(self, x0, y0, x1 = None, y1 = None, color = 255, thickness = 1):
+        if x1 is None: # called with a tuple
+            x0, y0, x1, y1 = x0
+        n = int(max(abs(x1 - x0), abs(y1 - y0))) + 1
+        xs = np.rint(np.linspace(x0, x1, n)).astype(np.int64)
+        ys = np.rint(np.linspace(y0, y1, n)).astype(np.int64)
+        self._plot(xs, ys, color)
+        return self
+
+    def draw_rectangle(self, x, y = None, w = None, h = None, color = 255, thickness = 1, fill = False):
+        if y is None:
+            x, y, w, h = x
+        if fill:
+            x0, y0, ww, hh = blob_engine.clip_roi((x, y, w, h), self.width(), self.height())
+            self.data[y0:y0 + hh, x0:x0 + ww] = color
+            return self
+        self.draw_line(x, y, x + w - 1, y, color)
+        self.draw_line(x, y + h - 1, x + w - 1, y + h - 1, color)
+        self.draw_line(x, y, x, y + h - 1, color)
+        self.draw_line(x + w - 1, y, x + w - 1, y + h - 1, color)
+        return self
+
+    def draw_ellipse(self, cx, cy, rx, ry, rotation = 0, color = 255, thickness = 1, fill = False):
+        n = max(16, int(round((rx + ry) * 4)))
+        t = np.linspace(0, 2 * np.pi, n, endpoint = False)
+        rot = np.radians(rotation)
+        ex = (rx * np.cos(t) * np.cos(rot)) - (ry * np.sin(t) * np.sin(rot))
+        ey = (rx * np.cos(t) * np.sin(rot)) + (ry * np.sin(t) * np.cos(rot))
+        self._plot(np.rint(cx + ex).astype(np.int64), np.rint(cy + ey).astype(np.int64), color)
+        return self
+
+    def draw_circle(self, x, y, radius, color = 255, thickness = 1, fill = False):
+        return self.draw_ellipse(x, y, radius, radius, 0, color)
+
+    def draw_cross(self, x, y, color = 255, size = 5, thickness = 1):
+        self.draw_line(x - size, y, x + size, y, color)
+        self.draw_line(x, y - size, x, y + size, color)
+        return self
+
+    def draw_string(self, x, y, text, color = 255, scale = 1, **kwargs):
+        # there is no bitmap font on the host, annotations are skipped
+        return self
+
+    def _plot(self, xs, ys, color):
+        keep = (xs >= 0) & (ys >= 0) & (xs < self.width()) & (ys < self.height())
+        self.data[ys[keep], xs[keep]] = color
+
+class Histogram(object):
+
+    def __init__(self, bins):
+        self.b = bins
+
+    def bins(self):
+        return list(self.b)
+
+    def l_bins(self):
+        return self.bins()
+
+    def get_percentile(self, percentile):
+        cdf = np.cumsum(self.b)
+        idx = int(np.searchsorted(cdf, percentile))
+        if idx >= len(self.b):
+            idx = len(self.b) - 1
+        return Percentile(int(round(idx * 255 / max(1, len(self.b) - 1))))
+
+    def get_statistics(self):
+        return Statistics(self.b)
+
+class Percentile(object):
+
+    def __init__(self, v):
+        self.v = v
+
+    def value(self):
+        return self.v
+
+    def l_value(self):
+        return self.v
+
+class Statistics(object):
+    # imlib computes these from the normalized histogram and truncates them to integers
+
+    def __init__(self, bins):
+        n = len(bins)
+        vals = np.arange(n, dtype = np.float64) * (255.0 / max(1, n - 1))
+        nz = np.flatnonzero(bins)
+        if len(nz) <= 0:
+            self.s = (0, 0, 0, 0, 0, 0, 0, 0)
+            return
+        mean = float(np.dot(bins, vals))
+        var = float(np.dot(bins, vals * vals)) - (mean * mean)
+        cdf = np.cumsum(bins)
+        median = vals[min(n - 1, int(np.searchsorted(cdf, 0.5)))]
+        lq = vals[min(n - 1, int(np.searchsorted(cdf, 0.25)))]
+        uq = vals[min(n - 1, int(np.searchsorted(cdf, 0.75)))]
+        mode = vals[int(np.argmax(bins))]
+        self.s = (int(mean), int(median), int(mode), int(np.sqrt(max(var, 0.0))), int(vals[nz[0]]), int(vals[nz[-1]]), int(lq), int(uq))
+
+    def mean(self):
+        return self.s[0]
+
+    def median(self):
+        return self.s[1]
+
+    def mode(self):
+        return self.s[2]
+
+    def stdev(self):
+        return self.s[3]
+
+    def min(self):
+        return self.s[4]
+
+    def max(self):
+        return self.s[5]
+
+    def lq(self):
+        return self.s[6]
+
+    def uq(self):
+        return self.s[7]
+
+    l_mean   = mean
+    l_median = median
+    l_mode   = mode
+    l_stdev  = stdev
+    l_min    = min
+    l_max    = max
+    l_lq     = lq
+    l_uq     = uq
+
+    def __getitem__(self, i):
+        return self.s[i]
+
+class Blob(object):
+
+    def __init__(self, x, y, w, h, pixels, cx, cy, brightness_sum):
+        self.bx = x
+        self.by = y
+        self.bw = w
+        self.bh = h
+        self.npix = pixels
+        self.fx = cx
+        self.fy = cy
+        self.bsum = brightness_sum
+        self.patch = None
+        self.patch_mask = None
+
+    def attach_pixels(self, gray, mask):
+        # guidestarmode keeps a copy of the pixels so that guidestar.blobs2guidestars can do sub-pixel analysis
+        self.patch = gray[self.by:self.by + self.bh, self.bx:self.bx + self.bw].copy()
+        self.patch_mask = mask.copy()
+
+    def rect(self):
+        return (self.bx, self.by, self.bw, self.bh)
+
+    def x(self):
+        return self.bx
+
+    def y(self):
+        return self.by
+
+    def w(self):
+        return self.bw
+
+    def h(self):
+        return self.bh
+
+    def pixels(self):
+        return self.npix
+
+    def area(self):
+        return self.bw * self.bh
+
+    def cx(self):
+        return int(round(self.fx))
+
+    def cy(self):
+        return int(round(self.fy))
+
+    def cxf(self):
+        return self.fx
+
+    def cyf(self):
+        return self.fy
+
+    def brightness_sum(self):
+        return self.bsum
+
+    def density(self):
+        return self.npix / float(self.area())
+
+    def code(self):
+        return 1
+
+    def count(self):
+        return 1
+
+    def __getitem__(self, i):
+        return (self.bx, self.by, self.bw, self.bh, self.npix, self.cx(), self.cy())[i]
+
+class CompressedImage(bytes):
+    # a JPEG byte string that also answers the Image size queries, it can be passed straight to socket.send()
+
+    def __new__(cls, payload, w, h):
+        obj = super().__new__(cls, payload)
+        obj.w = w
+        obj.h = h
+        return obj
+
+    def size(self):
+        return len(self)
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+    def bytearray(self):
+        return bytearray(self)
+
+def merge_blobs(blobs, margin = 0, merge_cb = None):
+    merged = True
+    while merged:
+        merged = False
+        i = 0
+        while i < len(blobs):
+            j = i + 1
+            while j < len(blobs):
+                a = blobs[i]
+                b = blobs[j]
+                if a.bx - margin <= b.bx + b.bw and b.bx - margin <= a.bx + a.bw and a.by - margin <= b.by + b.bh and b.by - margin <= a.by + a.bh:
+                    if merge_cb is None or merge_cb(a, b):
+                        x0 = min(a.bx, b.bx)
+                        y0 = min(a.by, b.by)
+                        x1 = max(a.bx + a.bw, b.bx + b.bw)
+                        y1 = max(a.by + a.bh, b.by + b.bh)
+                        n = a.npix + b.npix
+                        blobs[i] = Blob(x0, y0, x1 - x0, y1 - y0, n, ((a.fx * a.npix) + (b.fx * b.npix)) / n, ((a.fy * a.npix) + (b.fy * b.npix)) / n, a.bsum + b.bsum)
+                        del blobs[j]
+                        merged = True
+                        continue
+                j += 1
+            i += 1
+    return blobs
+
+def resize(data, x_scale, y_scale):
+    h, w = data.shape[0], data.shape[1]
+    nw = max(1, int(w * x_scale))
+    nh = max(1, int(h * y_scale))
+    if nw == w and nh == h:
+        return data.copy()
+    fx = w / float(nw)
+    fy = h / float(nh)
+    if fx == int(fx) and fy == int(fy) and fx >= 1 and fy >= 1:
+        # integer down-scaling is done by area averaging
+        fx = int(fx)
+        fy = int(fy)
+        block = data[0:nh * fy, 0:nw * fx].astype(np.uint32)
+        block = block.reshape((nh, fy, nw, fx) + data.shape[2:])
+        return (block.sum(axis = (1, 3)) // (fx * fy)).astype(np.uint8)
+    xs = np.minimum((np.arange(nw) * fx).astype(np.int64), w - 1)
+    ys = np.minimum((np.arange(nh) * fy).astype(np.int64), h - 1)
+    return data[ys][:, xs]
+
+def encode_jpeg(data, quality = 50):
+    if PilImage is None:
+        # without Pillow the "JPEG" is a binary PGM/PPM, browsers will not show it but sizes stay realistic enough for testing
+        return encode_pnm(data)
+    import io
+    buf = io.BytesIO()
+    PilImage.fromarray(data).save(buf, format = "JPEG", quality = quality)
+    return buf.getvalue()
+
+def encode_pnm(data):
+    magic = b"P6" if data.ndim == 3 else b"P5"
+    return magic + b"\n%u %u\n255\n" % (data.shape[1], data.shape[0]) + data.tobytes()
+
+def load_file(path):
+    lower = path.lower()
+    if lower.endswith(".npy"):
+        return np.ascontiguousarray(np.load(path), dtype = np.uint8)
+    with open(path, "rb") as f:
+        raw = f.read()
+    if raw[0:2] == b"BM":
+        return decode_bmp(raw)
+    if raw[0:2] in (b"P5", b"P6"):
+        return decode_pnm(raw)
+    if PilImage is None:
+        raise OSError("cannot load \"%s\" without Pillow installed" % path)
+    im = PilImage.open(path)
+    if im.mode not in ("L", "RGB"):
+        im = im.convert("RGB")
+    return np.ascontiguousarray(np.asarray(im), dtype = np.uint8)
+
+def save_file(path, data, quality = 50):
+    lower = path.lower()
+    if lower.endswith(".npy"):
+        np.save(path, data)
+        return
+    if lower.endswith(".pgm") or lower.endswith(".ppm"):
+        payload = encode_pnm(data)
+    elif lower.endswith(".bmp"):
+        payload = encode_bmp(data)
+    elif lower.endswith(".jpg") or lower.endswith(".jpeg"):
+        payload = encode_jpeg(data, quality)
+    elif PilImage is not None:
+        PilImage.fromarray(data).save(path)
+        return
+    else:
+        raise OSError("cannot save \"%s\" without Pillow installed" % path)
+    with open(path, "wb") as f:
+        f.write(payload)
+
+def decode_pnm(raw):
+    tokens = []
+    pos = 2
+    while len(tokens) < 3:
+        while raw[pos:pos + 1].isspace():
+            pos += 1
+        if raw[pos:pos + 1] == b"#":
+            pos = raw.index(b"\n", pos) + 1
+            continue
+        end = pos
+        while raw[end:end + 1].isspace() == False:
+            end += 1
+        tokens.append(int(raw[pos:end]))
+        pos = end
+    pos += 1
+    w, h, maxval = tokens
+    ch = 3 if raw[0:2] == b"P6" else 1
+    arr = np.frombuffer(raw, dtype = np.uint8, count = w * h * ch, offset = pos)
+    if ch == 3:
+        return arr.reshape((h, w, 3)).copy()
+    return arr.reshape((h, w)).copy()
+
+def decode_bmp(raw):
+    # uncompressed 8, 24 and 32 bit BMPs, which covers what the OpenMV IDE and PIL write
+    offset = struct.unpack_from("<I", raw, 10)[0]
+    w, h = struct.unpack_from("<ii", raw, 18)
+    bpp = struct.unpack_from("<H", raw, 28)[0]
+    comp = struct.unpack_from("<I", raw, 30)[0]
+    if comp not in (0, 3):
+        raise OSError("compressed BMP is not supported")
+    flip = h > 0
+    h = abs(h)
+    stride = ((w * bpp + 31) // 32) * 4
+    rows = np.frombuffer(raw, dtype = np.uint8, count = stride * h, offset = offset).reshape((h, stride))
+    if bpp == 8:
+        ncolors = struct.unpack_from("<I", raw, 46)[0] or 256
+        palette = np.frombuffer(raw, dtype = np.uint8, count = ncolors * 4, offset = 14 + struct.unpack_from("<I", raw, 14)[0]).reshape((ncolors, 4))
+        idx = rows[:, 0:w]
+        rgb = palette[idx][:, :, 2::-1]
+        if np.array_equal(rgb[:, :, 0], rgb[:, :, 1]) and np.array_equal(rgb[:, :, 1], rgb[:, :, 2]):
+            data = rgb[:, :, 0]
+        else:
+            data = rgb
+    elif bpp in (24, 32):
+        px = rows[:, 0:w * (bpp // 8)].reshape((h, w, bpp // 8))
+        data = px[:, :, 2::-1]
+    else:
+        raise OSError("%u bit BMP is not supported" % bpp)
+    if flip:
+        data = data[::-1]
+    return np.ascontiguousarray(data)
+
+def encode_bmp(data):
+    h, w = data.shape[0], data.shape[1]
+    if data.ndim == 2:
+        stride = ((w + 3) // 4) * 4
+        palette = np.repeat(np.arange(256, dtype = np.uint8), 4).reshape((256, 4))
+        palette[:, 3] = 0
+        pal = palette.tobytes()
+        bpp = 8
+        rows = np.zeros((h, stride), dtype = np.uint8)
+        rows[:, 0:w] = data[::-1]
+    else:
+        stride = ((w * 3 + 3) // 4) * 4
+        pal = b""
+        bpp = 24
+        rows = np.zeros((h, stride), dtype = np.uint8)
+        rows[:, 0:w * 3] = data[::-1, :, 2::-1].reshape((h, w * 3))
+    offset = 14 + 40 + len(pal)
+    header = struct.pack("<2sIHHI", b"BM", offset + rows.size, 0, 0, offset)
+    info = struct.pack("<IiiHHIIiiII", 40, w, h, 1, bpp, 0, rows.size, 2835, 2835, 256 if bpp == 8 else 0, 0)
+    return header + info + pal + rows.tobytes()
@@ -0,0 +1,14 @@
+# host stand-in for the MicroPython "machine" module
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+def soft_reset():
+    raise SystemExit("machine.soft_reset()")
+
+def freq():
+    return 480000000
+
+def unique_id():
+    import pyb
+    return pyb.unique_id()
@@ -0,0 +1,37 @@
+# host stand-in for the MicroPython "micropython" module
+# everything here is either an identity or a no-op, CPython has no code emitters or heap to inspect
+
+import gc
+
+def const(x):
+    return x
+
+def opt_level(level = None):
+    if level is None:
+        return 0
+    return None
+
+def mem_info(verbose = False):
+    print("mem: total=%u, current=%u, peak=%u" % (gc.mem_alloc() + gc.mem_free(), gc.mem_alloc(), gc.mem_alloc()))
+
+def qstr_info(verbose = False):
+    pass
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+def heap_lock():
+    return 0
+
+def heap_unlock():
+    return 0
+
+def schedule(func, arg):
+    func(arg)
+    return True
+
+def native(func):
+    return func
+
+def viper(func):
+    return func
@@ -0,0 +1,536 @@
+# mount and sky model, for testing guiding without a telescope
+#
+# the mount follows the guide pulses given to guidepulser.move(), on the pyb clock, and adds the errors of a real mount:
+#   periodic error, the RA worm gear's error as a sum of harmonics, each one (period in seconds, amplitude in pixels, phase in degrees)
+#   drift, a constant rate on both axis in pixels per second, what polar misalignment looks like over a short time
+#   backlash, a dead-band on each axis, after changing direction a guide pulse has to take up this many milliseconds of slack before the axis moves
+# the sky adds seeing, a random wander of the whole star field, the sum of a few components that each have a RMS in pixels and a correlation time in seconds
+# slow components look like a drift that the guider should follow, fast components are what it should not chase
+# on top of that, every star's centroid has its own noise
+# a recorded tracking error can be played back instead of, or on top of, the periodic error and drift, see load_error_trace()
+#
+# positions are in the axis' own coordinates (RA, DEC), in pixels, a positive pulse moves the stars along the axis' angle in the image
+# the sky is sampled every step_ms, the star positions in a frame are the average over the exposure, like on a real camera
+#
+# two ways of using it:
+#   attach(), the star finder returns the simulated stars, a whole AutoGuider can calibrate and guide from blank frames
+#   run_guiding(), feeds the star's position directly into AutoGuider.pulse_to_target(), skips star detection and motion analysis
+#   so thousands of frames run per second, for tuning the guide filters and backlash settings, see GuideTrace for the results
+
+import math, random, io, contextlib
+import numpy as np
+
+DEFAULT_PE      = [(480.0, 3.0, 0.0), (240.0, 0.8, 30.0), (160.0, 0.3, 70.0)]
+DEFAULT_SEEING  = [(0.3, 0.2), (0.2, 3.0)]
+SENSOR_WIDTH    = 2592
+SENSOR_HEIGHT   = 1944
+
+class MountSim(object):
+
+    def __init__(self, seed = None, stars = 20,
+                 ra_angle = 30.0, dec_angle = None, ra_rate = 0.005, dec_rate = 0.005,
+                 pe = DEFAULT_PE, drift = (0.0, 0.005), backlash = (0, 1000),
+                 seeing = DEFAULT_SEEING, noise = 0.05, step_ms = 50, disturbance = None):
+        # rates are pixels per millisecond of guide pulse, angles are in degrees
+        self.rand = random.Random(seed)
+        self.nrand = np.random.default_rng(seed)
+        self.nbuf = []
+        self.nidx = 0
+        self.ra_angle = ra_angle
+        self.dec_angle = dec_angle if dec_angle is not None else (ra_angle + 90.0)
+        self.rate = [ra_rate, dec_rate]
+        self.pe = list(pe)
+        self.pe_coef = [(h[1], 2.0 * math.pi / (h[0] * 1000.0), math.radians(h[2])) for h in self.pe]
+        self.drift = list(drift)
+        self.backlash = list(backlash)
+        self.seeing = list(seeing)
+        self.see_coef = {} # step length -> [(decay, gain), ...] for each seeing component
+        self.noise = noise
+        self.disturbance = disturbance # [(time, ra, dec), ...], time in milliseconds from the start, repeats when it runs out
+        self.dist_idx = 0
+        self.step_ms = step_ms
+        self.vec = [(math.cos(math.radians(self.ra_angle)), math.sin(math.radians(self.ra_angle))), (math.cos(math.radians(self.dec_angle)), math.sin(math.radians(self.dec_angle)))]
+
+        if isinstance(stars, int):
+            # random star field, kept away from the edges so guiding never walks them out of the frame
+            self.base_stars = []
+            i = 0
+            while i < stars:
+                self.base_stars.append((self.rand.uniform(200, SENSOR_WIDTH - 200), self.rand.uniform(200, SENSOR_HEIGHT - 200), self.rand.uniform(80, 250)))
+                i += 1
+        else:
+            # list of (x, y, max brightness)
+            self.base_stars = [tuple(s) for s in stars]
+
+        self.t = None
+        self.t0 = 0
+        self.motor = [0.0, 0.0]  # where the pulses have driven the motors to
+        self.axis = [0.0, 0.0]   # where the axis actually are, after backlash
+        self.pulses = [[], []]   # [start time, end time, signed rate] for each axis
+        self.see = [[0.0, 0.0] for s in self.seeing]
+        self.hist = []           # (time, x, y, true x, true y), the field's offset in the image, with and without seeing
+        self.hist_ms = 30000
+        self.pulse_total = [0, 0]
+        self.pulse_cnt = 0
+        self.frame_pulse = [0, 0] # signed sum of the pulses since run_guiding() last looked
+        self.attached = False
+        self.orig_find_stars = None
+
+    def start(self, t):
+        self.t = float(t)
+        self.t0 = self.t
+        self.record()
+
+    def gauss(self):
+        # normally distributed numbers are made in blocks, much faster than random.gauss() one at a time
+        if self.nidx >= len(self.nbuf):
+            self.nbuf = self.nrand.standard_normal(4096).tolist()
+            self.nidx = 0
+        x = self.nbuf[self.nidx]
+        self.nidx += 1
+        return x
+
+    def axis_offset(self, t):
+        # total position of each axis in pixels, without seeing
+        # the errors are timed from the start, so every run with the same seed sees exactly the same sky
+        t -= self.t0
+        ra = self.axis[0] + (self.drift[0] * t / 1000.0)
+        for h in self.pe_coef:
+            ra += h[0] * math.sin((h[1] * t) + h[2])
+        dec = self.axis[1] + (self.drift[1] * t / 1000.0)
+        if self.disturbance is not None and len(self.disturbance) > 1:
+            d_ra, d_dec = self.get_disturbance(t)
+            ra += d_ra
+            dec += d_dec
+        return ra, dec
+
+    def get_disturbance(self, t):
+        # linear interpolation, time only moves forward so the search carries on from where it was
+        d = self.disturbance
+        span = d[-1][0] - d[0][0]
+        if span <= 0:
+            return d[0][1], d[0][2]
+        laps = math.floor((t - d[0][0]) / span)
+        t -= laps * span
+        i = self.dist_idx
+        if i >= len(d) - 1 or d[i][0] > t:
+            i = 0
+        while i < len(d) - 2 and d[i + 1][0] <= t:
+            i += 1
+        self.dist_idx = i
+        t0, ra0, dec0 = d[i]
+        t1, ra1, dec1 = d[i + 1]
+        k = (t - t0) / (t1 - t0) if t1 > t0 else 0
+        # every lap carries on from where the last one ended, so a drift in the trace keeps going
+        ra_lap = (d[-1][1] - d[0][1]) * laps
+        dec_lap = (d[-1][2] - d[0][2]) * laps
+        return ra0 + ((ra1 - ra0) * k) + ra_lap, dec0 + ((dec1 - dec0) * k) + dec_lap
+
+    def to_image(self, ra, dec):
+        return (ra * self.vec[0][0]) + (dec * self.vec[1][0]), (ra * self.vec[0][1]) + (dec * self.vec[1][1])
+
+    def to_axis(self, x, y):
+        # inverse of to_image(), the axis do not need to be perpendicular
+        a, b = self.vec[0]
+        c, d = self.vec[1]
+        det = (a * d) - (b * c)
+        return ((x * d) - (y * c)) / det, ((y * a) - (x * b)) / det
+
+    def record(self):
+        ra, dec = self.axis_offset(self.t)
+        tx, ty = self.to_image(ra, dec)
+        sx = 0.0
+        sy = 0.0
+        for s in self.see:
+            sx += s[0]
+            sy += s[1]
+        self.hist.append((self.t, tx + sx, ty + sy, tx, ty))
+        if self.hist[0][0] < self.t - (self.hist_ms * 2):
+            # trimmed in big bites, removing one at a time from the front of a long list is slow
+            k = 0
+            while k < len(self.hist) and self.hist[k][0] < self.t - self.hist_ms:
+                k += 1
+            self.hist = self.hist[k:]
+
+    def advance_to(self, t):
+        if self.t is None:
+            self.start(t)
+            return
+        while self.t < t:
+            t0 = self.t
+            t1 = min(t, t0 + self.step_ms)
+            dt = t1 - t0
+            i = 0
+            while i < 2:
+                m = self.motor[i]
+                for p in self.pulses[i]:
+                    overlap = min(t1, p[1]) - max(t0, p[0])
+                    if overlap > 0:
+                        m += overlap * p[2]
+                if len(self.pulses[i]) > 0:
+                    self.pulses[i] = [p for p in self.pulses[i] if p[1] > t1]
+                self.motor[i] = m
+                # the axis stays put until the motor has taken up the slack on one side or the other
+                w = self.backlash[i] * self.rate[i] / 2.0
+                a = self.axis[i]
+                if a < m - w:
+                    a = m - w
+                elif a > m + w:
+                    a = m + w
+                self.axis[i] = a
+                i += 1
+            # each seeing component is a first order low pass filter of white noise, its RMS stays the same no matter the step length
+            coef = self.see_coef.get(dt)
+            if coef is None:
+                coef = []
+                for c in self.seeing:
+                    k = math.exp(-dt / (c[1] * 1000.0))
+                    coef.append((k, c[0] * math.sqrt(1.0 - (k * k))))
+                self.see_coef.update({dt: coef})
+            j = 0
+            while j < len(coef):
+                k, g = coef[j]
+                s = self.see[j]
+                s[0] = (k * s[0]) + (g * self.gauss())
+                s[1] = (k * s[1]) + (g * self.gauss())
+                j += 1
+            self.t = t1
+            self.record()
+
+    def on_pulser(self, event, args):
+        import pyb
+        now = pyb.millis()
+        if event == "move":
+            self.advance_to(now)
+            self.cut_pulses(now)
+            i = 0
+            while i < 2:
+                x = args[i]
+                if x != 0:
+                    self.pulses[i].append([now, now + abs(x), self.rate[i] if x > 0 else -self.rate[i]])
+                    self.pulse_total[i] += abs(x)
+                    self.frame_pulse[i] += x
+                i += 1
+            self.pulse_cnt += 1
+        elif event == "stop":
+            self.advance_to(now)
+            self.cut_pulses(now)
+
+    def cut_pulses(self, t):
+        # a new move replaces the one in progress
+        i = 0
+        while i < 2:
+            for p in self.pulses[i]:
+                if p[1] > t:
+                    p[1] = max(p[0], t)
+            i += 1
+
+    def exposure(self, t_start, t_end):
+        # average offset of the star field during the exposure, returns (x, y, true x, true y)
+        self.advance_to(t_end)
+        n = 0
+        acc = [0.0, 0.0, 0.0, 0.0]
+        i = len(self.hist) - 1
+        while i >= 0 and self.hist[i][0] > t_start:
+            h = self.hist[i]
+            if h[0] <= t_end:
+                acc[0] += h[1]
+                acc[1] += h[2]
+                acc[2] += h[3]
+                acc[3] += h[4]
+                n += 1
+            i -= 1
+        if n <= 0:
+            h = self.hist[-1]
+            return h[1], h[2], h[3], h[4]
+        return acc[0] / n, acc[1] / n, acc[2] / n, acc[3] / n
+
+    def star_pos(self, idx, ox, oy):
+        s = self.base_stars[idx]
+        return s[0] + ox + (self.noise * self.gauss()), s[1] + oy + (self.noise * self.gauss())
+
+    def get_stars(self, t_start, t_end):
+        ox, oy, tx, ty = self.exposure(t_start, t_end)
+        res = []
+        i = 0
+        while i < len(self.base_stars):
+            x, y = self.star_pos(i, ox, oy)
+            if x >= 0 and y >= 0 and x < SENSOR_WIDTH and y < SENSOR_HEIGHT:
+                res.append(make_star(x, y, self.base_stars[i][2]))
+            i += 1
+        return res
+
+    def find_stars(self, img, *args, **kwargs):
+        # replaces star_finder.find_stars(), the image is ignored except for its timestamp
+        import sensor, star_finder
+        t_end = img.timestamp()
+        stars = self.get_stars(t_end - (sensor.get_exposure_us() / 1000.0), t_end)
+        return stars, star_finder.EXPO_JUST_RIGHT
+
+    def attach(self, patch_star_finder = True):
+        import pyb, guidepulser, star_finder
+        if self.attached:
+            return
+        if self.t is None:
+            self.start(pyb.millis())
+        guidepulser.add_listener(self.on_pulser)
+        if patch_star_finder:
+            self.orig_find_stars = star_finder.find_stars
+            star_finder.find_stars = self.find_stars
+        self.attached = True
+
+    def detach(self):
+        import guidepulser, star_finder
+        if self.attached == False:
+            return
+        guidepulser.remove_listener(self.on_pulser)
+        if self.orig_find_stars is not None:
+            star_finder.find_stars = self.orig_find_stars
+            self.orig_find_stars = None
+        self.attached = False
+
+    def get_calibration_objs(self):
+        # the calibration that a perfect calibration run would produce, in the format of GuiderCalibration.get_json_obj()
+        res = []
+        i = 0
+        while i < 2:
+            res.append({"pulse_width": 500, "start_x": 0, "start_y": 0, "points_cnt": 0,
+                        "pix_per_ms": self.rate[i], "ms_per_pix": 1.0 / self.rate[i],
+                        "angle": self.ra_angle if i == 0 else self.dec_angle, "farthest": 0, "time": 0})
+            i += 1
+        return res
+
+    def apply_calibration(self, guider):
+        import guider_calibration
+        objs = self.get_calibration_objs()
+        i = 0
+        while i < 2:
+            guider.calibration[i] = guider_calibration.GuiderCalibration(0, 0, 0)
+            guider.calibration[i].load_json_obj(objs[i])
+            i += 1
+
+def make_star(x, y, maxb):
+    import guidestar
+    r = 3 + int(maxb / 64)
+    profile = [int(maxb * math.exp(-(i * i) / 4.0)) for i in range(8)]
+    return guidestar.GuideStar(x, y, r, int(maxb), profile, 40, 0)
+
+class GuideTrace(object):
+    # results of run_guiding(), one entry per frame
+    # err_* is the true tracking error in pixels along each axis, without seeing, what the long exposure camera would see
+    # meas_* is the error that the guider measured, including seeing and centroid noise
+    # pulse_* is the signed pulse given to guidepulser.move() after the frame, 0 if there was none
+
+    def __init__(self):
+        self.t = []
+        self.err_ra = []
+        self.err_dec = []
+        self.meas_ra = []
+        self.meas_dec = []
+        self.pulse_ra = []
+        self.pulse_dec = []
+
+    def __len__(self):
+        return len(self.t)
+
+    def rms(self, start = 0):
+        # total error, both axis combined
+        n = len(self.t) - start
+        if n <= 0:
+            return 0
+        x = 0.0
+        i = start
+        while i < len(self.t):
+            x += (self.err_ra[i] * self.err_ra[i]) + (self.err_dec[i] * self.err_dec[i])
+            i += 1
+        return math.sqrt(x / n)
+
+    def rms_axis(self, axis, start = 0):
+        e = self.err_ra if axis == 0 else self.err_dec
+        e = e[start:]
+        if len(e) <= 0:
+            return 0
+        return math.sqrt(sum([x * x for x in e]) / len(e))
+
+    def effort(self, start = 0):
+        # average pulse milliseconds per frame, both axis combined
+        n = len(self.t) - start
+        if n <= 0:
+            return 0
+        return (sum([abs(x) for x in self.pulse_ra[start:]]) + sum([abs(x) for x in self.pulse_dec[start:]])) / n
+
+    def reversals(self, axis, start = 0):
+        # how many times the pulses changed direction, each one has to get through the backlash
+        p = self.pulse_ra if axis == 0 else self.pulse_dec
+        cnt = 0
+        last = 0
+        for x in p[start:]:
+            if x == 0:
+                continue
+            if (x > 0) != (last > 0) and last != 0:
+                cnt += 1
+            last = x
+        return cnt
+
+    def summary(self, start = 0):
+        return "%u frames, RMS %0.3f px (RA %0.3f, DEC %0.3f), effort %0.1f ms/frame, reversals RA %u DEC %u" % (len(self.t) - start, self.rms(start), self.rms_axis(0, start), self.rms_axis(1, start), self.effort(start), self.reversals(0, start), self.reversals(1, start))
+
+def run_guiding(guider, sim, frames, interval_ms = None, star_idx = 0, quiet = True):
+    if quiet:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return run_guiding_inner(guider, sim, frames, interval_ms, star_idx)
+    return run_guiding_inner(guider, sim, frames, interval_ms, star_idx)
+
+def run_guiding_inner(guider, sim, frames, interval_ms, star_idx):
+    # does what AutoGuider.decide() does while guiding, the selected star's position comes straight from the simulator
+    # frames are back to back, each exposure is interval_ms long, and the pulse starts right at the end of the exposure
+    # the pulses of a frame include any preemptive pulse given before it
+    # the guider needs to be calibrated already, sim.apply_calibration() gives it a perfect one
+    import pyb, image, guidepulser, autoguider
+
+    if interval_ms is None:
+        interval_ms = guider.settings["guidecam_shutter"]
+    t = pyb.millis()
+    pyb.set_virtual_clock(True, start_ms = t, step_ms = 0)
+    sim.attach(patch_star_finder = False)
+    trace = GuideTrace()
+    guider.guide_state = autoguider.GUIDESTATE_GUIDING
+    guider.target_coord = None
+    guider.origin_coord = None
+    # pulses are logged with the frame's timestamp
+    guider.img = image.Image((16, 16))
+    guider.img_is_compressed = False
+    tgt_true = None
+    try:
+        f = 0
+        while f < frames:
+            t += interval_ms
+            pyb.set_virtual_clock(True, start_ms = t, step_ms = 0)
+            guidepulser.task()
+            # same as AutoGuider.task(), a frame taken during a long pulse is thrown away unless a preemptive pulse can be given
+            dt = ((guider.last_pulse_dur % interval_ms) * 100) / interval_ms
+            motionwhilecapture = guider.settings["motionwhilecapture"]
+            if f > 0 and dt > motionwhilecapture and motionwhilecapture < 100:
+                if guider.preemp_pulse() == 0:
+                    t += interval_ms
+                    pyb.set_virtual_clock(True, start_ms = t, step_ms = 0)
+                    guidepulser.task()
+                    guider.preemp_pulse()
+            guider.img.set_timestamp(t)
+            ox, oy, tx, ty = sim.exposure(t - interval_ms, t)
+            cx, cy = sim.star_pos(star_idx, ox, oy)
+            guider.selected_star = make_star(cx, cy, sim.base_stars[star_idx][2])
+            guider.virtual_star = [cx, cy]
+            if guider.target_coord is None:
+                guider.target_coord = (cx, cy)
+                guider.origin_coord = guider.target_coord
+            if tgt_true is None:
+                # where the field has to be for the star to be on target
+                tgt_true = (tx + guider.target_coord[0] - cx, ty + guider.target_coord[1] - cy)
+            guider.advfilt_ra.pause(False)
+            guider.advfilt_dec.pause(False)
+            guider.preempfilt_ra.pause(False)
+            guider.preempfilt_dec.pause(False)
+            guider.last_pulse_dur = guider.pulse_to_target()
+            guider.task_pec()
+            pulse_ra, pulse_dec = sim.frame_pulse
+            sim.frame_pulse = [0, 0]
+            era, edec = sim.to_axis(tx - tgt_true[0], ty - tgt_true[1])
+            mra, mdec = sim.to_axis(cx - guider.target_coord[0], cy - guider.target_coord[1])
+            trace.t.append(t)
+            trace.err_ra.append(era)
+            trace.err_dec.append(edec)
+            trace.meas_ra.append(mra)
+            trace.meas_dec.append(mdec)
+            trace.pulse_ra.append(pulse_ra)
+            trace.pulse_dec.append(pulse_dec)
+            f += 1
+    finally:
+        pyb.set_virtual_clock(True, start_ms = t, step_ms = 1)
+    return trace
+
+def load_error_trace(path):
+    # returns [(time, ra, dec), ...], a tracking error in pixels along each axis, for the disturbance parameter of MountSim
+    # from a CSV file with time in milliseconds, RA and DEC on each line
+    # or from a session file made by replay.Recorder, the pulses that the guider gave are taken back out of the guide star's positions
+    # or from a session log written on the camera by guide_session.py, the same is done by session_reader
+    res = []
+    if path.lower().endswith(".gsl"):
+        import session_reader
+        return session_reader.read_session(path).error_trace()
+    if path.lower().endswith(".jsonl") == False:
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.replace(",", " ").split()
+                try:
+                    res.append((float(parts[0]), float(parts[1]), float(parts[2])))
+                except (ValueError, IndexError):
+                    # headers and comments
+                    pass
+        return res
+
+    import json
+    with open(path, "r") as f:
+        records = [json.loads(line) for line in f if len(line.strip()) > 0]
+    head = records[0]
+    calib = head.get("calib", [None, None])
+    if len(calib) <= 0 or calib[0] is None:
+        raise ValueError("session has no RA calibration: " + path)
+    if len(calib) < 2 or calib[1] is None:
+        calib = [calib[0], dict(calib[0])]
+        calib[1].update({"angle": calib[0]["angle"] + 90})
+    settings = head.get("settings", {})
+    flip = [-1 if settings.get("flip_ra", 0) != 0 else 1, -1 if settings.get("flip_dec", 0) != 0 else 1]
+    rate = []
+    vec = []
+    for c in calib:
+        rate.append(c["pix_per_ms"] if c["pix_per_ms"] != 0 else (1.0 / c["ms_per_pix"]))
+        vec.append((math.cos(math.radians(c["angle"])), math.sin(math.radians(c["angle"]))))
+    det = (vec[0][0] * vec[1][1]) - (vec[0][1] * vec[1][0])
+    ref = None
+    pulsed = [0.0, 0.0]
+    for r in records[1:]:
+        if r.get("t") != "frame":
+            continue
+        out = r.get("out", {})
+        sel = out.get("sel")
+        if sel is not None:
+            if ref is None:
+                ref = (r["ts"], sel[0], sel[1])
+            x = sel[0] - ref[1]
+            y = sel[1] - ref[2]
+            ra = ((x * vec[1][1]) - (y * vec[1][0])) / det
+            dec = ((y * vec[0][0]) - (x * vec[0][1])) / det
+            res.append((float(r["ts"] - ref[0]), ra - pulsed[0], dec - pulsed[1]))
+        if ref is not None:
+            for m in out.get("moves", []):
+                # the moves are recorded after the flip, the calibration is from before it
+                pulsed[0] += m[0] * flip[0] * rate[0]
+                pulsed[1] += m[1] * flip[1] * rate[1]
+    return res
+
+def main():
+    # quick check, guides for a while with the default settings and a perfect calibration, prints how it went
+    import sys, time, tempfile
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    import hostenv
+    if hostenv.installed == False:
+        hostenv.install(flash_dir = tempfile.mkdtemp(prefix = "mountsim_"), virtual_clock = True, seed = 1)
+    import guidepulser, autoguider
+    guidepulser.init()
+    with contextlib.redirect_stdout(io.StringIO()):
+        guider = autoguider.AutoGuider()
+    guider.simulator = None
+    sim = MountSim(seed = 1)
+    sim.apply_calibration(guider)
+    t = time.perf_counter()
+    trace = run_guiding(guider, sim, frames)
+    t = time.perf_counter() - t
+    print(trace.summary(start = min(50, frames // 10)))
+    print("%0.2f s, %0.0f frames per second" % (t, frames / t))
+    sim.detach()
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
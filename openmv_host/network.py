@@ -0,0 +1,46 @@
+# host stand-in for the OpenMV "network" module
+# the WINC1500 WiFi shield is replaced by the host's own network stack, so every mode is "connected"
+
+class WINC(object):
+    OPEN          = 0
+    WEP           = 1
+    WPA_PSK       = 2
+    MODE_STA      = 1
+    MODE_AP       = 2
+    MODE_P2P      = 3
+    MODE_BSP      = 4
+    MODE_FIRMWARE = 5
+
+    # the address reported to the application, change this to advertise a LAN address
+    ip = "127.0.0.1"
+
+    def __init__(self, mode = MODE_STA):
+        self.mode = mode
+        self.ssid = None
+        self.connected = False
+
+    def connect(self, ssid, key = None, security = WPA_PSK, bssid = None):
+        self.ssid = ssid
+        self.connected = True
+
+    def start_ap(self, ssid, key = None, security = OPEN, channel = 1):
+        self.ssid = ssid
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def isconnected(self):
+        return self.connected
+
+    def ifconfig(self):
+        return (WINC.ip, "255.255.255.0", WINC.ip, WINC.ip)
+
+    def closeall(self):
+        pass
+
+    def fw_version(self):
+        return (19, 6, 1, 19, 6, 1, 0)
+
+    def fw_update(self, path):
+        pass
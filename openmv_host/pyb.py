@@ -0,0 +1,144 @@
+# host stand-in for the OpenMV "pyb" module
+# the clock can run in real time (default) or in virtual time
+# in virtual time, delay() returns immediately after advancing the clock,
+# and every read of the clock advances it by a small step so that busy-wait loops always make progress
+
+import time, random
+
+_virtual      = False
+_virtual_ms   = 0
+_virtual_step = 1
+_epoch        = time.monotonic()
+_rng          = random.Random()
+
+def set_virtual_clock(enable = True, start_ms = 0, step_ms = 1):
+    global _virtual, _virtual_ms, _virtual_step
+    _virtual = enable
+    _virtual_ms = start_ms
+    _virtual_step = step_ms
+
+def is_virtual_clock():
+    return _virtual
+
+def advance(ms):
+    global _virtual_ms
+    if _virtual:
+        _virtual_ms += ms
+
+def seed(x):
+    _rng.seed(x)
+
+def _now_ms():
+    global _virtual_ms
+    if _virtual:
+        t = _virtual_ms
+        _virtual_ms += _virtual_step
+        return t
+    return int((time.monotonic() - _epoch) * 1000)
+
+def millis():
+    return _now_ms() & 0x3FFFFFFF
+
+def micros():
+    if _virtual:
+        return (_now_ms() * 1000) & 0x3FFFFFFF
+    return int((time.monotonic() - _epoch) * 1000000) & 0x3FFFFFFF
+
+def elapsed_millis(start):
+    return (millis() - start) & 0x3FFFFFFF
+
+def elapsed_micros(start):
+    return (micros() - start) & 0x3FFFFFFF
+
+def delay(ms):
+    if _virtual:
+        advance(ms)
+    elif ms > 0:
+        time.sleep(ms / 1000.0)
+
+def udelay(us):
+    if _virtual:
+        advance(us // 1000)
+    elif us > 0:
+        time.sleep(us / 1000000.0)
+
+def rng():
+    return _rng.getrandbits(30)
+
+def unique_id():
+    return b"\x48\x4f\x53\x54\x00\x00\x00\x00\x00\x00\x00\x01"
+
+def hard_reset():
+    raise SystemExit("pyb.hard_reset()")
+
+def freq():
+    return (480000000, 240000000, 120000000, 120000000)
+
+def wfi():
+    pass
+
+class LED(object):
+    def __init__(self, id):
+        self.id = id
+        self.state = False
+
+    def on(self):
+        self.state = True
+
+    def off(self):
+        self.state = False
+
+    def toggle(self):
+        self.state = not self.state
+
+    def intensity(self, value = None):
+        if value is None:
+            return 255 if self.state else 0
+        self.state = value > 0
+
+class I2C(object):
+    MASTER = 0
+    SLAVE  = 1
+
+    # addresses that scan() reports, a host can add 0x38 here to boot main.py as the autoguider
+    devices = []
+
+    def __init__(self, bus, mode = None, addr = 0x12, baudrate = 400000):
+        self.bus = bus
+        self.mode = mode
+        self.regs = {}
+
+    def init(self, mode = None, addr = 0x12, baudrate = 400000):
+        self.mode = mode
+
+    def deinit(self):
+        pass
+
+    def scan(self):
+        return list(I2C.devices)
+
+    def is_ready(self, addr):
+        return addr in I2C.devices
+
+    def send(self, data, addr = 0, timeout = 5000):
+        if addr not in I2C.devices:
+            raise OSError(5)
+
+    def recv(self, data, addr = 0, timeout = 5000):
+        if addr not in I2C.devices:
+            raise OSError(5)
+        if isinstance(data, int):
+            return bytes(data)
+        return data
+
+    def mem_write(self, data, addr, memaddr, timeout = 5000, addr_size = 8):
+        if addr not in I2C.devices:
+            raise OSError(5)
+        self.regs.update({(addr, memaddr): data})
+
+    def mem_read(self, data, addr, memaddr, timeout = 5000, addr_size = 8):
+        if addr not in I2C.devices:
+            raise OSError(5)
+        if isinstance(data, int):
+            return bytes(data)
+        return data
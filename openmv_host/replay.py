@@ -0,0 +1,398 @@
+# deterministic replay of guiding sessions through AutoGuider.decide()
+#
+# a session is a JSON lines file, made by attaching a Recorder to an AutoGuider:
+#   {"t": "session", "ver": 1, "seed": ..., "settings": {...}, "calib": [ra, dec], "guide_state": ..., "selected_star": [...], "target_coord": [x, y], "origin_coord": [x, y]}   always the first line
+#   {"t": "cmd", "ts": ms, "msg": "..."}   a websocket message from the web page, given to parse_websocket()
+#   {"t": "frame", "ts": ms, "code": expo code, "stars": [[cx, cy, r, max brightness, profile, pointiness, saturation, rating, pixels], ...], "out": {...}}
+#   {"t": "pulse", "ts": ms, "kind": "preemp" or "target", "moving": [...], "out": {...}}   a preemp_pulse() or pulse_to_target() call made outside of decide()
+# a frame can have "img" instead of "stars", a path relative to the session file, the star finder is then run on that image
+# "out" is what decide() did with the frame: the pulse it returned, the guidepulser.move() calls, and the guider's state afterwards
+# the guider's state in the first line is where it was when the Recorder was attached, so a session can be recorded in the middle of guiding
+# a pulse record has the same "out", and what guidepulser.is_moving() told it, a "target" pulse also has "pulse_data" and "force_move"
+#
+# the replay is open loop, the recorded star positions are used no matter what pulses are decided
+# so it checks that decide() still does the same thing with the same input, the mount simulator is for checking if guiding converges
+# everything runs on the virtual clock with a seeded pyb.rng(), frames are fed as fast as decide() can take them
+#
+# usage:
+#   python replay.py session.jsonl [--rewrite] [--verbose] [--star-motion]
+# --rewrite replaces the expected outputs in the file with the new ones, after an intended change in behaviour
+# --star-motion uses star_motion.py instead of guidestar.py for the multi-star motion analysis, the results should not change
+
+import os, sys, io, json, time, math, tempfile, contextlib
+
+SESSION_VER = 1
+DEFAULT_TOL = 1e-6
+
+def star_to_rec(s):
+    return [s.cxf(), s.cyf(), s.r(), s.max_brightness(), list(s.star_profile()), s.star_pointiness(), getattr(s, "saturation", 0), s.star_rating(), s.pixels()]
+
+def rec_to_star(r):
+    import guidestar
+    s = guidestar.GuideStar(r[0], r[1], r[2], r[3], list(r[4]), r[5], r[6], r[8] if len(r) > 8 else 0)
+    s.set_rating(r[7])
+    return s
+
+def get_outputs(guider, pulse, moves):
+    import guidepulser
+    out = {}
+    out.update({"pulse" : pulse})
+    out.update({"moves" : moves})
+    out.update({"state" : guider.guide_state})
+    out.update({"panic" : guidepulser.is_panic()})
+    out.update({"sel"   : guider.selected_star.coord() if guider.selected_star is not None else None})
+    out.update({"tgt"   : guider.target_coord})
+    out.update({"err"   : guider.last_move_err})
+    out.update({"msc"   : guider.multistar_cnt})
+    # tuples become lists, so this compares equal with what is read back from the file
+    return json.loads(json.dumps(out))
+
+def compare(exp, act, tol, path = ""):
+    # returns a list of (path, expected, actual)
+    if isinstance(exp, bool) or isinstance(act, bool) or exp is None or act is None:
+        return [] if exp is act or exp == act else [(path, exp, act)]
+    if isinstance(exp, (int, float)) and isinstance(act, (int, float)):
+        if abs(exp - act) <= tol * max(1.0, abs(exp)):
+            return []
+        return [(path, exp, act)]
+    if isinstance(exp, list) and isinstance(act, list):
+        if len(exp) != len(act):
+            return [(path, exp, act)]
+        res = []
+        for i in range(len(exp)):
+            res += compare(exp[i], act[i], tol, "%s[%u]" % (path, i))
+        return res
+    if isinstance(exp, dict) and isinstance(act, dict):
+        res = []
+        for k in sorted(set(exp.keys()) | set(act.keys())):
+            res += compare(exp.get(k), act.get(k), tol, (path + "." + k) if len(path) > 0 else k)
+        return res
+    return [] if exp == act else [(path, exp, act)]
+
+def load_session(path):
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                records.append(json.loads(line))
+    if len(records) <= 0 or records[0].get("t") != "session":
+        raise ValueError("not a guiding session file: " + path)
+    if records[0].get("ver") != SESSION_VER:
+        raise ValueError("unsupported session version %s" % str(records[0].get("ver")))
+    return records
+
+def save_session(path, records):
+    with open(path, "w") as f:
+        for r in records:
+            f.write(json.dumps(r) + "\n")
+
+def percentile(x, p):
+    if len(x) <= 0:
+        return 0
+    x = sorted(x)
+    return x[min(len(x) - 1, int(math.floor(p * len(x) / 100.0)))]
+
+class Recorder(object):
+    # records everything that goes into and comes out of decide(), from a guider that is running normally
+    # and the pulses that task() gives outside of decide(), they change the filters and the backlash that later frames depend on
+    # hooks into the guider's decide(), preemp_pulse(), pulse_to_target() and parse_websocket(), the star finder, and guidepulser.is_moving(), call close() to undo that
+
+    def __init__(self, guider, path, seed = None):
+        import star_finder, guidestar, guidepulser
+        self.guider = guider
+        self.f = open(path, "w")
+        self.moves = None
+        self.stars = None
+        self.code = 0
+        self.moving = None
+
+        self.orig_find_stars = star_finder.find_stars
+        self.orig_process_list = guidestar.process_list
+        self.orig_decide = guider.decide
+        self.orig_parse_websocket = guider.parse_websocket
+        self.orig_preemp_pulse = guider.preemp_pulse
+        self.orig_pulse_to_target = guider.pulse_to_target
+        self.orig_is_moving = guidepulser.is_moving
+        star_finder.find_stars = self.find_stars
+        guidestar.process_list = self.process_list
+        guider.decide = self.decide
+        guider.parse_websocket = self.parse_websocket
+        guider.preemp_pulse = self.preemp_pulse
+        guider.pulse_to_target = self.pulse_to_target
+        guidepulser.is_moving = self.is_moving
+        guidepulser.add_listener(self.on_pulser)
+
+        calib = []
+        for c in guider.calibration:
+            calib.append(c.get_json_obj() if c is not None and c.has_cal else None)
+        head = {"t": "session", "ver": SESSION_VER, "seed": seed, "settings": dict(guider.settings), "calib": calib}
+        head.update({"guide_state"   : guider.guide_state})
+        head.update({"selected_star" : star_to_rec(guider.selected_star) if guider.selected_star is not None else None})
+        head.update({"target_coord"  : guider.target_coord})
+        head.update({"origin_coord"  : guider.origin_coord})
+        self.write(head)
+
+    def write(self, obj):
+        self.f.write(json.dumps(obj) + "\n")
+
+    def close(self):
+        import star_finder, guidestar, guidepulser
+        if self.f is None:
+            return
+        star_finder.find_stars = self.orig_find_stars
+        guidestar.process_list = self.orig_process_list
+        del self.guider.decide
+        del self.guider.parse_websocket
+        del self.guider.preemp_pulse
+        del self.guider.pulse_to_target
+        guidepulser.is_moving = self.orig_is_moving
+        guidepulser.remove_listener(self.on_pulser)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def find_stars(self, *args, **kwargs):
+        stars, code = self.orig_find_stars(*args, **kwargs)
+        self.code = code
+        return stars, code
+
+    def process_list(self, stars, *args, **kwargs):
+        # the star list is taken here instead of from the star finder, so a simulator's changes to it are included
+        if self.moves is not None:
+            self.stars = [star_to_rec(s) for s in stars]
+        return self.orig_process_list(stars, *args, **kwargs)
+
+    def on_pulser(self, event, args):
+        if event == "move" and self.moves is not None:
+            self.moves.append(list(args))
+
+    def decide(self):
+        self.moves = []
+        self.stars = None
+        try:
+            pulse = self.orig_decide()
+            if self.stars is not None:
+                # decide() did get as far as looking at the stars
+                self.write({"t": "frame", "ts": self.guider.img.timestamp(), "code": self.code, "stars": self.stars, "out": get_outputs(self.guider, pulse, self.moves)})
+        finally:
+            self.moves = None
+        return pulse
+
+    def is_moving(self):
+        x = self.orig_is_moving()
+        if self.moving is not None:
+            self.moving.append(x)
+        return x
+
+    def preemp_pulse(self):
+        return self.pulse("preemp", self.orig_preemp_pulse, {})
+
+    def pulse_to_target(self, pulse_data = None, force_move = False):
+        return self.pulse("target", self.orig_pulse_to_target, {"pulse_data": pulse_data, "force_move": force_move})
+
+    def pulse(self, kind, func, kwargs):
+        # the pulses given during decide() are part of its frame
+        if self.moves is not None:
+            return func(**kwargs)
+        import pyb
+        ts = pyb.millis()
+        self.moves = []
+        self.moving = []
+        try:
+            x = func(**kwargs)
+            rec = {"t": "pulse", "ts": ts, "kind": kind, "moving": self.moving}
+            rec.update(json.loads(json.dumps(kwargs)))
+            rec.update({"out": get_outputs(self.guider, x, self.moves)})
+            self.write(rec)
+        finally:
+            self.moves = None
+            self.moving = None
+        return x
+
+    def parse_websocket(self, x):
+        import pyb
+        if isinstance(x, (bytes, bytearray)):
+            x = x.decode("utf-8")
+        self.write({"t": "cmd", "ts": pyb.millis(), "msg": x})
+        return self.orig_parse_websocket(x)
+
+class ReplayResult(object):
+    def __init__(self):
+        self.frames = 0
+        self.mismatches = []  # (frame number, path, expected, actual)
+        self.decide_ms = []
+        self.elapsed = 0
+        self.session_ms = 0
+
+    def passed(self):
+        return len(self.mismatches) <= 0
+
+    def summary(self):
+        s = "%u frames, %u mismatches" % (self.frames, len(self.mismatches))
+        if len(self.decide_ms) > 0:
+            s += ", decide() mean %0.2f ms, p50 %0.2f ms, p95 %0.2f ms, max %0.2f ms" % (sum(self.decide_ms) / len(self.decide_ms), percentile(self.decide_ms, 50), percentile(self.decide_ms, 95), max(self.decide_ms))
+        s += ", replayed in %0.2f s" % self.elapsed
+        if self.elapsed > 0 and self.session_ms > 0:
+            s += " (%0.0fx real time)" % ((self.session_ms / 1000.0) / self.elapsed)
+        return s
+
+class Replay(object):
+
+    def __init__(self, path, debug = False, tol = DEFAULT_TOL, quiet = True):
+        # hostenv changes the working directory to the simulated flash drive
+        self.path = os.path.abspath(path)
+        self.records = load_session(path)
+        self.debug = debug
+        self.tol = tol
+        self.quiet = quiet
+        self.cur = None
+        self.guider = None
+        self.moving = None
+
+    def find_stars(self, img, *args, **kwargs):
+        if self.cur is not None and "stars" in self.cur:
+            return [rec_to_star(r) for r in self.cur["stars"]], self.cur["code"]
+        return self.orig_find_stars(img, *args, **kwargs)
+
+    def on_pulser(self, event, args):
+        if event == "move" and self.moves is not None:
+            self.moves.append(list(args))
+
+    def is_moving(self):
+        # a pulse is given with what guidepulser.is_moving() said when it was recorded, the frozen clock can't say when a move ended
+        if self.moving is not None and len(self.moving) > 0:
+            return self.moving.pop(0)
+        return self.orig_is_moving()
+
+    def run(self, rewrite = False):
+        if self.quiet:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return self.run_inner(rewrite)
+        return self.run_inner(rewrite)
+
+    def run_inner(self, rewrite):
+        import hostenv
+        if hostenv.installed == False:
+            hostenv.install(flash_dir = tempfile.mkdtemp(prefix = "replay_"), virtual_clock = True)
+        import pyb, image, guidepulser, star_finder, guider_calibration, autoguider
+
+        res = ReplayResult()
+        head = self.records[0]
+        first_ts = 0
+        last_ts = 0
+        for r in self.records[1:]:
+            if "ts" in r:
+                first_ts = r["ts"]
+                break
+
+        pyb.set_virtual_clock(True, start_ms = first_ts, step_ms = 1)
+        if head.get("seed") is not None:
+            pyb.seed(head["seed"])
+        guidepulser.init()
+        guider = autoguider.AutoGuider(debug = self.debug)
+        guider.simulator = None
+        guider.settings.update(head["settings"])
+        guider.apply_settings()
+        for i in range(len(head.get("calib", []))):
+            c = head["calib"][i]
+            if c is not None:
+                guider.calibration[i] = guider_calibration.GuiderCalibration(0, 0, 0)
+                guider.calibration[i].load_json_obj(c)
+        # where the guider was when recording started
+        guider.guide_state = head.get("guide_state", guider.guide_state)
+        if head.get("selected_star") is not None:
+            guider.selected_star = rec_to_star(head["selected_star"])
+        if head.get("target_coord") is not None:
+            guider.target_coord = tuple(head["target_coord"])
+        if head.get("origin_coord") is not None:
+            guider.origin_coord = tuple(head["origin_coord"])
+        self.guider = guider
+        blank = image.Image((16, 16))
+
+        self.orig_find_stars = star_finder.find_stars
+        star_finder.find_stars = self.find_stars
+        self.moves = None
+        self.orig_is_moving = guidepulser.is_moving
+        guidepulser.is_moving = self.is_moving
+        guidepulser.add_listener(self.on_pulser)
+        t_start = time.perf_counter()
+        try:
+            for r in self.records[1:]:
+                ts = r.get("ts", last_ts)
+                # the clock is frozen at the recorded time, nothing that decide() does can shift the timing of later frames
+                pyb.set_virtual_clock(True, start_ms = ts, step_ms = 0)
+                last_ts = ts
+                if r["t"] == "cmd":
+                    guider.parse_websocket(r["msg"])
+                elif r["t"] == "frame":
+                    self.cur = r
+                    if "img" in r:
+                        guider.img = image.Image(os.path.join(os.path.dirname(self.path), r["img"]))
+                    else:
+                        guider.img = blank
+                    guider.img.set_timestamp(ts)
+                    guider.img_is_compressed = False
+                    self.moves = []
+                    t = time.perf_counter()
+                    pulse = guider.decide()
+                    res.decide_ms.append((time.perf_counter() - t) * 1000.0)
+                    out = get_outputs(guider, pulse, self.moves)
+                    self.moves = None
+                    for m in compare(r.get("out"), out, self.tol):
+                        res.mismatches.append((res.frames, m[0], m[1], m[2]))
+                    if rewrite:
+                        r["out"] = out
+                    res.frames += 1
+                elif r["t"] == "pulse":
+                    self.moves = []
+                    self.moving = list(r.get("moving", []))
+                    if r["kind"] == "preemp":
+                        pulse = guider.preemp_pulse()
+                    else:
+                        pulse_data = r.get("pulse_data")
+                        pulse = guider.pulse_to_target(pulse_data = list(pulse_data) if pulse_data is not None else None, force_move = r.get("force_move", False))
+                    out = get_outputs(guider, pulse, self.moves)
+                    self.moves = None
+                    self.moving = None
+                    # counted with the frame that comes next
+                    for m in compare(r.get("out"), out, self.tol, "pulse"):
+                        res.mismatches.append((res.frames, m[0], m[1], m[2]))
+                    if rewrite:
+                        r["out"] = out
+        finally:
+            star_finder.find_stars = self.orig_find_stars
+            guidepulser.is_moving = self.orig_is_moving
+            guidepulser.remove_listener(self.on_pulser)
+            self.cur = None
+            pyb.set_virtual_clock(True, start_ms = last_ts, step_ms = 1)
+        res.elapsed = time.perf_counter() - t_start
+        res.session_ms = last_ts - first_ts
+        if rewrite:
+            save_session(self.path, self.records)
+        return res
+
+def main():
+    args = [a for a in sys.argv[1:] if a.startswith("--") == False]
+    if len(args) < 1:
+        print("usage: %s session.jsonl [--rewrite] [--verbose] [--star-motion]" % os.path.basename(sys.argv[0]))
+        return 1
+    if "--star-motion" in sys.argv:
+        import star_motion
+        star_motion.install()
+    rp = Replay(args[0], quiet = ("--verbose" not in sys.argv))
+    res = rp.run(rewrite = ("--rewrite" in sys.argv))
+    for m in res.mismatches[:20]:
+        print("frame %u: %s expected %s got %s" % m)
+    if len(res.mismatches) > 20:
+        print("... %u more" % (len(res.mismatches) - 20))
+    print(res.summary())
+    return 0 if res.passed() or "--rewrite" in sys.argv else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# host stand-in for the OpenMV "sensor" module
+# frames come from a "frame source" instead of a camera, which can be
+#  * a list of file paths, NumPy arrays or image.Image objects, played back in a loop
+#  * a directory, all image files inside are played back in sorted order
+#  * a callable, called with the frame index, returning any of the above
+# exposures take as long as the camera would, timed on the pyb clock, so the virtual clock keeps them deterministic
+
+import os
+import pyb, image
+
+GRAYSCALE = image.GRAYSCALE
+RGB565    = image.RGB565
+BAYER     = image.BAYER
+JPEG      = image.JPEG
+
+QQCIF  = 0
+QCIF   = 1
+QVGA   = 2
+VGA    = 3
+WQXGA2 = 4
+
+FRAME_SIZES = {
+    QQCIF  : (88, 72),
+    QCIF   : (176, 144),
+    QVGA   : (320, 240),
+    VGA    : (640, 480),
+    WQXGA2 : (2592, 1944),
+}
+
+IMAGE_EXTS = [".npy", ".bmp", ".pgm", ".ppm", ".jpg", ".jpeg", ".png"]
+
+_pixformat    = GRAYSCALE
+_framesize    = WQXGA2
+_vflip        = False
+_hmirror      = False
+_auto_exp     = True
+_exposure_us  = 500000
+_auto_gain    = True
+_gain_db      = 0
+_regs         = {}
+_source       = None
+_frame_idx    = 0
+_snap_start   = None
+_fb           = None
+
+def set_frame_source(src):
+    global _source, _frame_idx
+    if isinstance(src, str) and os.path.isdir(src):
+        names = sorted(os.listdir(src))
+        src = [os.path.join(src, n) for n in names if os.path.splitext(n)[1].lower() in IMAGE_EXTS]
+    elif src is not None and not isinstance(src, list) and not callable(src):
+        src = [src]
+    _source = src
+    _frame_idx = 0
+
+def get_frame_index():
+    return _frame_idx
+
+def reset():
+    global _pixformat, _framesize, _vflip, _hmirror, _auto_exp, _auto_gain, _snap_start, _regs
+    _pixformat = GRAYSCALE
+    _framesize = WQXGA2
+    _vflip = False
+    _hmirror = False
+    _auto_exp = True
+    _auto_gain = True
+    _snap_start = None
+    _regs = {}
+
+def set_pixformat(x):
+    global _pixformat
+    _pixformat = x
+
+def get_pixformat():
+    return _pixformat
+
+def set_framesize(x):
+    global _framesize
+    _framesize = x
+
+def get_framesize():
+    return _framesize
+
+def width():
+    return FRAME_SIZES[_framesize][0]
+
+def height():
+    return FRAME_SIZES[_framesize][1]
+
+def set_vflip(x):
+    global _vflip
+    _vflip = x
+
+def set_hmirror(x):
+    global _hmirror
+    _hmirror = x
+
+def set_auto_exposure(enable, exposure_us = None):
+    global _auto_exp, _exposure_us
+    _auto_exp = enable
+    if exposure_us is not None:
+        _exposure_us = exposure_us
+
+def get_exposure_us():
+    return _exposure_us
+
+def set_auto_gain(enable, gain_db = None):
+    global _auto_gain, _gain_db
+    _auto_gain = enable
+    if gain_db is not None:
+        _gain_db = gain_db
+
+def get_gain_db():
+    return _gain_db
+
+def __write_reg(addr, val):
+    _regs[addr] = val
+
+def __read_reg(addr):
+    return _regs.get(addr, 0)
+
+# astro_sensor calls sensor.__write_reg from inside a class, which CPython mangles into this name
+_AstroCam__write_reg = __write_reg
+_AstroCam__read_reg  = __read_reg
+
+def alloc_extra_fb(w, h, pixfmt):
+    return image.Image((w, h), pixformat = pixfmt)
+
+def dealloc_extra_fb():
+    pass
+
+def _exposure_ms():
+    # same timing as the real camera, long exposures run with a slowed down PLL
+    if _exposure_us > 500000:
+        return int(round(_exposure_us * 4 / 3000))
+    return int(round(_exposure_us / 1000))
+
+def _next_frame():
+    global _frame_idx
+    src = _source
+    if src is None:
+        item = None
+    elif callable(src):
+        item = src(_frame_idx)
+    elif len(src) > 0:
+        item = src[_frame_idx % len(src)]
+    else:
+        item = None
+    _frame_idx += 1
+    w = width()
+    h = height()
+    if item is None:
+        img = image.Image((w, h), pixformat = GRAYSCALE)
+    elif isinstance(item, image.Image):
+        img = item.copy()
+    else:
+        img = image.Image(item)
+    if _pixformat == GRAYSCALE and img.format() != GRAYSCALE:
+        img = img.to_grayscale()
+    if img.width() != w or img.height() != h:
+        img = img.scale(x_scale = w / img.width(), y_scale = h / img.height())
+    if _vflip or _hmirror:
+        # never flip in place, the source array might belong to the caller
+        arr = img.ndarray()
+        if _vflip:
+            arr = arr[::-1]
+        if _hmirror:
+            arr = arr[:, ::-1]
+        img = image.Image(arr.copy())
+    return img
+
+def snapshot():
+    global _fb, _snap_start
+    _snap_start = None
+    pyb.delay(_exposure_ms())
+    _fb = _next_frame()
+    _fb.set_timestamp(pyb.millis())
+    return _fb
+
+def snapshot_start():
+    global _snap_start
+    _snap_start = pyb.millis()
+
+def snapshot_check():
+    if _snap_start is None:
+        return False
+    return pyb.elapsed_millis(_snap_start) >= _exposure_ms()
+
+def snapshot_finish():
+    global _fb, _snap_start
+    if _snap_start is None:
+        raise RuntimeError("snapshot not started")
+    while snapshot_check() == False:
+        pyb.delay(1)
+    _snap_start = None
+    _fb = _next_frame()
+    _fb.set_timestamp(pyb.millis())
+    return _fb
+
+def get_fb():
+    return _fb
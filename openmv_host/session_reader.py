@@ -0,0 +1,253 @@
+# reads the binary guiding session logs written by openmv_filesys/guide_session.py into NumPy arrays
+# the record formats here must be kept in sync with guide_session.py
+#
+# usage:
+#   python session_reader.py guide-20230101-220000.gsl [--trace out.csv]
+# --trace writes the mount's tracking error with the guide pulses taken back out, which mount_sim.load_error_trace() can read
+#
+# from Python:
+#   ses = session_reader.read_session(path)
+#   ses.frames["sel_x"], ses.pulses["fin_ra"], ses.stars[ses.star_frame == 10] ...
+#   print(ses.analyze())
+
+import sys, json, math
+import numpy as np
+
+SES_MAGIC = b"GSES"
+SES_VER   = 1
+REC_HEAD_LEN = 3
+
+REC_INFO  = 1
+REC_FRAME = 2
+REC_PULSE = 3
+REC_MSG   = 4
+
+GUIDESTATE_GUIDING = 1
+
+FRAME_DTYPE = np.dtype([("ts", "<u4"), ("state", "u1"), ("flags", "u1"), ("code", "u1"),
+                        ("sel_x", "<f4"), ("sel_y", "<f4"), ("virt_x", "<f4"), ("virt_y", "<f4"), ("tgt_x", "<f4"), ("tgt_y", "<f4"),
+                        ("move_err", "<f4"), ("msc_used", "<u2"), ("msc_total", "<u2"), ("nstars", "<u2")])
+STAR_RAW_DTYPE = np.dtype([("x", "<u2"), ("y", "<u2"), ("r", "<u2"), ("maxb", "u1"), ("rating", "u1")])
+STAR_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("r", "<u2"), ("maxb", "u1"), ("rating", "u1")])
+STAR_SCALE = 16.0
+PULSE_DTYPE = np.dtype([("ts", "<u4"), ("kind", "u1"), ("req_ra", "<i2"), ("req_dec", "<i2"), ("fin_ra", "<i2"), ("fin_dec", "<i2"),
+                        ("filt_ra0", "<f4"), ("filt_ra1", "<f4"), ("filt_dec0", "<f4"), ("filt_dec1", "<f4"),
+                        ("backlash_ra", "<i2"), ("backlash_dec", "<i2")])
+
+FLAG_SHUTTER = 0x01
+FLAG_STARS   = 0x02
+
+PULSE_PREEMP     = 0
+PULSE_CORRECTIVE = 1
+
+def calib_done(c):
+    # false for a missing calibration, or one that was logged before it finished
+    return c is not None and c.get("success", "done") == "done" and (c["pix_per_ms"] != 0 or c["ms_per_pix"] != 0)
+
+class Session(object):
+    # frames, stars and pulses are structured arrays, star_frame gives the frame index of every star
+    # a file that was appended to holds several sessions, frame_seg and pulse_seg say which info record each one belongs to
+
+    def __init__(self):
+        self.info = []
+        self.frames = np.zeros(0, dtype = FRAME_DTYPE)
+        self.frame_seg = np.zeros(0, dtype = np.int32)
+        self.stars = np.zeros(0, dtype = STAR_DTYPE)
+        self.star_frame = np.zeros(0, dtype = np.int32)
+        self.pulses = np.zeros(0, dtype = PULSE_DTYPE)
+        self.pulse_seg = np.zeros(0, dtype = np.int32)
+        self.msgs = []  # (timestamp, text)
+        self.truncated = False
+
+    def get_calib(self, seg = 0):
+        # the RA and DEC calibration, [(pixels per millisecond, angle), ...], DEC is made up at a right angle to RA if it was not calibrated
+        if seg >= len(self.info):
+            raise ValueError("session has no info record")
+        # a session can start during a calibration, the one still being done counts as not calibrated
+        calib = [c if calib_done(c) else None for c in self.info[seg].get("calib", [None, None])]
+        if len(calib) <= 0 or calib[0] is None:
+            raise ValueError("session has no RA calibration")
+        res = []
+        for c in calib[0:2]:
+            if c is None:
+                c = dict(calib[0])
+                c.update({"angle": calib[0]["angle"] + 90})
+            rate = c["pix_per_ms"] if c["pix_per_ms"] != 0 else (1.0 / c["ms_per_pix"])
+            res.append((rate, c["angle"]))
+        if len(res) < 2:
+            res.append((res[0][0], res[0][1] + 90))
+        return res
+
+    def to_axis(self, dx, dy, seg = 0):
+        # image coordinates to RA and DEC, in pixels along each axis
+        calib = self.get_calib(seg)
+        v = [(math.cos(math.radians(c[1])), math.sin(math.radians(c[1]))) for c in calib]
+        det = (v[0][0] * v[1][1]) - (v[0][1] * v[1][0])
+        ra = ((dx * v[1][1]) - (dy * v[1][0])) / det
+        dec = ((dy * v[0][0]) - (dx * v[0][1])) / det
+        return ra, dec
+
+    def guide_pos(self):
+        # the virtual star where there is one, the selected star otherwise
+        x = np.where(np.isfinite(self.frames["virt_x"]), self.frames["virt_x"], self.frames["sel_x"]).astype(np.float64)
+        y = np.where(np.isfinite(self.frames["virt_y"]), self.frames["virt_y"], self.frames["sel_y"]).astype(np.float64)
+        return x, y
+
+    def guide_error(self, seg = 0):
+        # (mask, RA error, DEC error) of the frames that were guided, distance from the target in pixels
+        x, y = self.guide_pos()
+        mask = (self.frame_seg == seg) & (self.frames["state"] == GUIDESTATE_GUIDING) & np.isfinite(x) & np.isfinite(self.frames["tgt_x"])
+        ra, dec = self.to_axis(x[mask] - self.frames["tgt_x"][mask], y[mask] - self.frames["tgt_y"][mask], seg)
+        return mask, ra, dec
+
+    def tracking_error(self, seg = 0):
+        # (time in seconds, RA, DEC), where the star would have been without the pulses, relative to the first frame, in pixels
+        calib = self.get_calib(seg)
+        x, y = self.guide_pos()
+        fmask = (self.frame_seg == seg) & np.isfinite(x)
+        if np.count_nonzero(fmask) <= 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        fts = self.frames["ts"][fmask].astype(np.int64)
+        ra, dec = self.to_axis(x[fmask] - x[fmask][0], y[fmask] - y[fmask][0], seg)
+        pmask = self.pulse_seg == seg
+        pts = self.pulses["ts"][pmask].astype(np.int64)
+        # a pulse is in every frame that was exposed after it was given
+        cum_ra = np.concatenate([[0.0], np.cumsum(self.pulses["fin_ra"][pmask] * calib[0][0])])
+        cum_dec = np.concatenate([[0.0], np.cumsum(self.pulses["fin_dec"][pmask] * calib[1][0])])
+        k = np.searchsorted(pts, fts, side = "left")
+        first = np.searchsorted(pts, fts[0], side = "left")
+        ra = ra - (cum_ra[k] - cum_ra[first])
+        dec = dec - (cum_dec[k] - cum_dec[first])
+        return (fts - fts[0]) / 1000.0, ra, dec
+
+    def error_trace(self, seg = 0):
+        # [(time, ra, dec), ...] in milliseconds and pixels, for the disturbance parameter of mount_sim.MountSim
+        t, ra, dec = self.tracking_error(seg)
+        return [(float(t[i] * 1000.0), float(ra[i]), float(dec[i])) for i in range(len(t))]
+
+    def analyze(self, seg = 0, period_min = 60.0, period_max = None):
+        # RMS of the guided frames, drift, and the strongest periodic error in the tracking error, all in pixels
+        res = {}
+        mask, ra, dec = self.guide_error(seg)
+        res.update({"frames": int(np.count_nonzero(self.frame_seg == seg))})
+        res.update({"guided_frames": int(len(ra))})
+        res.update({"pulses": int(np.count_nonzero(self.pulse_seg == seg))})
+        if len(ra) > 0:
+            res.update({"rms_ra": float(np.sqrt(np.mean(ra * ra)))})
+            res.update({"rms_dec": float(np.sqrt(np.mean(dec * dec)))})
+            res.update({"rms": float(np.sqrt(np.mean((ra * ra) + (dec * dec))))})
+        t, tra, tdec = self.tracking_error(seg)
+        if len(t) < 8 or t[-1] <= 0:
+            return res
+        res.update({"duration_s": float(t[-1])})
+        a = np.vstack([t, np.ones_like(t)]).T
+        c_ra = np.linalg.lstsq(a, tra, rcond = None)[0]
+        c_dec = np.linalg.lstsq(a, tdec, rcond = None)[0]
+        res.update({"drift_ra": float(c_ra[0] * 60.0)})   # pixels per minute
+        res.update({"drift_dec": float(c_dec[0] * 60.0)})
+        resid = tra - (a @ c_ra)
+        res.update({"pe_p2p": float(np.percentile(resid, 99) - np.percentile(resid, 1))})
+        if period_max is None:
+            period_max = t[-1] / 2.0
+        if period_max > period_min:
+            periods = np.geomspace(period_min, period_max, 400)
+            w = (2.0 * math.pi) / periods
+            ph = np.outer(w, t)
+            # least squares amplitude at every period, the sine and cosine are close to orthogonal over a few cycles
+            cs = np.cos(ph)
+            sn = np.sin(ph)
+            amp_c = (cs @ resid) / np.sum(cs * cs, axis = 1)
+            amp_s = (sn @ resid) / np.sum(sn * sn, axis = 1)
+            amp = np.sqrt((amp_c * amp_c) + (amp_s * amp_s))
+            i = int(np.argmax(amp))
+            res.update({"pe_period_s": float(periods[i])})
+            res.update({"pe_amp": float(amp[i])})
+        return res
+
+def read_session(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    return parse_session(data)
+
+def parse_session(data):
+    if data[0:4] != SES_MAGIC:
+        raise ValueError("not a guiding session log")
+    if data[4] != SES_VER:
+        raise ValueError("unsupported session log version %u" % data[4])
+    ses = Session()
+    frame_parts = []
+    frame_segs = []
+    star_parts = []
+    pulse_parts = []
+    pulse_segs = []
+    seg = -1
+    i = 5
+    n = len(data)
+    flen = FRAME_DTYPE.itemsize
+    while i + REC_HEAD_LEN <= n:
+        t = data[i]
+        length = data[i + 1] | (data[i + 2] << 8)
+        j = i + REC_HEAD_LEN
+        if j + length > n:
+            # the guider was switched off while writing
+            ses.truncated = True
+            break
+        payload = data[j:j + length]
+        if t == REC_INFO:
+            ses.info.append(json.loads(payload.decode("utf-8")))
+            seg += 1
+        elif t == REC_FRAME:
+            frame_parts.append(payload[0:flen])
+            frame_segs.append(max(0, seg))
+            star_parts.append(payload[flen:])
+        elif t == REC_PULSE:
+            pulse_parts.append(payload)
+            pulse_segs.append(max(0, seg))
+        elif t == REC_MSG:
+            ts = int.from_bytes(payload[0:4], "little")
+            ses.msgs.append((ts, payload[4:].decode("utf-8", errors = "replace")))
+        i = j + length
+
+    if len(frame_parts) > 0:
+        ses.frames = np.frombuffer(b"".join(frame_parts), dtype = FRAME_DTYPE).copy()
+        ses.frame_seg = np.array(frame_segs, dtype = np.int32)
+        raw = np.frombuffer(b"".join(star_parts), dtype = STAR_RAW_DTYPE)
+        stars = np.zeros(len(raw), dtype = STAR_DTYPE)
+        stars["x"] = raw["x"] / STAR_SCALE
+        stars["y"] = raw["y"] / STAR_SCALE
+        stars["r"] = raw["r"]
+        stars["maxb"] = raw["maxb"]
+        stars["rating"] = raw["rating"]
+        ses.stars = stars
+        ses.star_frame = np.repeat(np.arange(len(ses.frames), dtype = np.int32), ses.frames["nstars"].astype(np.int64))
+    if len(pulse_parts) > 0:
+        ses.pulses = np.frombuffer(b"".join(pulse_parts), dtype = PULSE_DTYPE).copy()
+        ses.pulse_seg = np.array(pulse_segs, dtype = np.int32)
+    return ses
+
+def main():
+    args = [a for a in sys.argv[1:] if a.startswith("--") == False]
+    if len(args) < 1:
+        print("usage: %s session.gsl [--trace out.csv]" % sys.argv[0])
+        return 1
+    ses = read_session(args[0])
+    print("%u sessions, %u frames, %u stars, %u pulses, %u messages%s" % (len(ses.info), len(ses.frames), len(ses.stars), len(ses.pulses), len(ses.msgs), ", truncated" if ses.truncated else ""))
+    for seg in range(max(1, len(ses.info))):
+        try:
+            res = ses.analyze(seg)
+        except ValueError as exc:
+            print("session %u: %s" % (seg, str(exc)))
+            continue
+        print("session %u: %s" % (seg, ", ".join("%s %s" % (k, ("%0.3f" % v) if isinstance(v, float) else str(v)) for k, v in res.items())))
+    if "--trace" in sys.argv:
+        i = sys.argv.index("--trace")
+        out = sys.argv[i + 1] if i + 1 < len(sys.argv) else "trace.csv"
+        with open(out, "w") as f:
+            f.write("time_ms,ra,dec\n")
+            for r in ses.error_trace():
+                f.write("%0.0f,%0.4f,%0.4f\n" % r)
+        print("tracking error written to " + out)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
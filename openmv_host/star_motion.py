@@ -0,0 +1,298 @@
+# vectorized multi-star motion analysis, a drop-in for guidestar.get_multi_star_motion()
+#
+# derived from the firmware's py_guidestar.c, through its line for line port in guidestar.py:
+# every star in the new frame is tried as the destination of the selected star, each move is scored on how many old stars
+# land near a new star (rounded distance under the tolerance) and on their average error, 50% each,
+# then the stars near the selected one are averaged, weighted by (SENSOR_DIAG - distance to the selected star)
+# here all of the moves are checked at once, the nearest neighbour lookups go through a k-d tree
+# with the default options the results are the same as guidestar.py's, to rounding, check() compares the two
+#
+# robust = True replaces the weighted average with a least squares fit over all of the matched stars, which throws out stars that don't agree
+# rotation = True (implies robust) also fits a rotation of the star field around its center, for field rotation or a poor polar alignment
+#
+# scipy's cKDTree is used if scipy is installed, otherwise the lookups are done by brute force with NumPy, which is fine for a few hundred stars
+#
+#   import star_motion
+#   star_motion.install()                  # the guider and everything else now uses this version
+#   star_motion.install(robust = True)     # with outlier rejection
+#   star_motion.uninstall()
+
+import math
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+SENSOR_DIAG  = 3240
+CHUNK_PTS    = 65536 # lookups done at once, limits the memory used with many stars
+CLIP_SIGMA   = 3.0   # residuals further than this many standard deviations are outliers
+CLIP_MIN     = 0.1   # pixels, residuals this small are never outliers, stops a perfect fit from rejecting everything
+CLIP_LOOPS   = 3
+
+def star_arrays(stars):
+    n = len(stars)
+    xy = np.empty((n, 2), dtype = np.float64)
+    rating = np.empty(n, dtype = np.int64)
+    i = 0
+    for s in stars:
+        xy[i, 0] = s.cxf()
+        xy[i, 1] = s.cyf()
+        rating[i] = s.star_rating()
+        i += 1
+    return xy, rating
+
+def map_val_int(x, in_min, in_max, out_min, out_max):
+    # guidestar.map_val_int() over arrays, x and the results are never negative here, so floor division is the same as C's
+    y = (x - in_min) * (out_max - out_min)
+    div = in_max - in_min
+    if div == 0:
+        # the Cortex-M divider gives 0
+        return np.full(np.shape(x), out_min, dtype = np.int64)
+    y = (y + (div // 2)) // div
+    return y + out_min
+
+class NearestIndex(object):
+    # nearest star lookups, query() returns the distance and index of the nearest star for every point
+
+    def __init__(self, xy):
+        self.xy = xy
+        self.tree = cKDTree(xy) if cKDTree is not None and len(xy) > 0 else None
+
+    def query(self, pts):
+        if len(self.xy) <= 0:
+            return np.full(len(pts), np.inf), np.zeros(len(pts), dtype = np.int64)
+        if self.tree is not None:
+            d, i = self.tree.query(pts, k = 1)
+            return d, i
+        d_best = np.empty(len(pts))
+        i_best = np.empty(len(pts), dtype = np.int64)
+        step = max(1, CHUNK_PTS // len(self.xy))
+        j = 0
+        while j < len(pts):
+            p = pts[j:j + step]
+            d2 = ((p[:, None, 0] - self.xy[None, :, 0]) ** 2) + ((p[:, None, 1] - self.xy[None, :, 1]) ** 2)
+            k = np.argmin(d2, axis = 1)
+            i_best[j:j + step] = k
+            d_best[j:j + step] = np.sqrt(d2[np.arange(len(p)), k])
+            j += step
+        return d_best, i_best
+
+def eval_moves(prev_xy, index, moves, tolerance):
+    # the firmware's eval_move() for every move at once
+    # returns how many old stars land near a new star, and their average error, the error sum is an int that drops the fraction of each distance
+    nearby = np.zeros(len(moves), dtype = np.int64)
+    err_sum = np.zeros(len(moves), dtype = np.int64)
+    n = len(prev_xy)
+    step = max(1, CHUNK_PTS // max(1, n))
+    j = 0
+    while j < len(moves):
+        m = moves[j:j + step]
+        pts = (prev_xy[None, :, :] + m[:, None, :]).reshape(-1, 2)
+        d, i = index.query(pts)
+        d = np.minimum(d.reshape(len(m), n), SENSOR_DIAG)
+        hit = np.rint(d) < tolerance
+        nearby[j:j + step] = np.count_nonzero(hit, axis = 1)
+        err_sum[j:j + step] = np.where(hit, np.floor(d), 0.0).sum(axis = 1).astype(np.int64)
+        j += step
+    err_avg = np.zeros(len(moves), dtype = np.float64)
+    has = nearby > 0
+    err_avg[has] = err_sum[has] / nearby[has]
+    return nearby, err_avg
+
+def get_single_star_motion(prev_xy, lat_xy, index, sx, sy, tolerance, fast_mode):
+    # guidestar.get_single_star_motion() with arrays, returns (index of the new star or -1, error, nearby count)
+    n_new = len(lat_xy)
+    if n_new < 1:
+        return (-1, SENSOR_DIAG - 1, 0)
+    elif n_new == 1:
+        return (0, 0, 1)
+    fast_mode = int(fast_mode)
+    quick_match_required = (n_new * fast_mode) // 100 if fast_mode >= 0 else -((n_new * -fast_mode) // 100)
+
+    moves = lat_xy - [sx, sy]
+    mag = np.hypot(moves[:, 0], moves[:, 1])
+    ci = int(np.argmin(mag))
+    closest = ci if mag[ci] < SENSOR_DIAG else -1
+
+    nearby, err_avg = eval_moves(prev_xy, index, moves, tolerance)
+    err_round = np.rint(err_avg).astype(np.int64)
+    if fast_mode > 0:
+        # the first move that looks great is taken
+        quick = np.flatnonzero((err_round < tolerance) & (nearby >= quick_match_required))
+        if len(quick) > 0:
+            i = int(quick[0])
+            return (i, int(err_round[i]), int(nearby[i]))
+
+    if len(prev_xy) <= 1 and closest >= 0:
+        return (closest, 0, 1)
+
+    best_nearby = max(quick_match_required, int(nearby.max()))
+    ok = err_round < tolerance
+    score_nearby = map_val_int(nearby, 0, best_nearby, 0, 100) * 50
+    score_erravg = (100 - map_val_int(err_round, 0, tolerance, 0, 100)) * 50
+    score = np.where(ok, (score_nearby + score_erravg) // 100, 0)
+    bi = int(np.argmax(score)) # the first of the best scores, the firmware only takes a strictly better one
+    if score[bi] > 0 and nearby[bi] > 0:
+        return (bi, int(err_round[bi]), int(nearby[bi]))
+    return (-1, SENSOR_DIAG - 2, 0)
+
+def fit_transform(src, dst, rotation = False):
+    # least squares fit of dst = R(src - c) + c + t, c is the center of src, returns (angle in radians, c, t)
+    c = src.mean(axis = 0)
+    t = dst.mean(axis = 0) - c
+    if rotation == False or len(src) < 2:
+        return 0.0, c, t
+    a = src - c
+    b = dst - dst.mean(axis = 0)
+    ang = math.atan2(float(np.sum((a[:, 0] * b[:, 1]) - (a[:, 1] * b[:, 0]))), float(np.sum((a[:, 0] * b[:, 0]) + (a[:, 1] * b[:, 1]))))
+    return ang, c, t
+
+def apply_transform(pts, ang, c, t):
+    ca = math.cos(ang)
+    sa = math.sin(ang)
+    a = pts - c
+    return np.stack(((a[:, 0] * ca) - (a[:, 1] * sa), (a[:, 0] * sa) + (a[:, 1] * ca)), axis = 1) + c + t
+
+def robust_fit(src, dst, rotation = False):
+    # fits, then drops the pairs that are far off and fits again, returns (angle, center, translation, inlier mask)
+    keep = np.ones(len(src), dtype = bool)
+    ang, c, t = fit_transform(src, dst, rotation)
+    loop = 0
+    while loop < CLIP_LOOPS and np.count_nonzero(keep) > 2:
+        resid = np.hypot(*(apply_transform(src, ang, c, t) - dst).T)
+        # median absolute deviation, as a standard deviation
+        sigma = 1.4826 * np.median(resid[keep])
+        lim = max(CLIP_MIN, CLIP_SIGMA * sigma)
+        new_keep = resid <= lim
+        if np.count_nonzero(new_keep) < 2 or np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+        ang, c, t = fit_transform(src[keep], dst[keep], rotation)
+        loop += 1
+    return ang, c, t, keep
+
+def get_multi_star_motion(prev_stars, latest_stars, selected, tolerance, fast_mode, ratings_thresh, cnt_min, cnt_max, robust = False, rotation = False):
+    # returns (real star, virtual star x, virtual star y, move error, correctly moved count, multi-star count)
+    # the real star is None if no match is found, with 3240 as the error
+    if prev_stars is None or latest_stars is None or selected is None:
+        return (None, -1.0, -1.0, SENSOR_DIAG, 0, 0)
+    tolerance = int(tolerance)
+    lat_xy, lat_rating = star_arrays(latest_stars)
+    prev_xy, prev_rating = star_arrays(prev_stars)
+    sx = selected.cxf()
+    sy = selected.cyf()
+    index = NearestIndex(lat_xy)
+
+    si, single_err, single_nearby = get_single_star_motion(prev_xy, lat_xy, index, sx, sy, tolerance, fast_mode)
+    if si < 0:
+        return (None, -1.0, -1.0, SENSOR_DIAG, 0, 0)
+    star = latest_stars[si]
+    cnt_max = int(cnt_max)
+    if cnt_max <= 1 or len(latest_stars) <= 1:
+        return (star, star.cxf(), star.cyf(), single_err, single_nearby, 1)
+    ratings_thresh = int(ratings_thresh)
+    cnt_min = int(cnt_min)
+    dx = lat_xy[si, 0] - sx
+    dy = lat_xy[si, 1] - sy
+
+    # where every old star should be, and the new star nearest to that
+    pred = prev_xy + [dx, dy]
+    d, ni = index.query(pred)
+    found = d < SENSOR_DIAG
+    n_rating = np.where(found, lat_rating[ni], -1)
+    close = found & (n_rating >= 0) & (np.rint(d) < tolerance)
+    good = (prev_rating >= ratings_thresh) & (n_rating >= ratings_thresh)
+    # until cnt_min are used, any close star is used, after that only well rated ones
+    seen = np.cumsum(close) - 1
+    use = np.flatnonzero(close & ((seen < cnt_min) | good))
+    if robust == False and rotation == False:
+        use = use[0:cnt_max]
+    used = len(use)
+    if used <= 0:
+        # all stars have bad rating, the firmware falls back on the original calculated move
+        return (star, star.cxf() + dx, star.cyf() + dy, single_err, single_nearby, 0)
+    if robust or rotation:
+        ang, c, t, keep = robust_fit(prev_xy[use], lat_xy[ni[use]], rotation)
+        v = apply_transform(np.array([[sx, sy]]), ang, c, t)[0]
+        return (star, float(v[0]), float(v[1]), single_err, single_nearby, int(np.count_nonzero(keep)))
+    # the closer a star is to the selected star, the more weight it has
+    resid = lat_xy[ni[use]] - pred[use]
+    w = SENSOR_DIAG - np.hypot(sx - prev_xy[use, 0], sy - prev_xy[use, 1])
+    dx_avg = float(np.dot(resid[:, 0], w) / w.sum())
+    dy_avg = float(np.dot(resid[:, 1], w) / w.sum())
+    return (star, star.cxf() + dx_avg, star.cyf() + dy_avg, single_err, single_nearby, used)
+
+orig_motion = None
+
+def install(robust = False, rotation = False):
+    # makes guidestar.get_multi_star_motion() use this version, with these options
+    import guidestar
+    global orig_motion
+    if orig_motion is None:
+        orig_motion = guidestar.get_multi_star_motion
+    def motion(prev_stars, latest_stars, selected, tolerance, fast_mode, ratings_thresh, cnt_min, cnt_max):
+        return get_multi_star_motion(prev_stars, latest_stars, selected, tolerance, fast_mode, ratings_thresh, cnt_min, cnt_max, robust = robust, rotation = rotation)
+    guidestar.get_multi_star_motion = motion
+
+def uninstall():
+    import guidestar
+    global orig_motion
+    if orig_motion is not None:
+        guidestar.get_multi_star_motion = orig_motion
+        orig_motion = None
+
+def check(n = 2000, seed = 1, tol = 1e-6):
+    # compares against the port of the firmware's C code in guidestar.py on random star fields, returns the number of differences
+    import random
+    import guidestar
+    if orig_motion is not None:
+        ref_motion = orig_motion
+    else:
+        ref_motion = guidestar.get_multi_star_motion
+    rng = random.Random(seed)
+    diffs = 0
+    for k in range(n):
+        cnt = rng.randint(0, 40)
+        prev = []
+        for i in range(cnt):
+            s = guidestar.GuideStar(rng.uniform(0, guidestar.SENSOR_WIDTH), rng.uniform(0, guidestar.SENSOR_HEIGHT), 3, rng.randint(20, 255), [0], rng.randint(0, 100), rng.choice([0, 0, 0, 2, 12]))
+            prev.append(s)
+        guidestar.process_list(prev, 20, None, 2, 50)
+        # the field moves, loses some stars, gains some and jitters
+        mx = rng.gauss(0, 20)
+        my = rng.gauss(0, 20)
+        latest = []
+        for s in prev:
+            if rng.random() < 0.15:
+                continue
+            t = s.clone()
+            t.move_coord(s.cxf() + mx + rng.gauss(0, 0.7), s.cyf() + my + rng.gauss(0, 0.7))
+            latest.append(t)
+        for i in range(rng.randint(0, 4)):
+            latest.append(guidestar.GuideStar(rng.uniform(0, guidestar.SENSOR_WIDTH), rng.uniform(0, guidestar.SENSOR_HEIGHT), 3, rng.randint(20, 255), [0], rng.randint(0, 100), 0))
+        rng.shuffle(latest)
+        guidestar.process_list(latest, 20, None, 2, 50)
+        selected = prev[rng.randint(0, len(prev) - 1)] if len(prev) > 0 and rng.random() < 0.95 else None
+        args = (prev, latest, selected, rng.choice([5, 10, 20]), rng.choice([0, 0, 50]), 50, rng.randint(1, 3), rng.choice([1, 5, 10]))
+        a = ref_motion(*args)
+        b = get_multi_star_motion(*args)
+        same = a[0] is b[0] and a[3:] == b[3:]
+        if same:
+            same = abs(a[1] - b[1]) <= tol and abs(a[2] - b[2]) <= tol
+        if same == False:
+            diffs += 1
+    return diffs
+
+def main():
+    import sys, time
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    t = time.perf_counter()
+    diffs = check(n)
+    print("%u random frames, %u differ from guidestar.py, %0.2f s" % (n, diffs, time.perf_counter() - t))
+    return 0 if diffs <= 0 else 1
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
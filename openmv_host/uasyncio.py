@@ -0,0 +1,38 @@
+# host stand-in for MicroPython's "uasyncio" module
+# a thin layer over asyncio, adds the MicroPython-only names, and remaps privileged ports the same way usocket does
+# MicroPython runs one event loop for the whole program, so get_event_loop() always returns the same loop here too
+
+import asyncio as _asyncio
+from asyncio import sleep, wait_for, gather, create_task, Event, Lock, CancelledError, TimeoutError
+import usocket
+
+_loop = None
+
+def get_event_loop():
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = _asyncio.new_event_loop()
+        _asyncio.set_event_loop(_loop)
+    return _loop
+
+def new_event_loop():
+    global _loop
+    if _loop is not None and _loop.is_closed() == False:
+        _loop.close()
+    _loop = None
+    return get_event_loop()
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+async def sleep_ms(t):
+    await _asyncio.sleep(t / 1000.0)
+
+async def wait_for_ms(aw, timeout):
+    return await _asyncio.wait_for(aw, timeout / 1000.0)
+
+async def start_server(cb, host, port, backlog = 5):
+    return await _asyncio.start_server(cb, host, usocket.PORT_MAP.get(port, port), backlog = backlog, reuse_address = True)
+
+async def open_connection(host, port):
+    return await _asyncio.open_connection(host, usocket.PORT_MAP.get(port, port))
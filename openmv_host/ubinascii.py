@@ -0,0 +1,7 @@
+# host stand-in for the MicroPython "ubinascii" module
+
+from binascii import hexlify, unhexlify, a2b_base64, crc32
+
+def b2a_base64(data, newline = True):
+    import binascii
+    return binascii.b2a_base64(data, newline = newline)
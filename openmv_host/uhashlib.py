@@ -0,0 +1,27 @@
+# host stand-in for the MicroPython "uhashlib" module
+# MicroPython accepts str where CPython wants bytes
+
+import hashlib
+
+def _b(data):
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    return data
+
+class sha1(object):
+    def __init__(self, data = None):
+        self.h = hashlib.sha1()
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self.h.update(_b(data))
+
+    def digest(self):
+        return self.h.digest()
+
+class sha256(sha1):
+    def __init__(self, data = None):
+        self.h = hashlib.sha256()
+        if data is not None:
+            self.update(data)
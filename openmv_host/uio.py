@@ -0,0 +1,20 @@
+# host stand-in for the MicroPython "uio" module
+# MicroPython allows StringIO/BytesIO to be constructed with a pre-allocation size
+
+import io
+
+class StringIO(io.StringIO):
+    def __init__(self, initial = None):
+        if isinstance(initial, int):
+            initial = None
+        super().__init__(initial)
+
+class BytesIO(io.BytesIO):
+    def __init__(self, initial = None):
+        if isinstance(initial, int):
+            initial = None
+        super().__init__(initial)
+
+open = io.open
+FileIO = io.FileIO
+TextIOWrapper = io.TextIOWrapper
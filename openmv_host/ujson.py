@@ -0,0 +1,21 @@
+# host stand-in for the MicroPython "ujson" module
+# files on the device are opened in binary mode before calling dump/load, so bytes must be handled here
+
+import json
+
+def dumps(obj):
+    return json.dumps(obj)
+
+def loads(s):
+    if isinstance(s, (bytes, bytearray)):
+        s = s.decode("utf-8")
+    return json.loads(s)
+
+def dump(obj, stream):
+    s = json.dumps(obj)
+    if "b" in getattr(stream, "mode", ""):
+        s = s.encode("utf-8")
+    stream.write(s)
+
+def load(stream):
+    return loads(stream.read())
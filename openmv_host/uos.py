@@ -0,0 +1,55 @@
+# host stand-in for the MicroPython "uos" module
+# the device filesystem is a directory on the host, hostenv.install() makes it the working directory
+# so that both uos calls and the built-in open() see the same files
+
+import os
+import utime
+
+def listdir(path = None):
+    if path is None or len(path) <= 0:
+        path = "."
+    return sorted(os.listdir(path))
+
+def stat(path):
+    st = os.stat(path)
+    # MicroPython returns a plain 10-tuple, timestamps use the 2000-01-01 epoch
+    return (st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid, st.st_gid, st.st_size,
+            int(st.st_atime) - utime.EPOCH_OFFSET, int(st.st_mtime) - utime.EPOCH_OFFSET, int(st.st_ctime) - utime.EPOCH_OFFSET)
+
+def ilistdir(path = None):
+    for i in listdir(path):
+        fpath = i if path is None else os.path.join(path, i)
+        yield (i, 0x4000 if os.path.isdir(fpath) else 0x8000, 0, os.path.getsize(fpath))
+
+def statvfs(path = "."):
+    st = os.statvfs(path)
+    return (st.f_bsize, st.f_frsize, st.f_blocks, st.f_bfree, st.f_bavail, st.f_files, st.f_ffree, st.f_favail, st.f_flag, st.f_namemax)
+
+def remove(path):
+    os.remove(path)
+
+def rename(old_path, new_path):
+    os.replace(old_path, new_path)
+
+def mkdir(path):
+    os.mkdir(path)
+
+def rmdir(path):
+    os.rmdir(path)
+
+def chdir(path):
+    os.chdir(path)
+
+def getcwd():
+    return os.getcwd()
+
+def sync():
+    pass
+
+def urandom(n):
+    return os.urandom(n)
+
+def uname():
+    return ("openmv-host", "host", "1.0", "host", "OPENMV4P-HOST")
+
+sep = "/"
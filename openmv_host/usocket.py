@@ -0,0 +1,103 @@
+# host stand-in for the MicroPython "usocket" module
+# MicroPython sockets accept str wherever bytes are expected, and also act as streams (write/read)
+# privileged ports can be remapped through PORT_MAP, for example {80: 8080, 53: 5353}
+# when pyb runs on the virtual clock, waiting for a connection or data does not sleep,
+# the socket is polled and the clock is advanced by the timeout instead
+
+import socket as _socket
+import select as _select
+import pyb
+
+AF_INET     = _socket.AF_INET
+SOCK_STREAM = _socket.SOCK_STREAM
+SOCK_DGRAM  = _socket.SOCK_DGRAM
+SOL_SOCKET  = _socket.SOL_SOCKET
+SO_REUSEADDR = _socket.SO_REUSEADDR
+
+PORT_MAP = {}
+
+def _b(data):
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    return data
+
+def _addr(addr):
+    if isinstance(addr, tuple) and len(addr) == 2 and addr[1] in PORT_MAP:
+        return (addr[0], PORT_MAP[addr[1]])
+    return addr
+
+def getaddrinfo(host, port, af = 0, type = 0, proto = 0, flags = 0):
+    return _socket.getaddrinfo(host, port, af, type, proto, flags)
+
+class socket(object):
+    def __init__(self, af = AF_INET, type = SOCK_STREAM, proto = 0, sock = None):
+        if sock is None:
+            sock = _socket.socket(af, type, proto)
+            sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.sock = sock
+        self.timeout = None # seconds, None blocks
+
+    def wait_ready(self):
+        # on the virtual clock, a wait that would time out raises the timeout right away, after the clock has moved on
+        if pyb.is_virtual_clock() == False or self.timeout is None or self.timeout <= 0:
+            return
+        r, w, x = _select.select([self.sock], [], [], 0)
+        if len(r) <= 0:
+            pyb.advance(int(self.timeout * 1000))
+            raise _socket.timeout("timed out")
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def bind(self, addr):
+        self.sock.bind(_addr(addr))
+
+    def listen(self, backlog = 1):
+        self.sock.listen(backlog)
+
+    def accept(self):
+        self.wait_ready()
+        conn, addr = self.sock.accept()
+        return socket(sock = conn), addr
+
+    def connect(self, addr):
+        self.sock.connect(_addr(addr))
+
+    def settimeout(self, t):
+        self.timeout = t
+        self.sock.settimeout(t)
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0
+        self.sock.setblocking(flag)
+
+    def setsockopt(self, level, optname, value):
+        self.sock.setsockopt(level, optname, value)
+
+    def send(self, data):
+        data = _b(data)
+        self.sock.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def write(self, data):
+        return self.send(data)
+
+    def sendto(self, data, addr):
+        return self.sock.sendto(_b(data), addr)
+
+    def recv(self, bufsize):
+        self.wait_ready()
+        return self.sock.recv(bufsize)
+
+    def read(self, bufsize = 1024):
+        return self.recv(bufsize)
+
+    def recvfrom(self, bufsize):
+        self.wait_ready()
+        return self.sock.recvfrom(bufsize)
+
+    def close(self):
+        self.sock.close()
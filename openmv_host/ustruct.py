@@ -0,0 +1,3 @@
+# host stand-in for the MicroPython "ustruct" module
+
+from struct import pack, pack_into, unpack, unpack_from, calcsize
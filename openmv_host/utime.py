@@ -0,0 +1,46 @@
+# host stand-in for the MicroPython "utime" module
+# MicroPython on OpenMV uses 2000-01-01 as its epoch and has no concept of time zones
+# all conversions here are done as UTC with that epoch so numbers match the device
+
+import time as _time
+import calendar
+import pyb
+
+EPOCH_OFFSET = 946684800 # seconds between 1970-01-01 and 2000-01-01
+
+def mktime(t):
+    t = tuple(t) + (0,) * (8 - len(t))
+    return calendar.timegm((t[0], t[1], t[2], t[3], t[4], t[5], 0, 0, 0)) - EPOCH_OFFSET
+
+def localtime(secs = None):
+    if secs is None:
+        secs = time()
+    t = _time.gmtime(int(secs) + EPOCH_OFFSET)
+    # MicroPython: (year, month, mday, hour, minute, second, weekday, yearday), weekday 0 is Monday
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+gmtime = localtime
+
+def time():
+    return int(_time.time()) - EPOCH_OFFSET
+
+def sleep(s):
+    pyb.delay(int(round(s * 1000)))
+
+def sleep_ms(ms):
+    pyb.delay(ms)
+
+def sleep_us(us):
+    pyb.udelay(us)
+
+def ticks_ms():
+    return pyb.millis()
+
+def ticks_us():
+    return pyb.micros()
+
+def ticks_diff(a, b):
+    return (a - b) & 0x3FFFFFFF
+
+def ticks_add(a, b):
+    return (a + b) & 0x3FFFFFFF
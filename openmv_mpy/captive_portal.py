@@ -269,14 +269,14 @@ class CaptivePortal(object):
                 print(", file \"%s\" as \"%s\" size %u ..." % (fname, content_type, fsize), end="")
             try:
                 client_stream.write("HTTP/1.0 200 OK\r\ncontent-type: %s\r\ncache-control: no-cache\r\ncontent-length: %u\r\n\r\n" % (content_type, fsize))
-                stream_file(client_stream, f)
+                # the file is closed when the iterator finishes
+                send_iter(client_stream, iter_file(f, close = True))
             except Exception as exc:
                 exclogger.log_exception(exc)
-
-            try:
-                f.close()
-            except Exception as exc:
-                exclogger.log_exception(exc, to_print = False, to_file = False)
+                try:
+                    f.close()
+                except Exception as exc:
+                    exclogger.log_exception(exc, to_print = False, to_file = False)
             if self.debug:
                 print(" done")
         else:
@@ -462,21 +462,27 @@ class CaptivePortal(object):
             pass
         return STS_IDLE
 
-    def task(self, allow_kick = True):
-        self.task_conn()
+    def task_kick(self, allow_kick):
+        # returns True if the server had to be kicked or the WiFi hardware had to be rebooted
         if allow_kick:
             if self.last_http_time > 0 and pyb.elapsed_millis(self.last_http_time) > 10000:
                 self.kick()
-                return STS_KICKED
+                return True
             if self.allow_hw_kick:
                 if self.last_http_time < 0 and self.full_reboot_timer > 0 and pyb.elapsed_millis(self.full_reboot_timer) > 12000:
                     self.reboot()
-                    return STS_KICKED
+                    return True
         else:
             if self.last_http_time > 0:
                 self.last_http_time = pyb.millis()
             if self.full_reboot_timer > 0:
                 self.full_reboot_timer = pyb.millis()
+        return False
+
+    def task(self, allow_kick = True):
+        self.task_conn()
+        if self.task_kick(allow_kick):
+            return STS_KICKED
         x = self.task_dns()
         y = self.task_http()
         if x == STS_SERVED or y == STS_SERVED:
@@ -577,6 +583,9 @@ def socket_readall(sock, blocking = False):
     return res
 
 def websocket_readmsg(sock):
+    if hasattr(sock, "readmsg"):
+        # the event loop server has already received and decoded the messages
+        return sock.readmsg()
     sock.settimeout(0)
     try:
         hd1 = sock.recv(2)
@@ -629,6 +638,11 @@ def websocket_readmsg(sock):
         return None
 
 def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
+    send_iter(conn, iter_page(main_file, add_files = add_files, add_dir = add_dir, debug = debug))
+    conn.close()
+
+def iter_page(main_file, add_files = [], add_dir = None, debug = False):
+    # generates the page one piece at a time, so it never has to be in memory all at once
     total_size = 0
     total_size += uos.stat(main_file)[6]
     flist = []
@@ -653,7 +667,7 @@ def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
     if debug:
         print("gen_page \"%s\" sz %u files %u ..." % (main_file, total_size, len(flist)), end="")
 
-    conn.write(default_reply_header(content_length = total_size))
+    yield default_reply_header(content_length = total_size)
 
     sent = 0
     seekpos = 0
@@ -663,7 +677,7 @@ def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
             headstr += f.read(1).decode("ascii")
             seekpos += 1
             sent += 1
-        conn.write(headstr + "\r\n")
+        yield headstr + "\r\n"
         sent += 2
     if debug:
         print("-", end="")
@@ -675,19 +689,23 @@ def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
                 if fn.lower().endswith(".js"):
                     s = "\r\n<script type=\"text/javascript\">\r\n"
                     sent += len(s)
-                    conn.write(s)
-                    sent += stream_file(conn, f)
+                    yield s
+                    for x in iter_file(f):
+                        sent += len(x)
+                        yield x
                     s = "\r\n</script>\r\n"
                     sent += len(s)
-                    conn.write(s)
+                    yield s
                 elif fn.lower().endswith(".css"):
                     s = "\r\n<style type=\"text/css\">\r\n"
                     sent += len(s)
-                    conn.write(s)
-                    sent += stream_file(conn, f)
+                    yield s
+                    for x in iter_file(f):
+                        sent += len(x)
+                        yield x
                     s = "\r\n</style>\r\n"
                     sent += len(s)
-                    conn.write(s)
+                    yield s
                 else:
                     raise Exception("unsupported file type")
                 if debug:
@@ -698,25 +716,44 @@ def gen_page(conn, main_file, add_files = [], add_dir = None, debug = False):
     # send the rest of the file
     with open(main_file, "rb") as f:
         f.seek(seekpos)
-        sent += stream_html_to_body(conn, f)
-        sent += stream_file(conn, f)
+        for x in iter_html_to_body(f):
+            sent += len(x)
+            yield x
+        for x in iter_file(f):
+            sent += len(x)
+            yield x
         if debug:
             print("+", end="")
 
     # pad the end
-    while sent < total_size - 2:
-        conn.write(" ")
-        sent += 1
+    if sent < total_size - 2:
+        yield " " * (total_size - 2 - sent)
 
     if debug:
         print(" done!")
 
-    conn.close()
+def send_iter(conn, it):
+    # sends everything that an iterator generates
+    # the event loop server takes the iterator itself, and only pulls from it as fast as the client can receive
+    if hasattr(conn, "write_iter"):
+        conn.write_iter(it)
+        return
+    try:
+        for x in it:
+            conn.write(x)
+    finally:
+        it.close()
 
 def stream_html_to_body(dest, f):
+    sent = 0
+    for x in iter_html_to_body(f):
+        sent += len(x)
+        dest.write(x)
+    return sent
+
+def iter_html_to_body(f):
     strbuf = ""
     ignoring = False
-    sent = 0
     while True:
         x = f.read(1).decode("ascii")
         if x is None:
@@ -725,12 +762,10 @@ def stream_html_to_body(dest, f):
             break
         strbuf += x
         if "<body" in strbuf:
-            sent += len(strbuf)
-            dest.write(strbuf)
+            yield strbuf
             break
         elif "<!-- ignore -->" in strbuf:
-            sent += len(strbuf)
-            dest.write(strbuf)
+            yield strbuf
             strbuf = ""
             ignoring = True
         elif "<!-- end ignore -->" in strbuf:
@@ -738,13 +773,19 @@ def stream_html_to_body(dest, f):
             ignoring = False
             break
         elif "\n" in strbuf and ignoring == False:
-            sent += len(strbuf)
-            dest.write(strbuf)
+            yield strbuf
             strbuf = ""
-    return sent
 
 def stream_file(dest, f, bufsz = -1, buflim = 2048):
+    sent = 0
+    for x in iter_file(f, bufsz = bufsz, buflim = buflim):
+        sent += len(x)
+        dest.write(x)
+    return sent
+
+def iter_file(f, bufsz = -1, buflim = 2048, close = False):
     gc.collect()
+    mf = bufsz
     if bufsz <= 0:
         # handle large files by reading one chunk at a time
         mf = gc.mem_free()
@@ -755,18 +796,17 @@ def stream_file(dest, f, bufsz = -1, buflim = 2048):
         if mf > buflim:
             mf = buflim
         mf = int(round(mf))
-    sent = 0
-    while True:
-        x = f.read(mf)
-        if x is None:
-            break
-        xlen = len(x)
-        sent += xlen
-        if xlen > 0:
-            dest.write(x)
-        else:
-            break
-    return sent
+    try:
+        while True:
+            x = f.read(mf)
+            if x is None:
+                break
+            if len(x) <= 0:
+                break
+            yield x
+    finally:
+        if close:
+            f.close()
 
 def split_get_request(req):
     req_split = req.split(' ')
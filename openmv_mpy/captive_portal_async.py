@@ -0,0 +1,343 @@
+import micropython
+micropython.opt_level(2)
+
+import pyb, gc
+import uasyncio as asyncio
+import captive_portal
+import exclogger
+from captive_portal import STS_IDLE, STS_SERVED, STS_KICKED
+
+# event loop version of the captive portal
+# the listener, every client, the websocket, and the image stream are all coroutines on one event loop
+# task() only runs the loop for as long as there is something ready to do, a slow client can never hold it up
+# the HTTP handlers are the same ones used by CaptivePortal, they are given an AsyncClient instead of a socket
+
+HTTP_PORT       = micropython.const(80)
+HTTP_BACKLOG    = micropython.const(2)
+REQ_TIMEOUT_MS  = micropython.const(5000)  # a client has this long to send the request and its headers
+SEND_TIMEOUT_MS = micropython.const(10000) # a client that does not take any data for this long is dropped
+CONTENT_LIMIT   = micropython.const(4096)
+WEBSOCK_BACKLOG = micropython.const(8192)  # a new websocket message is refused while this much is still waiting to be sent
+RX_MSG_LIMIT    = micropython.const(8)
+TASK_SLICE_MS   = micropython.const(10)    # how long task() keeps running the loop while clients are still being sent data
+
+class AsyncClient(object):
+    # socket-like object that the HTTP handlers write into
+    # writes are queued and sent by the event loop as fast as the client can take them, they never block
+    # the request headers and content are already received, recv() reads them back for get_all_headers()
+    # websocket messages are received by the event loop and picked up with readmsg()
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.rx = b""
+        self.tx = []
+        self.tx_len = 0
+        self.tx_busy = 0
+        self.msgs = []
+        self.is_websocket = False
+        self.closing = False
+        self.closed = False
+        self.evt = asyncio.Event()
+
+    def settimeout(self, t):
+        pass
+
+    def setblocking(self, flag):
+        pass
+
+    def send(self, data):
+        if self.closing or self.closed:
+            raise OSError("client closed")
+        if type(data) == str:
+            data = data.encode("utf-8")
+        else:
+            # the caller might reuse its buffer, a JPEG in the frame buffer for example, so keep a copy
+            data = bytes(data)
+        dlen = len(data)
+        if dlen > 0:
+            self.tx.append(data)
+            self.tx_len += dlen
+            self.evt.set()
+        return dlen
+
+    def write(self, data):
+        return self.send(data)
+
+    def write_iter(self, it):
+        # the iterator is only read from when the client is ready for more, see captive_portal.send_iter
+        if self.closing or self.closed:
+            it.close()
+            raise OSError("client closed")
+        self.tx.append(it)
+        self.evt.set()
+
+    def recv(self, bufsize):
+        x = self.rx[0:bufsize]
+        self.rx = self.rx[bufsize:]
+        return x
+
+    def read(self, bufsize = 1024):
+        return self.recv(bufsize)
+
+    def readmsg(self):
+        if len(self.msgs) <= 0:
+            return None
+        return self.msgs.pop(0)
+
+    def backlog(self):
+        # number of bytes still waiting to be sent, an unfinished iterator counts as at least one
+        x = self.tx_len + self.tx_busy
+        if x <= 0 and len(self.tx) > 0:
+            x = 1
+        return x
+
+    def close(self):
+        # the connection is closed after everything queued has been sent
+        self.closing = True
+        self.evt.set()
+
+    async def run_tx(self):
+        try:
+            while True:
+                if len(self.tx) <= 0:
+                    if self.closing:
+                        break
+                    self.evt.clear()
+                    await self.evt.wait()
+                    continue
+                item = self.tx[0]
+                if type(item) == bytes:
+                    self.tx.pop(0)
+                    self.tx_len -= len(item)
+                    await self.send_now(item)
+                    continue
+                try:
+                    x = next(item)
+                except StopIteration:
+                    self.tx.pop(0)
+                    continue
+                if type(x) == str:
+                    x = x.encode("utf-8")
+                await self.send_now(x)
+        except Exception as exc:
+            # timeouts and disconnections end up here, both just mean that the client is gone
+            exclogger.log_exception(exc, to_print = False, to_file = False)
+        await self.shutdown()
+
+    async def send_now(self, data):
+        self.tx_busy = len(data)
+        self.writer.write(data)
+        await asyncio.wait_for_ms(self.writer.drain(), SEND_TIMEOUT_MS)
+        self.tx_busy = 0
+
+    async def shutdown(self):
+        self.closing = True
+        self.closed = True
+        for i in self.tx:
+            if type(i) != bytes:
+                i.close()
+        self.tx = []
+        self.tx_len = 0
+        self.tx_busy = 0
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception as exc:
+            exclogger.log_exception(exc, to_print = False, to_file = False)
+
+class AsyncCaptivePortal(captive_portal.CaptivePortal):
+    def __init__(self, debug = False, enable_dns = False):
+        self.loop = asyncio.get_event_loop()
+        self.server = None
+        self.server_starting = False
+        self.clients = []
+        self.served = 0
+        super().__init__(debug = debug, enable_dns = enable_dns)
+
+    def start_http(self):
+        if self.server is not None or self.server_starting:
+            return
+        self.server_starting = True
+        self.loop.create_task(self.run_server())
+
+    async def run_server(self):
+        try:
+            self.server = await asyncio.start_server(self.serve_client, "0.0.0.0", HTTP_PORT, backlog = HTTP_BACKLOG)
+            if self.debug:
+                print("start_http async")
+        except OSError as exc:
+            print("http server error " + str(exc))
+            self.server = None
+        self.server_starting = False
+
+    async def serve_client(self, reader, writer):
+        client = AsyncClient(reader, writer)
+        self.clients.append(client)
+        self.loop.create_task(client.run_tx())
+        try:
+            req = await asyncio.wait_for_ms(reader.readline(), REQ_TIMEOUT_MS)
+            headers = await asyncio.wait_for_ms(self.read_headers(reader, client), REQ_TIMEOUT_MS)
+            req = req.decode("utf-8").rstrip()
+            if len(req) <= 0:
+                raise OSError("socket no data")
+            can_drop = self.handle_request(client, req, headers)
+            if can_drop != False:
+                client.close()
+            elif client.is_websocket:
+                await self.run_websocket(client)
+            else:
+                # an image stream, nothing is expected from the client, wait for it to disconnect
+                while client.closed == False:
+                    x = await reader.read(64)
+                    if len(x) <= 0:
+                        break
+        except Exception as exc:
+            if self.debug:
+                print("http client error " + str(exc))
+            exclogger.log_exception(exc, to_print = False, to_file = False)
+        client.close()
+        if client in self.clients:
+            self.clients.remove(client)
+
+    async def read_headers(self, reader, client):
+        # reads all of the headers and the content, keeps them in the client for get_all_headers()
+        headers = {}
+        rx = b""
+        while True:
+            line = await reader.readline()
+            if len(line) <= 0:
+                break
+            rx += line
+            line = line.decode("utf-8").rstrip()
+            if len(line) <= 0:
+                break
+            if ':' in line:
+                headers.update({line[0:line.index(':')].lower(): line[line.index(':') + 1:].lstrip()})
+        clen = int(headers.get("content-length", "0"))
+        if clen > CONTENT_LIMIT:
+            raise OSError("content too long")
+        if clen > 0:
+            rx += await reader.readexactly(clen)
+        client.rx = rx
+        client.is_websocket = headers.get("upgrade", "").lower() == "websocket"
+        return headers
+
+    def handle_request(self, client, req, headers):
+        # same as the request handling in CaptivePortal.task_http
+        # the headers have been parsed already, but the handlers get what they would have gotten from task_http
+        if self.debug:
+            print("http req: " + req)
+        self.tickle()
+        req_split = req.split(' ')
+        request_page, request_urlparams = captive_portal.split_get_request(req)
+        can_drop = True
+        if req_split[0] == "GET":
+            if request_page in self.handlers:
+                can_drop = self.handlers[request_page](client, req, [], "")
+            else:
+                self.handle_default(client, req, [], "")
+        elif req_split[0] == "POST":
+            headers, content = captive_portal.get_all_headers(client)
+            if request_page in self.handlers:
+                can_drop = self.handlers[request_page](client, req, headers, content)
+            else:
+                self.handle_default(client, req, headers, content)
+        self.tickle()
+        self.served += 1
+        return can_drop
+
+    async def run_websocket(self, client):
+        while client.closed == False:
+            msg = await websocket_readmsg_async(client.reader)
+            if msg is None:
+                break
+            if len(client.msgs) >= RX_MSG_LIMIT:
+                # the application is not keeping up, the oldest message is the least useful
+                client.msgs.pop(0)
+            client.msgs.append(msg)
+            self.tickle()
+
+    def update_imgstream(self, client, img):
+        if client.backlog() > 0:
+            # the previous frame has not been sent yet, skip this one instead of letting frames pile up
+            return
+        super().update_imgstream(client, img)
+
+    def websocket_send_start(self, sock, dlen, opcode, timeout = 0.5):
+        if sock.backlog() > WEBSOCK_BACKLOG:
+            raise OSError("websocket backlog")
+        super().websocket_send_start(sock, dlen, opcode, timeout = timeout)
+
+    def is_busy(self):
+        for c in self.clients:
+            if c.backlog() > 0:
+                return True
+        return False
+
+    def task(self, allow_kick = True):
+        self.task_conn()
+        if self.task_kick(allow_kick):
+            return STS_KICKED
+        x = self.task_dns()
+        if self.wlan is not None:
+            self.start_http()
+        self.served = 0
+        t = pyb.millis()
+        while True:
+            # runs everything that is ready, and checks the sockets without waiting
+            self.loop.run_until_complete(asyncio.sleep_ms(0))
+            if self.is_busy() == False or pyb.elapsed_millis(t) >= TASK_SLICE_MS:
+                break
+        if x == True or self.served > 0:
+            return STS_SERVED
+        return STS_IDLE
+
+    def kick(self):
+        for c in self.clients:
+            c.close()
+        if self.server is not None:
+            try:
+                self.server.close()
+            except Exception as exc:
+                exclogger.log_exception(exc, to_print = True, to_file = False)
+            self.server = None
+        super().kick()
+        gc.collect()
+
+async def websocket_readmsg_async(reader):
+    # same as captive_portal.websocket_readmsg, but waits for the data instead of polling for it
+    # returns None when the client closes the websocket
+    hd1 = await reader.readexactly(2)
+    opcode0 = hd1[0]
+    opcode1 = hd1[1]
+    mask = False
+    if (opcode1 & 0x80) != 0:
+        mask = True
+        opcode1 &= 0x7F
+    datalen = opcode1
+    if datalen == 126:
+        hd2 = await reader.readexactly(2)
+        datalen = (hd2[0] << 8) + hd2[1]
+    elif datalen == 127:
+        hd2 = await reader.readexactly(8)
+        datalen = 0
+        i = 0
+        while i < 8:
+            datalen += hd2[i] << (8 * (7 - i))
+            i += 1
+    if mask:
+        mask = await reader.readexactly(4)
+    data = bytearray(datalen)
+    if datalen > 0:
+        data = bytearray(await reader.readexactly(datalen))
+    if mask != False:
+        i = 0
+        while i < datalen:
+            data[i] = data[i] ^ mask[i % 4]
+            i += 1
+    if (opcode0 & 0x0F) == 0x08:
+        return None
+    if (opcode0 & 0x0F) == 0x01:
+        return data.decode('utf-8')
+    return data
@@ -113,6 +113,54 @@ def find_stars(img, hist = None, stats = None, thresh = 0, max_dia = 100, region
             return stars, EXPO_TOO_MANY
     return stars, EXPO_JUST_RIGHT
 
+def find_stars_rois(img, rois, hist = None, stats = None, thresh = 0, max_dia = 100, force_solve = False, guider = False):
+    # same as find_stars, but only looks inside a few windows, rois is a list of (x, y, w, h)
+    # the histogram and statistics should come from one of the windows, computing them for the whole image would defeat the purpose
+    # a star in the overlap of two windows is only counted once
+    # a star touching the edge of a window is cut off and its centroid is pulled inwards, it is dropped, unless that edge is also the edge of the image
+    # a window that overlaps it might have the whole star
+    if hist is None:
+        hist = img.get_histogram(roi = rois[0])
+    if stats is None:
+        stats = hist.get_statistics()
+    res = []
+    i = 0
+    while i < len(rois):
+        stars, code = find_stars(img, hist = hist, stats = stats, thresh = thresh, max_dia = max_dia, region = rois[i], force_solve = force_solve, guider = guider)
+        if code != EXPO_JUST_RIGHT:
+            return res, code
+        for s in stars:
+            x = s.cxf() if guider else s.cx
+            y = s.cyf() if guider else s.cy
+            rad = s.r() if guider else s.r
+            if touches_inner_edge(x, y, rad, rois[i], img.width(), img.height()):
+                continue
+            dup = False
+            j = 0
+            while j < i:
+                r = rois[j]
+                if x >= r[0] and y >= r[1] and x < r[0] + r[2] and y < r[1] + r[3] and touches_inner_edge(x, y, rad, r, img.width(), img.height()) == False:
+                    # already taken from that window
+                    dup = True
+                    break
+                j += 1
+            if dup == False:
+                res.append(s)
+        i += 1
+    return res, EXPO_JUST_RIGHT
+
+def touches_inner_edge(x, y, r, roi, img_w, img_h):
+    # r is a bit more than half of the blob's width, so a blob that reaches the last row or column of the window counts as touching
+    if roi[0] > 0 and x - r <= roi[0]:
+        return True
+    if roi[1] > 0 and y - r <= roi[1]:
+        return True
+    if roi[0] + roi[2] < img_w and x + r >= roi[0] + roi[2] - 1:
+        return True
+    if roi[1] + roi[3] < img_h and y + r >= roi[1] + roi[3] - 1:
+        return True
+    return False
+
 def simple_list(list):
     cnt = len(list)
     res = [[1.5, 1.5]] * cnt
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-import sys
+import sys, multiprocessing
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
+import platesolver_db
 
 SENSOR_WIDTH  = 2592
 SENSOR_HEIGHT = 1944
@@ -16,6 +17,8 @@ USE_SPHERICAL_ARC = True
 USE_WARPED_CYLINDER = False
 USE_ONLY_AEP = False
 
+USE_PROCESS_POOL = True
+
 DRAW_AEP_IMAGE = False
 DRAW_STAR_CENTERED_IMAGE = False
 
@@ -63,146 +66,38 @@ class Star(object):
         x, y = star.get_aep_coord_xy()
         return (x - self.x), (y - self.y)
 
+    # the math for all of the vectors below is in the *_arr functions, which work on whole arrays of stars
+    # self is the star being measured, the input variable is the center star
+
     def calc_aep_vector(self, star):
         # azimuthal equidistant projection vector
-        dx, dy = self.calc_aep_dxdy(star)
-        #dist = np.sqrt((dx ** 2) + (dy ** 2))
-        dist = self.calc_arc_dist(star)
-        ang  = np.degrees(np.arctan2(dy, dx))
-        return dist, ang
+        dist, ang = calc_aep_vector_arr(self.ra_float, self.dec_float, star.ra_float, star.dec_float)
+        return dist[()], ang[()]
 
     def calc_gnomonic_dxdy(self, star):
-        delta_ra = np.radians(hours_to_degrees(self.ra_float) - hours_to_degrees(star.ra_float))
-        dec_0 = np.radians(star.dec_float)
-        dec   = np.radians(self.dec_float)
-        x_numerator   = np.cos(dec) * np.sin(delta_ra)
-        x_denominator = (np.cos(dec_0) * np.cos(dec) * np.cos(delta_ra)) + (np.sin(dec_0) * np.sin(dec))
-
-        # this is the original formula
-        #y_numerator = (np.sin(dec_0) * np.cos(dec) * np.cos(delta_ra)) - (np.cos(dec_0) * np.sin(dec))
-        #y_denominator = (np.cos(dec_0) * np.cos(dec) * np.cos(delta_ra)) - (np.sin(dec_0) * np.sin(dec))
-
-        # this modified equation keeps the declination lines equidistant
-        y_numerator = (np.sin(dec_0) * np.cos(dec) * np.cos(delta_ra)) - (np.cos(dec_0) * np.sin(dec_0))
-        y_denominator = (np.cos(dec_0) * np.cos(dec) * np.cos(delta_ra)) - (np.sin(dec_0) * np.sin(dec_0))
-
-        if x_denominator == 0:
-            return 0, 0
-        if y_denominator == 0:
-            return 0, 0
-
-        x = x_numerator / x_denominator
-        y = y_numerator / y_denominator
-
-        x = np.degrees(x) * PIXELS_PER_DEGREE
-        y = np.degrees(y) * PIXELS_PER_DEGREE
-
-        # this modifier I added to squish the Y down, unsure if valid
-        y *= np.sin(dec_0) * np.sin(dec)
-        return x, y
+        dx, dy = calc_gnomonic_dxdy_arr(self.ra_float, self.dec_float, star.ra_float, star.dec_float)
+        return dx[()], dy[()]
 
     def calc_gnomonic_vector(self, star):
-        dx, dy = self.calc_gnomonic_dxdy(star)
-        if dx == 0 and dy == 0:
-            return 0, 0
-        dist = np.sqrt((dx ** 2) + (dy ** 2))
-        ang  = np.degrees(np.arctan2(dy, dx))
-        return dist, ang
+        dist, ang = calc_gnomonic_vector_arr(self.ra_float, self.dec_float, star.ra_float, star.dec_float)
+        return dist[()], ang[()]
 
     def calc_warpedcylinder_vector(self, star):
-        dist = self.calc_arc_dist(star)
-        if dist == 0:
-            return 0, 0
-        # RA still in hours, convert to degrees
-        ra1 = hours_to_degrees(self.ra_float)
-        ra2 = hours_to_degrees(star.ra_float)
-        delta_ra = angle_norm(ra1 - ra2) # east is positive, just like X is positive
-        # SOHCAHTOA, cos(theta) = A/H, where A is delta_ra converted to pixels, and H is dist
-        fra = delta_ra * pix_per_ra(self.dec_float) / (dist * PIXELS_PER_DEGREE)
-        if fra > 1.0:
-            fra = 1.0
-        elif fra < -1.0:
-            fra = -1.0
-        theta = np.arccos(fra)
-        # theta is positive if target star has lower dec than reference star
-        if star.dec_float > self.dec_float:
-            theta *= -1.0
-        return dist, np.degrees(theta)
-
-    #def calc_warpedcylinder2_vector(self, star):
-    #    # RA still in hours, convert to degrees
-    #    delta_ra = angle_norm(hours_to_degrees(self.ra_float) - hours_to_degrees(star.ra_float)) # east is positive, just like X is positive
-    #
-    #    dy = (star.dec_float - self.dec_float) * PIXELS_PER_DEGREE
-    #    dx = delta_ra * pix_per_ra(self.dec_float)
-    #    dist = np.sqrt((dx ** 2) + (dy ** 2))
-    #    ang  = np.degrees(np.arctan2(dy, dx))
-    #    return dist, ang
+        dist, ang = calc_warpedcylinder_vector_arr(self.ra_float, self.dec_float, star.ra_float, star.dec_float)
+        return dist[()], ang[()]
 
     def calc_arc_dist(self, star):
-        # https://en.wikipedia.org/wiki/Great-circle_distance
-        # https://www.gyes.eu/calculator/calculator_page1.htm
         ra1, dec1 = self.get_celestial_coord_float()
         ra2, dec2 = star.get_celestial_coord_float()
-        ra1 = np.radians(hours_to_degrees(ra1))
-        ra2 = np.radians(hours_to_degrees(ra2))
-        dec1 = np.radians(dec1)
-        dec2 = np.radians(dec2)
-        cosa = (np.sin(dec1) * np.sin(dec2)) + (np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2))
-        if cosa > 1.0:
-            cosa = 1.0
-        elif cosa < -1.0:
-            cosa = -1.0
-        arcdist = np.arccos(cosa)
-        return np.degrees(arcdist)
+        return calc_arc_dist_arr(ra1, dec1, ra2, dec2)[()]
 
     def calc_arc_vector(self, star):
-        arcdist = self.calc_arc_dist(star)
-
-        # https://en.wikipedia.org/wiki/Solution_of_triangles (Solving spherical triangles)
-        # point C is the NCP, point A is the center star (input variable), point B is self star
-        # all units are radians right now
-        arc_a = (np.pi / 2.0) - np.radians(self.dec_float)
-        arc_b = (np.pi / 2.0) - np.radians(star.dec_float)
-        arc_c = np.radians(arcdist)
-        # the angle we want is alpha
-        numerator = np.cos(arc_a) - (np.cos(arc_b) * np.cos(arc_c))
-        denominator = np.sin(arc_b) * np.sin(arc_c)
-        if denominator == 0.0:
-            return 0, 0
-        x = numerator / denominator
-        if x > 1.0:
-            x = 1.0
-        elif x < -1.0:
-            x = -1.0
-        alpha = np.arccos(x)
-
-        # if the star is more east, then we want alpha to be positive
-        # otherwise, alpha should be negative
-        # lower RA is more East, so if ra1 - ra2 is greater than zero, ra2 is more east
-        delta_ra = angle_norm(hours_to_degrees(star.ra_float) - hours_to_degrees(self.ra_float))
-        if delta_ra < 0:
-            alpha *= -1.0
-
-        return arcdist, np.degrees(alpha)
+        dist, ang = calc_arc_vector_arr(self.ra_float, self.dec_float, star.ra_float, star.dec_float)
+        return dist[()], ang[()]
 
     def calc_visual_vector(self, star):
-        # the azimuthal equidistant projection still works great near the pole, do not re-calculate for stars here
-        if star.dec_float >= LIMIT_DEC or USE_ONLY_AEP:
-            dist, ang = self.calc_aep_vector(star)
-            return dist * PIXELS_PER_DEGREE, ang
-
-        if USE_GNOMONIC:
-            dist, ang = self.calc_gnomonic_vector(star)
-            return dist, ang
-
-        if USE_SPHERICAL_ARC:
-            dist, ang = self.calc_arc_vector(star)
-            return dist * PIXELS_PER_DEGREE, ang
-
-        if USE_WARPED_CYLINDER:
-            dist, ang = self.calc_warpedcylinder_vector(star)
-            return dist * PIXELS_PER_DEGREE, ang
+        dist, ang = calc_visual_vector_arr(self.ra_float, self.dec_float, star.ra_float, star.dec_float)
+        return dist[()], ang[()]
 
     def printme(self):
         ra, dec = self.get_celestial_coord_float()
@@ -220,6 +115,127 @@ def angle_norm(x):
 def hours_to_degrees(x):
     return x * 360.0 / 24.0
 
+# the projection math, vectorized
+# ra and dec are the coordinates of the stars being measured (RA in hours, dec in degrees), they can be arrays
+# ra0 and dec0 are the coordinates of the center star
+# a vector that cannot be calculated is returned as a distance and angle of zero, just like the original scalar code did, and gets filtered out later
+
+def calc_aep_coord_xy_arr(ra, dec):
+    # azimuthal equidistant projection absolute cartesian coordinates
+    rho = (90 - np.asarray(dec)) * PIXELS_PER_DEGREE
+    phi = np.radians(hours_to_degrees(np.asarray(ra)))
+    return rho * np.cos(phi), rho * np.sin(phi)
+
+def calc_aep_vector_arr(ra, dec, ra0, dec0):
+    x, y = calc_aep_coord_xy_arr(ra, dec)
+    x0, y0 = calc_aep_coord_xy_arr(ra0, dec0)
+    dist = calc_arc_dist_arr(ra, dec, ra0, dec0)
+    ang  = np.degrees(np.arctan2(y0 - y, x0 - x))
+    return dist, ang
+
+def calc_gnomonic_dxdy_arr(ra, dec, ra0, dec0):
+    delta_ra = np.radians(hours_to_degrees(np.asarray(ra)) - hours_to_degrees(ra0))
+    dec_0 = np.radians(dec0)
+    dec   = np.radians(dec)
+    x_numerator   = np.cos(dec) * np.sin(delta_ra)
+    x_denominator = (np.cos(dec_0) * np.cos(dec) * np.cos(delta_ra)) + (np.sin(dec_0) * np.sin(dec))
+
+    # this is the original formula
+    #y_numerator = (np.sin(dec_0) * np.cos(dec) * np.cos(delta_ra)) - (np.cos(dec_0) * np.sin(dec))
+    #y_denominator = (np.cos(dec_0) * np.cos(dec) * np.cos(delta_ra)) - (np.sin(dec_0) * np.sin(dec))
+
+    # this modified equation keeps the declination lines equidistant
+    y_numerator = (np.sin(dec_0) * np.cos(dec) * np.cos(delta_ra)) - (np.cos(dec_0) * np.sin(dec_0))
+    y_denominator = (np.cos(dec_0) * np.cos(dec) * np.cos(delta_ra)) - (np.sin(dec_0) * np.sin(dec_0))
+
+    bad = (x_denominator == 0) | (y_denominator == 0)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        x = x_numerator / x_denominator
+        y = y_numerator / y_denominator
+
+    x = np.degrees(x) * PIXELS_PER_DEGREE
+    y = np.degrees(y) * PIXELS_PER_DEGREE
+
+    # this modifier I added to squish the Y down, unsure if valid
+    y *= np.sin(dec_0) * np.sin(dec)
+    return np.where(bad, 0, x), np.where(bad, 0, y)
+
+def calc_gnomonic_vector_arr(ra, dec, ra0, dec0):
+    dx, dy = calc_gnomonic_dxdy_arr(ra, dec, ra0, dec0)
+    dist = np.sqrt((dx ** 2) + (dy ** 2))
+    ang  = np.degrees(np.arctan2(dy, dx))
+    return dist, np.where(dist == 0, 0, ang)
+
+def calc_warpedcylinder_vector_arr(ra, dec, ra0, dec0):
+    dist = calc_arc_dist_arr(ra, dec, ra0, dec0)
+    # RA still in hours, convert to degrees
+    ra1 = hours_to_degrees(np.asarray(ra))
+    ra2 = hours_to_degrees(ra0)
+    delta_ra = angle_norm(ra1 - ra2) # east is positive, just like X is positive
+    # SOHCAHTOA, cos(theta) = A/H, where A is delta_ra converted to pixels, and H is dist
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        fra = delta_ra * pix_per_ra(dec) / (dist * PIXELS_PER_DEGREE)
+    theta = np.arccos(np.clip(fra, -1.0, 1.0))
+    # theta is positive if target star has lower dec than reference star
+    theta = np.where(dec0 > np.asarray(dec), -theta, theta)
+    zero = dist == 0
+    return np.where(zero, 0, dist), np.where(zero, 0, np.degrees(theta))
+
+def calc_arc_dist_arr(ra1, dec1, ra2, dec2):
+    # https://en.wikipedia.org/wiki/Great-circle_distance
+    # https://www.gyes.eu/calculator/calculator_page1.htm
+    ra1 = np.radians(hours_to_degrees(np.asarray(ra1)))
+    ra2 = np.radians(hours_to_degrees(np.asarray(ra2)))
+    dec1 = np.radians(dec1)
+    dec2 = np.radians(dec2)
+    cosa = (np.sin(dec1) * np.sin(dec2)) + (np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2))
+    arcdist = np.arccos(np.clip(cosa, -1.0, 1.0))
+    return np.degrees(arcdist)
+
+def calc_arc_vector_arr(ra, dec, ra0, dec0):
+    arcdist = calc_arc_dist_arr(ra, dec, ra0, dec0)
+
+    # https://en.wikipedia.org/wiki/Solution_of_triangles (Solving spherical triangles)
+    # point C is the NCP, point A is the center star, point B is the star being measured
+    # all units are radians right now
+    arc_a = (np.pi / 2.0) - np.radians(dec)
+    arc_b = (np.pi / 2.0) - np.radians(dec0)
+    arc_c = np.radians(arcdist)
+    # the angle we want is alpha
+    numerator = np.cos(arc_a) - (np.cos(arc_b) * np.cos(arc_c))
+    denominator = np.sin(arc_b) * np.sin(arc_c)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        x = numerator / denominator
+    alpha = np.arccos(np.clip(x, -1.0, 1.0))
+
+    # if the star is more east, then we want alpha to be positive
+    # otherwise, alpha should be negative
+    # lower RA is more East, so if ra1 - ra2 is greater than zero, ra2 is more east
+    delta_ra = angle_norm(hours_to_degrees(ra0) - hours_to_degrees(np.asarray(ra)))
+    alpha = np.where(delta_ra < 0, -alpha, alpha)
+
+    zero = denominator == 0.0
+    return np.where(zero, 0, arcdist), np.where(zero, 0, np.degrees(alpha))
+
+def calc_visual_vector_arr(ra, dec, ra0, dec0):
+    # returns distances in pixels and angles in degrees
+    # the azimuthal equidistant projection still works great near the pole, do not re-calculate for stars here
+    if dec0 >= LIMIT_DEC or USE_ONLY_AEP:
+        dist, ang = calc_aep_vector_arr(ra, dec, ra0, dec0)
+        return dist * PIXELS_PER_DEGREE, ang
+
+    if USE_GNOMONIC:
+        dist, ang = calc_gnomonic_vector_arr(ra, dec, ra0, dec0)
+        return dist, ang
+
+    if USE_SPHERICAL_ARC:
+        dist, ang = calc_arc_vector_arr(ra, dec, ra0, dec0)
+        return dist * PIXELS_PER_DEGREE, ang
+
+    if USE_WARPED_CYLINDER:
+        dist, ang = calc_warpedcylinder_vector_arr(ra, dec, ra0, dec0)
+        return dist * PIXELS_PER_DEGREE, ang
+
 def draw_stars(stars):
     # this function draws all the stars onto an azimuthal equidistant projection
     # first, figure out how big the image needs to be
@@ -370,6 +386,25 @@ def sort_declination(x):
 #    GNOMONIC_CAL = should_be / dy
 #    print("gnomonic distance calibration %.16f" % GNOMONIC_CAL)
 
+# state of each worker process, set once by init_bucket_worker so that the catalog is not sent with every task
+bucket_ra = None
+bucket_dec = None
+bucket_maxdist = 0
+
+def init_bucket_worker(ra, dec, maxdist):
+    global bucket_ra, bucket_dec, bucket_maxdist
+    bucket_ra = ra
+    bucket_dec = dec
+    bucket_maxdist = maxdist
+
+def calc_bucket(ci):
+    # finds the stars that are within range of one center star, sorted by distance
+    # returns their indices, distances, and angles
+    dist, ang = calc_visual_vector_arr(bucket_ra, bucket_dec, bucket_ra[ci], bucket_dec[ci])
+    sel = np.flatnonzero((dist > 0) & (dist < bucket_maxdist)) # and bmag <= 7
+    sel = sel[np.argsort(dist[sel], kind = "stable")]
+    return sel, dist[sel], ang[sel]
+
 def main():
     stars = []
     print("parsing SIMBAD file")
@@ -406,23 +441,34 @@ def main():
 
     print("writing to file")
     fsz = 0
+    bin_entries = []
     file = open("generic_platesolver_database_output.txt", "w") 
-    for i in dec_sorted:
-        if i.bmag > 6:
-            continue
-        for j in dec_sorted:
-            dist, ang = j.calc_visual_vector(i)
-            j.rel_dist = dist
-            j.rel_ang = ang
-        dist_sorted = sorted(stars, key = sort_rel_dist, reverse = False)
+    # the neighbours of every center star are found in parallel
+    centers = [i for i in dec_sorted if i.bmag <= 6]
+    ra_arr  = np.array([j.ra_float  for j in stars])
+    dec_arr = np.array([j.dec_float for j in stars])
+    center_idx = [stars.index(i) for i in centers]
+    if USE_PROCESS_POOL:
+        pool = multiprocessing.Pool(initializer = init_bucket_worker, initargs = (ra_arr, dec_arr, maxdist))
+        results = pool.map(calc_bucket, center_idx, chunksize = 8)
+        pool.close()
+        pool.join()
+    else:
+        init_bucket_worker(ra_arr, dec_arr, maxdist)
+        results = [calc_bucket(ci) for ci in center_idx]
+
+    for i, (sel, dists, angs) in zip(centers, results):
         bucket = []
-        for j in dist_sorted:
-            if j.rel_dist > 0 and j.rel_dist < maxdist: # and j.bmag <= 7:
-                bucket.append(j)
+        for k in range(len(sel)):
+            j = stars[sel[k]]
+            j.rel_dist = dists[k]
+            j.rel_ang = angs[k]
+            bucket.append(j)
         if len(bucket) < 4: # need a minimum number of matches
             continue
         if i.name in DRAW_ME and DRAW_STAR_CENTERED_IMAGE:
             draw_single_star(i, bucket)
+        bin_entries.append((i.name, [j.rel_dist for j in bucket], [j.rel_ang for j in bucket]))
         bucket_str = ""
         pre_val = ""
         for j in bucket:
@@ -464,6 +510,9 @@ def main():
     file.close()
     print("finished writing %u bytes to file" % fsz)
 
+    fsz = platesolver_db.write_catalog("generic_platesolver_database_output.bin", bin_entries)
+    print("finished writing %u bytes to binary file" % fsz)
+
     return 0
 
 if __name__ == "__main__":
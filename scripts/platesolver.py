@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+# plate solver for the polar scope, solves a whole frame against the database made by generic_platesolver_database_generator.py
+# this replaces the loop in web/platesolver.js, which tries 360 rotations of every database entry against one clicked star
+# here, every bright star in the frame is tried as the center star at the same time:
+#  * each database entry is turned into rotation invariant features, the distances to two neighbouring stars and the angle between them
+#  * all features go into a k-d tree, the features of the frame are looked up in it
+#  * every hit votes for a database entry, a center star, and a rotation
+#  * the candidates with the most votes are scored the same way as web/platesolver.js does it, including the penalty for unmatched stars
+# the scoring and the acceptance rules are kept identical to web/platesolver.js so the results can be compared
+#
+# usage:
+#   python platesolver.py database star_list [x y]
+# the database can be the generator's output text file, its binary version (see platesolver_db.py), or web/platesolver.js (the database string is embedded in it)
+# the star list can be the JSON returned by the polar scope's "getstate" request, or a text file with "x,y,brightness" per line
+# x and y are optional, they pick the center star like clicking on the star in the web page would
+
+import sys, os, re, json, time
+import numpy as np
+from scipy.spatial import cKDTree
+
+SENSOR_WIDTH  = 2592
+SENSOR_HEIGHT = 1944
+
+MATCH_TOL     = SENSOR_HEIGHT / 20 # same as web/platesolver.js, the expected position has to be this close to a star
+SCORE_REQ     = 4                  # same as platesolve_scorereq in web/platesolver.js
+ERR_LIMIT     = 100
+HOT_PIXEL_TOL = 2.0
+
+FEATURE_MIN_DIST = 80    # neighbours closer than this have too much angular error
+FEATURE_MAX_DIST = 1000  # neighbours further than this are often out of the frame
+FEATURE_DIST_TOL = 0.05  # ratio
+FEATURE_ANG_TOL  = 4.0   # degrees
+FEATURE_IMG_CNT  = 8     # nearest neighbours of each center star used to make features
+FEATURE_IMG_STARS = 50   # brightest stars in the frame used as center stars and neighbours, same as the number of stars that getstate sends
+ROT_BIN          = 10    # degrees
+VOTE_MIN         = 2
+VERIFY_LIMIT     = 200
+RANK_ERR_OFFSET  = 5.0   # pixels, about the error of a centroid, keeps a tiny average error from dominating the ranking
+REFINE_LOOPS     = 2
+
+class StarEntry(object):
+    def __init__(self, name, dist, ang):
+        self.name = name
+        # vectors from this star to its neighbours, in pixels and degrees, sorted by distance
+        self.dist = dist
+        self.ang = ang
+
+class PlateSolution(object):
+    def __init__(self, entry, center_idx, cx, cy, rot, score, avg_err, penalty, matches):
+        self.name = entry.name
+        self.entry = entry
+        self.center_idx = center_idx
+        self.cx = cx
+        self.cy = cy
+        self.rot = rot
+        self.score = score
+        self.avg_err = avg_err
+        self.penalty = penalty
+        # list of (neighbour index in the database entry, star index in the frame)
+        self.matches = matches
+        self.votes = 0
+
+    def get_rank(self):
+        # web/platesolver.js accepts a solution using the score minus half the penalty, then ranks by average error
+        # with every star in the frame being a possible center, chance matches are common, so both are combined
+        return (self.score - (self.penalty / 2.0)) / (self.avg_err + RANK_ERR_OFFSET)
+
+    def to_jsonobj(self):
+        obj = {}
+        obj.update({"name": self.name})
+        obj.update({"cx": self.cx})
+        obj.update({"cy": self.cy})
+        obj.update({"rot": round(self.rot, 2)})
+        obj.update({"score": self.score})
+        obj.update({"avg_err": round(self.avg_err, 2)})
+        obj.update({"penalty": self.penalty})
+        return obj
+
+class PlateSolver(object):
+    def __init__(self, database):
+        if isinstance(database, str):
+            database = load_database(database)
+        self.entries = database
+        self.build_index()
+
+    def build_index(self):
+        feats = []
+        owners = []
+        angs = []
+        for ei in range(len(self.entries)):
+            e = self.entries[ei]
+            sel = np.flatnonzero((e.dist >= FEATURE_MIN_DIST) & (e.dist <= FEATURE_MAX_DIST))
+            if len(sel) < 2:
+                continue
+            ia, ib = np.triu_indices(len(sel), 1)
+            ia = sel[ia]
+            ib = sel[ib]
+            f = make_features(e.dist[ia], e.dist[ib], e.ang[ia], e.ang[ib])
+            feats.append(f)
+            owners.append(np.full(len(ia), ei))
+            angs.append(e.ang[ia])
+            # neighbours at almost the same distance might be seen in the other order in the frame
+            close = np.abs(f[:, 1] - f[:, 0]) < 1.0
+            if np.any(close):
+                feats.append(make_features(e.dist[ib[close]], e.dist[ia[close]], e.ang[ib[close]], e.ang[ia[close]]))
+                owners.append(np.full(np.count_nonzero(close), ei))
+                angs.append(e.ang[ib[close]])
+        if len(feats) <= 0:
+            self.tree = None
+            return
+        feats = np.concatenate(feats)
+        owners = np.concatenate(owners)
+        angs = np.concatenate(angs)
+        # the angle between neighbours wraps around, duplicate the features near the edge
+        wrap_lo = feats[:, 2] > ((180.0 - FEATURE_ANG_TOL) / FEATURE_ANG_TOL)
+        wrap_hi = feats[:, 2] < ((FEATURE_ANG_TOL - 180.0) / FEATURE_ANG_TOL)
+        shift = 360.0 / FEATURE_ANG_TOL
+        self.feat = np.concatenate((feats, feats[wrap_lo] - [0, 0, shift], feats[wrap_hi] + [0, 0, shift]))
+        self.feat_owner = np.concatenate((owners, owners[wrap_lo], owners[wrap_hi]))
+        self.feat_ang = np.concatenate((angs, angs[wrap_lo], angs[wrap_hi]))
+        self.tree = cKDTree(self.feat)
+
+    def solve(self, stars, hot_pixels = None, center = None):
+        # stars can be dictionaries (like the ones in getstate), objects with cx/cy/brightness, or (x, y, brightness) tuples
+        # returns all acceptable solutions, the best first
+        xy, brite = star_arrays(stars)
+        if len(xy) < SCORE_REQ or self.tree is None:
+            return []
+        self.xy = xy
+        self.brite = brite
+        self.star_tree = cKDTree(xy)
+        self.hot_tree = None
+        hot = hot_pixel_array(hot_pixels)
+        if len(hot) > 0:
+            self.hot_tree = cKDTree(hot)
+
+        # only the brightest stars are used to make features, fainter ones are less likely to be in the database
+        order = np.argsort(-brite, kind = "stable")[0:FEATURE_IMG_STARS]
+        if center is not None:
+            d = np.hypot(xy[:, 0] - center[0], xy[:, 1] - center[1])
+            centers = np.array([np.argmin(d)])
+        else:
+            centers = order
+
+        hyps = self.vote(centers, order)
+        sols = []
+        for h in hyps:
+            sol = self.verify(h[0], h[1], h[2])
+            if sol is None:
+                continue
+            sol.votes = h[3]
+            sols.append(sol)
+        sols.sort(key = sort_solution_func)
+        return sols
+
+    def vote(self, centers, neighbours):
+        # returns a list of [entry index, center star index, rotation, votes], most votes first
+        fa = []
+        fb = []
+        fc = []
+        pxy = self.xy[neighbours]
+        for c in centers:
+            v = pxy - self.xy[c]
+            d = np.hypot(v[:, 0], v[:, 1])
+            sel = np.flatnonzero((d >= FEATURE_MIN_DIST) & (d <= FEATURE_MAX_DIST))
+            sel = sel[np.argsort(d[sel], kind = "stable")][0:FEATURE_IMG_CNT]
+            if len(sel) < 2:
+                continue
+            ia, ib = np.triu_indices(len(sel), 1)
+            fa.append(sel[ia])
+            fb.append(sel[ib])
+            fc.append(np.full(len(ia), c))
+        if len(fa) <= 0:
+            return []
+        fa = np.concatenate(fa)
+        fb = np.concatenate(fb)
+        fc = np.concatenate(fc)
+        va = pxy[fa] - self.xy[fc]
+        vb = pxy[fb] - self.xy[fc]
+        da = np.hypot(va[:, 0], va[:, 1])
+        db = np.hypot(vb[:, 0], vb[:, 1])
+        aa = np.degrees(np.arctan2(va[:, 1], va[:, 0]))
+        ab = np.degrees(np.arctan2(vb[:, 1], vb[:, 0]))
+        # keep the nearer neighbour first, like the database features
+        swap = da > db
+        da[swap], db[swap] = db[swap], da[swap].copy()
+        aa[swap], ab[swap] = ab[swap], aa[swap].copy()
+        qf = make_features(da, db, aa, ab)
+
+        hits = self.tree.query_ball_point(qf, 1.0)
+        cnt = np.array([len(h) for h in hits])
+        if np.sum(cnt) <= 0:
+            return []
+        qi = np.repeat(np.arange(len(hits)), cnt)
+        fi = np.concatenate([h for h in hits if len(h) > 0]).astype(np.int64)
+
+        # the database angle is the image angle plus the rotation
+        rot = ang_normalize(self.feat_ang[fi] - aa[qi]) % 360.0
+        nbins = int(360 // ROT_BIN)
+        rbin = np.floor(rot / ROT_BIN).astype(np.int64) % nbins
+        ncenters = len(self.xy)
+        key = (self.feat_owner[fi] * ncenters) + fc[qi]
+
+        # a rotation near the edge of a bin should also count for the neighbouring bin
+        keys, inv = np.unique(key, return_inverse = True)
+        hist = np.zeros((len(keys), nbins), dtype = np.int64)
+        np.add.at(hist, (inv, rbin), 1)
+        summed = hist + np.roll(hist, 1, axis = 1) + np.roll(hist, -1, axis = 1)
+        best_bin = np.argmax(summed, axis = 1)
+        votes = summed[np.arange(len(keys)), best_bin]
+
+        sel = np.flatnonzero(votes >= VOTE_MIN)
+        sel = sel[np.argsort(-votes[sel], kind = "stable")][0:VERIFY_LIMIT]
+        res = []
+        for k in sel:
+            # circular mean of the rotations inside the winning bins
+            in_bin = (inv == k) & (((rbin - best_bin[k] + 1) % nbins) <= 2)
+            r = np.radians(rot[in_bin])
+            rot_ang = np.degrees(np.arctan2(np.mean(np.sin(r)), np.mean(np.cos(r))))
+            res.append([int(keys[k] // ncenters), int(keys[k] % ncenters), rot_ang, int(votes[k])])
+        return res
+
+    def score(self, ei, ci, rot):
+        # identical rules to platesolve_tick in web/platesolver.js
+        e = self.entries[ei]
+        c = self.xy[ci]
+        a = np.radians(e.ang - rot)
+        expected = np.column_stack((c[0] + (e.dist * np.cos(a)), c[1] + (e.dist * np.sin(a))))
+        # the center star can't be its own neighbour
+        err, idx = self.star_tree.query(expected, k = 2)
+        use2 = idx[:, 0] == ci
+        err = np.where(use2, err[:, 1], err[:, 0])
+        idx = np.where(use2, idx[:, 1], idx[:, 0])
+        matched = np.flatnonzero(err < MATCH_TOL)
+        score = len(matched)
+        if score <= 0:
+            return 0, -1, 0, []
+        midx = idx[matched]
+        avg_err = float(np.sum(err[matched])) / score
+        min_brite = min(self.brite[ci], np.min(self.brite[midx]))
+        mv = self.xy[midx] - c
+        max_dist = np.max(np.hypot(mv[:, 0], mv[:, 1]))
+
+        v = self.xy - c
+        d = np.hypot(v[:, 0], v[:, 1])
+        unmatched = np.ones(len(self.xy), dtype = bool)
+        unmatched[midx] = False
+        unmatched[ci] = False
+        suspects = np.flatnonzero(unmatched & (d < max_dist) & (self.brite > min_brite))
+        penalty = len(suspects)
+        if penalty > 0 and self.hot_tree is not None:
+            hd, hi = self.hot_tree.query(self.xy[suspects])
+            penalty -= int(np.count_nonzero(hd <= HOT_PIXEL_TOL))
+        return score, avg_err, penalty, list(zip(matched.tolist(), midx.tolist()))
+
+    def verify(self, ei, ci, rot):
+        e = self.entries[ei]
+        c = self.xy[ci]
+        best = None
+        i = 0
+        while True:
+            score, avg_err, penalty, matches = self.score(ei, ci, rot)
+            if best is None or score > best[1] or (score == best[1] and avg_err < best[2]):
+                best = (rot, score, avg_err, penalty, matches)
+            else:
+                break
+            i += 1
+            if i > REFINE_LOOPS or score <= 0:
+                break
+            # the database angle is the image angle plus the rotation, weighted by distance since far stars give a better angle
+            ni = np.array([m[0] for m in matches])
+            si = np.array([m[1] for m in matches])
+            v = self.xy[si] - c
+            diff = np.radians(ang_normalize(e.ang[ni] - np.degrees(np.arctan2(v[:, 1], v[:, 0]))))
+            w = e.dist[ni]
+            rot = float(np.degrees(np.arctan2(np.sum(w * np.sin(diff)), np.sum(w * np.cos(diff)))))
+        rot, score, avg_err, penalty, matches = best
+        if (score - (penalty / 2.0)) >= SCORE_REQ and avg_err < ERR_LIMIT and avg_err > 0:
+            return PlateSolution(e, ci, float(c[0]), float(c[1]), rot, score, avg_err, penalty, matches)
+        return None
+
+def make_features(d1, d2, a1, a2):
+    return np.column_stack((np.log(d1) / np.log(1.0 + FEATURE_DIST_TOL), np.log(d2) / np.log(1.0 + FEATURE_DIST_TOL), ang_normalize(a2 - a1) / FEATURE_ANG_TOL))
+
+def ang_normalize(x):
+    return ((np.asarray(x, dtype = np.float64) + 180.0) % 360.0) - 180.0
+
+def sort_solution_func(x):
+    return -x.get_rank()
+
+def parse_database(s):
+    # format is "name:dist,ang,dist,ang...;name:dist,ang..."
+    res = []
+    for chunk in s.split(";"):
+        if ":" not in chunk:
+            continue
+        name, vals = chunk.rsplit(":", 1)
+        # the generator leaves a trailing comma when it skips a duplicate at the end
+        vals = [int(v) for v in vals.split(",") if len(v.strip()) > 0]
+        if len(vals) < 2:
+            continue
+        v = np.array(vals[0:(len(vals) // 2) * 2], dtype = np.float64).reshape(-1, 2)
+        res.append(StarEntry(name.strip(), v[:, 0], v[:, 1]))
+    return res
+
+def load_database(fpath):
+    if fpath.lower().endswith(".bin"):
+        import platesolver_db
+        with platesolver_db.Catalog(fpath) as cat:
+            return cat.to_entries()
+    with open(fpath, "r") as f:
+        s = f.read()
+    if fpath.lower().endswith(".js"):
+        m = re.search(r"star_database_str\s*=\s*\"([^\"]*)\"", s)
+        if m is None:
+            raise ValueError("no database found in %s" % fpath)
+        s = m.group(1)
+    return parse_database(s.strip())
+
+def star_arrays(stars):
+    xy = []
+    brite = []
+    for s in stars:
+        if isinstance(s, dict):
+            xy.append((s["cx"], s["cy"]))
+            brite.append(s.get("brightness", 0))
+        elif hasattr(s, "cx"):
+            xy.append((s.cx, s.cy))
+            brite.append(getattr(s, "brightness", 0))
+        else:
+            xy.append((s[0], s[1]))
+            brite.append(s[2] if len(s) > 2 else 0)
+    return np.array(xy, dtype = np.float64).reshape(-1, 2), np.array(brite, dtype = np.float64)
+
+def hot_pixel_array(hot_pixels):
+    if hot_pixels is None:
+        return np.zeros((0, 2))
+    if isinstance(hot_pixels, str):
+        # same format as the "hotpixels" setting
+        hot_pixels = [i.split(",") for i in hot_pixels.split(";") if len(i.split(",")) == 2]
+    xy = []
+    for i in hot_pixels:
+        if isinstance(i, dict):
+            xy.append((i["cx"], i["cy"]))
+        else:
+            xy.append((float(i[0]), float(i[1])))
+    return np.array(xy, dtype = np.float64).reshape(-1, 2)
+
+def load_stars(fpath):
+    # returns the star list and the hot pixel list
+    with open(fpath, "r") as f:
+        s = f.read()
+    try:
+        obj = json.loads(s)
+        if isinstance(obj, list):
+            return obj, None
+        return obj.get("stars", []), obj.get("hotpixels", None)
+    except ValueError:
+        pass
+    stars = []
+    for line in s.splitlines():
+        split = line.replace(" ", "").split(",")
+        if len(split) < 2:
+            continue
+        try:
+            stars.append(tuple([float(i) for i in split[0:3]]))
+        except ValueError:
+            continue
+    return stars, None
+
+def main():
+    if len(sys.argv) < 3:
+        print("usage: %s database star_list [x y]" % os.path.basename(sys.argv[0]))
+        return 1
+    t = time.time()
+    solver = PlateSolver(sys.argv[1])
+    print("loaded %u database entries, %u features, in %.3f s" % (len(solver.entries), len(solver.feat), time.time() - t))
+    stars, hot_pixels = load_stars(sys.argv[2])
+    center = None
+    if len(sys.argv) >= 5:
+        center = (float(sys.argv[3]), float(sys.argv[4]))
+    t = time.time()
+    sols = solver.solve(stars, hot_pixels = hot_pixels, center = center)
+    print("%u stars, %u solutions, in %.3f s" % (len(stars), len(sols), time.time() - t))
+    for s in sols[0:10]:
+        print("%s @ (%.1f, %.1f): score %u, avg err %.1f, penalty %u, rot %.1f" % (s.name, s.cx, s.cy, s.score, s.avg_err, s.penalty, s.rot))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
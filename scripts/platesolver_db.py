@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+# compact binary format for the generic plate solver database
+# the text format is "name:dist,ang,dist,ang...;" which has to be parsed completely before it can be used
+# the binary format can be memory mapped and used right away, every section is a fixed-width array
+#
+# all values are little-endian, the file is laid out as:
+#   header    HEADER_FMT, see below
+#   entries   entry_cnt x ENTRY_DTYPE, one per center star, in the same order as the text database
+#   records   record_cnt x RECORD_DTYPE, the neighbours of all entries, each entry's neighbours are contiguous and sorted by distance
+#   index     entry_cnt x uint32, entry numbers sorted by name, for looking up a star by name with a binary search
+#   strings   all names, UTF-8, not terminated, the entries have the offset and length
+# every section starts on a 4 byte boundary
+#
+# distances are stored in units of 1/DIST_SCALE pixels, angles in units of 1/ANG_SCALE degrees
+#
+# usage:
+#   python platesolver_db.py input output
+# the input can be the generator's text output, or web/platesolver.js, the output is the binary file
+
+import sys, os, mmap, struct
+import numpy as np
+
+MAGIC       = b"PSDB"
+VERSION     = 1
+DIST_SCALE  = 10.0
+ANG_SCALE   = 100.0
+
+# magic, version, header size, entry count, record count, string table size, then the offsets of entries, records, index, strings
+HEADER_FMT  = "<4sHHIIIIIII"
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+
+ENTRY_DTYPE  = np.dtype([("name_off", "<u4"), ("name_len", "<u2"), ("cnt", "<u2"), ("first", "<u4")])
+RECORD_DTYPE = np.dtype([("dist", "<u2"), ("ang", "<i2")])
+
+def align4(x):
+    return (x + 3) & ~3
+
+def quantize(dist, ang):
+    # the angle is normalized to -180 to 180 so it fits
+    d = np.round(np.asarray(dist, dtype = np.float64) * DIST_SCALE)
+    a = np.round(((((np.asarray(ang, dtype = np.float64) + 180.0) % 360.0) - 180.0) * ANG_SCALE))
+    if len(d) > 0 and (np.min(d) < 0 or np.max(d) > 0xFFFF):
+        raise ValueError("distance out of range")
+    return d.astype(np.uint16), a.astype(np.int16)
+
+def write_catalog(fpath, entries):
+    # entries is a list of (name, distances, angles), or objects with name, dist, and ang
+    names = []
+    dists = []
+    angs = []
+    for e in entries:
+        if hasattr(e, "name"):
+            name, dist, ang = e.name, e.dist, e.ang
+        else:
+            name, dist, ang = e
+        d, a = quantize(dist, ang)
+        order = np.argsort(d, kind = "stable")
+        names.append(name.encode("utf-8"))
+        dists.append(d[order])
+        angs.append(a[order])
+
+    cnt = len(names)
+    if cnt > 0 and max([len(d) for d in dists]) > 0xFFFF:
+        raise ValueError("too many neighbours for one entry")
+    ent = np.zeros(cnt, dtype = ENTRY_DTYPE)
+    ent["cnt"] = [len(d) for d in dists]
+    ent["name_len"] = [len(n) for n in names]
+    ent["first"] = np.cumsum(ent["cnt"], dtype = np.int64) - ent["cnt"]
+    ent["name_off"] = np.cumsum(ent["name_len"], dtype = np.int64) - ent["name_len"]
+
+    rec = np.zeros(int(np.sum(ent["cnt"])), dtype = RECORD_DTYPE)
+    if len(rec) > 0:
+        rec["dist"] = np.concatenate(dists)
+        rec["ang"] = np.concatenate(angs)
+    index = np.array(sorted(range(cnt), key = lambda i: names[i]), dtype = "<u4")
+    strings = b"".join(names)
+
+    entries_off = align4(HEADER_SIZE)
+    records_off = align4(entries_off + ent.nbytes)
+    index_off = align4(records_off + rec.nbytes)
+    strings_off = align4(index_off + index.nbytes)
+    hdr = struct.pack(HEADER_FMT, MAGIC, VERSION, HEADER_SIZE, cnt, len(rec), len(strings), entries_off, records_off, index_off, strings_off)
+
+    with open(fpath, "wb") as f:
+        for off, data in [(0, hdr), (entries_off, ent.tobytes()), (records_off, rec.tobytes()), (index_off, index.tobytes()), (strings_off, strings)]:
+            f.write(b"\0" * (off - f.tell()))
+            f.write(data)
+        return f.tell()
+
+class Catalog(object):
+    def __init__(self, fpath):
+        self.mm = None
+        self.file = open(fpath, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        if len(self.mm) < HEADER_SIZE:
+            self.close()
+            raise ValueError("file too short")
+        magic, ver, hdr_size, cnt, rec_cnt, str_size, entries_off, records_off, index_off, strings_off = struct.unpack_from(HEADER_FMT, self.mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("not a plate solver database")
+        if ver != VERSION:
+            self.close()
+            raise ValueError("unsupported database version %u" % ver)
+        self.version = ver
+        # these are views into the memory map, nothing is copied
+        self.entries = np.frombuffer(self.mm, dtype = ENTRY_DTYPE, count = cnt, offset = entries_off)
+        self.records = np.frombuffer(self.mm, dtype = RECORD_DTYPE, count = rec_cnt, offset = records_off)
+        self.index = np.frombuffer(self.mm, dtype = "<u4", count = cnt, offset = index_off)
+        self.strings_off = strings_off
+        self.strings_size = str_size
+
+    def close(self):
+        self.entries = None
+        self.records = None
+        self.index = None
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # a caller is still holding on to a view
+                pass
+            self.mm = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_name(self, i):
+        e = self.entries[i]
+        start = self.strings_off + int(e["name_off"])
+        return self.mm[start:start + int(e["name_len"])].decode("utf-8")
+
+    def get_records(self, i):
+        e = self.entries[i]
+        first = int(e["first"])
+        return self.records[first:first + int(e["cnt"])]
+
+    def get_vectors(self, i):
+        # returns the distances (pixels) and angles (degrees) of the neighbours
+        r = self.get_records(i)
+        return r["dist"] / DIST_SCALE, r["ang"] / ANG_SCALE
+
+    def find(self, name):
+        # binary search over the name index, returns the entry number, or -1
+        key = name.encode("utf-8")
+        lo = 0
+        hi = len(self.index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = int(self.index[mid])
+            start = self.strings_off + int(self.entries[i]["name_off"])
+            s = self.mm[start:start + int(self.entries[i]["name_len"])]
+            if s < key:
+                lo = mid + 1
+            elif s > key:
+                hi = mid
+            else:
+                return i
+        return -1
+
+    def to_entries(self):
+        # a list of StarEntry objects for platesolver.PlateSolver, the vectors are copies so the file can be closed afterwards
+        import platesolver
+        res = []
+        for i in range(len(self)):
+            d, a = self.get_vectors(i)
+            res.append(platesolver.StarEntry(self.get_name(i), d, a))
+        return res
+
+def main():
+    if len(sys.argv) < 3:
+        print("usage: %s input output" % os.path.basename(sys.argv[0]))
+        return 1
+    import platesolver
+    entries = platesolver.load_database(sys.argv[1])
+    sz = write_catalog(sys.argv[2], entries)
+    print("%u entries written, %u bytes (input was %u bytes)" % (len(entries), sz, os.path.getsize(sys.argv[1])))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())